@@ -0,0 +1,78 @@
+"""
+Measure the per-request cost of authentication: building the
+:class:`txchoretracker.kleinhelpers.JSONApiRequest` for a request with
+a valid auth ticket cookie, and reading its ``authenticatedUserId``.
+
+Compares verifying the ticket on every request (ticket cache off) with
+the ticket cache, and shows what a route that doesn't need
+authentication now pays. Needs no database::
+
+    python -m benchmarks.bench_authentication
+"""
+import time
+
+import click
+from twisted.web.test.requesthelper import DummyRequest
+
+from txchoretracker import authentication
+from txchoretracker.kleinhelpers import JSONApiRequest
+from benchmarks.benchutils import summarizeLatencies
+from benchmarks.benchutils import timeCall
+
+
+class _CookieRequest(DummyRequest):
+    def __init__(self, cookies):
+        super().__init__([b''])
+        self.received_cookies = cookies
+
+    def getCookie(self, key):
+        return self.received_cookies.get(key)
+
+    def addCookie(self, key, value, **kwargs):
+        self.received_cookies[key.encode('ascii')] = value
+
+
+def _makePolicy(ticketCacheSize):
+    return authentication.AuthTicketAuthenticationPolicy(
+        cookieDomain='localhost',
+        secret=b'0123456789abcdef' * 4,
+        ticketCacheSize=ticketCacheSize,
+    )
+
+
+def _makeTXRequest(policy):
+    txRequest = _CookieRequest({})
+    policy.rememberUser(txRequest, 12345)
+    return txRequest
+
+
+@click.command()
+@click.option('--repeat', default=100000)
+def main(repeat):
+    uncached = _makePolicy(0)
+    cached = _makePolicy(10000)
+    uncachedTXRequest = _makeTXRequest(uncached)
+    cachedTXRequest = _makeTXRequest(cached)
+
+    def authenticate(policy, txRequest):
+        userId = JSONApiRequest(txRequest, policy).authenticatedUserId
+        assert userId == 12345
+
+    cases = [
+        ('verify every time',
+         lambda: authenticate(uncached, uncachedTXRequest)),
+        ('ticket cache',
+         lambda: authenticate(cached, cachedTXRequest)),
+        ('no auth needed',
+         lambda: JSONApiRequest(uncachedTXRequest, uncached)),
+    ]
+    for label, func in cases:
+        start = time.perf_counter()
+        latencies = timeCall(func, repeat=repeat)
+        print(summarizeLatencies(
+            label, latencies, time.perf_counter() - start))
+    print('ticket cache: {0}'.format(cached.ticketCacheStats()))
+
+
+if __name__ == '__main__':
+    main()
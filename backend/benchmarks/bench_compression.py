@@ -0,0 +1,103 @@
+"""
+Weigh the CPU cost of compressing JSON API responses against the bytes
+saved, for each content coding and level in
+:mod:`txchoretracker.compression`.
+
+Each task listing is compressed in one go (like
+:class:`txchoretracker.kleinhelpers.JSONResponseResource`) and in
+flushed chunks (like the streaming listing). br is skipped unless the
+brotli package is installed. Needs no database::
+
+    python -m benchmarks.bench_compression
+"""
+import json
+import random
+import time
+
+import click
+
+from txchoretracker import compression
+from benchmarks.benchutils import summarizeLatencies
+from benchmarks.benchutils import timeCall
+
+
+_WORDS = (
+    'take out the trash recycling dishes laundry vacuum living room '
+    'water plants feed cat walk dog groceries milk eggs bread call '
+    'plumber about the sink before friday clean bathroom mirror'
+).split()
+
+
+def _listingBody(listSize, seed=0):
+    rng = random.Random(seed)
+    tasks = [
+        {
+            'id': taskId,
+            'taskGroup': rng.randrange(1, 20),
+            'name': ' '.join(rng.sample(_WORDS, 3)),
+            'description': ' '.join(
+                rng.choice(_WORDS) for _ in range(rng.randrange(0, 40))),
+            'due': 1489626309 + rng.randrange(10 ** 6),
+            'created': 1489453509,
+            'modified': 1489539909,
+        }
+        for taskId in range(1, listSize + 1)
+    ]
+    return json.dumps({'status': 200, 'data': tasks}).encode('ascii')
+
+
+def _compressWhole(policy, encoding, body):
+    compressor = policy.makeCompressor(encoding)
+    return compressor.compress(body) + compressor.finish()
+
+
+def _compressChunked(policy, encoding, body, chunkSize):
+    compressor = policy.makeCompressor(encoding)
+    output = []
+    for start in range(0, len(body), chunkSize):
+        output.append(compressor.compress(body[start:start + chunkSize]))
+        output.append(compressor.flush())
+    output.append(compressor.finish())
+    return b''.join(output)
+
+
+def _settings():
+    for level in (1, 6, 9):
+        yield ('gzip', level,
+               compression.CompressionPolicy(gzipLevel=level))
+    if compression.brotli is None:
+        print('br: brotli not installed, skipping')
+        return
+    for quality in (1, 4, 6, 11):
+        yield ('br', quality,
+               compression.CompressionPolicy(brotliQuality=quality))
+
+
+@click.command()
+@click.option('--list-size', default=1000)
+@click.option('--chunk-size', default=16 * 1024)
+@click.option('--repeat', default=50)
+def main(list_size, chunk_size, repeat):
+    body = _listingBody(list_size)
+    print('{0} tasks, {1} bytes uncompressed'.format(list_size, len(body)))
+    for encoding, level, policy in _settings():
+        for mode, compress in (
+                ('whole', lambda: _compressWhole(policy, encoding, body)),
+                ('chunked', lambda: _compressChunked(
+                    policy, encoding, body, chunk_size))):
+            size = len(compress())
+            start = time.perf_counter()
+            cpuStart = time.process_time()
+            latencies = timeCall(compress, repeat=repeat)
+            cpuPerCall = (time.process_time() - cpuStart) / repeat
+            label = '{0}-{1} {2}'.format(encoding, level, mode)
+            print(summarizeLatencies(
+                label, latencies, time.perf_counter() - start))
+            print('  {0:>9d} bytes ({1:.1%})  {2:.3f}ms CPU per '
+                  'response  {3:.0f} bytes saved per CPU ms'.format(
+                      size, size / len(body), cpuPerCall * 1000,
+                      (len(body) - size) / (cpuPerCall * 1000)))
+
+
+if __name__ == '__main__':
+    main()
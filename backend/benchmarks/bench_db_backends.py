@@ -0,0 +1,83 @@
+"""
+Compare the adbapi and txpostgres database backends.
+
+Runs ``asUserFetchTask`` (the smallest of the api.* calls, so the
+per-query overhead dominates) through each backend with a fixed
+number of concurrent callers and reports throughput and latency.
+
+Needs a database that has the fixture installed::
+
+    python -m txchoretracker.cli -c choretracker.ini install-fixture
+    python -m benchmarks.bench_db_backends -c choretracker.ini
+"""
+import time
+
+import attr
+import click
+from twisted.internet import defer
+from twisted.internet import task
+
+from txchoretracker import db
+from txchoretracker.config import processConfigFile
+from benchmarks.benchutils import summarizeLatencies
+
+
+async def _runCallers(dbWrapper, *, requests, concurrency, userId, taskId):
+    latencies = []
+
+    async def caller(count):
+        for _ in range(count):
+            start = time.perf_counter()
+            await dbWrapper.asUserFetchTask(userId=userId, taskId=taskId)
+            latencies.append(time.perf_counter() - start)
+
+    perCaller, remainder = divmod(requests, concurrency)
+    counts = [perCaller + (1 if i < remainder else 0)
+              for i in range(concurrency)]
+    start = time.perf_counter()
+    await defer.gatherResults(
+        [defer.ensureDeferred(caller(count)) for count in counts],
+        consumeErrors=True)
+    return latencies, time.perf_counter() - start
+
+
+async def _benchmarkBackend(dbConfig, backend, **options):
+    dbWrapper = await db.setupDBWrapper(attr.evolve(dbConfig, backend=backend))
+    try:
+        # Warm up so connection setup isn't counted.
+        await _runCallers(
+            dbWrapper,
+            **dict(options, requests=options['concurrency'] * 10))
+        latencies, elapsed = await _runCallers(dbWrapper, **options)
+    finally:
+        dbWrapper.pool.close()
+    print(summarizeLatencies(backend, latencies, elapsed))
+
+
+@click.command()
+@click.option(
+    '-c', '--config-file',
+    type=click.Path(exists=True),
+    required=True,
+)
+@click.option('--backend', 'backends', multiple=True,
+              default=['adbapi', 'txpostgres'])
+@click.option('--requests', default=10000)
+@click.option('--concurrency', default=20)
+@click.option('--user-id', default=1)
+@click.option('--task-id', default=1)
+def main(config_file, backends, requests, concurrency, user_id, task_id):
+    dbConfig = processConfigFile(config_file).db
+
+    async def run(reactor):
+        for backend in backends:
+            await _benchmarkBackend(
+                dbConfig, backend,
+                requests=requests, concurrency=concurrency,
+                userId=user_id, taskId=task_id)
+
+    task.react(lambda reactor: defer.ensureDeferred(run(reactor)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Measure Google sign-in token verification under concurrency: how many
+ID tokens a second :class:`txchoretracker.authentication.GoogleSignInValidator`
+verifies when a burst of them arrives at once, and how long the
+reactor is held up meanwhile (the worst gap between ticks of a 1ms
+timer).
+
+Compares verifying with google-auth on the reactor thread (parsing the
+certificate for every token, as sign-in used to) with the validator's
+cached keys, inline and in pools of verification threads. Uses a
+locally generated key and self-signed certificate, so needs neither
+network access nor a database. Results only apply to deployments
+with the same google-auth backend (printed first)::
+
+    python -m benchmarks.bench_google_signin
+"""
+import datetime
+import time
+
+import click
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt as google_crypt
+from google.auth import jwt as google_jwt
+from twisted.internet import defer
+from twisted.internet import task
+
+from txchoretracker import authentication
+
+
+_CLIENT_ID = 'bench client id'
+_KEY_ID = 'bench-key'
+
+
+def _makeKeyAndCert():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'bench')])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(
+        name).public_key(key.public_key()).serial_number(1).not_valid_before(
+        now).not_valid_after(now + datetime.timedelta(days=1)).sign(
+        key, hashes.SHA256())
+    privatePEM = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    return privatePEM, cert.public_bytes(serialization.Encoding.PEM).decode(
+        'ascii')
+
+
+def _makeTokens(privatePEM, count):
+    signer = google_crypt.RSASigner.from_string(privatePEM, _KEY_ID)
+    now = int(time.time())
+    return [
+        google_jwt.encode(signer, {
+            'iss': 'accounts.google.com', 'aud': _CLIENT_ID,
+            'sub': str(i), 'iat': now, 'exp': now + 3600,
+        })
+        for i in range(count)
+    ]
+
+
+def _makeValidator(reactor, certPEM, verificationThreads):
+    validator = authentication.GoogleSignInValidator(
+        _CLIENT_ID, reactor=reactor, verificationThreads=verificationThreads)
+    # Skip the fetch from Google.
+    validator._certs = authentication._GoogleCerts({_KEY_ID: certPEM})
+    validator._certsRetrievedAt = validator._clock()
+    return validator
+
+
+async def _measureBurst(reactor, validate, tokens):
+    gaps = []
+    lastTick = [time.perf_counter()]
+
+    def tick():
+        now = time.perf_counter()
+        gaps.append(now - lastTick[0])
+        lastTick[0] = now
+    ticker = task.LoopingCall(tick)
+    ticker.clock = reactor
+    ticker.start(0.001, now=False)
+
+    start = time.perf_counter()
+    results = await defer.gatherResults(
+        [defer.ensureDeferred(validate(token)) for token in tokens])
+    elapsed = time.perf_counter() - start
+    ticker.stop()
+    assert results == [str(i) for i in range(len(tokens))]
+    # The last gap runs until the burst finished.
+    gaps.append(time.perf_counter() - lastTick[0])
+    return elapsed, max(gaps)
+
+
+async def _run(reactor, burst, threadCounts):
+    privatePEM, certPEM = _makeKeyAndCert()
+    tokens = _makeTokens(privatePEM, burst)
+
+    async def validateWithGoogleAuth(token):
+        idinfo = google_jwt.decode(
+            token, certs={_KEY_ID: certPEM}, audience=_CLIENT_ID)
+        return idinfo['sub']
+
+    cases = [('google-auth inline', validateWithGoogleAuth)]
+    for threadCount in threadCounts:
+        validator = _makeValidator(reactor, certPEM, threadCount)
+        if threadCount == 0:
+            label = 'cached keys, inline'
+        else:
+            label = 'cached keys, {0} thread{1}'.format(
+                threadCount, '' if threadCount == 1 else 's')
+        cases.append((label, validator.validateUserIdFromToken))
+
+    print('{0} concurrent sign-ins, RSA in {1}'.format(
+        burst, 'OpenSSL' if authentication._OPENSSL_VERIFIER
+        else 'pure Python (threads add no throughput)'))
+    for label, validate in cases:
+        # Warm up (and start the thread pool).
+        await _measureBurst(reactor, validate, tokens[:10])
+        elapsed, worstGap = await _measureBurst(reactor, validate, tokens)
+        print('{0:<24} {1:>8.1f} sign-ins/s  worst reactor stall '
+              '{2:.1f}ms'.format(label, burst / elapsed, worstGap * 1000))
+
+
+@click.command()
+@click.option('--burst', default=500)
+@click.option('--threads', 'threadCounts', default='0,1,4,8')
+def main(burst, threadCounts):
+    threadCounts = [int(count) for count in threadCounts.split(',')]
+    task.react(lambda reactor: defer.ensureDeferred(
+        _run(reactor, burst, threadCounts)))
+
+
+if __name__ == '__main__':
+    main()
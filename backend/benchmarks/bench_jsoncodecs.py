@@ -0,0 +1,80 @@
+"""
+Compare the JSON codecs in :mod:`txchoretracker.jsoncodecs` on
+representative API payloads: encoding task listing responses, and
+decoding task create and batch request bodies.
+
+Codecs whose packages aren't installed are skipped. Needs no
+database::
+
+    python -m benchmarks.bench_jsoncodecs
+"""
+import time
+
+import click
+
+from txchoretracker import jsoncodecs
+from benchmarks.benchutils import summarizeLatencies
+from benchmarks.benchutils import timeCall
+
+
+def _taskStructure(taskId):
+    return {
+        'id': taskId,
+        'taskGroup': taskId % 10,
+        'name': 'task {0}'.format(taskId),
+        'description': 'description of task {0} with some ünïcödé'.format(
+            taskId),
+        'due': 1489626309 + taskId,
+        'created': 1489453509,
+        'modified': 1489539909,
+    }
+
+
+def _payloads(listSize, batchSize):
+    tasks = [_taskStructure(taskId) for taskId in range(1, listSize + 1)]
+    newTask = dict(_taskStructure(1))
+    for key in ('id', 'created', 'modified'):
+        del newTask[key]
+    batch = {'operations': [
+        {'op': 'create', 'task': newTask} for _ in range(batchSize)]}
+    stdlib = jsoncodecs.makeJSONCodec('stdlib')
+    return [
+        ('encode single task', 'encode',
+         {'status': 200, 'data': tasks[0]}),
+        ('encode {0} tasks'.format(listSize), 'encode',
+         {'status': 200, 'data': tasks, 'meta': {'nextCursor': None}}),
+        ('decode new task', 'decode', stdlib.encode(newTask)),
+        ('decode {0}-item batch'.format(batchSize), 'decode',
+         stdlib.encode(batch)),
+    ]
+
+
+def _availableCodecs():
+    for name in ('stdlib', 'ujson', 'orjson', 'auto'):
+        try:
+            yield jsoncodecs.makeJSONCodec(name)
+        except RuntimeError:
+            print('{0}: not installed, skipping'.format(name))
+
+
+@click.command()
+@click.option('--list-size', default=1000)
+@click.option('--batch-size', default=500)
+@click.option('--repeat', default=200)
+def main(list_size, batch_size, repeat):
+    codecs = list(_availableCodecs())
+    for label, direction, payload in _payloads(list_size, batch_size):
+        print(label)
+        expected = codecs[0].encode(payload) if direction == 'encode' else None
+        for codec in codecs:
+            func = getattr(codec, direction)
+            if expected is not None:
+                assert func(payload) == expected, codec.name
+            start = time.perf_counter()
+            latencies = timeCall(lambda: func(payload), repeat=repeat)
+            print('  ' + summarizeLatencies(
+                codec.name, latencies, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare building tasks the old way (DictCursor rows unpacked as
+keyword arguments into a class with a per-instance ``__dict__``) with
+the way :mod:`txchoretracker.db` does it now (plain row tuples passed
+positionally to the slotted :class:`txchoretracker.models.Task`).
+
+Reports construction time and the memory held by the resulting tasks.
+Needs no database; the rows are made up in memory::
+
+    python -m benchmarks.bench_models --rows 100000
+"""
+import collections
+import time
+import tracemalloc
+
+import attr
+import click
+import psycopg2.extras
+
+from txchoretracker import db
+from txchoretracker import models
+from benchmarks.benchutils import summarizeLatencies
+from benchmarks.benchutils import timeCall
+
+
+COLUMNS = [
+    'id', 'task_group_id', 'name', 'description',
+    'due_unix', 'created_unix', 'modified_unix',
+]
+
+# What models.Task was before it was slotted.
+DictTask = attr.make_class(
+    'DictTask', [a.name for a in attr.fields(models.Task)])
+
+
+class _FakeDictCursor:
+    # Just enough of a DictCursor to make DictRows from.
+    description = [(name,) for name in COLUMNS]
+    index = collections.OrderedDict(
+        (name, position) for position, name in enumerate(COLUMNS))
+
+
+def _makeTupleRows(count):
+    return [
+        (
+            taskId, taskId % 10, 'task {0}'.format(taskId),
+            'description of task {0}'.format(taskId),
+            1489626309 + taskId, 1489453509, 1489539909,
+        )
+        for taskId in range(1, count + 1)
+    ]
+
+
+def _makeDictRows(tupleRows):
+    dictRows = []
+    for values in tupleRows:
+        row = psycopg2.extras.DictRow(_FakeDictCursor)
+        row[:] = values
+        dictRows.append(row)
+    return dictRows
+
+
+def _buildFromDictRows(tupleRows):
+    # Includes making the DictRows, which DictCursor does per row.
+    return [DictTask(**row) for row in _makeDictRows(tupleRows)]
+
+
+def _buildFromTuples(tupleRows):
+    makeTask = db._TASK_ROWS(COLUMNS)
+    return [makeTask(row) for row in tupleRows]
+
+
+def _measureMemory(build, tupleRows):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tasks = build(tupleRows)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del tasks
+    return after - before
+
+
+@click.command()
+@click.option('--rows', 'rowCount', default=100000)
+@click.option('--repeat', default=10)
+def main(rowCount, repeat):
+    tupleRows = _makeTupleRows(rowCount)
+    candidates = [
+        ('dictrow+kwargs', _buildFromDictRows),
+        ('tuple+slots', _buildFromTuples),
+    ]
+    for label, build in candidates:
+        start = time.perf_counter()
+        latencies = timeCall(lambda: build(tupleRows), repeat=repeat)
+        print(summarizeLatencies(
+            label, latencies, time.perf_counter() - start))
+    for label, build in candidates:
+        # The row values are shared, so this is the cost of the rows
+        # and models themselves.
+        allocated = _measureMemory(build, tupleRows)
+        print('{0:<24} {1:>8.1f} bytes/task'.format(
+            label, allocated / rowCount))
+
+
+if __name__ == '__main__':
+    main()
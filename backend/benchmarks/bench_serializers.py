@@ -0,0 +1,70 @@
+"""
+Compare dumping tasks with TaskSchema and with the dumper compiled from
+it by :func:`txchoretracker.serializers.compileDumper`.
+
+Each run dumps a list of ``--tasks`` tasks and encodes it as the API
+would. Needs no database::
+
+    python -m benchmarks.bench_serializers --tasks 10000
+"""
+import time
+
+import click
+
+from txchoretracker import models
+from txchoretracker.kleinhelpers import _makeJSONBytes
+from txchoretracker.serializers import compileDumper
+from benchmarks.benchutils import summarizeLatencies
+from benchmarks.benchutils import timeCall
+
+
+def _makeTasks(count):
+    return [
+        models.Task(
+            id=taskId,
+            task_group_id=taskId % 10,
+            name='task {0}'.format(taskId),
+            description='description of task {0}'.format(taskId),
+            due_unix=1489626309 + taskId,
+            created_unix=1489453509,
+            modified_unix=1489539909,
+        )
+        for taskId in range(1, count + 1)
+    ]
+
+
+@click.command()
+@click.option('--tasks', 'taskCount', default=10000)
+@click.option('--repeat', default=20)
+def main(taskCount, repeat):
+    tasks = _makeTasks(taskCount)
+    schema = models.TaskSchema()
+    dumper = compileDumper(schema)
+    assert (_makeJSONBytes(dumper.dumpMany(tasks))
+            == _makeJSONBytes(schema.dump(tasks, many=True).data))
+
+    candidates = [
+        ('marshmallow', lambda: schema.dump(tasks, many=True).data),
+        ('compiled', lambda: dumper.dumpMany(tasks)),
+    ]
+    means = {}
+    for label, dump in candidates:
+        for withJSON in (False, True):
+            func = dump
+            if withJSON:
+                label += '+json'
+                func = lambda dump=dump: _makeJSONBytes(dump())
+            start = time.perf_counter()
+            latencies = timeCall(func, repeat=repeat)
+            print(summarizeLatencies(
+                label, latencies, time.perf_counter() - start))
+            means[label] = sum(latencies) / len(latencies)
+
+    for suffix in ('', '+json'):
+        print('speedup{0}: {1:.1f}x'.format(
+            suffix,
+            means['marshmallow' + suffix] / means['compiled' + suffix]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Measure how API throughput scales with the number of worker processes
+(see :mod:`txchoretracker.workers`).
+
+For each worker count, starts that many workers on a shared listening
+socket, like :class:`txchoretracker.workers.WorkerPoolService` does,
+then has ``--clients`` client processes send requests over keep-alive
+connections for ``--duration`` seconds, and reports throughput and
+latency. The clients run on the same machine, so leave cores for them:
+with N cores, worker counts up to about N/2 are meaningful.
+
+Needs a database that has the fixture installed::
+
+    python -m txchoretracker.cli -c choretracker.ini install-fixture
+    python -m benchmarks.bench_workers -c choretracker.ini -w 1 -w 2 -w 4
+"""
+import http.client
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import click
+
+from txchoretracker.config import processConfigFile
+from txchoretracker.workers import makeListeningSocket
+from benchmarks.benchutils import summarizeLatencies
+
+
+def _request(connection, path):
+    connection.request('GET', path)
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def _waitUntilServing(port, path, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            if _request(connection, path) == 200:
+                connection.close()
+                return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError('the workers did not start serving')
+        time.sleep(0.2)
+
+
+def _client(arguments):
+    # Runs in a client process.
+    port, path, duration = arguments
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    while True:
+        start = time.perf_counter()
+        if start > deadline:
+            break
+        if _request(connection, path) != 200:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+    return latencies, errors
+
+
+def _benchmarkWorkers(configFile, workerCount, *, clients, duration, path):
+    listeningSocket = makeListeningSocket('127.0.0.1', 0)
+    port = listeningSocket.getsockname()[1]
+    fileno = listeningSocket.fileno()
+    workers = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'txchoretracker.workers',
+             configFile, str(fileno), str(index)],
+            pass_fds=[fileno],
+            stdout=subprocess.DEVNULL,
+        )
+        for index in range(workerCount)
+    ]
+    try:
+        _waitUntilServing(port, path)
+        with multiprocessing.Pool(clients) as pool:
+            # Warm up, so that every worker has its connections.
+            pool.map(_client, [(port, path, 1.0)] * clients)
+            results = pool.map(_client, [(port, path, duration)] * clients)
+    finally:
+        for worker in workers:
+            worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            worker.wait()
+        listeningSocket.close()
+    latencies = [latency for result in results for latency in result[0]]
+    errors = sum(result[1] for result in results)
+    return latencies, errors
+
+
+@click.command()
+@click.option(
+    '-c', '--config-file',
+    type=click.Path(exists=True),
+    required=True,
+)
+@click.option('-w', '--workers', 'workerCounts', multiple=True, type=int,
+              default=[1, 2, 4])
+@click.option('--clients', default=os.cpu_count() or 2)
+@click.option('--duration', default=10.0)
+@click.option('--path', default=None,
+              help='What to request; /tasks (or /apis/tasks in '
+                   'development mode) by default.')
+def main(config_file, workerCounts, clients, duration, path):
+    if path is None:
+        development = processConfigFile(config_file).restapi.development
+        path = '/apis/tasks' if development else '/tasks'
+    baseline = None
+    for workerCount in workerCounts:
+        latencies, errors = _benchmarkWorkers(
+            os.path.abspath(config_file), workerCount,
+            clients=clients, duration=duration, path=path)
+        rate = len(latencies) / duration
+        if baseline is None:
+            baseline = rate / workerCount
+        label = '{0} workers'.format(workerCount)
+        print('{0}  scaling={1:.2f}x of linear  errors={2}'.format(
+            summarizeLatencies(label, latencies, duration),
+            rate / (baseline * workerCount), errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Small helpers shared by the benchmark scripts.
+
+The benchmarks are run from the backend directory as modules, e.g.::
+
+    python -m benchmarks.bench_db_backends -c choretracker.ini
+"""
+import statistics
+import time
+
+
+def percentile(sortedValues, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sortedValues:
+        return float('nan')
+    index = min(len(sortedValues) - 1, int(len(sortedValues) * fraction))
+    return sortedValues[index]
+
+
+def summarizeLatencies(label, latencies, elapsed):
+    """
+    Format a one-line summary of per-operation latencies (in seconds)
+    measured over ``elapsed`` seconds of wall clock time.
+    """
+    latencies = sorted(latencies)
+    return (
+        '{label:<24} n={n:<7d} {rate:>10.1f} ops/s  '
+        'mean={mean:.3f}ms  p50={p50:.3f}ms  p99={p99:.3f}ms'
+    ).format(
+        label=label,
+        n=len(latencies),
+        rate=len(latencies) / elapsed if elapsed else float('inf'),
+        mean=statistics.mean(latencies) * 1000 if latencies else 0.0,
+        p50=percentile(latencies, 0.50) * 1000,
+        p99=percentile(latencies, 0.99) * 1000,
+    )
+
+
+def timeCall(func, *, repeat):
+    """
+    Call ``func`` ``repeat`` times and return the per-call latencies.
+    """
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return latencies
@@ -0,0 +1,499 @@
+import inspect
+import io
+import json
+
+import attr
+import pytest
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+
+from txchoretracker import api
+from txchoretracker import changes
+from txchoretracker import exceptions
+from txchoretracker import models
+from txchoretracker.dbcache import CachingChoreTrackerDatabase
+from txchoretracker.versions import ChangeVersions
+
+
+class SwitchableAuthPolicy:
+    userId = 7
+
+    def getAuthenticatedUserId(self, request):
+        return self.userId
+
+
+@pytest.fixture
+def authPolicy(monkeypatch):
+    authPolicy = SwitchableAuthPolicy()
+    for endpointClass in [
+            api.TasksApiEndpoint, api.RepeatingTasksApiEndpoint]:
+        monkeypatch.setattr(endpointClass.json, '_authPolicy', authPolicy)
+    return authPolicy
+
+
+class StreamingDummyRequest(DummyRequest):
+    # twisted.web.server.Request keeps the response code here.
+    @property
+    def code(self):
+        return self.responseCode
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+
+def _makeTask(taskId, taskGroupId=1, dueUnix=0):
+    return models.Task(
+        id=taskId,
+        task_group_id=taskGroupId,
+        name='task {0}'.format(taskId),
+        description='',
+        due_unix=dueUnix,
+    )
+
+
+class FakeDatabase:
+    def __init__(self, tasks, membersByTaskGroup):
+        self.tasks = {task.id: task for task in tasks}
+        self.membersByTaskGroup = membersByTaskGroup
+        self.calls = []
+
+    def _visibleTasks(self, userId):
+        return sorted(
+            (task for task in self.tasks.values()
+             if userId in self.membersByTaskGroup[task.task_group_id]),
+            key=lambda task: (task.due_unix, task.id))
+
+    async def asUserIterAllTasks(self, *, userId):
+        self.calls.append(('asUserIterAllTasks', userId))
+        for task in self._visibleTasks(userId):
+            yield task
+
+    def _matchingTasks(self, userId, taskListQuery):
+        if (taskListQuery.task_group_id is not None
+                and userId not in self.membersByTaskGroup.get(
+                    taskListQuery.task_group_id, [])):
+            raise exceptions.UserNotInRequestedTaskGroup()
+        after = taskListQuery.after
+        return [
+            task for task in self._visibleTasks(userId)
+            if taskListQuery.task_group_id in (None, task.task_group_id)
+            and (after is None
+                 or (task.due_unix, task.id) > (after.due_unix, after.id))
+        ]
+
+    async def asUserIterTasks(self, *, userId, taskListQuery):
+        self.calls.append(('asUserIterTasks', userId))
+        for task in self._matchingTasks(userId, taskListQuery):
+            yield task
+
+    async def asUserFetchTasksPage(self, *, userId, taskListQuery, limit):
+        self.calls.append(('asUserFetchTasksPage', userId))
+        return self._matchingTasks(userId, taskListQuery)[:limit]
+
+    async def asUserFetchTask(self, *, userId, taskId):
+        self.calls.append(('asUserFetchTask', userId, taskId))
+        task = self.tasks.get(taskId)
+        if task is None:
+            raise exceptions.NoSuchTask()
+        if userId not in self.membersByTaskGroup[task.task_group_id]:
+            raise exceptions.UserNotInTaskGroup()
+        return task
+
+    async def fetchTaskGroupMemberIds(self, *, taskGroupId):
+        return self.membersByTaskGroup.get(taskGroupId, [])
+
+
+def _request(method, uri, headers=None, body=None):
+    txRequest = StreamingDummyRequest([b''])
+    txRequest.method = method
+    txRequest.uri = uri
+    for name, value in (headers or {}).items():
+        txRequest.requestHeaders.setRawHeaders(name, [value])
+    if body is not None:
+        txRequest.requestHeaders.setRawHeaders(
+            b'content-type', [b'application/json'])
+        txRequest.content = io.BytesIO(json.dumps(body).encode('utf-8'))
+    return txRequest
+
+
+def _respond(handler, txRequest, **kwargs):
+    """
+    Run the route ``handler`` and render its response to
+    ``txRequest``. Returns the status code and the decoded body (None
+    if there is none).
+    """
+    response = handler(txRequest, **kwargs)
+    if inspect.iscoroutine(response):
+        results = []
+        defer.ensureDeferred(response).addBoth(results.append)
+        [response] = results
+    response.render(txRequest)
+    body = b''.join(txRequest.written)
+    return txRequest.responseCode, json.loads(body) if body else None
+
+
+class TestTaskListing:
+    def test_second_listing_is_served_from_the_cache(self, authPolicy):
+        fakeDB = FakeDatabase(
+            [_makeTask(1, dueUnix=20), _makeTask(2, dueUnix=10),
+             _makeTask(3, dueUnix=10)],
+            {1: [7]},
+        )
+        cachingDB = CachingChoreTrackerDatabase(
+            fakeDB, maxEntries=100, maxBytes=10 ** 6, ttl=60)
+        cachingDB.handleChange(changes.RESYNC)
+        endpoint = api.TasksApiEndpoint(cachingDB)
+        first = _respond(endpoint.fetchAll, _request(b'GET', b'/'))
+        second = _respond(endpoint.fetchAll, _request(b'GET', b'/'))
+        assert first == second
+        assert [task['id'] for task in first[1]['data']] == [2, 3, 1]
+        assert fakeDB.calls == [('asUserIterAllTasks', 7)]
+
+
+    def makeEndpoint(self, taskCount):
+        self.db = FakeDatabase(
+            [_makeTask(taskId, taskGroupId=1 + taskId % 2,
+                       dueUnix=taskId // 3)
+             for taskId in range(1, taskCount + 1)],
+            {1: [7], 2: [7], 3: [8]},
+        )
+        return api.TasksApiEndpoint(self.db)
+
+    def test_pages_follow_the_next_cursor(self, authPolicy):
+        endpoint = self.makeEndpoint(5)
+        taskIds = []
+        uri = b'/?limit=2'
+        while uri is not None:
+            status, body = _respond(endpoint.fetchAll, _request(b'GET', uri))
+            assert status == 200
+            assert len(body['data']) <= 2
+            taskIds.extend(task['id'] for task in body['data'])
+            nextCursor = body['meta']['nextCursor']
+            uri = None if nextCursor is None else \
+                '/?limit=2&cursor={0}'.format(nextCursor).encode('ascii')
+        assert taskIds == [1, 2, 3, 4, 5]
+        assert self.db.calls == [('asUserFetchTasksPage', 7)] * 3
+
+    def test_unrelated_parameters_still_get_every_task(self, authPolicy):
+        endpoint = self.makeEndpoint(150)
+        status, body = _respond(
+            endpoint.fetchAll, _request(b'GET', b'/?_=1507000000000'))
+        assert status == 200
+        assert len(body['data']) == 150
+        assert 'meta' not in body
+        assert self.db.calls == [('asUserIterAllTasks', 7)]
+
+    def test_filters_without_paging_get_every_matching_task(
+                self, authPolicy):
+        endpoint = self.makeEndpoint(150)
+        status, body = _respond(
+            endpoint.fetchAll, _request(b'GET', b'/?taskGroup=2'))
+        assert status == 200
+        assert len(body['data']) == 75
+        assert {task['taskGroup'] for task in body['data']} == {2}
+
+        status, body = _respond(
+            endpoint.fetchAll, _request(b'GET', b'/?taskGroup=3'))
+        assert status == 403
+
+
+class TestTaskFetch:
+    def makeEndpoint(self):
+        self.db = FakeDatabase(
+            [_makeTask(1, taskGroupId=1), _makeTask(2, taskGroupId=2)],
+            {1: [7, 8], 2: [8]},
+        )
+        versions = ChangeVersions()
+        versions.handleChange(changes.RESYNC)
+        return api.TasksApiEndpoint(self.db, versions)
+
+    def fetch(self, endpoint, taskId, ifNoneMatch=None):
+        """
+        Returns the status and the ETag header of the response.
+        """
+        headers = {}
+        if ifNoneMatch is not None:
+            headers[b'if-none-match'] = ifNoneMatch
+        txRequest = _request(b'GET', b'/', headers)
+        status, body = _respond(endpoint.fetch, txRequest, taskId=taskId)
+        etag = txRequest.responseHeaders.getRawHeaders(b'etag', [None])[0]
+        return status, etag
+
+    def test_matching_etag_is_not_modified(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        status, etag = self.fetch(endpoint, 1)
+        assert status == 200
+        assert self.fetch(endpoint, 1, etag) == (304, etag)
+
+    def test_never_not_modified_without_access(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        # Even with the right ETag (or a wildcard), a task the user
+        # can't see is never "not modified".
+        for taskId, expectedStatus in [(3, 404), (2, 403)]:
+            etag = endpoint._versions.taskETag(authPolicy.userId, taskId)
+            for ifNoneMatch in ['"{0}"'.format(etag).encode('ascii'), b'*']:
+                assert self.fetch(endpoint, taskId, ifNoneMatch) == (
+                    expectedStatus, None)
+
+    def test_etags_are_per_user(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        authPolicy.userId = 8
+        status, otherUsersETag = self.fetch(endpoint, 1)
+        assert status == 200
+        authPolicy.userId = 7
+        status, etag = self.fetch(endpoint, 1, otherUsersETag)
+        assert status == 200
+        assert etag != otherUsersETag
+
+
+class FakeChangeLog:
+    """
+    A task database with a change log, pruned up to ``oldestTxid``.
+    """
+    def __init__(self, tasks, membersByTaskGroup):
+        self.tasks = {task.id: task for task in tasks}
+        self.membersByTaskGroup = membersByTaskGroup
+        self.txid = 1
+        self.oldestTxid = 1
+        # (txid, task ID, task group ID, deleted)
+        self.log = []
+
+    def change(self, task=None, deletedTaskId=None):
+        if task is not None:
+            self.tasks[task.id] = task
+            self.log.append((self.txid, task.id, task.task_group_id, False))
+        else:
+            task = self.tasks.pop(deletedTaskId)
+            self.log.append((self.txid, task.id, task.task_group_id, True))
+        self.txid += 1
+
+    async def asUserFetchTaskChanges(self, *, userId, since):
+        cursor = models.SyncCursor(txid=self.txid)
+        visible = {
+            taskGroupId for taskGroupId, memberIds
+            in self.membersByTaskGroup.items() if userId in memberIds}
+        if since is None or since.txid < self.oldestTxid:
+            return models.TaskChanges(
+                cursor=cursor, reset=True,
+                tasks=[task for task in self.tasks.values()
+                       if task.task_group_id in visible])
+        changes = models.TaskChanges(cursor=cursor)
+        for txid, taskId, taskGroupId, deleted in self.log:
+            if txid < since.txid or taskGroupId not in visible:
+                continue
+            if deleted:
+                changes.deleted_task_ids.append(taskId)
+            else:
+                changes.tasks.append(self.tasks[taskId])
+        return changes
+
+
+class TestTaskChanges:
+    def makeEndpoint(self):
+        self.db = FakeChangeLog(
+            [_makeTask(1, taskGroupId=1), _makeTask(2, taskGroupId=2),
+             _makeTask(3, taskGroupId=1)],
+            {1: [7], 2: [8]},
+        )
+        return api.TasksApiEndpoint(self.db)
+
+    def fetchChanges(self, endpoint, since=None):
+        uri = b'/changes'
+        if since is not None:
+            uri += b'?since=' + since.encode('ascii')
+        return _respond(endpoint.fetchChanges, _request(b'GET', uri))
+
+    def test_changes_since_the_cursor(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        status, body = self.fetchChanges(endpoint)
+        assert status == 200
+        assert body['data']['reset'] is True
+        assert [task['id'] for task in body['data']['tasks']] == [1, 3]
+        cursor = body['meta']['cursor']
+
+        self.db.change(task=attr.evolve(self.db.tasks[1], name='renamed'))
+        self.db.change(deletedTaskId=3)
+        # Not in the user's task groups.
+        self.db.change(task=attr.evolve(self.db.tasks[2], name='renamed'))
+        status, body = self.fetchChanges(endpoint, cursor)
+        assert status == 200
+        assert body['data']['reset'] is False
+        assert [(task['id'], task['name'])
+                for task in body['data']['tasks']] == [(1, 'renamed')]
+        assert body['data']['deleted'] == [3]
+        assert body['meta']['cursor'] != cursor
+
+        status, body = self.fetchChanges(endpoint, body['meta']['cursor'])
+        assert body['data'] == {'tasks': [], 'deleted': [], 'reset': False}
+
+    def test_changes_are_the_users_own(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        authPolicy.userId = 8
+        status, body = self.fetchChanges(endpoint)
+        cursor = body['meta']['cursor']
+        assert [task['id'] for task in body['data']['tasks']] == [2]
+        self.db.change(deletedTaskId=3)
+        self.db.change(task=attr.evolve(self.db.tasks[2], name='renamed'))
+        status, body = self.fetchChanges(endpoint, cursor)
+        assert [task['id'] for task in body['data']['tasks']] == [2]
+        assert body['data']['deleted'] == []
+
+    def test_invalid_cursor_is_400(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        for since in ['nonsense', models.TaskCursor(1, 2).encode()]:
+            status, body = self.fetchChanges(endpoint, since)
+            assert status == 400
+            assert 'since' in body['error']['fields']
+
+    def test_expired_cursor_gets_everything_again(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        status, body = self.fetchChanges(endpoint)
+        cursor = body['meta']['cursor']
+        self.db.change(deletedTaskId=3)
+        self.db.oldestTxid = self.db.txid
+        status, body = self.fetchChanges(endpoint, cursor)
+        assert status == 200
+        assert body['data']['reset'] is True
+        assert [task['id'] for task in body['data']['tasks']] == [1]
+        assert body['data']['deleted'] == []
+
+
+class FakeRepeatingTaskDatabase:
+    def __init__(self, membersByTaskGroup):
+        self.membersByTaskGroup = membersByTaskGroup
+        self.repeatingTasks = {}
+
+    def _check(self, userId, repeatingTaskId):
+        repeatingTask = self.repeatingTasks.get(repeatingTaskId)
+        if repeatingTask is None:
+            raise exceptions.NoSuchRepeatingTask()
+        if userId not in self.membersByTaskGroup[
+                repeatingTask.task_group_id]:
+            raise exceptions.UserNotInTaskGroup()
+        return repeatingTask
+
+    async def asUserFetchAllRepeatingTasks(self, *, userId):
+        return [
+            repeatingTask for repeatingTask in self.repeatingTasks.values()
+            if userId in self.membersByTaskGroup[
+                repeatingTask.task_group_id]]
+
+    async def asUserCreateRepeatingTask(self, *, userId,
+                                        repeatingTaskToCreate):
+        taskGroupId = repeatingTaskToCreate.task_group_id
+        if userId not in self.membersByTaskGroup.get(taskGroupId, []):
+            raise exceptions.UserNotInRequestedTaskGroup()
+        repeatingTask = attr.evolve(
+            repeatingTaskToCreate, id=len(self.repeatingTasks) + 1)
+        self.repeatingTasks[repeatingTask.id] = repeatingTask
+        return repeatingTask
+
+    async def asUserFetchRepeatingTask(self, *, userId, repeatingTaskId):
+        return self._check(userId, repeatingTaskId)
+
+    async def asUserDeleteRepeatingTask(self, *, userId, repeatingTaskId):
+        self._check(userId, repeatingTaskId)
+        del self.repeatingTasks[repeatingTaskId]
+
+
+class FakeScheduler:
+    wakes = 0
+
+    def wake(self):
+        self.wakes += 1
+
+
+# Monday 2018-01-01 09:00 UTC.
+START = 1514797200
+
+
+def _repeatingTask(taskGroupId=1, recurrence='FREQ=WEEKLY;BYDAY=TU'):
+    return {
+        'taskGroup': taskGroupId,
+        'name': 'Bins',
+        'description': 'Put the bins out',
+        'recurrence': recurrence,
+        'start': START,
+    }
+
+
+class TestRepeatingTasks:
+    def makeEndpoint(self):
+        self.db = FakeRepeatingTaskDatabase({1: [7], 2: [8]})
+        self.scheduler = FakeScheduler()
+        return api.RepeatingTasksApiEndpoint(self.db, self.scheduler)
+
+    def test_create_fetch_and_delete(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        status, body = _respond(endpoint.create, _request(
+            b'POST', b'/', body=_repeatingTask()))
+        assert status == 201
+        created = body['data']
+        # The first Tuesday from the start.
+        assert created['nextDue'] == START + 24 * 60 * 60
+        assert self.scheduler.wakes == 1
+
+        status, body = _respond(
+            endpoint.fetch, _request(b'GET', b'/'),
+            repeatingTaskId=created['id'])
+        assert (status, body['data']) == (200, created)
+        status, body = _respond(endpoint.fetchAll, _request(b'GET', b'/'))
+        assert (status, body['data']) == (200, [created])
+
+        status, body = _respond(
+            endpoint.delete, _request(b'DELETE', b'/'),
+            repeatingTaskId=created['id'])
+        assert status == 200
+        status, body = _respond(
+            endpoint.fetch, _request(b'GET', b'/'),
+            repeatingTaskId=created['id'])
+        assert status == 404
+
+    def test_bad_recurrence_is_400(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        for recurrence in ['FREQ=HOURLY', 'FREQ=DAILY;INTERVAL=0', '']:
+            status, body = _respond(endpoint.create, _request(
+                b'POST', b'/', body=_repeatingTask(recurrence=recurrence)))
+            assert status == 400
+            assert 'recurrence' in body['error']['fields']
+        assert self.db.repeatingTasks == {}
+        assert self.scheduler.wakes == 0
+
+    def test_only_task_group_members_get_access(self, authPolicy):
+        endpoint = self.makeEndpoint()
+        status, body = _respond(endpoint.create, _request(
+            b'POST', b'/', body=_repeatingTask(taskGroupId=2)))
+        assert status == 400
+        assert self.db.repeatingTasks == {}
+
+        authPolicy.userId = 8
+        status, body = _respond(endpoint.create, _request(
+            b'POST', b'/', body=_repeatingTask(taskGroupId=2)))
+        repeatingTaskId = body['data']['id']
+        authPolicy.userId = 7
+        status, body = _respond(endpoint.fetchAll, _request(b'GET', b'/'))
+        assert body['data'] == []
+        for handler, method in [
+                (endpoint.fetch, b'GET'), (endpoint.delete, b'DELETE')]:
+            status, body = _respond(
+                handler, _request(method, b'/'),
+                repeatingTaskId=repeatingTaskId)
+            assert status == 403
+        assert repeatingTaskId in self.db.repeatingTasks
+
+
+class TestTaskBatch:
+    def test_bad_json_is_400(self, authPolicy):
+        endpoint = api.TasksApiEndpoint(dbWrapper=None)
+        for contentType, body in [
+                (b'text/plain', b'{}'), (b'application/json', b'{')]:
+            txRequest = DummyRequest([b''])
+            txRequest.method = b'POST'
+            txRequest.requestHeaders.setRawHeaders(
+                b'content-type', [contentType])
+            txRequest.content = io.BytesIO(body)
+            response = defer.ensureDeferred(endpoint.batch(txRequest)).result
+            assert response.status == 400
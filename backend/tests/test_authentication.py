@@ -0,0 +1,410 @@
+import json
+import time
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.auth import crypt as google_crypt
+from google.auth import jwt as google_jwt
+from treq.testing import StubTreq
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.web import resource
+from twisted.web import server
+
+from txchoretracker import authentication
+
+
+def _keyring(*keyIds):
+    return [
+        authentication.SigningKey(
+            keyId=keyId, secret='secret {0}'.format(keyId).encode('ascii'))
+        for keyId in keyIds
+    ]
+
+
+def _serializer(keyring):
+    return authentication.SignedJSONSerializer(
+        keyring=keyring, digestmod='sha512')
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRequest:
+    def __init__(self, cookies=None):
+        self.cookies = dict(cookies or {})
+
+    def getCookie(self, cookieName):
+        return self.cookies.get(cookieName)
+
+    def addCookie(self, cookieName, value, **kwargs):
+        self.cookies[cookieName] = value
+
+
+class CountingSerializer(authentication.SignedJSONSerializer):
+    verifications = 0
+
+    def verify(self, serialized):
+        self.verifications += 1
+        return super().verify(serialized)
+
+
+class TestAuthTicketAuthenticationPolicy:
+    def makePolicy(self, **kwargs):
+        self.clock = FakeClock()
+        kwargs.setdefault('reauthPeriod', 100)
+        policy = authentication.AuthTicketAuthenticationPolicy(
+            cookieDomain='localhost', secret=b'secret', clock=self.clock,
+            **kwargs)
+        self.serializer = CountingSerializer(
+            secret=b'secret', digestmod='sha512')
+        policy._serializer = self.serializer
+        return policy
+
+    def rememberedRequest(self, policy, userId=7):
+        request = FakeRequest()
+        policy.rememberUser(request, userId)
+        return request
+
+    def test_round_trip(self):
+        policy = self.makePolicy()
+        request = self.rememberedRequest(policy)
+        assert policy.getAuthenticatedUserId(request) == 7
+        assert policy.getAuthenticatedUserId(FakeRequest()) is None
+
+    def test_verified_tickets_are_cached(self):
+        policy = self.makePolicy()
+        request = self.rememberedRequest(policy)
+        for _ in range(3):
+            assert policy.getAuthenticatedUserId(request) == 7
+        assert self.serializer.verifications == 1
+        assert policy.ticketCacheStats()['hits'] == 2
+
+    def test_bad_tickets_are_not_cached(self):
+        policy = self.makePolicy()
+        request = self.rememberedRequest(policy)
+        request.cookies['AUTHTKT'] = request.cookies['AUTHTKT'].replace(
+            b'"userId": 7', b'"userId": 8')
+        for _ in range(2):
+            assert policy.getAuthenticatedUserId(request) is None
+        assert self.serializer.verifications == 2
+        assert policy.ticketCacheStats()['entries'] == 0
+
+    def test_cached_tickets_expire_at_reauth_boundary(self):
+        for ticketCacheSize in (0, 10):
+            policy = self.makePolicy(ticketCacheSize=ticketCacheSize)
+            request = self.rememberedRequest(policy)
+            self.clock.now += 100.5
+            assert policy.getAuthenticatedUserId(request) == 7
+            self.clock.now += 0.5
+            assert policy.getAuthenticatedUserId(request) is None
+
+    def test_without_cache(self):
+        policy = self.makePolicy(ticketCacheSize=0)
+        request = self.rememberedRequest(policy)
+        for _ in range(2):
+            assert policy.getAuthenticatedUserId(request) == 7
+        assert self.serializer.verifications == 2
+        assert policy.ticketCacheStats() is None
+
+    def test_old_key_tickets_are_resigned(self):
+        policy = self.makePolicy()
+        oldPolicy = authentication.AuthTicketAuthenticationPolicy(
+            cookieDomain='localhost', keyring=_keyring('old'),
+            reauthPeriod=100, clock=self.clock)
+        policy._serializer = CountingSerializer(
+            keyring=_keyring('new', 'old'), digestmod='sha512')
+        request = self.rememberedRequest(oldPolicy)
+        oldTicket = request.cookies['AUTHTKT']
+        self.clock.now += 30
+
+        assert policy.getAuthenticatedUserId(request) == 7
+        newTicket = request.cookies['AUTHTKT']
+        assert b':kid=new:' in newTicket
+        verified = policy._serializer.verify(newTicket)
+        assert verified.structure == \
+            policy._serializer.verify(oldTicket).structure
+        assert not verified.needsResigning
+        assert policy.ticketCacheStats()['entries'] == 0
+
+
+class TestSignedJSONSerializer:
+    def test_single_secret_tickets_have_no_key_id(self):
+        serializer = authentication.SignedJSONSerializer(
+            secret=b'secret', digestmod='sha512')
+        serialized = serializer.serializeWithSignature({'a': 1})
+        assert serialized.startswith(b'{"a": 1}:mac=')
+        verified = serializer.verify(serialized)
+        assert verified.structure == {'a': 1}
+        assert verified.keyId is None
+        assert not verified.needsResigning
+
+    def test_verifies_with_any_key_in_the_keyring(self):
+        serialized = _serializer(_keyring('1')).serializeWithSignature(
+            {'a': 1})
+        verified = _serializer(_keyring('2', '1')).verify(serialized)
+        assert verified.structure == {'a': 1}
+        assert verified.keyId == '1'
+        assert verified.needsResigning
+
+    def test_legacy_key_in_keyring(self):
+        legacy = authentication.SignedJSONSerializer(
+            secret=b'legacy', digestmod='sha512')
+        keyring = _keyring('1') + [
+            authentication.SigningKey(keyId=None, secret=b'legacy')]
+        verified = _serializer(keyring).verify(
+            legacy.serializeWithSignature({'a': 1}))
+        assert verified.keyId is None
+        assert verified.needsResigning
+
+    def test_dropped_key(self):
+        serialized = _serializer(_keyring('1')).serializeWithSignature({})
+        with pytest.raises(authentication.UnknownKey):
+            _serializer(_keyring('2')).verify(serialized)
+
+    def test_key_id_is_signed(self):
+        serialized = _serializer(_keyring('1')).serializeWithSignature({})
+        forged = serialized.replace(b':kid=1:', b':kid=2:')
+        with pytest.raises(authentication.SignatureMismatch):
+            _serializer(_keyring('1', '2')).verify(forged)
+
+    def test_rejects_bad_keyrings(self):
+        with pytest.raises(TypeError):
+            authentication.SignedJSONSerializer(digestmod='sha512')
+        with pytest.raises(ValueError):
+            _serializer([])
+        with pytest.raises(ValueError):
+            _serializer(_keyring('1', '1'))
+        with pytest.raises(ValueError):
+            _keyring('a:b')
+
+
+class StandInCertsResource(resource.Resource):
+    """
+    Serves certificates like Google's certs endpoint. With ``hold``,
+    requests are only answered by :meth:`release`.
+    """
+    isLeaf = True
+
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+        self.maxAge = 1000
+        self.status = 200
+        self.hold = False
+        self.requestCount = 0
+        self.held = []
+
+    def render_GET(self, request):
+        self.requestCount += 1
+        if self.hold:
+            self.held.append(request)
+            return server.NOT_DONE_YET
+        return self._respond(request)
+
+    def _respond(self, request):
+        request.setResponseCode(self.status)
+        request.setHeader(
+            b'Cache-Control',
+            'public, max-age={0}, must-revalidate'.format(
+                self.maxAge).encode('ascii'))
+        return json.dumps({'key': 'cert {0}'.format(
+            self.version)}).encode('ascii')
+
+    def release(self):
+        held, self.held = self.held, []
+        for request in held:
+            request.write(self._respond(request))
+            request.finish()
+
+
+class TestGoogleSignInValidatorCerts:
+    def makeValidator(self):
+        self.certsResource = StandInCertsResource()
+        self.httpClient = StubTreq(self.certsResource)
+        self.reactor = task.Clock()
+        return authentication.GoogleSignInValidator(
+            'client id',
+            certsUrl='http://certs.test/certs',
+            httpClient=self.httpClient,
+            reactor=self.reactor,
+            clock=self.reactor.seconds,
+            verificationThreads=0,
+        )
+
+    def getCerts(self, validator):
+        results = []
+        defer.ensureDeferred(
+            validator._getCerts()
+        ).addBoth(results.append)
+        self.httpClient.flush()
+        return results
+
+    def certsVersion(self, certs):
+        return certs.certsByKeyId['key']
+
+    def test_concurrent_fetches_are_coalesced(self):
+        validator = self.makeValidator()
+        self.certsResource.hold = True
+        pending = [self.getCerts(validator) for _ in range(5)]
+        assert self.certsResource.requestCount == 1
+        assert pending[0] == []
+        self.certsResource.release()
+        self.httpClient.flush()
+        fakes = [results[0] for results in pending]
+        assert all(fake is fakes[0] for fake in fakes)
+        assert self.certsVersion(fakes[0]) == 'cert 0'
+
+    def test_refreshes_in_background_before_expiry(self):
+        validator = self.makeValidator()
+        self.getCerts(validator)
+        self.certsResource.version = 1
+        self.reactor.advance(799)
+        assert self.certsResource.requestCount == 1
+        self.reactor.advance(1)
+        self.httpClient.flush()
+        assert self.certsResource.requestCount == 2
+        [fake] = self.getCerts(validator)
+        assert self.certsVersion(fake) == 'cert 1'
+        assert self.certsResource.requestCount == 2
+        validator.stop()
+        assert not self.reactor.getDelayedCalls()
+
+    def test_serves_stale_certs_while_refreshing(self):
+        validator = self.makeValidator()
+        self.getCerts(validator)
+        validator.stop()
+        self.reactor.advance(1001)
+        self.certsResource.hold = True
+        self.certsResource.version = 1
+        [fake] = self.getCerts(validator)
+        assert self.certsVersion(fake) == 'cert 0'
+        assert self.certsResource.requestCount == 2
+        self.certsResource.release()
+        self.httpClient.flush()
+        [fake] = self.getCerts(validator)
+        assert self.certsVersion(fake) == 'cert 1'
+
+    def test_failed_background_refresh_is_retried(self):
+        validator = self.makeValidator()
+        self.getCerts(validator)
+        self.certsResource.status = 500
+        self.reactor.advance(800)
+        self.httpClient.flush()
+        assert self.certsResource.requestCount == 2
+        [fake] = self.getCerts(validator)
+        assert self.certsVersion(fake) == 'cert 0'
+
+        self.certsResource.status = 200
+        self.certsResource.version = 1
+        self.reactor.advance(60)
+        self.httpClient.flush()
+        [fake] = self.getCerts(validator)
+        assert self.certsVersion(fake) == 'cert 1'
+        validator.stop()
+
+    def test_first_fetch_failure(self):
+        validator = self.makeValidator()
+        self.certsResource.status = 503
+        [failure] = self.getCerts(validator)
+        assert failure.check(authentication.GoogleCertsUnavailable)
+
+
+def _makeKeyPair():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    privatePEM = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    publicPEM = key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    return privatePEM, publicPEM.decode('ascii')
+
+
+class TestVerifyGoogleIdToken:
+    @classmethod
+    def setup_class(cls):
+        cls.privatePEM, cls.publicPEM = _makeKeyPair()
+        cls.otherPrivatePEM, _ = _makeKeyPair()
+
+    def makeToken(self, keyId='k1', privatePEM=None, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': 'accounts.google.com', 'aud': 'client id',
+            'sub': '1234', 'iat': now, 'exp': now + 3600,
+        }
+        payload.update(claims)
+        signer = google_crypt.RSASigner.from_string(
+            privatePEM or self.privatePEM, keyId)
+        return google_jwt.encode(signer, payload)
+
+    def verify(self, token, certs=None):
+        if certs is None:
+            certs = authentication._GoogleCerts({'k1': self.publicPEM})
+        return authentication._verifyGoogleIdToken(token, certs, 'client id')
+
+    def test_valid_token(self):
+        certs = authentication._GoogleCerts({'k1': self.publicPEM})
+        assert self.verify(self.makeToken(), certs)['sub'] == '1234'
+        verifier = certs.getVerifier('k1')
+        assert self.verify(self.makeToken(), certs)['sub'] == '1234'
+        # Parsed once, and kept across refreshes that don't change it.
+        assert certs.getVerifier('k1') is verifier
+        refreshed = authentication._GoogleCerts(
+            {'k1': self.publicPEM, 'k2': 'other'}, previous=certs)
+        assert refreshed.getVerifier('k1') is verifier
+
+    def test_matches_google_auth(self):
+        token = self.makeToken()
+        assert self.verify(token) == google_jwt.decode(
+            token, certs={'k1': self.publicPEM}, audience='client id')
+
+    @pytest.mark.parametrize('makeBadToken', [
+        lambda self: self.makeToken(privatePEM=self.otherPrivatePEM),
+        lambda self: self.makeToken(keyId='k2'),
+        lambda self: self.makeToken(aud='other client'),
+        lambda self: self.makeToken(iss='evil.example.com'),
+        lambda self: self.makeToken(exp=int(time.time()) - 3600),
+        lambda self: self.makeToken(iat=int(time.time()) + 3600),
+        lambda self: self.makeToken()[:-10],
+        lambda self: b'not a token',
+        lambda self: 'ünïcödé',
+    ])
+    def test_invalid_tokens(self, makeBadToken):
+        with pytest.raises(ValueError):
+            self.verify(makeBadToken(self))
+
+    def test_validate_user_id_from_token(self):
+        certsResource = StandInCertsResource()
+        certsResource.render_GET = lambda request: json.dumps(
+            {'k1': self.publicPEM}).encode('ascii')
+        httpClient = StubTreq(certsResource)
+        calls = []
+
+        def runVerification(function, *args):
+            calls.append(function)
+            return defer.maybeDeferred(function, *args)
+        validator = authentication.GoogleSignInValidator(
+            'client id', certsUrl='http://certs.test/certs',
+            httpClient=httpClient, reactor=task.Clock())
+        validator._runVerification = runVerification
+
+        results = []
+        for token in (self.makeToken(), b'bad'):
+            defer.ensureDeferred(
+                validator.validateUserIdFromToken(token)
+            ).addBoth(results.append)
+            httpClient.flush()
+        validator.stop()
+        assert results[0] == '1234'
+        assert results[1].check(authentication.InvalidGoogleSignInIdToken)
+        assert calls == [authentication._verifyGoogleIdToken] * 2
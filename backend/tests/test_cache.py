@@ -0,0 +1,386 @@
+import attr
+from twisted.internet import defer
+
+from txchoretracker import changes
+from txchoretracker import exceptions
+from txchoretracker import models
+from txchoretracker.cache import LRUCache
+from txchoretracker.dbcache import CachingChoreTrackerDatabase
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _result(coroutine):
+    results = []
+    defer.ensureDeferred(coroutine).addBoth(results.append)
+    [result] = results
+    return result
+
+
+def _collect(asyncIterable):
+    async def collect():
+        return [item async for item in asyncIterable]
+    return _result(collect())
+
+
+def _makeTask(taskId, taskGroupId=1):
+    return models.Task(
+        id=taskId,
+        task_group_id=taskGroupId,
+        name='task {0}'.format(taskId),
+        description='',
+        due_unix=0,
+    )
+
+
+class FakeDatabase:
+    def __init__(self, tasks, membersByTaskGroup):
+        self.tasks = {task.id: task for task in tasks}
+        self.membersByTaskGroup = membersByTaskGroup
+        self.calls = []
+
+    def _canView(self, userId, task):
+        return userId in self.membersByTaskGroup.get(task.task_group_id, [])
+
+    def _visibleTasks(self, userId):
+        return sorted(
+            (task for task in self.tasks.values()
+             if self._canView(userId, task)),
+            key=lambda task: task.id)
+
+    async def asUserFetchAllTasks(self, *, userId):
+        self.calls.append(('asUserFetchAllTasks', userId))
+        return self._visibleTasks(userId)
+
+    async def asUserIterAllTasks(self, *, userId):
+        self.calls.append(('asUserIterAllTasks', userId))
+        for task in self._visibleTasks(userId):
+            yield task
+
+    async def asUserFetchTask(self, *, userId, taskId):
+        self.calls.append(('asUserFetchTask', userId, taskId))
+        task = self.tasks[taskId]
+        if not self._canView(userId, task):
+            raise exceptions.UserNotInTaskGroup()
+        return task
+
+    async def asUserCreateTask(self, *, userId, taskToCreate):
+        task = _makeTask(max(self.tasks) + 1, taskToCreate.task_group_id)
+        self.tasks[task.id] = task
+        return task
+
+    async def asUserUpdateTask(self, *, userId, taskId, taskToUpdate):
+        task = _makeTask(taskId, taskToUpdate.task_group_id)
+        self.tasks[taskId] = task
+        return task
+
+    async def asUserDeleteTask(self, *, userId, taskId):
+        del self.tasks[taskId]
+
+    async def asUserApplyTaskBatch(self, *, userId, operations):
+        results = []
+        for operation in operations:
+            if operation.operation == 'create':
+                task = await self.asUserCreateTask(
+                    userId=userId, taskToCreate=operation.task)
+            elif operation.operation == 'update':
+                task = await self.asUserUpdateTask(
+                    userId=userId, taskId=operation.task_id,
+                    taskToUpdate=operation.task)
+            else:
+                await self.asUserDeleteTask(
+                    userId=userId, taskId=operation.task_id)
+                task = None
+            results.append(models.TaskBatchResult(
+                task_id=operation.task_id or task.id, task=task))
+        return results
+
+    async def fetchTaskGroupMemberIds(self, *, taskGroupId):
+        return self.membersByTaskGroup.get(taskGroupId, [])
+
+
+class TestLRUCache:
+    def makeCache(self, **kwargs):
+        kwargs.setdefault('maxEntries', 3)
+        kwargs.setdefault('maxSize', 100)
+        kwargs.setdefault('ttl', 10)
+        self.clock = FakeClock()
+        return LRUCache(clock=self.clock, **kwargs)
+
+    def test_get_and_put(self):
+        cache = self.makeCache()
+        assert cache.get('a') is None
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_evicts_least_recently_used(self):
+        cache = self.makeCache()
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('c', 3)
+        cache.get('a')
+        cache.put('d', 4)
+        assert 'b' not in cache
+        assert 'a' in cache
+        assert cache.evictions == 1
+
+    def test_evicts_to_stay_within_size(self):
+        cache = self.makeCache()
+        cache.put('a', 1, size=60)
+        cache.put('b', 2, size=60)
+        assert 'a' not in cache
+        assert cache.size == 60
+
+    def test_refuses_oversized_entries(self):
+        cache = self.makeCache()
+        cache.put('a', 1, size=10)
+        cache.put('b', 2, size=101)
+        assert 'a' in cache
+        assert 'b' not in cache
+
+    def test_entries_expire(self):
+        cache = self.makeCache()
+        cache.put('a', 1)
+        self.clock.now = 10
+        assert cache.get('a') is None
+        assert cache.expirations == 1
+        assert len(cache) == 0
+
+    def test_on_remove_is_called(self):
+        removed = []
+        cache = self.makeCache(maxEntries=1, onRemove=removed.append)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.invalidate('b')
+        assert removed == ['a', 'b']
+
+
+class TestCachingChoreTrackerDatabase:
+    def makeCachingDatabase(self):
+        self.db = FakeDatabase(
+            [_makeTask(1, taskGroupId=1), _makeTask(2, taskGroupId=2)],
+            {1: [10, 11], 2: [10]},
+        )
+        cachingDB = CachingChoreTrackerDatabase(
+            self.db, maxEntries=100, maxBytes=10 ** 6, ttl=60)
+        # The change listener has connected.
+        _result(cachingDB.handleChange(changes.RESYNC))
+        return cachingDB
+
+    def test_task_list_is_cached_per_user(self):
+        cachingDB = self.makeCachingDatabase()
+        first = _result(cachingDB.asUserFetchAllTasks(userId=10))
+        second = _result(cachingDB.asUserFetchAllTasks(userId=10))
+        _result(cachingDB.asUserFetchAllTasks(userId=11))
+        assert first is second
+        assert self.db.calls == [
+            ('asUserFetchAllTasks', 10),
+            ('asUserFetchAllTasks', 11),
+        ]
+
+    def test_iterating_uses_cached_task_list(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchAllTasks(userId=10))
+        fromCache = _collect(cachingDB.asUserIterAllTasks(userId=10))
+        assert [task.id for task in fromCache] == [1, 2]
+        assert self.db.calls == [('asUserFetchAllTasks', 10)]
+
+    def test_iterating_to_the_end_caches_the_task_list(self):
+        cachingDB = self.makeCachingDatabase()
+        streamed = _collect(cachingDB.asUserIterAllTasks(userId=10))
+        fromCache = _collect(cachingDB.asUserIterAllTasks(userId=10))
+        assert streamed == fromCache
+        assert _result(cachingDB.asUserFetchAllTasks(userId=10)) == streamed
+        assert self.db.calls == [('asUserIterAllTasks', 10)]
+
+    def test_partial_or_oversized_iterations_are_not_cached(self):
+        cachingDB = self.makeCachingDatabase()
+
+        async def firstTask():
+            async for task in cachingDB.asUserIterAllTasks(userId=10):
+                return task
+        assert _result(firstTask()).id == 1
+        assert ('tasks', 10) not in cachingDB.cache
+
+        cachingDB = CachingChoreTrackerDatabase(
+            self.db, maxEntries=100, maxBytes=1000, ttl=60)
+        _result(cachingDB.handleChange(changes.RESYNC))
+        assert len(_collect(cachingDB.asUserIterAllTasks(userId=10))) == 2
+        assert ('tasks', 10) not in cachingDB.cache
+
+    def test_create_evicts_lists_of_task_group_members(self):
+        cachingDB = self.makeCachingDatabase()
+        for userId in (10, 11, 12):
+            _result(cachingDB.asUserFetchAllTasks(userId=userId))
+        _result(cachingDB.asUserCreateTask(
+            userId=10, taskToCreate=_makeTask(None, taskGroupId=1)))
+        assert ('tasks', 10) not in cachingDB.cache
+        assert ('tasks', 11) not in cachingDB.cache
+        # Not a member of task group 1.
+        assert ('tasks', 12) in cachingDB.cache
+
+    def test_update_evicts_task_and_lists_containing_it(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        _result(cachingDB.asUserFetchTask(userId=11, taskId=1))
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=2))
+        _result(cachingDB.asUserFetchAllTasks(userId=11))
+        _result(cachingDB.asUserUpdateTask(
+            userId=10, taskId=1, taskToUpdate=_makeTask(1, taskGroupId=1)))
+        assert ('task', 10, 1) not in cachingDB.cache
+        assert ('task', 11, 1) not in cachingDB.cache
+        assert ('tasks', 11) not in cachingDB.cache
+        assert ('task', 10, 2) in cachingDB.cache
+
+    def test_delete_evicts_task(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=2))
+        _result(cachingDB.asUserFetchAllTasks(userId=10))
+        _result(cachingDB.asUserDeleteTask(userId=10, taskId=2))
+        assert len(cachingDB.cache) == 0
+        assert cachingDB._keysByTaskId == {}
+
+    def test_batch_evicts_like_single_writes(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=2))
+        _result(cachingDB.asUserFetchAllTasks(userId=11))
+        _result(cachingDB.asUserApplyTaskBatch(userId=10, operations=[
+            models.TaskBatchOperation(
+                operation='create', task=_makeTask(None, taskGroupId=1)),
+            models.TaskBatchOperation(operation='delete', task_id=2),
+        ]))
+        assert ('tasks', 11) not in cachingDB.cache
+        assert ('task', 10, 2) not in cachingDB.cache
+        assert ('task', 10, 1) in cachingDB.cache
+
+    def test_read_in_flight_during_write_is_not_stored(self):
+        cachingDB = self.makeCachingDatabase()
+        pending = defer.Deferred()
+
+        async def slowFetchAllTasks(*, userId):
+            return await pending
+        self.db.asUserFetchAllTasks = slowFetchAllTasks
+
+        read = defer.ensureDeferred(cachingDB.asUserFetchAllTasks(userId=10))
+        _result(cachingDB.asUserDeleteTask(userId=10, taskId=2))
+        pending.callback([_makeTask(1), _makeTask(2)])
+        assert read.called
+        assert ('tasks', 10) not in cachingDB.cache
+
+    def test_other_methods_pass_through(self):
+        cachingDB = self.makeCachingDatabase()
+        assert _result(cachingDB.fetchTaskGroupMemberIds(taskGroupId=2)) \
+            == [10]
+
+    def test_handles_changes_from_other_processes(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        _result(cachingDB.asUserFetchAllTasks(userId=11))
+        _result(cachingDB.asUserFetchAllTasks(userId=10))
+        _result(cachingDB.handleChange(changes.ChangeEvent(
+            table='task', operation='INSERT', rowId=3, taskGroupIds=(2,))))
+        assert ('tasks', 10) not in cachingDB.cache
+        assert ('tasks', 11) in cachingDB.cache
+
+        _result(cachingDB.handleChange(changes.ChangeEvent(
+            table='task', operation='UPDATE', rowId=1, taskGroupIds=(1,))))
+        assert len(cachingDB.cache) == 0
+
+    def test_membership_change_evicts_all_of_the_users_entries(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchTask(userId=11, taskId=1))
+        _result(cachingDB.asUserFetchAllTasks(userId=11))
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        # User 11 is removed from task group 1.
+        _result(cachingDB.handleChange(changes.ChangeEvent(
+            table='users_m2m_task_groups', operation='DELETE', rowId=11,
+            taskGroupIds=(1,))))
+        assert ('task', 11, 1) not in cachingDB.cache
+        assert ('tasks', 11) not in cachingDB.cache
+        assert ('task', 10, 1) in cachingDB.cache
+        assert set(cachingDB._keysByUserId) == {10}
+
+    def test_resync_clears_everything(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        _result(cachingDB.handleChange(changes.RESYNC))
+        assert len(cachingDB.cache) == 0
+
+    def test_bypassed_until_the_listener_connects(self):
+        self.db = FakeDatabase([_makeTask(1)], {1: [10]})
+        cachingDB = CachingChoreTrackerDatabase(
+            self.db, maxEntries=100, maxBytes=10 ** 6, ttl=60)
+        assert not cachingDB.live
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        _collect(cachingDB.asUserIterAllTasks(userId=10))
+        assert len(cachingDB.cache) == 0
+        _result(cachingDB.handleChange(changes.RESYNC))
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        assert ('task', 10, 1) in cachingDB.cache
+
+    def test_bypassed_while_the_listener_is_disconnected(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        _result(cachingDB.asUserFetchAllTasks(userId=10))
+        _result(cachingDB.handleChange(changes.DISCONNECTED))
+        assert len(cachingDB.cache) == 0
+        # Changes made now are never heard of, so nothing read now may
+        # be cached, and every read goes to the database.
+        self.db.tasks[1] = attr.evolve(self.db.tasks[1], name='renamed')
+        for i in range(2):
+            task = _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+            assert task.name == 'renamed'
+            assert _result(cachingDB.asUserFetchAllTasks(userId=10))[0] \
+                is self.db.tasks[1]
+            _collect(cachingDB.asUserIterAllTasks(userId=10))
+        assert len(cachingDB.cache) == 0
+        assert self.db.calls[-6:] == [
+            ('asUserFetchTask', 10, 1),
+            ('asUserFetchAllTasks', 10),
+            ('asUserIterAllTasks', 10),
+        ] * 2
+
+        _result(cachingDB.handleChange(changes.RESYNC))
+        _result(cachingDB.asUserFetchTask(userId=10, taskId=1))
+        assert ('task', 10, 1) in cachingDB.cache
+
+    def test_read_in_flight_when_disconnected_is_not_stored(self):
+        cachingDB = self.makeCachingDatabase()
+        pending = defer.Deferred()
+
+        async def slowFetchTask(*, userId, taskId):
+            return await pending
+        self.db.asUserFetchTask = slowFetchTask
+
+        read = defer.ensureDeferred(
+            cachingDB.asUserFetchTask(userId=10, taskId=1))
+        _result(cachingDB.handleChange(changes.DISCONNECTED))
+        _result(cachingDB.handleChange(changes.RESYNC))
+        pending.callback(_makeTask(1))
+        assert read.called
+        assert len(cachingDB.cache) == 0
+
+    def test_membership_revoked_while_disconnected_is_not_served(self):
+        cachingDB = self.makeCachingDatabase()
+        _result(cachingDB.asUserFetchTask(userId=11, taskId=1))
+        _result(cachingDB.asUserFetchAllTasks(userId=11))
+        _result(cachingDB.handleChange(changes.DISCONNECTED))
+        # User 11 is removed from task group 1, but the notification
+        # is lost.
+        self.db.membersByTaskGroup[1] = [10]
+        for i in range(2):
+            failure = _result(cachingDB.asUserFetchTask(userId=11, taskId=1))
+            assert failure.check(exceptions.UserNotInTaskGroup)
+            assert _result(cachingDB.asUserFetchAllTasks(userId=11)) == []
+            assert _collect(cachingDB.asUserIterAllTasks(userId=11)) == []
+            # The listener reconnects.
+            _result(cachingDB.handleChange(changes.RESYNC))
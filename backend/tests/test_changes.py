@@ -0,0 +1,133 @@
+import json
+
+from twisted.internet import task
+
+from txchoretracker import changes
+
+
+class FakeNotify:
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class FakeConnection:
+    def __init__(self):
+        self.notifies = []
+        self.closed = False
+
+    def poll(self):
+        pass
+
+    def fileno(self):
+        return 42
+
+    def close(self):
+        self.closed = True
+
+
+class FakeReactor(task.Clock):
+    def __init__(self):
+        super().__init__()
+        self.readers = set()
+
+    def addReader(self, reader):
+        self.readers.add(reader)
+
+    def removeReader(self, reader):
+        self.readers.discard(reader)
+
+
+def _payload(**structure):
+    return json.dumps(structure)
+
+
+class TestParseNotifyPayload:
+    def test_task_change(self):
+        event = changes.parseNotifyPayload(_payload(
+            table='task', op='UPDATE', id=5, taskGroupIds=[1, 2]))
+        assert event == changes.ChangeEvent(
+            table='task', operation='UPDATE', rowId=5, taskGroupIds=(1, 2))
+
+    def test_null_task_group_ids(self):
+        event = changes.parseNotifyPayload(_payload(
+            table='user_profile', op='INSERT', id=3, taskGroupIds=None))
+        assert event.taskGroupIds == ()
+
+
+class TestChangeListener:
+    def makeConnectedListener(self):
+        self.reactor = FakeReactor()
+        listener = changes.ChangeListener('postgres:///x', reactor=self.reactor)
+        self.connection = FakeConnection()
+        listener._connection = self.connection
+        self.reactor.addReader(listener)
+        return listener
+
+    def test_delivers_notifications_to_subscribers(self):
+        listener = self.makeConnectedListener()
+        received = []
+        listener.subscribe(received.append)
+        self.connection.notifies.append(FakeNotify(_payload(
+            table='task', op='DELETE', id=7, taskGroupIds=[3])))
+        listener.doRead()
+        assert received == [changes.ChangeEvent(
+            table='task', operation='DELETE', rowId=7, taskGroupIds=(3,))]
+        assert self.connection.notifies == []
+
+    def test_ignores_malformed_payloads(self):
+        listener = self.makeConnectedListener()
+        received = []
+        listener.subscribe(received.append)
+        self.connection.notifies.extend([
+            FakeNotify('not json'),
+            FakeNotify(_payload(table='task', op='INSERT', id=1)),
+        ])
+        listener.doRead()
+        assert [event.rowId for event in received] == [1]
+
+    def test_unsubscribe(self):
+        listener = self.makeConnectedListener()
+        received = []
+        unsubscribe = listener.subscribe(received.append)
+        unsubscribe()
+        self.connection.notifies.append(FakeNotify(_payload(
+            table='task', op='INSERT', id=1)))
+        listener.doRead()
+        assert received == []
+
+    def test_subscriber_failure_does_not_stop_delivery(self):
+        listener = self.makeConnectedListener()
+        received = []
+
+        def broken(event):
+            raise RuntimeError('oops')
+        listener.subscribe(broken)
+        listener.subscribe(received.append)
+        self.connection.notifies.append(FakeNotify(_payload(
+            table='task', op='INSERT', id=1)))
+        listener.doRead()
+        assert len(received) == 1
+
+    def test_reconnects_after_connection_lost(self):
+        listener = self.makeConnectedListener()
+        listener._stopped = False
+        connectAttempts = []
+        listener._connect = lambda: connectAttempts.append(True)
+        listener.connectionLost(Exception('gone'))
+        assert self.connection.closed
+        assert listener not in self.reactor.readers
+        self.reactor.advance(listener.initialRetryDelay)
+        assert connectAttempts == [True]
+
+    def test_disconnect_is_delivered(self):
+        listener = self.makeConnectedListener()
+        received = []
+        listener.subscribe(received.append)
+        listener.connectionLost(Exception('gone'))
+        assert received == [changes.DISCONNECTED]
+
+    def test_no_reconnect_after_stop(self):
+        listener = self.makeConnectedListener()
+        listener.stop()
+        assert self.connection.closed
+        assert self.reactor.getDelayedCalls() == []
@@ -0,0 +1,62 @@
+import zlib
+
+import pytest
+
+from txchoretracker import compression
+
+
+class TestNegotiate:
+    def makePolicy(self, encodings=('gzip', 'br')):
+        return compression.CompressionPolicy(encodings=encodings)
+
+    @pytest.mark.parametrize('header, expected', [
+        (None, None),
+        (b'', None),
+        (b'identity', None),
+        (b'gzip', 'gzip'),
+        (b'gzip, deflate, br', 'gzip'),
+        (b'br;q=1.0, gzip;q=0.8', 'br'),
+        (b'gzip;q=0, br', 'br'),
+        (b'GZIP', 'gzip'),
+        (b'x-gzip', 'gzip'),
+        (b'*', 'gzip'),
+        (b'*;q=0.5, gzip;q=0', 'br'),
+        (b'gzip;q=oops', None),
+    ])
+    def test_negotiate(self, header, expected):
+        assert self.makePolicy().negotiate(header) == expected
+
+    def test_never_compresses_without_encodings(self):
+        assert self.makePolicy(()).negotiate(b'gzip') is None
+
+
+class TestCompressors:
+    def test_gzip_chunks_decompress_to_input(self):
+        compressor = compression.CompressionPolicy(
+            gzipLevel=1).makeCompressor('gzip')
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        output = b''
+        for chunk in (b'{"a": ', b'"' + b'x' * 5000 + b'"', b'}'):
+            output += decompressor.decompress(
+                compressor.compress(chunk) + compressor.flush())
+        output += decompressor.decompress(compressor.finish())
+        assert output == b'{"a": "' + b'x' * 5000 + b'"}'
+        assert decompressor.eof
+
+
+class TestMakeCompressionPolicy:
+    def test_unknown_encoding(self):
+        with pytest.raises(ValueError):
+            compression.makeCompressionPolicy(['deflate'])
+
+    def test_missing_package(self, monkeypatch):
+        monkeypatch.setattr(compression, 'brotli', None)
+        with pytest.raises(RuntimeError):
+            compression.makeCompressionPolicy(['br'])
+
+    def test_passes_settings(self):
+        policy = compression.makeCompressionPolicy(
+            ['gzip'], minSize=10, gzipLevel=9)
+        assert policy.encodings == ('gzip',)
+        assert policy.minSize == 10
+        assert policy.gzipLevel == 9
@@ -0,0 +1,186 @@
+import attr
+from twisted.internet import defer
+
+from txchoretracker import db
+from txchoretracker import exceptions
+from txchoretracker import models
+
+
+def _result(coroutine):
+    return defer.ensureDeferred(coroutine).result
+
+
+TASK_COLUMNS = [
+    'id', 'task_group_id', 'name', 'description',
+    'due_unix', 'created_unix', 'modified_unix',
+]
+
+
+class TestModelRowFactory:
+    def test_builds_model_from_row_tuple(self):
+        makeTask = db._modelRowFactory(models.Task)(TASK_COLUMNS)
+        task = makeTask((1, 2, 'name', 'description', 30, 10, 20))
+        assert task == models.Task(
+            id=1,
+            task_group_id=2,
+            name='name',
+            description='description',
+            due_unix=30,
+            created_unix=10,
+            modified_unix=20,
+        )
+
+    def test_follows_column_order(self):
+        columns = list(reversed(TASK_COLUMNS))
+        makeTask = db._modelRowFactory(models.Task)(columns)
+        task = makeTask((20, 10, 30, 'description', 'name', 2, 1))
+        assert (task.id, task.name, task.modified_unix) == (1, 'name', 20)
+
+    def test_reuses_maker_for_same_columns(self):
+        rowFactory = db._modelRowFactory(models.UserProfile)
+        columns = ['user_id', 'email', 'display_name', 'email_verified']
+        assert rowFactory(columns) is rowFactory(tuple(columns))
+
+
+class FakeBackend:
+    def __init__(self, columnNames, rows):
+        self.columnNames = columnNames
+        self.rows = rows
+        self.calls = []
+
+    def runPreparedQuery(self, statementName, params, rowFactory=None):
+        self.calls.append((statementName, params))
+        makeRow = rowFactory(self.columnNames)
+        return defer.succeed([makeRow(row) for row in self.rows])
+
+
+class FakePagingBackend:
+    """
+    Serves asuser_fetch_tasks_page from task rows in (due, id) order.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.params = []
+
+    def runPreparedQuery(self, statementName, params, rowFactory=None):
+        self.params.append(params)
+        userId, afterDue, afterId, limit, taskGroupId = params[:5]
+        makeRow = rowFactory(TASK_COLUMNS)
+        rows = [
+            row for row in self.rows
+            if (afterDue is None or (row[4], row[0]) > (afterDue, afterId))
+            and taskGroupId in (None, row[1])
+        ]
+        return defer.succeed([makeRow(row) for row in rows[:limit]])
+
+
+class TestIterTasks:
+    def test_iterates_in_batches(self):
+        backend = FakePagingBackend([
+            (taskId, 1 + taskId % 2, 'name', '', taskId // 2, 0, 0)
+            for taskId in range(1, 6)])
+        database = db.ChoreTrackerDatabase(backend)
+
+        async def collect(tasks):
+            return [task.id async for task in tasks]
+        assert _result(collect(database.asUserIterAllTasks(
+            userId=1, batchSize=2))) == [1, 2, 3, 4, 5]
+        assert [params[1:4] for params in backend.params] == [
+            (None, None, 2), (1, 2, 2), (2, 4, 2)]
+
+        taskListQuery = models.TaskListQuery(task_group_id=2)
+        assert _result(collect(database.asUserIterTasks(
+            userId=1, taskListQuery=taskListQuery, batchSize=2))) == [1, 3, 5]
+
+
+class TestApplyTaskBatch:
+    def test_maps_rows_to_results(self):
+        backend = FakeBackend(
+            ['item_index', 'error'] + TASK_COLUMNS,
+            [
+                (0, None, 7, 2, 'name', 'description', 30, 10, 10),
+                (1, 'NO_SUCH_TASK') + (None,) * 7,
+                (2, None, 6) + (None,) * 6,
+            ],
+        )
+        task = models.Task(
+            task_group_id=2, name='name', description='description',
+            due_unix=30)
+        operations = [
+            models.TaskBatchOperation(operation='create', task=task),
+            models.TaskBatchOperation(
+                operation='update', task_id=5, task=task),
+            models.TaskBatchOperation(operation='delete', task_id=6),
+        ]
+        database = db.ChoreTrackerDatabase(backend)
+        results = _result(database.asUserApplyTaskBatch(
+            userId=1, operations=operations))
+
+        [(statementName, (userId, batch))] = backend.calls
+        assert statementName == 'asuser_apply_task_batch'
+        assert [item['op'] for item in batch.adapted] == [
+            'create', 'update', 'delete']
+        assert batch.adapted[1]['task_id'] == 5
+        assert results[0] == models.TaskBatchResult(
+            task_id=7,
+            task=attr.evolve(task, id=7, created_unix=10, modified_unix=10))
+        assert isinstance(results[1].error, exceptions.NoSuchTask)
+        assert results[2] == models.TaskBatchResult(task_id=6)
+
+
+class TestFetchTaskChanges:
+    def _fetch(self, rows, since):
+        backend = FakeBackend(['change_kind'] + TASK_COLUMNS, rows)
+        database = db.ChoreTrackerDatabase(backend)
+        changes = _result(database.asUserFetchTaskChanges(
+            userId=1, since=since))
+        return backend.calls, changes
+
+    def test_maps_rows_to_changes(self):
+        calls, changes = self._fetch(
+            [
+                ('cursor', 900) + (None,) * 6,
+                ('task', 7, 2, 'name', 'description', 30, 10, 20),
+                ('deleted', 8) + (None,) * 6,
+            ],
+            since=models.SyncCursor(txid=800),
+        )
+        assert calls == [('asuser_fetch_task_changes', (1, 800))]
+        assert changes == models.TaskChanges(
+            cursor=models.SyncCursor(txid=900),
+            reset=False,
+            tasks=[models.Task(
+                id=7, task_group_id=2, name='name',
+                description='description', due_unix=30,
+                created_unix=10, modified_unix=20)],
+            deleted_task_ids=[8],
+        )
+
+    def test_reset(self):
+        calls, changes = self._fetch(
+            [
+                ('cursor', 900) + (None,) * 6,
+                ('reset',) + (None,) * 7,
+                ('task', 7, 2, 'name', 'description', 30, 10, 20),
+            ],
+            since=None,
+        )
+        assert calls == [('asuser_fetch_task_changes', (1, None))]
+        assert changes.reset
+        assert [task.id for task in changes.tasks] == [7]
+        assert changes.deleted_task_ids == []
+
+
+class TestCallMetrics:
+    def test_times_calls_and_counts_errors(self):
+        class FailingBackend:
+            def runPreparedQuery(self, statementName, params, rowFactory=None):
+                return defer.fail(RuntimeError('gone'))
+
+        latency = db._callSeconds.labels('prune_task_changes')
+        errors = db._callErrors.labels('prune_task_changes')
+        before = (latency.count, errors.value)
+        dbWrapper = db.ChoreTrackerDatabase(FailingBackend())
+        dfd = defer.ensureDeferred(dbWrapper.pruneTaskChanges(keepSeconds=1))
+        dfd.addErrback(lambda failure: failure.trap(RuntimeError))
+        assert (latency.count, errors.value) == (before[0] + 1, before[1] + 1)
@@ -0,0 +1,392 @@
+import threading
+
+import psycopg2
+import pytest
+from twisted.internet import defer
+from twisted.internet import task
+
+from txchoretracker import db
+from txchoretracker import dbbackends
+from txchoretracker import tracing
+from txchoretracker.config import DatabaseConfig
+from txchoretracker.dbbackends import AdaptivePoolSizer
+from txchoretracker.dbbackends import AdbapiConnectionBackend
+from txchoretracker.dbbackends import InstrumentedConnectionPool
+from txchoretracker.dbbackends import TxPostgresConnectionBackend
+from txchoretracker.metrics import Histogram
+from txchoretracker.preparedstatements import PreparedStatementRegistry
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestInstrumentedConnectionPool:
+    def makePool(self, **kwargs):
+        self.clock = FakeClock()
+        return InstrumentedConnectionPool(
+            'sqlite3', ':memory:', check_same_thread=False,
+            cp_min=1, cp_max=2, cp_clock=self.clock, **kwargs)
+
+    def test_counts_waits_and_use(self):
+        pool = self.makePool()
+
+        def interaction(txn):
+            assert pool.stats()['inUse'] == 1
+            self.clock.now += 0.5
+            txn.execute('SELECT 1')
+            return txn.fetchall()
+
+        pool.waiters += 1
+        self.clock.now = 0.02
+        assert pool._runTimedInteraction(0.0, None, interaction) == [(1,)]
+        stats = pool.stats()
+        assert (stats['waiters'], stats['inUse']) == (0, 0)
+        assert stats['waitTime']['count'] == 1
+        assert pool.waitTimes.quantile(1.0) == 0.025
+        assert pool.useTimes.quantile(1.0) == 0.5
+        assert pool.takePeakInUse() == 1
+        assert pool.takePeakInUse() == 0
+
+    def test_records_spans_for_traced_queries(self):
+        pool = self.makePool()
+        root = tracing.Tracer(tracing.InMemorySpanExporter()).startTrace(
+            'root')
+        self.clock.now = 2.0
+
+        def interaction(txn):
+            self.clock.now = 5.0
+        pool.waiters += 1
+        pool._runTimedInteraction(1.0, root, interaction)
+        assert [(span.name, span.start, span.end)
+                for span in root.trace.spans[1:]] == [
+            ('db.pool_wait', 1.0, 2.0), ('db.query', 2.0, 5.0)]
+
+    def test_idle_connections_are_checked(self):
+        pool = self.makePool(cp_check_after=60)
+        conn = pool.connect()
+        self.clock.now = 30
+        assert pool.connect() is conn
+        # Broken while idle.
+        conn.close()
+        self.clock.now = 100
+        newConn = pool.connect()
+        assert newConn is not conn
+        assert newConn.execute('SELECT 1').fetchall() == [(1,)]
+        assert pool.stats()['checksFailed'] == 1
+
+    def test_pool_threads_close_their_connections(self):
+        pool = self.makePool()
+        thread = pool.threadpool.threadFactory(target=pool.connect)
+        thread.start()
+        thread.join()
+        assert pool.connections == {}
+        assert isinstance(thread, threading.Thread)
+
+
+class FakePool:
+    def __init__(self, size):
+        self.size = size
+        self.waiters = 0
+        self.peakInUse = 0
+        self.waitTimes = Histogram([0.01, 0.1])
+
+    def resize(self, size):
+        self.size = size
+
+    def takePeakInUse(self):
+        return self.peakInUse
+
+
+class TestAdaptivePoolSizer:
+    def makeSizer(self, pool):
+        self.clock = task.Clock()
+        sizer = AdaptivePoolSizer(
+            pool, minSize=2, maxSize=10, targetWait=0.01, interval=5,
+            reactor=self.clock)
+        sizer.start()
+        return sizer
+
+    def test_grows_while_queries_wait(self):
+        pool = FakePool(4)
+        self.makeSizer(pool)
+        assert pool.size == 2
+        pool.peakInUse = 2
+        for _ in range(10):
+            pool.waitTimes.observe(0.05)
+        self.clock.advance(5)
+        assert pool.size == 3
+        for _ in range(10):
+            pool.waitTimes.observe(0.05)
+        self.clock.advance(5)
+        assert pool.size == 4
+        # Queries stuck behind slow ones.
+        pool.waiters, pool.peakInUse = 3, 4
+        self.clock.advance(5)
+        assert pool.size == 6
+
+    def test_shrinks_while_connections_go_unused(self):
+        pool = FakePool(2)
+        sizer = self.makeSizer(pool)
+        pool.size = 5
+        pool.peakInUse = 5
+        self.clock.advance(5)
+        assert pool.size == 5
+        pool.peakInUse = 1
+        self.clock.pump([5, 5, 5])
+        assert pool.size == 2
+        self.clock.advance(5)
+        assert pool.size == 2
+        assert (sizer.grown, sizer.shrunk) == (0, 3)
+        sizer.stop()
+        assert self.clock.getDelayedCalls() == []
+
+
+class FakeRawConnection:
+    closed = 0
+
+
+class FakeTxPostgresConnection:
+    """
+    Stands in for :class:`txpostgres.txpostgres.Connection`, recording
+    the queries run on it.
+    """
+    def __init__(self):
+        self.queries = []
+        self._rawConnection = None
+
+    def connect(self, dsn, **kwargs):
+        self._rawConnection = FakeRawConnection()
+        return defer.succeed(self)
+
+    def pollable(self):
+        return self._rawConnection
+
+    def runQuery(self, sql, params=None):
+        if self._rawConnection.closed:
+            return defer.fail(psycopg2.OperationalError('connection lost'))
+        self.queries.append(sql)
+        return defer.succeed([('row',)])
+
+    def runOperation(self, sql, params=None):
+        self.queries.append(sql)
+        return defer.succeed(None)
+
+    def close(self):
+        self._rawConnection.closed = 1
+
+
+class FakeTxPostgresModule:
+    Connection = FakeTxPostgresConnection
+
+
+def _result(dfd):
+    results = []
+    dfd.addBoth(results.append)
+    [result] = results
+    return result
+
+
+class TestTxPostgresConnectionBackend:
+    def makeBackend(self, minSize, maxSize):
+        self.connections = []
+
+        def connectionFactory():
+            connection = FakeTxPostgresConnection()
+            self.connections.append(connection)
+            return connection
+
+        backend = TxPostgresConnectionBackend(
+            'dbname=test',
+            PreparedStatementRegistry(db.API_STATEMENTS),
+            minSize=minSize,
+            maxSize=maxSize,
+            connectionFactory=connectionFactory,
+        )
+        _result(backend.start())
+        return backend
+
+    def test_opens_connections_as_needed_up_to_the_pool_size(self):
+        backend = self.makeBackend(minSize=1, maxSize=2)
+        assert len(self.connections) == 1
+        blockers = [defer.Deferred() for _ in range(3)]
+
+        def query(connection, blocker):
+            return blocker
+        results = [backend._withConnection(query, blocker)
+                   for blocker in blockers]
+        assert backend.stats() == {
+            'size': 2, 'connections': 2, 'waiters': 1, 'inUse': 2,
+            'reconnects': 0}
+        for blocker in blockers:
+            blocker.callback(None)
+        assert [_result(result) for result in results] == [None] * 3
+        assert len(self.connections) == 2
+        assert backend.stats()['inUse'] == 0
+
+    def test_runs_queries(self):
+        backend = self.makeBackend(minSize=1, maxSize=1)
+        [connection] = self.connections
+        assert _result(backend.runQuery('SELECT 1')) == [('row',)]
+        assert _result(backend.runOperation('SET x = 1')) is None
+        assert connection.queries == ['SELECT 1', 'SET x = 1']
+        backend.close()
+        assert connection.pollable().closed
+
+    def test_prepared_statements_survive_reconnects(self):
+        backend = self.makeBackend(minSize=1, maxSize=1)
+        [first] = self.connections
+
+        def fetchTask():
+            return _result(backend.runPreparedQuery(
+                'asuser_fetch_task', (1, 2)))
+
+        assert fetchTask() == [('row',)]
+        assert fetchTask() == [('row',)]
+        assert first.queries[0].startswith('DEALLOCATE ALL; PREPARE ')
+        assert first.queries[1].startswith('EXECUTE asuser_fetch_task')
+
+        # The server goes away.
+        first.pollable().closed = 2
+        assert fetchTask().check(psycopg2.OperationalError)
+        assert backend.stats()['reconnects'] == 1
+
+        assert fetchTask() == [('row',)]
+        assert fetchTask() == [('row',)]
+        [first, second] = self.connections
+        assert second.queries[0].startswith('DEALLOCATE ALL; PREPARE ')
+        assert second.queries[1].startswith('EXECUTE asuser_fetch_task')
+        assert backend.stats()['connections'] == 1
+        # The failed query was a hit too.
+        assert backend.statements.stats()['hits'] == 3
+        assert backend.statements.stats()['misses'] == 2
+
+
+class FakeCursor:
+    description = [('id',), ('name',)]
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql, params=None):
+        self.connection.queries.append((sql, params))
+
+    def fetchall(self):
+        return [(1, 'one')]
+
+    def close(self):
+        pass
+
+
+class FakePsycopgConnection:
+    def __init__(self):
+        self.queries = []
+        self.commits = 0
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeDBAPI:
+    Error = psycopg2.Error
+
+    def __init__(self):
+        self.connections = []
+
+    def connect(self, *args, **kwargs):
+        connection = FakePsycopgConnection()
+        self.connections.append(connection)
+        return connection
+
+
+def _makeRowDict(columns):
+    return lambda row: dict(zip(columns, row))
+
+
+def _runInThisThread(reactor, threadpool, func, *args, **kwargs):
+    return defer.maybeDeferred(func, *args, **kwargs)
+
+
+class TestAdbapiConnectionBackend:
+    def test_runs_queries_and_prepared_queries(self, monkeypatch):
+        monkeypatch.setattr(
+            dbbackends.threads, 'deferToThreadPool', _runInThisThread)
+        backend = AdbapiConnectionBackend(
+            'dbname=test', PreparedStatementRegistry(db.API_STATEMENTS),
+            minSize=1, maxSize=1)
+        backend._pool.dbapi = dbapi = FakeDBAPI()
+        try:
+            assert _result(backend.runQuery('SELECT 1')) == [(1, 'one')]
+            for i in range(2):
+                rows = _result(backend.runPreparedQuery(
+                    'asuser_fetch_task', (1, 2),
+                    rowFactory=_makeRowDict))
+                assert rows == [{'id': 1, 'name': 'one'}]
+        finally:
+            backend.close()
+        [connection] = dbapi.connections
+        [query, prepareAndExecute, execute] = [
+            sql for sql, params in connection.queries]
+        assert query == 'SELECT 1'
+        assert prepareAndExecute.startswith('DEALLOCATE ALL; PREPARE ')
+        assert execute == 'EXECUTE asuser_fetch_task (%s, %s)'
+        assert connection.commits == 3
+
+
+class TestMakeConnectionBackend:
+    def makeConfig(self, **kwargs):
+        return DatabaseConfig(dbname='test', pool_min=2, pool_max=4, **kwargs)
+
+    def test_adbapi_by_default(self):
+        backend = dbbackends.makeConnectionBackend(
+            self.makeConfig(), PreparedStatementRegistry([]))
+        try:
+            assert isinstance(backend, AdbapiConnectionBackend)
+            assert (backend._pool.min, backend._pool.max) == (2, 4)
+        finally:
+            backend.close()
+
+    def test_txpostgres(self, monkeypatch):
+        monkeypatch.setattr(dbbackends, 'txpostgres', FakeTxPostgresModule)
+        backend = dbbackends.makeConnectionBackend(
+            self.makeConfig(backend='txpostgres'),
+            PreparedStatementRegistry([]))
+        assert isinstance(backend, TxPostgresConnectionBackend)
+        assert backend.stats()['size'] == 4
+        _result(backend.start())
+        assert backend.stats()['connections'] == 2
+
+    def test_falls_back_to_adbapi_without_txpostgres(self, monkeypatch):
+        monkeypatch.setattr(dbbackends, 'txpostgres', None)
+        backend = dbbackends.makeConnectionBackend(
+            self.makeConfig(backend='txpostgres'),
+            PreparedStatementRegistry([]))
+        try:
+            assert isinstance(backend, AdbapiConnectionBackend)
+        finally:
+            backend.close()
+        with pytest.raises(RuntimeError):
+            TxPostgresConnectionBackend(
+                'dbname=test', PreparedStatementRegistry([]))
+
+    def test_unknown_backends_are_rejected(self):
+        with pytest.raises(ValueError):
+            self.makeConfig(backend='asyncpg')
+        dbConfig = self.makeConfig()
+        dbConfig.backend = 'asyncpg'
+        with pytest.raises(ValueError):
+            dbbackends.makeConnectionBackend(
+                dbConfig, PreparedStatementRegistry([]))
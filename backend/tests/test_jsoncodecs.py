@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from txchoretracker import jsoncodecs
+
+
+STRUCTURES = [
+    {'status': 200, 'data': [
+        {
+            'id': 1, 'taskGroup': 2, 'name': 'some name',
+            'description': 'some description', 'due': 1489626309,
+            'created': 1489453509, 'modified': None,
+        },
+    ]},
+    {'status': 400, 'error': {'message': 'bad request'}},
+    {'items': {0: {'task': {'name': ['Missing data for required field.']}}}},
+    ['ünïcödé ☃ 😀', 'tab\tnew\nline', '\x00\x1f\x7f', '"quoted" \\ / </'],
+    [True, False, None, -1, 2 ** 70, [], {}],
+    [0.5, -0.0, 1e-07, 1e+20, 1e300, 5e-324, 123456789.123456789],
+    ['1e-7 in a string', 2.5e-05, {'e-5': 1e-5}],
+    [float('nan'), float('inf')],
+]
+
+
+def _codecNames():
+    names = ['stdlib', 'auto']
+    if jsoncodecs.ujson is not None:
+        names.append('ujson')
+    if jsoncodecs.orjson is not None:
+        names.append('orjson')
+    return names
+
+
+@pytest.mark.parametrize('name', _codecNames())
+class TestCodecs:
+    @pytest.mark.parametrize('structure', STRUCTURES)
+    def test_encodes_like_stdlib_ascii(self, name, structure):
+        codec = jsoncodecs.makeJSONCodec(name)
+        expected = json.dumps(structure, ensure_ascii=True).encode('ascii')
+        assert codec.encode(structure) == expected
+
+    @pytest.mark.parametrize('structure', STRUCTURES[:5])
+    def test_decodes_what_it_encodes(self, name, structure):
+        codec = jsoncodecs.makeJSONCodec(name)
+        data = codec.encode(structure)
+        assert codec.decode(data) == json.loads(data)
+
+    def test_decode_raises_value_error(self, name):
+        codec = jsoncodecs.makeJSONCodec(name)
+        with pytest.raises(ValueError):
+            codec.decode(b'{"unterminated": ')
+
+    def test_encode_raises_type_error(self, name):
+        codec = jsoncodecs.makeJSONCodec(name)
+        with pytest.raises(TypeError):
+            codec.encode({'not serializable': object()})
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        jsoncodecs.makeJSONCodec('simplejson')
@@ -0,0 +1,308 @@
+import io
+import json
+import zlib
+
+import pytest
+from twisted.web.test.requesthelper import DummyRequest
+
+from txchoretracker import compression
+from txchoretracker import kleinhelpers
+from txchoretracker.kleinhelpers import JSONApiRequest
+from txchoretracker.kleinhelpers import JSONResponseResource
+from txchoretracker.kleinhelpers import StreamingJSONResponseResource
+
+
+class StreamingDummyRequest(DummyRequest):
+    """
+    DummyRequest only supports pull producers.
+    """
+    producer = None
+    lostConnection = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.lostConnection = True
+
+
+async def _items(count):
+    for i in range(count):
+        yield {'id': i, 'name': 'task {0}'.format(i)}
+
+
+def _expectedBody(count):
+    return json.dumps({
+        'status': 200,
+        'data': [{'id': i, 'name': 'task {0}'.format(i)}
+                 for i in range(count)],
+    }).encode('ascii')
+
+
+def _requestWithIfNoneMatch(value):
+    request = StreamingDummyRequest([b''])
+    if value is not None:
+        request.requestHeaders.setRawHeaders(b'if-none-match', [value])
+    return request
+
+
+class TestJSONResponseResourceConditional:
+    def test_sends_etag_and_cache_control(self):
+        request = _requestWithIfNoneMatch(None)
+        JSONResponseResource(
+            {'a': 1}, etag='v1', cacheControl='private, no-cache',
+        ).render(request)
+        assert request.responseCode == 200
+        assert request.responseHeaders.getRawHeaders(b'etag') == [b'"v1"']
+        assert request.responseHeaders.getRawHeaders(b'cache-control') == [
+            b'private, no-cache']
+        assert json.loads(b''.join(request.written))['data'] == {'a': 1}
+
+    def test_matching_if_none_match_is_not_modified(self):
+        for header in (b'"v1"', b'W/"v1"', b'"v0", "v1"', b'*'):
+            request = _requestWithIfNoneMatch(header)
+            JSONResponseResource({'a': 1}, etag='v1').render(request)
+            assert request.responseCode == 304
+            assert request.written == []
+            assert request.responseHeaders.getRawHeaders(b'etag') == [
+                b'"v1"']
+            assert request.finished
+
+    def test_other_if_none_match_gets_full_response(self):
+        request = _requestWithIfNoneMatch(b'"v0"')
+        JSONResponseResource({'a': 1}, etag='v1').render(request)
+        assert request.responseCode == 200
+        assert request.written
+
+    def test_errors_are_never_not_modified(self):
+        request = _requestWithIfNoneMatch(b'*')
+        JSONResponseResource(
+            {'message': 'nope'}, status=404, etag='v1').render(request)
+        assert request.responseCode == 404
+
+    def test_make_not_modified(self):
+        request = _requestWithIfNoneMatch(None)
+        JSONResponseResource.makeNotModified('v1').render(request)
+        assert request.responseCode == 304
+        assert request.written == []
+
+
+class CountingAuthPolicy:
+    calls = 0
+
+    def getAuthenticatedUserId(self, request):
+        self.calls += 1
+        return 7
+
+
+class TestJSONApiRequest:
+    def test_authenticates_lazily_and_once(self):
+        authPolicy = CountingAuthPolicy()
+        request = JSONApiRequest(DummyRequest([b'']), authPolicy)
+        assert authPolicy.calls == 0
+        assert request.authenticatedUserId == 7
+        assert request.authenticatedUserId == 7
+        assert authPolicy.calls == 1
+
+    @pytest.mark.parametrize('contentType, body, exceptionClass', [
+        (None, b'{}', kleinhelpers.MissingContentType),
+        (b'text/plain', b'{}', kleinhelpers.NotJSONContent),
+        (b'application/json', b'{', kleinhelpers.InvalidJSONContent),
+    ])
+    def test_bad_json_content(self, contentType, body, exceptionClass):
+        txRequest = DummyRequest([b''])
+        if contentType is not None:
+            txRequest.requestHeaders.setRawHeaders(
+                b'content-type', [contentType])
+        txRequest.content = io.BytesIO(body)
+        request = JSONApiRequest(txRequest, CountingAuthPolicy())
+        with pytest.raises(exceptionClass):
+            request.getJSONContent()
+
+
+@pytest.fixture
+def gzipPolicy(monkeypatch):
+    monkeypatch.setattr(
+        kleinhelpers, '_compressionPolicy',
+        compression.CompressionPolicy(encodings=('gzip',), minSize=100))
+
+
+def _requestAcceptingGzip():
+    request = StreamingDummyRequest([b''])
+    request.requestHeaders.setRawHeaders(b'accept-encoding', [b'gzip'])
+    return request
+
+
+def _gunzip(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = b''.join(decompressor.decompress(chunk) for chunk in chunks)
+    assert decompressor.eof
+    return data
+
+
+@pytest.mark.usefixtures('gzipPolicy')
+class TestCompressedResponses:
+    def test_compresses_large_bodies(self):
+        request = _requestAcceptingGzip()
+        structure = [{'id': i} for i in range(100)]
+        JSONResponseResource(structure, etag='v1').render(request)
+        headers = request.responseHeaders
+        assert headers.getRawHeaders(b'content-encoding') == [b'gzip']
+        assert headers.getRawHeaders(b'vary') == [b'Accept-Encoding']
+        assert headers.getRawHeaders(b'etag') == [b'W/"v1"']
+        assert json.loads(_gunzip(request.written))['data'] == structure
+
+    def test_small_bodies_are_not_compressed(self):
+        request = _requestAcceptingGzip()
+        JSONResponseResource({'a': 1}, etag='v1').render(request)
+        headers = request.responseHeaders
+        assert headers.getRawHeaders(b'content-encoding') is None
+        assert headers.getRawHeaders(b'vary') == [b'Accept-Encoding']
+        assert headers.getRawHeaders(b'etag') == [b'"v1"']
+        assert json.loads(b''.join(request.written))['data'] == {'a': 1}
+
+    def test_not_compressed_unless_accepted(self):
+        request = StreamingDummyRequest([b''])
+        JSONResponseResource([{'id': i} for i in range(100)]).render(request)
+        assert request.responseHeaders.getRawHeaders(
+            b'content-encoding') is None
+
+    def test_streaming_compresses_each_chunk(self):
+        request = _requestAcceptingGzip()
+        StreamingJSONResponseResource(
+            _items(500), chunkSize=256).render(request)
+        assert request.responseHeaders.getRawHeaders(
+            b'content-encoding') == [b'gzip']
+        assert len(request.written) > 10
+        # Every chunk but the last can be decompressed as it arrives.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for chunk in request.written[:-1]:
+            assert decompressor.decompress(chunk).endswith(b'}')
+        assert _gunzip(request.written) == _expectedBody(500)
+
+    def test_streaming_small_bodies_are_not_compressed(self):
+        request = _requestAcceptingGzip()
+        StreamingJSONResponseResource(_items(1)).render(request)
+        assert request.responseHeaders.getRawHeaders(
+            b'content-encoding') is None
+        assert b''.join(request.written) == _expectedBody(1)
+
+
+class TestStreamingJSONResponseResource:
+    def test_matches_non_streaming_body(self):
+        for count in (0, 1, 2, 500):
+            request = StreamingDummyRequest([b''])
+            StreamingJSONResponseResource(
+                _items(count), chunkSize=256).render(request)
+            assert b''.join(request.written) == _expectedBody(count)
+            assert request.finished
+            assert request.producer is None
+            assert request.responseCode == 200
+
+    def test_writes_in_chunks(self):
+        request = StreamingDummyRequest([b''])
+        StreamingJSONResponseResource(
+            _items(500), chunkSize=256).render(request)
+        assert len(request.written) > 10
+        assert all(len(chunk) < 512 for chunk in request.written)
+
+    def test_serializes_items(self):
+        async def numbers():
+            yield 1
+            yield 2
+        request = StreamingDummyRequest([b''])
+        StreamingJSONResponseResource(
+            numbers(), serializeItem=lambda n: {'n': n}).render(request)
+        assert json.loads(b''.join(request.written)) == {
+            'status': 200, 'data': [{'n': 1}, {'n': 2}]}
+
+    def test_waits_while_paused(self):
+        request = StreamingDummyRequest([b''])
+        resource = StreamingJSONResponseResource(_items(500), chunkSize=256)
+        resource.pauseProducing()
+        resource.render(request)
+        assert len(request.written) == 1
+        assert not request.finished
+
+        resource.resumeProducing()
+        assert b''.join(request.written) == _expectedBody(500)
+        assert request.finished
+
+    def test_stops_when_client_goes_away(self):
+        closed = []
+
+        async def items():
+            try:
+                for i in range(500):
+                    yield {'id': i}
+            finally:
+                closed.append(True)
+
+        request = StreamingDummyRequest([b''])
+        resource = StreamingJSONResponseResource(items(), chunkSize=256)
+        resource.pauseProducing()
+        resource.render(request)
+        request.processingFailed(Exception('connection lost'))
+        assert not request.finished
+        assert closed == [True]
+
+    def test_matching_if_none_match_skips_the_items(self):
+        iterated = []
+
+        async def items():
+            iterated.append(True)
+            yield 1
+        request = _requestWithIfNoneMatch(b'"v1"')
+        StreamingJSONResponseResource(items(), etag='v1').render(request)
+        assert request.responseCode == 304
+        assert request.written == []
+        assert iterated == []
+
+    def test_failure_before_first_item_is_a_500(self):
+        async def items():
+            raise RuntimeError('database is down')
+            yield
+
+        request = StreamingDummyRequest([b''])
+        StreamingJSONResponseResource(items()).render(request)
+        assert request.responseCode == 500
+        assert json.loads(b''.join(request.written))['status'] == 500
+        assert request.finished
+
+    def test_failure_mid_stream_drops_the_connection(self):
+        async def items():
+            for i in range(500):
+                yield {'id': i}
+            raise RuntimeError('database went away')
+
+        request = StreamingDummyRequest([b''])
+        StreamingJSONResponseResource(items(), chunkSize=256).render(request)
+        assert request.lostConnection
+        assert not request.finished
+
+
+class CodeDummyRequest(DummyRequest):
+    # twisted.web.server.Request keeps the response code here.
+    @property
+    def code(self):
+        return self.responseCode
+
+
+class TestResponseMetrics:
+    def test_records_duration_and_status(self):
+        samples = kleinhelpers._responses.labels(
+            'Endpoint.handler', 'GET', '404')
+        before = samples.value
+        latency = kleinhelpers._requestSeconds.labels(
+            'Endpoint.handler', 'GET')
+        latencyCount = latency.count
+        txRequest = CodeDummyRequest([b''])
+        kleinhelpers._recordResponse(txRequest, 'Endpoint.handler')
+        txRequest.setResponseCode(404)
+        assert samples.value == before
+        txRequest.finish()
+        assert samples.value == before + 1
+        assert latency.count == latencyCount + 1
@@ -0,0 +1,72 @@
+import pytest
+
+from txchoretracker.metrics import Gauge
+from txchoretracker.metrics import Histogram
+from txchoretracker.metrics import MetricsRegistry
+
+
+class TestHistogram:
+    def test_observe_and_snapshot(self):
+        histogram = Histogram([1.0, 0.1])
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+        assert histogram.snapshot() == {
+            'buckets': [(0.1, 2), (1.0, 3), (float('inf'), 4)],
+            'count': 4,
+            'sum': 2.65,
+        }
+
+    def test_quantile(self):
+        histogram = Histogram([0.1, 1.0])
+        assert histogram.quantile(0.9) == 0.0
+        for value in [0.05] * 9 + [0.5]:
+            histogram.observe(value)
+        assert histogram.quantile(0.9) == 0.1
+        assert histogram.quantile(1.0) == 1.0
+        earlier = histogram.copy()
+        histogram.observe(5.0)
+        assert histogram.quantile(0.5, since=earlier) == float('inf')
+
+
+class TestMetricsRegistry:
+    def test_exposition(self):
+        registry = MetricsRegistry()
+        responses = registry.counter(
+            'responses_total', 'Responses.', ('route', 'status'))
+        responses.labels('fetch', '200').inc()
+        responses.labels('fetch', '200').inc()
+        responses.labels('a "b"\n', '404').inc()
+        latency = registry.histogram(
+            'latency_seconds', 'Latency.', bounds=(0.1,))
+        latency.labels().observe(0.05)
+
+        def collect():
+            gauge = Gauge('connections', 'Open connections.')
+            gauge.labels().set(3)
+            yield gauge
+        registry.addCollector(collect)
+        assert registry.exposition().decode('utf-8').splitlines() == [
+            '# HELP responses_total Responses.',
+            '# TYPE responses_total counter',
+            'responses_total{route="a \\"b\\"\\n",status="404"} 1',
+            'responses_total{route="fetch",status="200"} 2',
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="+Inf"} 1',
+            'latency_seconds_sum 0.05',
+            'latency_seconds_count 1',
+            '# HELP connections Open connections.',
+            '# TYPE connections gauge',
+            'connections 3',
+        ]
+        registry.removeCollector(collect)
+        assert b'connections' not in registry.exposition()
+
+    def test_rejects_duplicates_and_wrong_labels(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('things_total', 'Things.', ('kind',))
+        with pytest.raises(ValueError):
+            registry.gauge('things_total', 'Things.')
+        with pytest.raises(ValueError):
+            counter.labels('a', 'b')
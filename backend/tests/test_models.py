@@ -1,3 +1,5 @@
+import pytest
+
 from txchoretracker import models
 
 _day = 24 * 60 * 60
@@ -72,3 +74,114 @@ class TestUserProfileSchema:
         )
         assert not errors
         assert result == expected
+
+
+class TestTaskCursor:
+    def test_round_trips(self):
+        cursor = models.TaskCursor(due_unix=DUE, id=123)
+        assert models.TaskCursor.decode(cursor.encode()) == cursor
+
+    def test_after_task(self):
+        task = models.Task(
+            id=7,
+            task_group_id=2,
+            name=NAME,
+            description=DESCRIPTION,
+            due_unix=DUE,
+        )
+        assert models.TaskCursor.afterTask(task) == \
+            models.TaskCursor(due_unix=DUE, id=7)
+
+    def test_rejects_garbage(self):
+        for encoded in ['', 'not base64!', 'MTIz', 'YTpi']:
+            with pytest.raises(ValueError):
+                models.TaskCursor.decode(encoded)
+
+
+class TestSyncCursor:
+    def test_round_trips(self):
+        cursor = models.SyncCursor(txid=123456789)
+        assert models.SyncCursor.decode(cursor.encode()) == cursor
+
+    def test_rejects_garbage(self):
+        taskCursor = models.TaskCursor(due_unix=DUE, id=5).encode()
+        for encoded in ['', 'not base64!', 'MTIz', taskCursor]:
+            with pytest.raises(ValueError):
+                models.SyncCursor.decode(encoded)
+
+    def test_changes_query_schema(self):
+        cursor = models.SyncCursor(txid=42)
+        schema = models.TaskChangesQuerySchema()
+        assert schema.load({'since': cursor.encode()}) == (
+            {'since': cursor}, {})
+        assert schema.load({}) == ({}, {})
+        result, errors = schema.load({'since': 'nope'})
+        assert set(errors) == {'since'}
+
+
+class TestTaskListQuerySchema:
+    def test_deserializes_query_parameters(self):
+        cursor = models.TaskCursor(due_unix=DUE, id=5)
+        query = {
+            'taskGroup': '2',
+            'dueAfter': str(CREATED),
+            'dueBefore': str(DUE),
+            'overdue': 'true',
+            'cursor': cursor.encode(),
+            'limit': '20',
+        }
+        result, errors = models.TaskListQuerySchema().load(query)
+        assert not errors
+        assert result == models.TaskListQuery(
+            task_group_id=2,
+            due_after_unix=CREATED,
+            due_before_unix=DUE,
+            overdue=True,
+            after=cursor,
+            limit=20,
+        )
+
+    def test_defaults(self):
+        result, errors = models.TaskListQuerySchema().load({'overdue': '0'})
+        assert not errors
+        assert result == models.TaskListQuery(overdue=False)
+        assert result.limit == models.DEFAULT_TASK_PAGE_LIMIT
+
+    def test_rejects_invalid_parameters(self):
+        query = {
+            'cursor': 'nope',
+            'limit': str(models.MAX_TASK_PAGE_LIMIT + 1),
+            'taskGroup': 'abc',
+        }
+        result, errors = models.TaskListQuerySchema().load(query)
+        assert set(errors) == {'cursor', 'limit', 'taskGroup'}
+
+
+class TestTaskBatchOperationSchema:
+    def test_deserializes_operations(self):
+        task = {'taskGroup': 2, 'name': NAME, 'description': '', 'due': DUE}
+        structure = [
+            {'op': 'create', 'task': task},
+            {'op': 'update', 'id': 5, 'task': task},
+            {'op': 'delete', 'id': 6},
+        ]
+        schema = models.TaskBatchOperationSchema(many=True)
+        result, errors = schema.load(structure)
+        assert not errors
+        assert result == [
+            models.TaskBatchOperation(operation='create', task=task),
+            models.TaskBatchOperation(
+                operation='update', task_id=5, task=task),
+            models.TaskBatchOperation(operation='delete', task_id=6),
+        ]
+
+    @pytest.mark.parametrize('structure, errorField', [
+        ({'op': 'create', 'id': 1, 'task': {}}, 'id'),
+        ({'op': 'create'}, 'task'),
+        ({'op': 'update', 'task': {}}, 'id'),
+        ({'op': 'delete', 'id': 1, 'task': {}}, 'task'),
+        ({'op': 'upsert', 'id': 1}, 'op'),
+    ])
+    def test_rejects_fields_wrong_for_operation(self, structure, errorField):
+        result, errors = models.TaskBatchOperationSchema().load(structure)
+        assert errorField in errors
@@ -0,0 +1,222 @@
+import email
+
+from twisted.internet import defer
+from twisted.internet import task
+
+from txchoretracker import changes
+from txchoretracker import models
+from txchoretracker import notifications
+
+
+def _taskEvent(taskId, operation='UPDATE'):
+    return changes.ChangeEvent(
+        table='task', operation=operation, rowId=taskId, taskGroupIds=(1,))
+
+
+def _notification(taskId, email='ann@example.com', **kwargs):
+    kwargs.setdefault('task_name', 'task {0}'.format(taskId))
+    kwargs.setdefault('task_group_name', 'home')
+    kwargs.setdefault('due_unix', 0)
+    kwargs.setdefault('display_name', 'Ann')
+    return models.DueTaskNotification(task_id=taskId, email=email, **kwargs)
+
+
+class FakeDatabase:
+    """
+    Keeps task due times in memory, and claims notifications like
+    api.claim_due_task_notifications.
+    """
+    def __init__(self, dueByTaskId):
+        self.dueByTaskId = dueByTaskId
+        self.notifiedDueByTaskId = {}
+        self.loadedRows = 0
+        self.failClaims = False
+
+    def _unnotified(self, taskId):
+        return (self.notifiedDueByTaskId.get(taskId)
+                != self.dueByTaskId[taskId])
+
+    async def fetchUpcomingTaskDues(
+                self, *, fromUnix, afterTaskId, beforeUnix, limit):
+        rows = sorted(
+            (dueUnix, taskId) for taskId, dueUnix in self.dueByTaskId.items()
+            if (dueUnix, taskId) > (fromUnix, afterTaskId)
+            and dueUnix < beforeUnix and self._unnotified(taskId))
+        rows = [(taskId, dueUnix) for dueUnix, taskId in rows[:limit]]
+        self.loadedRows += len(rows)
+        return rows
+
+    async def fetchTaskDues(self, *, taskIds):
+        return [
+            (taskId, self.dueByTaskId[taskId]) for taskId in taskIds
+            if taskId in self.dueByTaskId]
+
+    async def claimDueTaskNotifications(
+                self, *, taskIds, notBeforeUnix, beforeUnix):
+        if self.failClaims:
+            raise RuntimeError('database went away')
+        claimed = []
+        for taskId in taskIds:
+            dueUnix = self.dueByTaskId.get(taskId)
+            if (dueUnix is not None and notBeforeUnix <= dueUnix < beforeUnix
+                    and self._unnotified(taskId)):
+                self.notifiedDueByTaskId[taskId] = dueUnix
+                claimed.append(_notification(taskId, due_unix=dueUnix))
+        return claimed
+
+
+class FakeSender:
+    def __init__(self):
+        self.batches = []
+
+    def send(self, notifications):
+        self.batches.append(sorted(n.task_id for n in notifications))
+        return defer.succeed(None)
+
+
+class TestDueTaskNotifier:
+    def makeNotifier(self, dueByTaskId, **kwargs):
+        self.db = FakeDatabase(dueByTaskId)
+        self.sender = FakeSender()
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        kwargs.setdefault('lookahead', 100)
+        kwargs.setdefault('maxLateness', 50)
+        notifier = notifications.DueTaskNotifier(
+            self.db, self.sender, reactor=self.clock, **kwargs)
+        notifier.start()
+        return notifier
+
+    def test_notifies_as_tasks_come_due(self):
+        notifier = self.makeNotifier({
+            # Too late, due, due later, and beyond the window.
+            1: 900, 2: 990, 3: 1010, 4: 1140})
+        assert notifier.stats()['pending'] == 2
+        self.clock.advance(0)
+        assert self.sender.batches == [[2]]
+        self.clock.advance(10)
+        assert self.sender.batches == [[2], [3]]
+
+        # The next window is loaded halfway through this one.
+        self.clock.advance(40)
+        assert notifier.stats()['pending'] == 1
+        self.clock.advance(100)
+        assert self.sender.batches == [[2], [3], [4]]
+        assert notifier.stats() == {
+            'pending': 0, 'batches': 3, 'notifications': 3}
+
+    def test_batches(self):
+        self.makeNotifier(
+            {taskId: 1005 for taskId in range(1, 6)}, batchSize=2)
+        self.clock.advance(5)
+        assert self.sender.batches == [[1, 2], [3, 4], [5]]
+
+    def test_lead_time(self):
+        self.makeNotifier({1: 1030}, leadTime=20)
+        self.clock.advance(9)
+        assert self.sender.batches == []
+        self.clock.advance(1)
+        assert self.sender.batches == [[1]]
+
+    def test_task_writes_are_followed(self):
+        notifier = self.makeNotifier({1: 1010, 2: 1020})
+        # Created, moved earlier, and deleted.
+        self.db.dueByTaskId[3] = 1030
+        notifier.handleChange(_taskEvent(3, operation='INSERT'))
+        self.db.dueByTaskId[2] = 1005
+        notifier.handleChange(_taskEvent(2))
+        del self.db.dueByTaskId[1]
+        notifier.handleChange(_taskEvent(1, operation='DELETE'))
+        self.clock.advance(5)
+        assert self.sender.batches == [[2]]
+        self.clock.advance(25)
+        assert self.sender.batches == [[2], [3]]
+
+    def test_changed_tasks_are_looked_up_together(self):
+        notifier = self.makeNotifier({1: 1010, 2: 1020})
+        lookups = []
+        fetchTaskDues = self.db.fetchTaskDues
+
+        async def recordingFetchTaskDues(*, taskIds):
+            lookups.append(taskIds)
+            return await fetchTaskDues(taskIds=taskIds)
+        self.db.fetchTaskDues = recordingFetchTaskDues
+        notifier.handleChange(_taskEvent(2))
+        notifier.handleChange(_taskEvent(1))
+        notifier.handleChange(_taskEvent(2))
+        self.clock.advance(0)
+        assert lookups == [[1, 2]]
+
+    def test_moved_due_time_is_notified_again(self):
+        notifier = self.makeNotifier({1: 1005})
+        self.clock.advance(5)
+        self.db.dueByTaskId[1] = 1020
+        notifier.handleChange(_taskEvent(1))
+        self.clock.advance(15)
+        assert self.sender.batches == [[1], [1]]
+
+    def test_resync_does_not_notify_again(self):
+        notifier = self.makeNotifier({1: 1005, 2: 1020})
+        self.clock.advance(5)
+        notifier.handleChange(changes.RESYNC)
+        self.clock.advance(15)
+        assert self.sender.batches == [[1], [2]]
+
+    def test_failed_claims_are_retried(self):
+        notifier = self.makeNotifier({1: 1005}, maxLateness=100)
+        self.db.failClaims = True
+        self.clock.advance(5)
+        assert self.sender.batches == []
+        self.db.failClaims = False
+        self.clock.advance(notifier.retryDelay)
+        assert self.sender.batches == [[1]]
+
+    def test_stop(self):
+        notifier = self.makeNotifier({1: 1005})
+        notifier.stop()
+        assert self.clock.getDelayedCalls() == []
+
+
+class TestSenders:
+    def test_compose_messages_per_recipient(self):
+        messages = notifications.composeMessages([
+            _notification(1, task_name='water plants', due_unix=86400),
+            _notification(2, email='bob@example.com', display_name='Bob'),
+            _notification(3, task_name='feed cat'),
+        ], 'tasks@example.com')
+        assert [(to, m['Subject']) for to, m in messages] == [
+            ('ann@example.com', '2 tasks due'),
+            ('bob@example.com', 'Due: task 2'),
+        ]
+        body = messages[0][1].get_content()
+        assert body.startswith('Hi Ann,')
+        assert '- water plants (home), due 1970-01-02 00:00 UTC' in body
+
+    def test_smtp_sender(self):
+        sent = []
+        failures = []
+
+        def sendmail(host, fromAddress, toAddresses, message, port):
+            sent.append((host, port, fromAddress, toAddresses,
+                         email.message_from_bytes(message)['Subject']))
+            if toAddresses == ['bob@example.com']:
+                failures.append(defer.Deferred())
+                return failures[-1]
+            return defer.succeed(None)
+
+        sender = notifications.SMTPNotificationSender(
+            'mail.example.com', 587, 'tasks@example.com', sendmail=sendmail)
+        results = []
+        sender.send([
+            _notification(1), _notification(2, email='bob@example.com'),
+        ]).addCallback(results.append)
+        assert results == []
+        failures[0].errback(RuntimeError('refused'))
+        assert len(results) == 1
+        assert sent == [
+            ('mail.example.com', 587, 'tasks@example.com',
+             ['ann@example.com'], 'Due: task 1'),
+            ('mail.example.com', 587, 'tasks@example.com',
+             ['bob@example.com'], 'Due: task 2'),
+        ]
+        assert (sender.sent, sender.failed) == (1, 1)
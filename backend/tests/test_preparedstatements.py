@@ -0,0 +1,116 @@
+from txchoretracker import db
+from txchoretracker.preparedstatements import (
+    PreparedStatement, PreparedStatementRegistry
+)
+
+FETCH_TASK = PreparedStatement(
+    'asuser_fetch_task',
+    'SELECT * FROM api.asuser_fetch_task($1, $2)',
+    ('bigint', 'bigint'),
+)
+
+
+class FakeConnection:
+    pass
+
+
+class FakeDBError(Exception):
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+
+
+class TestPreparedStatement:
+    def test_prepare_sql(self):
+        assert FETCH_TASK.prepareSQL() == (
+            'PREPARE asuser_fetch_task (bigint, bigint) AS '
+            'SELECT * FROM api.asuser_fetch_task($1, $2)'
+        )
+
+    def test_execute_sql(self):
+        assert FETCH_TASK.executeSQL() == 'EXECUTE asuser_fetch_task (%s, %s)'
+
+    def test_direct_sql(self):
+        assert FETCH_TASK.directSQL() == (
+            'SELECT * FROM api.asuser_fetch_task(%s, %s)')
+
+    def test_direct_sql_many_placeholders(self):
+        statement = PreparedStatement(
+            'many', 'SELECT f($1, $10)', ('integer',) * 10)
+        assert statement.directSQL() == 'SELECT f(%s, %s)'
+
+    def test_no_parameters(self):
+        statement = PreparedStatement('none', 'SELECT f()', ())
+        assert statement.prepareSQL() == 'PREPARE none AS SELECT f()'
+        assert statement.executeSQL() == 'EXECUTE none'
+
+    def test_api_statement_names_are_unique(self):
+        names = [statement.name for statement in db.API_STATEMENTS]
+        assert len(names) == len(set(names))
+
+
+class TestPreparedStatementRegistry:
+    def test_first_use_prepares_then_executes_by_name(self):
+        registry = PreparedStatementRegistry([FETCH_TASK])
+        connection = FakeConnection()
+
+        sql = registry.sqlFor(connection, 'asuser_fetch_task')
+        assert sql == (
+            'DEALLOCATE ALL; ' + FETCH_TASK.prepareSQL() + '; ' +
+            FETCH_TASK.executeSQL()
+        )
+        registry.markPrepared(connection)
+
+        sql = registry.sqlFor(connection, 'asuser_fetch_task')
+        assert sql == FETCH_TASK.executeSQL()
+        assert registry.stats() == {
+            'hits': 1,
+            'misses': 1,
+            'reprepares': 0,
+            'hitRate': 0.5,
+            'preparedConnections': 1,
+        }
+
+    def test_not_marked_prepared_until_told(self):
+        registry = PreparedStatementRegistry([FETCH_TASK])
+        connection = FakeConnection()
+        registry.sqlFor(connection, 'asuser_fetch_task')
+        registry.sqlFor(connection, 'asuser_fetch_task')
+        assert registry.misses == 2
+        assert registry.hits == 0
+
+    def test_new_connection_is_prepared_again(self):
+        registry = PreparedStatementRegistry([FETCH_TASK])
+        oldConnection = FakeConnection()
+        registry.sqlFor(oldConnection, 'asuser_fetch_task')
+        registry.markPrepared(oldConnection)
+        del oldConnection
+
+        newConnection = FakeConnection()
+        sql = registry.sqlFor(newConnection, 'asuser_fetch_task')
+        assert sql.startswith('DEALLOCATE ALL; ')
+        assert registry.stats()['preparedConnections'] == 0
+
+    def test_forget_if_stale(self):
+        registry = PreparedStatementRegistry([FETCH_TASK])
+        connection = FakeConnection()
+        registry.markPrepared(connection)
+
+        assert not registry.forgetIfStale(connection, FakeDBError('P0001'))
+        assert registry.forgetIfStale(connection, FakeDBError('26000'))
+        assert registry.reprepares == 1
+        sql = registry.sqlFor(connection, 'asuser_fetch_task')
+        assert sql.startswith('DEALLOCATE ALL; ')
+
+    def test_forget_if_stale_while_preparing(self):
+        registry = PreparedStatementRegistry([FETCH_TASK])
+        connection = FakeConnection()
+        assert not registry.forgetIfStale(connection, FakeDBError('26000'))
+
+    def test_unprepared_mode(self):
+        registry = PreparedStatementRegistry([FETCH_TASK], usePrepared=False)
+        connection = FakeConnection()
+        sql = registry.sqlFor(connection, 'asuser_fetch_task')
+        registry.markPrepared(connection)
+        assert sql == FETCH_TASK.directSQL()
+        assert registry.sqlFor(connection, 'asuser_fetch_task') == sql
+        assert registry.stats()['preparedConnections'] == 0
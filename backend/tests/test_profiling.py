@@ -0,0 +1,130 @@
+import json
+import pstats
+
+import pytest
+from twisted import logger
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+
+from txchoretracker import db
+from txchoretracker import profiling
+from txchoretracker import tracing
+
+
+@pytest.fixture
+def events(monkeypatch):
+    events = []
+    observer = events.append
+    monkeypatch.setattr(profiling, 'log', logger.Logger(observer=observer))
+    monkeypatch.setattr(db, 'log', logger.Logger(observer=observer))
+    return events
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = profiling.RequestProfiler(
+        slowThreshold=None, outputDir=str(tmp_path / 'profiles'))
+    tracer = tracing.Tracer(None, sampleRate=0.0)
+    tracer.addObserver(profiler)
+    tracing.setTracer(tracer)
+    yield profiler
+    tracing.setTracer(None)
+
+
+def _request(route, uri='/tasks', **attributes):
+    return tracing.startTrace(
+        'http.request', route=route, method='GET', uri=uri, **attributes)
+
+
+def _busyWork():
+    return sum(range(1000))
+
+
+class TestRequestProfiler:
+    def test_redact_params(self):
+        assert profiling.redactParams(
+            [7, None, True, 1.5, 'ann@example.com', [1, 2], object()]
+        ) == [7, None, True, 1.5, '<str 15 chars>', '<list of 2>',
+              '<object>']
+
+    def test_slow_requests_are_logged_with_their_call_path(
+                self, profiler, events):
+        profiler.routeThresholds = {'Apis.slow': 0.0}
+        for route in ['Apis.fast', 'Apis.slow']:
+            rootSpan = _request(route, uri='/tasks?email=ann@example.com')
+            dbSpan = rootSpan.child('db', function='fetch_tasks')
+            dbSpan.params = [3, 'secret']
+            dbSpan.record('db.query', dbSpan.start, dbSpan.start + 0.002)
+            dbSpan.finish()
+            rootSpan.finish(status=200)
+        assert profiler.slowRequests == 1
+        [event] = events
+        message = logger.formatEvent(event)
+        assert message.startswith(
+            'Slow request: GET /tasks (Apis.slow) took ')
+        assert 'ann@example.com' not in message
+        callPath = message.split('\n')[1:]
+        assert callPath[0].startswith('http.request ')
+        assert callPath[1].startswith('  db fetch_tasks ')
+        assert callPath[1].endswith("params=[3, '<str 6 chars>']")
+        assert callPath[2] == '    db.query 2.0ms'
+
+    def test_long_lived_requests_are_not_logged_as_slow(
+                self, profiler, events):
+        profiler.slowThreshold = 0.0
+        rootSpan = _request(
+            'ChangesApiEndpoint.stream', uri='/changes', longLived=True)
+        rootSpan.finish(status=200)
+        assert profiler.slowRequests == 0
+        assert events == []
+
+    def test_captures_profiles_of_the_next_requests(self, profiler):
+        profiler.capture('Apis.profiled', 1)
+
+        async def handle():
+            await defer.succeed(None)
+            return _busyWork()
+
+        rootSpans = [_request('Apis.profiled') for i in range(2)]
+        for rootSpan in rootSpans:
+            tracing.ensureDeferred(handle(), rootSpan)
+            rootSpan.finish(status=200)
+        assert profiler.captures() == {}
+        [path] = profiler.profiles
+        assert path.endswith('.prof')
+        functionNames = [
+            function[2] for function in pstats.Stats(path).stats]
+        assert '_busyWork' in functionNames
+
+    def test_admin_resource(self, profiler):
+        resource = profiling.ProfilingAdminResource(profiler)
+        route = b'TasksApiEndpoint.fetchAll'
+        request = DummyRequest([b''])
+        request.method = b'POST'
+        request.args = {b'route': [route], b'count': [b'3']}
+        body = json.loads(resource.render(request).decode('utf-8'))
+        assert body == {
+            'captures': {'TasksApiEndpoint.fetchAll': 3}, 'profiles': []}
+
+        request = DummyRequest([b''])
+        request.method = b'POST'
+        request.args = {b'route': [route], b'count': [b'many']}
+        resource.render(request)
+        assert request.responseCode == 400
+
+
+class TestSlowQueries:
+    def test_slow_calls_are_logged_with_redacted_params(self, events):
+        class Backend:
+            def runPreparedQuery(self, statementName, params, rowFactory=None):
+                return defer.succeed([])
+
+        db.setSlowQueryThreshold(1e-9)
+        try:
+            dbWrapper = db.ChoreTrackerDatabase(Backend())
+            defer.ensureDeferred(dbWrapper.fetchTaskDues(taskIds=[1, 2]))
+        finally:
+            db.setSlowQueryThreshold(None)
+        [event] = events
+        assert event['function'] == 'fetch_task_dues'
+        assert event['params'] == ['<list of 2>']
@@ -0,0 +1,220 @@
+import json
+
+import pytest
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.web.test.requesthelper import DummyRequest
+
+from txchoretracker import changes
+from txchoretracker import push
+
+
+def _result(dfd):
+    results = []
+    dfd.addBoth(results.append)
+    [result] = results
+    return result
+
+
+def _taskEvent(taskId, *taskGroupIds, operation='UPDATE'):
+    return changes.ChangeEvent(
+        table='task', operation=operation, rowId=taskId,
+        taskGroupIds=taskGroupIds)
+
+
+def _parseEvents(chunks):
+    events = []
+    for block in b''.join(chunks).decode('ascii').split('\n\n'):
+        fields = dict(
+            line.split(': ', 1) for line in block.splitlines()
+            if line and not line.startswith(':') and ': ' in line)
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+class FakeDatabase:
+    def __init__(self, membersByTaskGroup):
+        self.membersByTaskGroup = membersByTaskGroup
+        self.lookups = []
+
+    async def fetchTaskGroupMemberIds(self, *, taskGroupId):
+        self.lookups.append(taskGroupId)
+        return self.membersByTaskGroup.get(taskGroupId, [])
+
+
+class TestTaskChangeHub:
+    def makeHub(self, **kwargs):
+        self.db = FakeDatabase({1: [10, 11], 2: [10, 12]})
+        self.clock = task.Clock()
+        return push.TaskChangeHub(self.db, reactor=self.clock, **kwargs)
+
+    def connect(self, hub, userId):
+        written = []
+        stream = hub.connect(written.append, userId)
+        return stream, written
+
+    def test_task_changes_go_to_task_group_members(self):
+        hub = self.makeHub()
+        _, written10 = self.connect(hub, 10)
+        _, written11 = self.connect(hub, 11)
+        _, written12 = self.connect(hub, 12)
+        _result(hub.handleChange(_taskEvent(5, 1)))
+        # Moved from task group 1 to 2: both groups' members hear.
+        _result(hub.handleChange(_taskEvent(6, 1, 2, operation='DELETE')))
+        assert _parseEvents(written10) == [
+            ('task', {'op': 'UPDATE', 'id': 5}),
+            ('task', {'op': 'DELETE', 'id': 6}),
+        ]
+        assert _parseEvents(written11) == _parseEvents(written10)
+        assert _parseEvents(written12) == [
+            ('task', {'op': 'DELETE', 'id': 6})]
+
+    def test_members_are_cached_until_membership_changes(self):
+        hub = self.makeHub()
+        _, written = self.connect(hub, 13)
+        _result(hub.handleChange(_taskEvent(5, 1)))
+        _result(hub.handleChange(_taskEvent(5, 1)))
+        assert self.db.lookups == [1]
+
+        self.db.membersByTaskGroup[1].append(13)
+        _result(hub.handleChange(changes.ChangeEvent(
+            table='users_m2m_task_groups', operation='INSERT', rowId=13,
+            taskGroupIds=(1,))))
+        _result(hub.handleChange(_taskEvent(5, 1)))
+        assert self.db.lookups == [1, 1]
+        assert _parseEvents(written) == [
+            ('resync', {}), ('task', {'op': 'UPDATE', 'id': 5})]
+
+    def test_lookup_during_membership_change_is_not_cached(self):
+        hub = self.makeHub()
+        self.connect(hub, 10)
+        pending = defer.Deferred()
+
+        async def slowLookup(*, taskGroupId):
+            return await pending
+        self.db.fetchTaskGroupMemberIds = slowLookup
+        dfd = hub.handleChange(_taskEvent(5, 1))
+        _result(hub.handleChange(changes.ChangeEvent(
+            table='users_m2m_task_groups', operation='DELETE', rowId=11,
+            taskGroupIds=(1,))))
+        pending.callback([10, 11])
+        assert dfd.called
+        assert hub.stats()['cachedTaskGroups'] == 0
+
+    def test_changes_arrive_through_the_change_listener(self):
+        hub = self.makeHub()
+        _, written = self.connect(hub, 10)
+        listener = changes.ChangeListener(
+            'postgres:///x', reactor=task.Clock())
+        listener.subscribe(hub.handleChange)
+        # The listener runs subscribers with maybeDeferred, which only
+        # runs coroutines on newer Twisteds, so it needs a Deferred.
+        assert isinstance(hub.handleChange(changes.RESYNC), defer.Deferred)
+        listener._deliver(_taskEvent(5, 1))
+        assert _parseEvents(written) == [
+            ('resync', {}), ('task', {'op': 'UPDATE', 'id': 5})]
+
+    def test_no_lookups_without_streams(self):
+        hub = self.makeHub()
+        _result(hub.handleChange(_taskEvent(5, 1)))
+        assert self.db.lookups == []
+
+    def test_resync_goes_to_everyone(self):
+        hub = self.makeHub()
+        _, written10 = self.connect(hub, 10)
+        _, written99 = self.connect(hub, 99)
+        _result(hub.handleChange(changes.RESYNC))
+        _result(hub.handleChange(changes.DISCONNECTED))
+        assert _parseEvents(written10) == [('resync', {})] * 2
+        assert _parseEvents(written99) == [('resync', {})] * 2
+
+    def test_connection_limits(self):
+        hub = self.makeHub(maxConnections=3, maxConnectionsPerUser=2)
+        first, _ = self.connect(hub, 10)
+        self.connect(hub, 10)
+        with pytest.raises(push.TooManyConnections):
+            self.connect(hub, 10)
+        self.connect(hub, 11)
+        with pytest.raises(push.TooManyConnections):
+            self.connect(hub, 12)
+        hub.disconnect(first)
+        self.connect(hub, 12)
+        assert hub.connectionCount == 3
+
+    def test_keepalives_only_while_connected(self):
+        hub = self.makeHub(keepaliveInterval=30)
+        stream, written = self.connect(hub, 10)
+        self.clock.advance(30)
+        assert written == [b': keepalive\n\n']
+        hub.disconnect(stream)
+        assert not self.clock.getDelayedCalls()
+
+
+class TestEventStream:
+    def makeStream(self, maxQueuedEvents=2):
+        self.written = []
+        return push.EventStream(self.written.append, 10, maxQueuedEvents)
+
+    def test_queues_while_paused(self):
+        stream = self.makeStream()
+        stream.pauseProducing()
+        stream.send(b'a')
+        stream.send(b'b')
+        assert self.written == []
+        stream.resumeProducing()
+        assert self.written == [b'a', b'b']
+
+    def test_overflow_becomes_resync(self):
+        stream = self.makeStream()
+        stream.pauseProducing()
+        for data in (b'a', b'b', b'c', b'd'):
+            stream.send(data)
+        stream.resumeProducing()
+        assert _parseEvents(self.written) == [('resync', {})]
+        assert stream.droppedEvents == 4
+        stream.send(b'e')
+        assert self.written[-1] == b'e'
+
+
+class StreamingDummyRequest(DummyRequest):
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class TestEventStreamResource:
+    def test_streams_events_until_client_goes_away(self):
+        hub = push.TaskChangeHub(FakeDatabase({1: [10]}), reactor=task.Clock())
+        request = StreamingDummyRequest([b''])
+        push.EventStreamResource(hub, 10).render(request)
+        assert request.responseHeaders.getRawHeaders(b'content-type') == [
+            b'text/event-stream']
+        assert isinstance(request.producer, push.EventStream)
+        _result(hub.handleChange(_taskEvent(5, 1)))
+        assert _parseEvents(request.written) == [
+            ('task', {'op': 'UPDATE', 'id': 5})]
+        request.processingFailed(Exception('connection lost'))
+        assert hub.connectionCount == 0
+
+    def test_close_all_ends_the_responses(self):
+        hub = push.TaskChangeHub(FakeDatabase({}), reactor=task.Clock())
+        requests = [StreamingDummyRequest([b'']) for _ in range(3)]
+        for userId, request in zip([10, 10, 11], requests):
+            push.EventStreamResource(hub, userId).render(request)
+        hub.closeAll()
+        assert all(request.finished for request in requests)
+        assert all(request.producer is None for request in requests)
+        assert hub.connectionCount == 0
+
+    def test_too_many_connections_is_503(self):
+        hub = push.TaskChangeHub(
+            FakeDatabase({}), maxConnections=0, reactor=task.Clock())
+        request = StreamingDummyRequest([b''])
+        push.EventStreamResource(hub, 10).render(request)
+        assert request.responseCode == 503
+        assert request.finished
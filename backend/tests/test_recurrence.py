@@ -0,0 +1,111 @@
+import calendar
+import datetime
+import itertools
+
+import pytest
+
+from txchoretracker.recurrence import Recurrence, parseRecurrence
+
+
+def _unix(*args):
+    return calendar.timegm(datetime.datetime(*args).timetuple())
+
+
+def _dates(rule, start, count=6, fromUnix=None):
+    occurrences = Recurrence.parse(rule).occurrences(start, fromUnix)
+    return [
+        datetime.datetime.utcfromtimestamp(unix).strftime('%Y-%m-%d %H:%M')
+        for unix in itertools.islice(occurrences, count)
+    ]
+
+
+START = _unix(2018, 1, 31, 9, 30)
+
+
+class TestOccurrences:
+    def test_daily_interval(self):
+        assert _dates('FREQ=DAILY;INTERVAL=3', START, 3) == [
+            '2018-01-31 09:30', '2018-02-03 09:30', '2018-02-06 09:30']
+
+    def test_weekly_by_day(self):
+        # The start (a Wednesday) isn't an occurrence.
+        assert _dates('FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH', START, 4) == [
+            '2018-02-01 09:30', '2018-02-12 09:30',
+            '2018-02-15 09:30', '2018-02-26 09:30']
+
+    def test_monthly_skips_short_months(self):
+        assert _dates('FREQ=MONTHLY', START, 3) == [
+            '2018-01-31 09:30', '2018-03-31 09:30', '2018-05-31 09:30']
+
+    def test_monthly_last_day(self):
+        assert _dates('FREQ=MONTHLY;BYMONTHDAY=-1', START, 3) == [
+            '2018-01-31 09:30', '2018-02-28 09:30', '2018-03-31 09:30']
+
+    def test_monthly_nth_weekday(self):
+        assert _dates('FREQ=MONTHLY;BYDAY=1SA,-1FR', START, 4) == [
+            '2018-02-03 09:30', '2018-02-23 09:30',
+            '2018-03-03 09:30', '2018-03-30 09:30']
+
+    def test_yearly(self):
+        assert _dates('FREQ=YEARLY', _unix(2016, 2, 29), 3) == [
+            '2016-02-29 00:00', '2020-02-29 00:00', '2024-02-29 00:00']
+        assert _dates('FREQ=YEARLY;BYMONTH=4,10;BYMONTHDAY=1', START, 3) == [
+            '2018-04-01 09:30', '2018-10-01 09:30', '2019-04-01 09:30']
+
+    def test_count_and_until(self):
+        assert len(_dates('FREQ=DAILY;COUNT=4', START, 10)) == 4
+        assert _dates('FREQ=DAILY;UNTIL=20180202', START, 10) == [
+            '2018-01-31 09:30', '2018-02-01 09:30', '2018-02-02 09:30']
+
+    def test_never_matching_rule_ends(self):
+        assert _dates('FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=30', START) == []
+
+    def test_stops_at_last_due_time(self):
+        assert _dates('FREQ=YEARLY', _unix(2036, 1, 1), 10) == [
+            '2036-01-01 00:00', '2037-01-01 00:00', '2038-01-01 00:00']
+
+    @pytest.mark.parametrize('rule', [
+        'FREQ=DAILY;INTERVAL=3;BYMONTH=2,3',
+        'FREQ=WEEKLY;INTERVAL=3;BYDAY=TU,SU',
+        'FREQ=MONTHLY;INTERVAL=5;BYDAY=2WE',
+        'FREQ=YEARLY;INTERVAL=2;BYMONTHDAY=15,-1',
+    ])
+    def test_from_skips_to_the_same_occurrences(self, rule):
+        # The occurrences up to the last due time.
+        everything = list(Recurrence.parse(rule).occurrences(START))
+        middle = everything[len(everything) // 2]
+        for fromUnix in [START - 1, middle, middle + 1,
+                         everything[-3] - 86400]:
+            expected = [unix for unix in everything if unix >= fromUnix]
+            assert list(Recurrence.parse(rule).occurrences(
+                START, fromUnix)) == expected
+
+
+class TestParse:
+    def test_format_is_canonical(self):
+        recurrence = Recurrence.parse(
+            'freq=monthly;byday=-1fr,1sa,mo;interval=2;count=5')
+        assert recurrence.format() == (
+            'FREQ=MONTHLY;INTERVAL=2;BYDAY=MO,-1FR,1SA;COUNT=5')
+        assert Recurrence.parse(recurrence.format()) == recurrence
+
+    @pytest.mark.parametrize('rule', [
+        '',
+        'FREQ=HOURLY',
+        'INTERVAL=2',
+        'FREQ=DAILY;INTERVAL=0',
+        'FREQ=DAILY;FREQ=WEEKLY',
+        'FREQ=DAILY;COUNT=3;UNTIL=20180101',
+        'FREQ=DAILY;UNTIL=20181301',
+        'FREQ=DAILY;BYDAY=1MO',
+        'FREQ=YEARLY;BYDAY=MO',
+        'FREQ=WEEKLY;BYMONTHDAY=1',
+        'FREQ=MONTHLY;BYMONTHDAY=0',
+        'FREQ=MONTHLY;BYSETPOS=1',
+    ])
+    def test_rejects_invalid_rules(self, rule):
+        with pytest.raises(ValueError):
+            Recurrence.parse(rule)
+
+    def test_parse_recurrence_caches(self):
+        assert parseRecurrence('FREQ=DAILY') is parseRecurrence('FREQ=DAILY')
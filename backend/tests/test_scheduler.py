@@ -0,0 +1,144 @@
+import attr
+from twisted.internet import defer
+from twisted.internet import task
+
+from txchoretracker import models
+from txchoretracker import scheduler
+
+
+DAY = 24 * 60 * 60
+
+
+def _repeatingTask(**kwargs):
+    kwargs.setdefault('id', 1)
+    kwargs.setdefault('recurrence', 'FREQ=DAILY')
+    kwargs.setdefault('start_unix', 0)
+    kwargs.setdefault('next_due_unix', kwargs['start_unix'])
+    return models.RepeatingTask(
+        task_group_id=2, name='water plants', description='', **kwargs)
+
+
+class TestMaterialize:
+    def test_up_to_horizon(self):
+        result = scheduler.materialize(
+            _repeatingTask(next_due_unix=10 * DAY, occurrence_count=10),
+            horizonUnix=13 * DAY, maxOccurrences=100)
+        assert result == models.RepeatingTaskMaterialization(
+            repeating_task_id=1,
+            expected_next_due_unix=10 * DAY,
+            due_unixes=[10 * DAY, 11 * DAY, 12 * DAY],
+            next_due_unix=13 * DAY,
+            occurrence_count=13,
+        )
+
+    def test_count_ends_it(self):
+        result = scheduler.materialize(
+            _repeatingTask(
+                recurrence='FREQ=DAILY;COUNT=5',
+                next_due_unix=3 * DAY, occurrence_count=3),
+            horizonUnix=100 * DAY, maxOccurrences=100)
+        assert result.due_unixes == [3 * DAY, 4 * DAY]
+        assert result.next_due_unix is None
+        assert result.occurrence_count == 5
+
+    def test_max_occurrences(self):
+        result = scheduler.materialize(
+            _repeatingTask(), horizonUnix=100 * DAY, maxOccurrences=2)
+        assert result.due_unixes == [0, DAY]
+        assert result.next_due_unix == 2 * DAY
+
+
+class FakeDatabase:
+    """
+    Keeps repeating tasks in memory, and applies materializations
+    like api.apply_repeating_task_materializations.
+    """
+    def __init__(self, repeatingTasks):
+        self.repeatingTasks = {rt.id: rt for rt in repeatingTasks}
+        self.dueUnixesById = {rt.id: [] for rt in repeatingTasks}
+        self.fetches = 0
+
+    async def fetchDueRepeatingTasks(self, *, beforeUnix, limit):
+        self.fetches += 1
+        due = sorted(
+            (rt for rt in self.repeatingTasks.values()
+             if rt.next_due_unix is not None
+             and rt.next_due_unix < beforeUnix),
+            key=lambda rt: rt.next_due_unix)
+        return due[:limit]
+
+    async def fetchNextRepeatingTaskDue(self):
+        return min(
+            (rt.next_due_unix for rt in self.repeatingTasks.values()
+             if rt.next_due_unix is not None),
+            default=None)
+
+    async def applyRepeatingTaskMaterializations(self, materializations):
+        created = 0
+        for m in materializations:
+            rt = self.repeatingTasks[m.repeating_task_id]
+            if rt.next_due_unix != m.expected_next_due_unix:
+                continue
+            self.repeatingTasks[rt.id] = attr.evolve(
+                rt, next_due_unix=m.next_due_unix,
+                occurrence_count=m.occurrence_count)
+            self.dueUnixesById[rt.id].extend(m.due_unixes)
+            created += len(m.due_unixes)
+        return created
+
+
+class TestRepeatingTaskScheduler:
+    def _makeScheduler(self, database, clock, **kwargs):
+        kwargs.setdefault('horizon', 7 * DAY)
+        kwargs.setdefault('maxDelay', DAY)
+        return scheduler.RepeatingTaskScheduler(
+            database, reactor=clock, **kwargs)
+
+    def test_pass_works_through_batches(self):
+        database = FakeDatabase([
+            _repeatingTask(id=i, start_unix=i * 60) for i in range(1, 11)])
+        clock = task.Clock()
+        taskScheduler = self._makeScheduler(
+            database, clock, batchSize=3, maxOccurrencesPerBatch=4)
+        created = defer.ensureDeferred(taskScheduler.runPass()).result
+        assert created == 70
+        for rt in database.repeatingTasks.values():
+            assert len(database.dueUnixesById[rt.id]) == 7
+            assert rt.next_due_unix == rt.start_unix + 7 * DAY
+
+        # Nothing more to do until the clock moves on.
+        assert defer.ensureDeferred(taskScheduler.runPass()).result == 0
+
+    def test_sleeps_until_next_occurrence_is_within_horizon(self):
+        database = FakeDatabase([_repeatingTask(recurrence='FREQ=WEEKLY')])
+        clock = task.Clock()
+        taskScheduler = self._makeScheduler(database, clock, maxDelay=30 * DAY)
+        taskScheduler.start()
+        clock.advance(0)
+        assert database.dueUnixesById[1] == [0]
+        # The next occurrence (day 7) is just past the horizon, so the
+        # next pass a second later picks it up, then it sleeps a week.
+        [delayedCall] = clock.getDelayedCalls()
+        assert delayedCall.getTime() == 1
+
+        clock.advance(1)
+        assert database.dueUnixesById[1] == [0, 7 * DAY]
+        [delayedCall] = clock.getDelayedCalls()
+        assert delayedCall.getTime() == 7 * DAY + 1
+
+        taskScheduler.stop()
+        assert clock.getDelayedCalls() == []
+
+    def test_wake_runs_a_pass_now(self):
+        database = FakeDatabase([])
+        clock = task.Clock()
+        taskScheduler = self._makeScheduler(database, clock)
+        taskScheduler.start()
+        clock.advance(0)
+        database.repeatingTasks[1] = _repeatingTask(start_unix=DAY)
+        database.dueUnixesById[1] = []
+        taskScheduler.wake()
+        clock.advance(0)
+        assert database.dueUnixesById[1] == [
+            day * DAY for day in range(1, 7)]
+        assert taskScheduler.stats() == {'passes': 2, 'tasksCreated': 6}
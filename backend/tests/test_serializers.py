@@ -0,0 +1,133 @@
+import marshmallow as mm
+import pytest
+from twisted.internet import defer
+
+from txchoretracker import api
+from txchoretracker import models
+from txchoretracker.kleinhelpers import _makeJSONBytes
+from txchoretracker.serializers import compileDumper
+
+
+def _makeTask(**kwargs):
+    fields = dict(
+        id=1,
+        task_group_id=2,
+        name='some name',
+        description='some description',
+        due_unix=1489626309,
+        created_unix=1489453509,
+        modified_unix=1489539909,
+    )
+    fields.update(kwargs)
+    return models.Task(**fields)
+
+
+TASKS = [
+    _makeTask(),
+    _makeTask(id=None, created_unix=None, modified_unix=None),
+    _makeTask(name='ünïcödé ☃', description=''),
+    _makeTask(name=b'bytes name', description=42),
+    _makeTask(task_group_id=True, due_unix='1489626309', id=3.0),
+]
+
+USER_PROFILES = [
+    models.UserProfile(
+        email='foo@example.com', display_name='Foo', user_id=1,
+        email_verified=True),
+    models.UserProfile(email='bar@example.com', display_name='Bar'),
+    models.UserProfile(
+        email='baz@example.com', display_name='Bäz', user_id=None,
+        email_verified=None),
+    models.UserProfile(
+        email='qux@example.com', display_name='Qux', user_id=2,
+        email_verified='yes'),
+]
+
+
+class TestCompiledDumperParity:
+    @pytest.mark.parametrize('task', TASKS)
+    def test_task_matches_schema(self, task):
+        schema = models.TaskSchema()
+        expected = schema.dump(task).data
+        dumped = compileDumper(schema).dumpOne(task)
+        assert dumped == expected
+        assert list(dumped) == list(expected)
+        assert _makeJSONBytes(dumped) == _makeJSONBytes(expected)
+
+    def test_many_tasks_match_schema(self):
+        schema = models.TaskSchema()
+        expected = schema.dump(TASKS, many=True).data
+        dumped = compileDumper(schema).dump(TASKS, many=True)
+        assert _makeJSONBytes(dumped) == _makeJSONBytes(expected)
+
+    @pytest.mark.parametrize('userProfile', USER_PROFILES)
+    def test_user_profile_matches_schema(self, userProfile):
+        schema = models.UserProfileSchema()
+        expected = schema.dump(userProfile).data
+        dumped = compileDumper(schema).dumpOne(userProfile)
+        assert dumped == expected
+        assert _makeJSONBytes(dumped) == _makeJSONBytes(expected)
+
+
+class TestCompileDumper:
+    def test_skips_load_only_fields(self):
+        class Schema(mm.Schema):
+            name = mm.fields.String()
+            description = mm.fields.String(load_only=True)
+
+        dumper = compileDumper(Schema())
+        assert dumper.dumpOne(_makeTask()) == {'name': 'some name'}
+
+    def test_uses_attribute(self):
+        class Schema(mm.Schema):
+            title = mm.fields.String(attribute='name')
+
+        assert compileDumper(Schema()).dumpOne(_makeTask()) == {
+            'title': 'some name'}
+
+    def test_rejects_dump_defaults(self):
+        class Schema(mm.Schema):
+            name = mm.fields.String(default='unnamed')
+
+        with pytest.raises(TypeError):
+            compileDumper(Schema())
+
+    def test_rejects_post_dump_hooks(self):
+        class Schema(mm.Schema):
+            name = mm.fields.String()
+
+            @mm.post_dump
+            def envelope(self, data):
+                return {'task': data}
+
+        with pytest.raises(TypeError):
+            compileDumper(Schema())
+
+
+class TestSerializationMetrics:
+    def test_compiled_dumps_are_timed(self):
+        schema = models.TaskSchema()
+        dumper = compileDumper(schema)
+        histogram = api._serializationSeconds.labels('TaskSchema')
+        before = histogram.count
+        assert api._dumpCompiled(dumper, schema, TASKS[0]) == \
+            dumper.dumpOne(TASKS[0])
+        api._dumpCompiled(dumper, schema, TASKS[:2], many=True)
+        assert histogram.count == before + 2
+
+    def test_streamed_dumps_are_timed_once(self):
+        schema = models.TaskSchema()
+        dumper = compileDumper(schema)
+        histogram = api._serializationSeconds.labels('TaskSchema')
+        before = histogram.count
+
+        async def tasks():
+            for task in TASKS[:3]:
+                yield task
+
+        async def collect():
+            return [item async for item in api._dumpStreamed(
+                dumper, schema, tasks())]
+        dumped = defer.ensureDeferred(collect()).result
+        assert dumped == dumper.dumpMany(TASKS[:3])
+        assert histogram.count == before + 1
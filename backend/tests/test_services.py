@@ -0,0 +1,64 @@
+from twisted.web import resource
+from twisted.web.test.requesthelper import DummyRequest
+
+from txchoretracker import config
+from txchoretracker import metrics
+from txchoretracker import services
+
+
+class LeafResource(resource.Resource):
+    isLeaf = True
+
+
+class TestDrainableSite:
+    def test_when_drained(self):
+        site = services.DrainableSite(LeafResource())
+        assert site.whenDrained().called
+
+        requests = [DummyRequest([b'']) for _ in range(2)]
+        for request in requests:
+            site.getResourceFor(request)
+        assert site.requestsInProgress == 2
+        drained = site.whenDrained()
+        requests[0].finish()
+        assert not drained.called
+        # Connection lost counts as finished too.
+        requests[1].processingFailed(Exception('connection lost'))
+        assert drained.called
+        assert site.requestsInProgress == 0
+
+
+class FakePool:
+    def stats(self):
+        return {
+            'size': 5, 'connections': 2, 'waiters': 0, 'inUse': 1,
+            'waitTime': metrics.Histogram([0.1]).snapshot(),
+        }
+
+
+class FakeCachingDatabase:
+    pool = FakePool()
+
+    def stats(self):
+        return {
+            'entries': 3, 'size': 300, 'hits': 10, 'misses': 4,
+            'evictions': 0, 'expirations': 1, 'invalidations': 2,
+        }
+
+
+class TestMetricsCollection:
+    def test_collects_pool_and_cache_stats(self):
+        apiService = services.ChoreTrackerAPIService(
+            config.RestApiConfig(
+                development=False, cookie_secret='', domain='localhost'),
+            config.DatabaseConfig(dbname='choretracker'),
+            config.CacheConfig(enabled=True),
+        )
+        apiService._dbWrapper = FakeCachingDatabase()
+        registry = metrics.MetricsRegistry()
+        registry.addCollector(apiService._collectMetrics)
+        lines = registry.exposition().decode('utf-8').splitlines()
+        assert 'choretracker_db_pool_in_use 1' in lines
+        assert 'choretracker_db_pool_wait_time_seconds_count 0' in lines
+        assert 'choretracker_task_cache_hits_total 10' in lines
+        assert 'choretracker_task_cache_entries 3' in lines
@@ -0,0 +1,144 @@
+import json
+
+import klein
+import pytest
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+
+from txchoretracker import tracing
+from txchoretracker.kleinhelpers import JSONApiRouter
+
+
+class CodeDummyRequest(DummyRequest):
+    @property
+    def code(self):
+        return self.responseCode
+
+
+class FixedAuthPolicy:
+    def getAuthenticatedUserId(self, request):
+        return 7
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.InMemorySpanExporter()
+    tracing.setTracer(tracing.Tracer(exporter))
+    yield exporter
+    tracing.setTracer(None)
+
+
+def _tree(trace):
+    namesById = {span.spanId: span.name for span in trace.spans}
+    return [(namesById.get(span.parentId), span.name) for span in trace.spans]
+
+
+class TestTracing:
+    def test_current_span_survives_awaits(self, exporter):
+        waits = [defer.Deferred(), defer.Deferred()]
+
+        async def work(index):
+            with tracing.span('before'):
+                pass
+            await waits[index]
+            with tracing.span('after', index=index):
+                with tracing.span('inner'):
+                    pass
+            return index
+
+        roots = [tracing.startTrace('root{0}'.format(i)) for i in range(2)]
+        results = [tracing.ensureDeferred(work(i), roots[i]) for i in range(2)]
+        assert tracing.currentSpan() is None
+        # Resumed in the other order, from outside any span.
+        waits[1].callback(None)
+        waits[0].callback(None)
+        assert [result.result for result in results] == [0, 1]
+        for index, root in enumerate(roots):
+            root.finish()
+            assert _tree(root.trace) == [
+                (None, 'root{0}'.format(index)),
+                ('root{0}'.format(index), 'before'),
+                ('root{0}'.format(index), 'after'),
+                ('after', 'inner'),
+            ]
+            assert root.trace.spans[2].attributes == {'index': index}
+        assert list(exporter.traces) == [roots[0].trace, roots[1].trace]
+
+    def test_errors_are_recorded_and_propagated(self, exporter):
+        async def fail():
+            await defer.succeed(None)
+            with tracing.span('failing'):
+                raise KeyError('x')
+
+        root = tracing.startTrace('root')
+        dfd = tracing.ensureDeferred(fail(), root)
+        dfd.addErrback(lambda failure: failure.trap(KeyError))
+        assert root.trace.spans[1].attributes == {'error': 'KeyError'}
+
+    def test_untraced_spans_do_nothing(self):
+        with tracing.span('nothing') as span:
+            assert span is None
+        assert tracing.startSpan('nothing') is None
+
+    def test_sampling(self):
+        tracer = tracing.Tracer(
+            tracing.InMemorySpanExporter(), 0.1, random=lambda: 0.5)
+        assert tracer.startTrace('root') is None
+        tracer.sampleRate = 0.6
+        assert tracer.startTrace('root') is not None
+
+    def test_json_lines_exporter(self, tmp_path):
+        path = str(tmp_path / 'traces.jsonl')
+        exporter = tracing.JSONLinesSpanExporter(path)
+        root = tracing.Tracer(exporter).startTrace('root', route='r')
+        root.child('child').finish()
+        root.finish(status=200)
+        exporter.close()
+        with open(path) as fp:
+            lines = [json.loads(line) for line in fp]
+        assert [(line['name'], line['parentId']) for line in lines] == [
+            ('root', None), ('child', root.spanId)]
+        assert lines[0]['attributes'] == {'route': 'r', 'status': 200}
+        assert lines[0]['traceId'] == lines[1]['traceId']
+
+
+class TestRequestTracing:
+    def test_traces_routed_requests(self, exporter):
+        router = JSONApiRouter(klein.Klein())
+        router.injectAuthPolicy(FixedAuthPolicy())
+        wait = defer.Deferred()
+
+        async def handler(instance, request):
+            await wait
+            assert request.authenticatedUserId == 7
+            return 'done'
+
+        txRequest = CodeDummyRequest([b''])
+        txRequest.uri = b'/tasks'
+        dfd = router._translateRequest(handler)(None, txRequest)
+        assert tracing.currentSpan() is None
+        wait.callback(None)
+        assert dfd.result == 'done'
+        assert list(exporter.traces) == []
+        txRequest.setResponseCode(200)
+        txRequest.finish()
+        [trace] = exporter.traces
+        assert _tree(trace) == [(None, 'http.request'), ('http.request', 'auth')]
+        assert trace.spans[0].attributes == {
+            'route': handler.__qualname__, 'method': 'GET',
+            'uri': '/tasks', 'status': 200}
+
+    def test_undecodable_uris_are_still_served(self, exporter):
+        router = JSONApiRouter(klein.Klein())
+        router.injectAuthPolicy(FixedAuthPolicy())
+
+        def handler(instance, request):
+            return 'done'
+
+        txRequest = CodeDummyRequest([b''])
+        txRequest.uri = b'/ping?x=\xff'
+        assert router._translateRequest(handler)(None, txRequest) == 'done'
+        txRequest.setResponseCode(200)
+        txRequest.finish()
+        [trace] = exporter.traces
+        assert trace.spans[0].attributes['uri'] == '/ping?x=\ufffd'
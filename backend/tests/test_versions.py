@@ -0,0 +1,61 @@
+from txchoretracker import changes
+from txchoretracker.versions import ChangeVersions
+
+
+def _taskEvent(taskId):
+    return changes.ChangeEvent(
+        table='task', operation='UPDATE', rowId=taskId, taskGroupIds=(1,))
+
+
+class TestChangeVersions:
+    def makeLiveVersions(self):
+        versions = ChangeVersions()
+        versions.handleChange(changes.RESYNC)
+        return versions
+
+    def test_no_etags_until_live(self):
+        versions = ChangeVersions()
+        assert versions.taskETag(10, 1) is None
+        assert versions.taskListETag(1) is None
+        assert versions.profileETag(1) is None
+
+    def test_task_change_changes_task_and_list_etags(self):
+        versions = self.makeLiveVersions()
+        before = (
+            versions.taskETag(10, 1), versions.taskETag(10, 2),
+            versions.taskListETag(10))
+        versions.handleChange(_taskEvent(1))
+        assert versions.taskETag(10, 1) != before[0]
+        assert versions.taskETag(10, 2) == before[1]
+        assert versions.taskListETag(10) != before[2]
+
+    def test_membership_change_changes_list_and_task_etags(self):
+        versions = self.makeLiveVersions()
+        before = (versions.taskListETag(10), versions.taskETag(10, 1))
+        versions.handleChange(changes.ChangeEvent(
+            table='users_m2m_task_groups', operation='DELETE', rowId=10,
+            taskGroupIds=(1,)))
+        assert versions.taskListETag(10) != before[0]
+        assert versions.taskETag(10, 1) != before[1]
+
+    def test_task_etags_are_per_user(self):
+        versions = self.makeLiveVersions()
+        assert versions.taskETag(10, 1) != versions.taskETag(11, 1)
+
+    def test_profile_change(self):
+        versions = self.makeLiveVersions()
+        before = versions.profileETag(10)
+        versions.profileChanged(10)
+        assert versions.profileETag(10) != before
+        assert versions.profileETag(11) == versions.profileETag(11)
+
+    def test_resync_starts_new_epoch(self):
+        versions = self.makeLiveVersions()
+        before = versions.taskETag(10, 1)
+        versions.handleChange(changes.RESYNC)
+        assert versions.taskETag(10, 1) != before
+
+    def test_disconnect_stops_etags(self):
+        versions = self.makeLiveVersions()
+        versions.handleChange(changes.DISCONNECTED)
+        assert versions.taskETag(10, 1) is None
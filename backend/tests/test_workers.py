@@ -0,0 +1,99 @@
+from twisted.internet import error
+from twisted.internet import task
+from twisted.python import failure
+
+from txchoretracker import config
+from txchoretracker import workers
+
+
+class FakeProcessTransport:
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signalName):
+        self.signals.append(signalName)
+
+
+class FakeReactor(task.Clock):
+    def __init__(self):
+        super().__init__()
+        self.spawned = []
+
+    def spawnProcess(self, processProtocol, executable, args, env, childFDs):
+        transport = FakeProcessTransport()
+        processProtocol.makeConnection(transport)
+        self.spawned.append((processProtocol, args, childFDs))
+        return transport
+
+
+def _exit(processProtocol, status=0):
+    if status == 0:
+        reason = error.ProcessDone(status)
+    else:
+        reason = error.ProcessTerminated(status)
+    processProtocol.processEnded(failure.Failure(reason))
+
+
+class TestWorkerPoolService:
+    def makePool(self, workerCount=3):
+        self.reactor = FakeReactor()
+        restApiConfig = config.RestApiConfig(
+            development=False, cookie_secret='', domain='localhost',
+            port=0, interface='127.0.0.1', workers=workerCount,
+            shutdown_timeout=10.0)
+        pool = workers.WorkerPoolService(
+            'choretracker.ini', restApiConfig,
+            executable='python3', reactor=self.reactor)
+        pool.startService()
+        return pool
+
+    def test_workers_share_the_listening_socket(self):
+        pool = self.makePool()
+        assert len(self.reactor.spawned) == 3
+        for _, args, childFDs in self.reactor.spawned:
+            assert args[:3] == ['python3', '-m', 'txchoretracker.workers']
+            assert args[3].endswith('choretracker.ini')
+            assert args[4] == str(workers.WORKER_LISTEN_FD)
+            assert childFDs[workers.WORKER_LISTEN_FD] == pool._socket.fileno()
+        assert [args[5] for _, args, _ in self.reactor.spawned] == [
+            '0', '1', '2']
+        pool.stopService()
+
+    def test_exited_worker_is_restarted(self):
+        pool = self.makePool()
+        crashed = self.reactor.spawned[1][0]
+        _exit(crashed, 1)
+        assert len(self.reactor.spawned) == 3
+        self.reactor.advance(pool.restartDelay)
+        assert len(self.reactor.spawned) == 4
+        assert self.reactor.spawned[3][0].index == crashed.index
+        assert pool.restarts == 1
+        pool.stopService()
+
+    def test_stop_waits_for_workers(self):
+        pool = self.makePool(2)
+        results = []
+        pool.stopService().addCallback(results.append)
+        processProtocols = [spawned[0] for spawned in self.reactor.spawned]
+        assert [p.transport.signals for p in processProtocols] == [
+            ['TERM'], ['TERM']]
+        _exit(processProtocols[0])
+        assert results == []
+        _exit(processProtocols[1])
+        assert len(results) == 1
+        # Not restarted, and the socket is closed.
+        self.reactor.advance(pool.restartDelay)
+        assert len(self.reactor.spawned) == 2
+        assert pool._socket is None
+
+    def test_stop_kills_workers_that_dont_stop(self):
+        pool = self.makePool(2)
+        results = []
+        pool.stopService().addCallback(results.append)
+        processProtocols = [spawned[0] for spawned in self.reactor.spawned]
+        _exit(processProtocols[0])
+        self.reactor.advance(10.0 + pool.killGrace)
+        assert processProtocols[0].transport.signals == ['TERM']
+        assert processProtocols[1].transport.signals == ['TERM', 'KILL']
+        _exit(processProtocols[1], 9)
+        assert len(results) == 1
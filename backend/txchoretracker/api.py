@@ -1,3 +1,6 @@
+import contextlib
+import time
+
 import klein
 import zope.interface
 from twisted import logger
@@ -8,13 +11,31 @@ import attr
 from txchoretracker import models
 from txchoretracker import exceptions
 from txchoretracker import authentication
+from txchoretracker import metrics
+from txchoretracker import tracing
+from txchoretracker import push
+from txchoretracker.recurrence import parseRecurrence
+from txchoretracker.serializers import compileDumper
+from txchoretracker.versions import ChangeVersions
 from txchoretracker.kleinhelpers import (
-    JSONApiRouter, JSONResponseResource
+    InvalidJSONRequest, JSONApiRouter, JSONResponseResource,
+    StreamingJSONResponseResource,
 )
 
 
 log = logger.Logger()
 
+# Responses are per user, and should be revalidated (cheaply, with
+# If-None-Match) before being reused.
+_CACHE_CONTROL = 'private, no-cache'
+
+_serializationSeconds = metrics.REGISTRY.histogram(
+    'choretracker_serialization_duration_seconds',
+    'Time to dump models with a marshmallow schema, or a dumper '
+    'compiled from one.',
+    ('schema',),
+)
+
 
 class IApiEndpoint(zope.interface.Interface):
     router = zope.interface.Attribute('''
@@ -51,11 +72,24 @@ class ChoreTrackerApi:
 
 
 
-def makeApisApp(dbWrapper):
+def makeApisApp(dbWrapper, versions=None, changeHub=None, scheduler=None):
+    """
+    ``versions`` is the :class:`ChangeVersions` used for ETags. Without
+    one, no ETags are sent.
+
+    ``changeHub`` is the :class:`push.TaskChangeHub` for the changes
+    endpoint, which is only mounted if one is given.
+
+    ``scheduler`` is the :class:`scheduler.RepeatingTaskScheduler` to
+    wake when a repeating task is created, if any.
+    """
     authPolicy = authentication.CrappyAuthenticationPolicy()
     endpoints = [
-        TasksApiEndpoint(dbWrapper)
+        TasksApiEndpoint(dbWrapper, versions),
+        RepeatingTasksApiEndpoint(dbWrapper, scheduler),
     ]
+    if changeHub is not None:
+        endpoints.append(ChangesApiEndpoint(changeHub))
     return ChoreTrackerApi(authPolicy, endpoints).router
 
 
@@ -69,15 +103,26 @@ class UserApiEndpoint:
     json = JSONApiRouter(router)
     mountAt = 'user'
 
-    def __init__(self, dbWrapper, authPolicy, googleAppClientId):
+    def __init__(
+                self, dbWrapper, authPolicy, googleAppClientId,
+                versions=None,
+            ):
         self._db = dbWrapper
         self._authPolicy = authPolicy
+        if versions is None:
+            # Never live, so never gives out ETags.
+            versions = ChangeVersions()
+        self._versions = versions
         self._googleValidator = authentication.GoogleSignInValidator(
             googleAppClientId)
         self._userProfileSchema = models.UserProfileSchema()
+        self._userProfileDumper = compileDumper(self._userProfileSchema)
 
     @json.route('/profile', methods=['GET'])
     async def fetchProfile(self, request):
+        etag = self._versions.profileETag(request.authenticatedUserId)
+        if request.isNotModified(etag):
+            return JSONResponseResource.makeNotModified(etag, _CACHE_CONTROL)
         try:
             userProfile = await self._db.fetchUserProfile(
                 userId=request.authenticatedUserId)
@@ -90,8 +135,10 @@ class UserApiEndpoint:
             return JSONResponseResource.makeInternalServerError(
                 'unknown user ID {0}'.format(request.authenticatedUserId))
 
-        serialized = _dumpWithSchema(self._userProfileSchema, userProfile)
-        return JSONResponseResource(serialized)
+        serialized = _dumpCompiled(
+            self._userProfileDumper, self._userProfileSchema, userProfile)
+        return JSONResponseResource(
+            serialized, etag=etag, cacheControl=_CACHE_CONTROL)
 
     @json.route('/profile', methods=['PUT'])
     async def updateProfile(self, request):
@@ -102,6 +149,7 @@ class UserApiEndpoint:
         # Update the profile from the request
         userProfile = await self._db.createOrUpdateUserProfile(
             userId=request.authenticatedUserId, userProfile=editedUserProfile)
+        self._versions.profileChanged(request.authenticatedUserId)
 
         serialized = _dumpWithSchema(self._userProfileSchema, userProfile)
         return JSONResponseResource(userProfile)
@@ -129,7 +177,7 @@ class UserApiEndpoint:
         })
 
 
-@zope.interface.implementer(IApiEndpoint):
+@zope.interface.implementer(IApiEndpoint)
 class TaskGroupsApiEndpoint:
     router = klein.Klein()
     json = JSONApiRouter(router)
@@ -227,19 +275,92 @@ class TasksApiEndpoint:
     json = JSONApiRouter(router)
     mountAt = 'tasks'
 
-    def __init__(self, dbWrapper):
+    def __init__(self, dbWrapper, versions=None):
+        if versions is None:
+            # Never live, so never gives out ETags.
+            versions = ChangeVersions()
+        self._versions = versions
         self._schema = models.TaskSchema()
+        # Dumping tasks is the bulk of the work for the read paths, so
+        # use a dumper compiled from the schema rather than the schema.
+        self._dumper = compileDumper(self._schema)
+        self._listQuerySchema = models.TaskListQuerySchema()
+        self._changesQuerySchema = models.TaskChangesQuerySchema()
+        self._batchOperationSchema = models.TaskBatchOperationSchema(
+            many=True)
+        self._batchTaskSchema = models.TaskSchema(many=True, strict=False)
         self._db = dbWrapper
 
     @json.route('/', methods=['GET'])
     async def fetchAll(self, request):
         """
-        Send all the tasks that the user can view.
+        Send the tasks that the user can view, ordered by due time,
+        filtered by the query parameters (see
+        :class:`models.TaskListQuerySchema`).
+
+        Unless there's a ``limit`` or ``cursor`` parameter, all the
+        matching tasks are sent. Otherwise they are sent a page at a
+        time, and ``meta.nextCursor`` is the ``cursor`` parameter for
+        the next page, or null if this is the last one.
         """
-        tasks = await self._db.asUserFetchAllTasks(
-            userId=request.authenticatedUserId)
-        serialized = _dumpWithSchema(self._schema, tasks, many=True)
-        return JSONResponseResource(serialized)
+        # Taken before the query, so if the tasks change meanwhile the
+        # client gets an older ETag and just fetches again next time.
+        etag = self._versions.taskListETag(request.authenticatedUserId)
+        if request.isNotModified(etag):
+            return JSONResponseResource.makeNotModified(etag, _CACHE_CONTROL)
+
+        taskListQuery, errors = self._listQuerySchema.load(request.query)
+        if errors:
+            return JSONResponseResource(
+                {'message': 'invalid query parameters', 'fields': errors},
+                status=400,
+            )
+
+        if 'limit' not in request.query and 'cursor' not in request.query:
+            # This can be a lot of tasks, so stream them out rather
+            # than building the whole response in memory.
+            if taskListQuery == models.TaskListQuery():
+                tasks = self._db.asUserIterAllTasks(
+                    userId=request.authenticatedUserId)
+            else:
+                try:
+                    tasks = await _startIterating(self._db.asUserIterTasks(
+                        userId=request.authenticatedUserId,
+                        taskListQuery=taskListQuery))
+                except exceptions.UserNotInRequestedTaskGroup:
+                    return JSONResponseResource.makeForbidden(
+                        'not allowed to access task group {0}'.format(
+                            taskListQuery.task_group_id))
+            return StreamingJSONResponseResource(
+                _dumpStreamed(self._dumper, self._schema, tasks),
+                etag=etag,
+                cacheControl=_CACHE_CONTROL,
+            )
+
+        try:
+            # Ask for one extra to find out if there's another page.
+            tasks = await self._db.asUserFetchTasksPage(
+                userId=request.authenticatedUserId,
+                taskListQuery=taskListQuery,
+                limit=taskListQuery.limit + 1)
+        except exceptions.UserNotInRequestedTaskGroup:
+            return JSONResponseResource.makeForbidden(
+                'not allowed to access task group {0}'.format(
+                    taskListQuery.task_group_id))
+
+        nextCursor = None
+        if len(tasks) > taskListQuery.limit:
+            del tasks[taskListQuery.limit:]
+            nextCursor = models.TaskCursor.afterTask(tasks[-1]).encode()
+
+        serialized = _dumpCompiled(
+            self._dumper, self._schema, tasks, many=True)
+        return JSONResponseResource(
+            serialized,
+            meta={'nextCursor': nextCursor},
+            etag=etag,
+            cacheControl=_CACHE_CONTROL,
+        )
 
 
     @json.route('/', methods=['POST'])
@@ -258,16 +379,163 @@ class TasksApiEndpoint:
             return JSONResponseResource.makeBadRequest(
                 'not allowed to access task group {0}'.format(
                     taskToCreate.task_group_id))
+        self._versions.taskChanged(task.id)
 
         serialized = _dumpWithSchema(self._schema, task)
         return JSONResponseResource(serialized, status=201)
 
 
+    @json.route('/batch', methods=['POST'])
+    async def batch(self, request):
+        """
+        Create, update and delete tasks in bulk, in one transaction.
+
+        The request body is ``{"operations": [...]}``, where each
+        operation is one of::
+
+            {"op": "create", "task": {...}}
+            {"op": "update", "id": 123, "task": {...}}
+            {"op": "delete", "id": 123}
+
+        If any operation is malformed, nothing is applied and the
+        response is a 400 with the errors by operation index.
+        Otherwise the response has a result per operation, in order,
+        each with the status and data (or error) the single-task
+        endpoint would have responded with. Operations that fail don't
+        stop the others being applied.
+        """
+        try:
+            structure = request.getJSONContent()
+        except InvalidJSONRequest as e:
+            return JSONResponseResource.makeBadRequest(str(e))
+        operationStructures = None
+        if isinstance(structure, dict):
+            operationStructures = structure.get('operations')
+        if (not isinstance(operationStructures, list)
+                or not 1 <= len(operationStructures)
+                        <= models.MAX_TASK_BATCH_SIZE):
+            return JSONResponseResource.makeBadRequest(
+                'operations must be a list of 1 to {0} operations'.format(
+                    models.MAX_TASK_BATCH_SIZE))
+
+        operations, errors = self._batchOperationSchema.load(
+            operationStructures)
+        if not errors:
+            operations, errors = self._loadBatchTasks(operations)
+        if errors:
+            return JSONResponseResource(
+                {'message': 'invalid batch operations', 'items': errors},
+                status=400,
+            )
+
+        batchResults = await self._db.asUserApplyTaskBatch(
+            userId=request.authenticatedUserId, operations=operations)
+        for batchResult in batchResults:
+            if batchResult.error is None:
+                self._versions.taskChanged(batchResult.task_id)
+        return JSONResponseResource({
+            'results': [
+                self._serializeBatchResult(operation, batchResult)
+                for operation, batchResult in zip(operations, batchResults)
+            ],
+        })
+
+    def _loadBatchTasks(self, operations):
+        """
+        Load the tasks of the operations with :class:`models.TaskSchema`.
+        Returns the operations with their tasks loaded, and the errors
+        by operation index.
+        """
+        withTasks = [
+            index for index, operation in enumerate(operations)
+            if operation.task is not None
+        ]
+        tasks, taskErrors = self._batchTaskSchema.load(
+            [operations[index].task for index in withTasks])
+        if taskErrors:
+            errors = {
+                withTasks[taskIndex]: {'task': errors}
+                for taskIndex, errors in taskErrors.items()
+            }
+            return operations, errors
+        operations = list(operations)
+        for index, task in zip(withTasks, tasks):
+            operations[index] = attr.evolve(operations[index], task=task)
+        return operations, {}
+
+    def _serializeBatchResult(self, operation, batchResult):
+        error = batchResult.error
+        if error is None:
+            if operation.operation == 'delete':
+                return {'status': 200, 'data': {}}
+            status = 201 if operation.operation == 'create' else 200
+            return {
+                'status': status,
+                'data': _dumpCompiled(
+                    self._dumper, self._schema, batchResult.task),
+            }
+        if isinstance(error, exceptions.NoSuchTask):
+            status = 404
+            message = 'no such task'
+        elif isinstance(error, exceptions.UserNotInTaskGroup):
+            status = 403
+            message = 'not allowed to access that task'
+        elif isinstance(error, exceptions.UserNotInRequestedTaskGroup):
+            status = 400
+            message = 'not allowed to access task group {0}'.format(
+                operation.task.task_group_id)
+        elif isinstance(error, exceptions.DuplicateTaskInBatch):
+            status = 400
+            message = 'task already changed earlier in the batch'
+        else:
+            raise error
+        return {'status': status, 'error': {'message': message}}
+
+    @json.route('/changes', methods=['GET'])
+    async def fetchChanges(self, request):
+        """
+        Send what changed in the tasks the user can view since the
+        ``since`` cursor, for clients that keep a copy of them::
+
+            {"tasks": [...], "deleted": [123, ...], "reset": false}
+
+        ``tasks`` were created or modified, and ``deleted`` are the IDs
+        of the tasks deleted or no longer visible to the user.
+        ``meta.cursor`` is the ``since`` parameter for the next sync.
+
+        Without ``since`` (the first sync), or if the cursor is too old
+        or the user's task groups have changed since, ``reset`` is
+        true and ``tasks`` are all the user's tasks: the client should
+        replace its copy with them.
+        """
+        query, errors = self._changesQuerySchema.load(request.query)
+        if errors:
+            return JSONResponseResource(
+                {'message': 'invalid query parameters', 'fields': errors},
+                status=400,
+            )
+
+        changes = await self._db.asUserFetchTaskChanges(
+            userId=request.authenticatedUserId, since=query.get('since'))
+        return JSONResponseResource(
+            {
+                'tasks': _dumpCompiled(
+                    self._dumper, self._schema, changes.tasks, many=True),
+                'deleted': changes.deleted_task_ids,
+                'reset': changes.reset,
+            },
+            meta={'cursor': changes.cursor.encode()},
+            cacheControl=_CACHE_CONTROL,
+        )
+
     @json.route('/<pgbigserial:taskId>', methods=['GET'])
     async def fetch(self, request, taskId):
         """
         Send this task.
         """
+        etag = self._versions.taskETag(request.authenticatedUserId, taskId)
+        # Fetched even for a conditional GET (usually from the cache),
+        # so that only users who can see the task get a 304.
         try:
             task = await self._db.asUserFetchTask(
                 userId=request.authenticatedUserId,
@@ -278,8 +546,11 @@ class TasksApiEndpoint:
         except exceptions.UserNotInTaskGroup:
             return JSONResponseResource.makeForbidden(
                 'Not allowed to access task with ID {0}'.format(taskId))
-        serialized = _dumpWithSchema(self._schema, task)
-        return JSONResponseResource(serialized)
+        if request.isNotModified(etag):
+            return JSONResponseResource.makeNotModified(etag, _CACHE_CONTROL)
+        serialized = _dumpCompiled(self._dumper, self._schema, task)
+        return JSONResponseResource(
+            serialized, etag=etag, cacheControl=_CACHE_CONTROL)
 
     @json.route('/<pgbigserial:taskId>', methods=['PUT'])
     async def update(self, request, taskId):
@@ -301,6 +572,7 @@ class TasksApiEndpoint:
             return JSONResponseResource.makeBadRequest(
                 'not allowed to move task to task group {0}'.format(
                     task_to_update.task_group_id))
+        self._versions.taskChanged(taskId)
 
         serialized = _dumpWithSchema(self._schema, task)
         return JSONResponseResource(serialized)
@@ -319,10 +591,132 @@ class TasksApiEndpoint:
         except exceptions.UserNotInTaskGroup:
             return JSONResponseResource.makeForbidden(
                 'not allowed to access that task')
+        self._versions.taskChanged(taskId)
 
         return JSONResponseResource({})
 
 
+@zope.interface.implementer(IApiEndpoint)
+class RepeatingTasksApiEndpoint:
+    """
+    Repeating tasks, whose tasks are created ahead of time by the
+    :class:`scheduler.RepeatingTaskScheduler`.
+    """
+    router = klein.Klein()
+    json = JSONApiRouter(router)
+    mountAt = 'repeating-tasks'
+
+    def __init__(self, dbWrapper, scheduler=None):
+        self._schema = models.RepeatingTaskSchema()
+        self._loadSchema = models.RepeatingTaskSchema(strict=False)
+        self._db = dbWrapper
+        self._scheduler = scheduler
+
+    @json.route('/', methods=['GET'])
+    async def fetchAll(self, request):
+        """
+        Send all the repeating tasks that the user can view.
+        """
+        repeatingTasks = await self._db.asUserFetchAllRepeatingTasks(
+            userId=request.authenticatedUserId)
+        serialized = _dumpWithSchema(self._schema, repeatingTasks, many=True)
+        return JSONResponseResource(serialized)
+
+    @json.route('/', methods=['POST'])
+    async def create(self, request):
+        """
+        Create a new repeating task. Its first tasks are created
+        shortly after.
+        """
+        repeatingTaskToCreate, errors = self._loadSchema.load(
+            request.getJSONContent())
+        if errors:
+            return JSONResponseResource(
+                {'message': 'invalid repeating task', 'fields': errors},
+                status=400,
+            )
+        recurrence = parseRecurrence(repeatingTaskToCreate.recurrence)
+        repeatingTaskToCreate = attr.evolve(
+            repeatingTaskToCreate,
+            next_due_unix=next(recurrence.occurrences(
+                repeatingTaskToCreate.start_unix), None))
+
+        try:
+            repeatingTask = await self._db.asUserCreateRepeatingTask(
+                userId=request.authenticatedUserId,
+                repeatingTaskToCreate=repeatingTaskToCreate)
+        except exceptions.UserNotInRequestedTaskGroup:
+            return JSONResponseResource.makeBadRequest(
+                'not allowed to access task group {0}'.format(
+                    repeatingTaskToCreate.task_group_id))
+        if self._scheduler is not None:
+            self._scheduler.wake()
+
+        serialized = _dumpWithSchema(self._schema, repeatingTask)
+        return JSONResponseResource(serialized, status=201)
+
+    @json.route('/<pgbigserial:repeatingTaskId>', methods=['GET'])
+    async def fetch(self, request, repeatingTaskId):
+        """
+        Send this repeating task.
+        """
+        try:
+            repeatingTask = await self._db.asUserFetchRepeatingTask(
+                userId=request.authenticatedUserId,
+                repeatingTaskId=repeatingTaskId)
+        except exceptions.NoSuchRepeatingTask:
+            return JSONResponseResource.makeNotFound(
+                'Repeating task with ID {0} does not exist'.format(
+                    repeatingTaskId))
+        except exceptions.UserNotInTaskGroup:
+            return JSONResponseResource.makeForbidden(
+                'Not allowed to access repeating task with ID {0}'.format(
+                    repeatingTaskId))
+        serialized = _dumpWithSchema(self._schema, repeatingTask)
+        return JSONResponseResource(serialized)
+
+    @json.route('/<pgbigserial:repeatingTaskId>', methods=['DELETE'])
+    async def delete(self, request, repeatingTaskId):
+        """
+        Delete this repeating task, and its tasks that aren't due yet.
+        """
+        try:
+            await self._db.asUserDeleteRepeatingTask(
+                userId=request.authenticatedUserId,
+                repeatingTaskId=repeatingTaskId)
+        except exceptions.NoSuchRepeatingTask:
+            return JSONResponseResource.makeNotFound(
+                'no such repeating task')
+        except exceptions.UserNotInTaskGroup:
+            return JSONResponseResource.makeForbidden(
+                'not allowed to access that repeating task')
+
+        return JSONResponseResource({})
+
+
+@zope.interface.implementer(IApiEndpoint)
+class ChangesApiEndpoint:
+    """
+    Live task changes, so clients don't have to poll.
+    """
+    router = klein.Klein()
+    json = JSONApiRouter(router)
+    mountAt = 'changes'
+
+    def __init__(self, changeHub):
+        self._changeHub = changeHub
+
+    @json.route('/', methods=['GET'], longLived=True)
+    def stream(self, request):
+        """
+        Open a Server-Sent Events stream of changes to the tasks the
+        user can view (see :mod:`txchoretracker.push`). Responds with
+        503 if too many streams are open already.
+        """
+        return push.EventStreamResource(
+            self._changeHub, request.authenticatedUserId)
+
+
 def _loadWithSchemaFromRequest(schema, request):
     # TODO: Figure out what exceptions this might raise
     structure = request.getJSONContent()
@@ -332,9 +726,71 @@ def _loadWithSchemaFromRequest(schema, request):
     return task
 
 
+@contextlib.contextmanager
+def _timedSerialization(schema):
+    # Time the block (which must not await) as serialization with
+    # ``schema``, in the histogram and as a span.
+    schemaName = type(schema).__name__
+    start = time.perf_counter()
+    with tracing.span('serialize', schema=schemaName):
+        yield
+    _serializationSeconds.labels(schemaName).observe(
+        time.perf_counter() - start)
+
+
+def _dumpCompiled(dumper, schema, model_or_models, many=False):
+    """
+    Dump with ``dumper``, a :class:`CompiledDumper` compiled from
+    ``schema``.
+    """
+    with _timedSerialization(schema):
+        return dumper.dump(model_or_models, many=many)
+
+
+async def _startIterating(asyncIterable):
+    """
+    Get the first item from ``asyncIterable`` now, so that a failure
+    to start (like a forbidden filter) is raised here rather than once
+    the response is being streamed. Returns an async iterator over all
+    the items.
+    """
+    iterator = asyncIterable.__aiter__()
+    try:
+        firstItems = [await iterator.__anext__()]
+    except StopAsyncIteration:
+        firstItems = []
+
+    async def allItems():
+        try:
+            for item in firstItems:
+                yield item
+            async for item in iterator:
+                yield item
+        finally:
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+    return allItems()
+
+
+async def _dumpStreamed(dumper, schema, models):
+    """
+    Dump the models from the async iterable ``models`` one by one with
+    ``dumper``, recording the total time taken once they've all been
+    dumped.
+    """
+    elapsed = 0.0
+    async for model in models:
+        start = time.perf_counter()
+        serialized = dumper.dumpOne(model)
+        elapsed += time.perf_counter() - start
+        yield serialized
+    _serializationSeconds.labels(type(schema).__name__).observe(elapsed)
+
+
 def _dumpWithSchema(schema, model_or_models, many=False):
     # TODO: Raise a better exception if errors is not empty
-    structure, errors = schema.dump(model_or_models, many=many)
+    with _timedSerialization(schema):
+        structure, errors = schema.dump(model_or_models, many=many)
     if errors:
         raise Exception('failed to serialize {0}: {1}'.format(
             model_or_models, errors))
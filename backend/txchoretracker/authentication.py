@@ -1,11 +1,21 @@
+import base64
 import time
 import json
 import hmac
+import re
 
 import attr
 import treq
-from google.oauth2 import id_token as google_id_token
-from google.auth import transport as google_auth_transport
+from google.auth import crypt as google_crypt
+from twisted import logger
+from twisted.internet import defer
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+from txchoretracker.cache import LRUCache
+
+
+log = logger.Logger()
 
 
 class CrappyAuthenticationPolicy:
@@ -14,19 +24,40 @@ class CrappyAuthenticationPolicy:
 
 
 class AuthTicketAuthenticationPolicy:
+    """
+    Authenticates users by a signed cookie holding their user ID and
+    when they authenticated.
+
+    Verifying a ticket means an HMAC and a JSON parse, so the tickets
+    that pass are remembered (up to ``ticketCacheSize`` of them, least
+    recently used first out) until they reach the reauth boundary.
+    Only verified tickets are cached, so junk cookies can't push out
+    real ones. Set ``ticketCacheSize`` to 0 to verify every time.
+
+    Tickets are signed with a single ``secret`` or a ``keyring`` (see
+    :class:`SignedJSONSerializer`). A ticket that verifies with an
+    older key of the keyring is replaced on the response by one
+    signed with the current key, with the same ``authenticatedAt``.
+    Rotating the key therefore doesn't log anyone out, as long as
+    they come back before the old key is dropped.
+    """
     def __init__(
                 self,
                 *,
                 cookieDomain: str,
-                secret: bytes,
+                secret: bytes = None,
+                keyring=None,
                 digestmod='sha512',
                 reauthPeriod=3600 * 24,  # Default to 1 day
                 cookiePath: str = None,
                 cookieName='AUTHTKT',
                 cookieSecure=True,
+                ticketCacheSize=10000,
+                clock=time.time,
             ):
         self._serializer = SignedJSONSerializer(
             secret=secret,
+            keyring=keyring,
             digestmod=digestmod)
         self._addCookieKeywords = {
             'domain': cookieDomain,
@@ -37,6 +68,20 @@ class AuthTicketAuthenticationPolicy:
         }
         self._reauthPeriod = reauthPeriod
         self._cookieName = cookieName
+        self._clock = clock
+        self._ticketCache = None
+        if ticketCacheSize > 0:
+            # Every entry gets its own TTL, so the default is unused.
+            # The cache runs on the same (wall) clock as the reauth
+            # check, so an entry expires exactly when verifying the
+            # ticket again would start failing, even if the clock
+            # jumps.
+            self._ticketCache = LRUCache(
+                maxEntries=ticketCacheSize,
+                maxSize=ticketCacheSize,
+                ttl=reauthPeriod,
+                clock=clock,
+            )
 
     def rememberUser(self, txRequest, userId):
         """
@@ -45,13 +90,12 @@ class AuthTicketAuthenticationPolicy:
         """
         structure = {
             'userId': userId,
-            'authenticatedAt': int(time.time())
+            'authenticatedAt': int(self._clock())
         }
         cookiePayload = self._serializer.serializeWithSignature(structure)
         txRequest.addCookie(
             self._cookieName, cookiePayload, **self._addCookieKeywords)
 
-
     def getAuthenticatedUserId(self, request):
         """
         Ensure that the auth cookie has not expired and the signature
@@ -62,40 +106,140 @@ class AuthTicketAuthenticationPolicy:
         cookiePayload = request.getCookie(self._cookieName)
         if cookiePayload is None:
             return None
+        if self._ticketCache is not None:
+            userId = self._ticketCache.get(cookiePayload)
+            if userId is not None:
+                return userId
         try:
-            deserialized = self._serializer.deserializeVerifyingSignature(
-                cookiePayload)
+            verified = self._serializer.verify(cookiePayload)
         except SignedJSONSerializerError:
             return None
-        sinceAuth = int(time.time()) - deserialized.get('authenticatedAt', 0)
+        deserialized = verified.structure
+        authenticatedAt = deserialized.get('authenticatedAt', 0)
+        now = self._clock()
+        sinceAuth = int(now) - authenticatedAt
         if sinceAuth > self._reauthPeriod:
             return None
-        return deserialized['userId']
+        userId = deserialized['userId']
+        if verified.needsResigning:
+            # Not cached: the client should send the new ticket from
+            # now on, and the old one stops verifying once its key is
+            # dropped.
+            self._resignTicket(request, deserialized, sinceAuth)
+        elif self._ticketCache is not None:
+            # Valid until sinceAuth would go past reauthPeriod.
+            self._ticketCache.put(
+                cookiePayload, userId,
+                ttl=authenticatedAt + self._reauthPeriod + 1 - now)
+        return userId
+
+    def _resignTicket(self, request, deserialized, sinceAuth):
+        cookiePayload = self._serializer.serializeWithSignature(deserialized)
+        addCookieKeywords = dict(
+            self._addCookieKeywords,
+            max_age=max(self._reauthPeriod - sinceAuth, 0),
+        )
+        request.addCookie(
+            self._cookieName, cookiePayload, **addCookieKeywords)
+
+    def ticketCacheStats(self):
+        """
+        The ticket cache counters (see :meth:`LRUCache.stats`), or None
+        if there is no cache.
+        """
+        if self._ticketCache is None:
+            return None
+        return self._ticketCache.stats()
 
 
 
+def _checkKeyId(instance, attribute, value):
+    if value is not None and not _KEY_ID_RE.match(value):
+        raise ValueError(
+            'Key IDs must be letters, digits, "-" and "_", not {0!r}'.format(
+                value))
+
+
+_KEY_ID_RE = re.compile(r'\A[A-Za-z0-9_-]+\Z')
+
+
+@attr.s(frozen=True)
+class SigningKey:
+    """
+    One key of a :class:`SignedJSONSerializer` keyring.
+
+    Attributes:
+        keyId (str or None):
+            Names the key in the tickets it signs. None for a key
+            whose tickets don't name it, like all tickets from before
+            there were keyrings.
+        secret (bytes):
+            The HMAC secret.
+    """
+    keyId = attr.ib(validator=_checkKeyId)
+    secret = attr.ib(repr=False, validator=attr.validators.instance_of(bytes))
+
+
+@attr.s(frozen=True)
+class VerifiedPayload:
+    """
+    Attributes:
+        structure (dict):
+            The deserialized mapping.
+        keyId (str or None):
+            The ID of the key whose signature matched.
+        needsResigning (bool):
+            If the signature was made with a key other than the
+            current signing key.
+    """
+    structure = attr.ib()
+    keyId = attr.ib()
+    needsResigning = attr.ib()
+
+
 class SignedJSONSerializer:
     """
     Supports serialization of a mapping to a signed JSON payload.
 
     Keys must be strings, values can be strings or ints.
+
+    Either a single ``secret`` or a ``keyring`` of
+    :class:`SigningKey` instances is given. Payloads are always signed
+    with the first key of the keyring, and named by its key ID, while
+    a payload signed by any key in the keyring verifies. To rotate
+    keys, put a new key first, and drop the old one once the payloads
+    it signed have been re-signed or have expired. A single ``secret``
+    is a keyring of one key without a key ID.
     """
-    def __init__(self, *, secret: bytes, digestmod):
-        self._secret = secret
+    def __init__(self, *, secret: bytes = None, digestmod, keyring=None):
+        if (secret is None) == (keyring is None):
+            raise TypeError('Give exactly one of secret and keyring')
+        if keyring is None:
+            keyring = [SigningKey(keyId=None, secret=secret)]
+        keyring = list(keyring)
+        if not keyring:
+            raise ValueError('The keyring must have at least one key')
+        self._signingKey = keyring[0]
+        self._keysById = {}
+        for key in keyring:
+            if key.keyId in self._keysById:
+                raise ValueError('Duplicate key ID {0!r}'.format(key.keyId))
+            self._keysById[key.keyId] = key
         self._digestmod = digestmod
 
     def serializeWithSignature(self, dataStructure: dict) -> bytes:
         """
         Serialize ``dataStructure`` to an ascii-only JSON payload
-        with a hex signature appended.
+        with the signing key ID (if it has one) and a hex signature
+        appended.
         """
         payload = json.dumps(dataStructure, ensure_ascii=True).encode('ascii')
-        hexmac = hmac.new(
-            self._secret,
-            payload,
-            digestmod=self._digestmod,
-        ).hexdigest()
-        return '{0};mac={1}'.format(serialized, hexmac).encode('ascii')
+        if self._signingKey.keyId is not None:
+            payload += ':kid={0}'.format(
+                self._signingKey.keyId).encode('ascii')
+        return payload + ':mac={0}'.format(
+            self._hexmac(self._signingKey, payload).decode('ascii'),
+        ).encode('ascii')
 
     def deserializeVerifyingSignature(self, serialized: bytes):
         """
@@ -106,21 +250,48 @@ class SignedJSONSerializer:
             FormatMismatch:
                 if the serialized payload could not be properly
                 parsed.
+            UnknownKey:
+                if the payload names a key that isn't in the keyring.
             SignatureMismatch:
                 if the MAC doesn't match up with the payload.
 
         """
-        payload, sep, hexmac = serialized.rpartition(b':mac=')
+        return self.verify(serialized).structure
+
+    def verify(self, serialized: bytes) -> VerifiedPayload:
+        """
+        Like :meth:`deserializeVerifyingSignature`, but also says
+        which key the payload was signed with.
+        """
+        # The MAC covers the key ID too, so it can't be swapped.
+        signed, sep, hexmac = serialized.rpartition(b':mac=')
         if not sep:
             raise FormatMismatch('Missing separator')
-        calculated_hexmac = hmac.new(
-            self._secret,
-            payload,
+        payload, sep, keyId = signed.rpartition(b':kid=')
+        if sep:
+            try:
+                keyId = keyId.decode('ascii')
+            except UnicodeDecodeError:
+                raise FormatMismatch('Invalid key ID')
+        else:
+            payload, keyId = signed, None
+        key = self._keysById.get(keyId)
+        if key is None:
+            raise UnknownKey(keyId)
+        if not hmac.compare_digest(hexmac, self._hexmac(key, signed)):
+            raise SignatureMismatch
+        return VerifiedPayload(
+            structure=json.loads(payload),
+            keyId=keyId,
+            needsResigning=key is not self._signingKey,
+        )
+
+    def _hexmac(self, key, signed):
+        return hmac.new(
+            key.secret,
+            signed,
             digestmod=self._digestmod,
         ).hexdigest().encode('ascii')
-        if not hmac.compare_digest(hexmac, calculated_hexmac):
-            raise SignatureMismatch
-        return json.loads(payload)
 
 
 class SignedJSONSerializerError(Exception):
@@ -135,98 +306,347 @@ class SignatureMismatch(SignedJSONSerializerError):
     pass
 
 
+class UnknownKey(SignedJSONSerializerError):
+    pass
+
+
 
 
 # https://developers.google.com/identity/sign-in/web/backend-auth
-# It looks like google.oauth2.verify_oauth2_token just uses
-# the passed-in request to grab the Google certificates for
-# verification... So if I pre-grab those and just make the
-# passed-in request check the URL matches what's expected,
-# it should be good enough to use the lib.
 #
 # The URL that provides public certificates for verifying ID tokens issued
 # by Google's OAuth 2.0 authorization server.
 _GOOGLE_OAUTH2_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
 
+_GOOGLE_ISSUERS = frozenset({'accounts.google.com', 'https://accounts.google.com'})
+# Leeway for the clock differences between us and Google when checking
+# the token's issued at and expiry times, as google-auth 1.x allows.
+_ID_TOKEN_CLOCK_SKEW = 300
+# google-auth (from 1.4.1) verifies signatures with cryptography, and
+# so OpenSSL, if it's installed, and otherwise in pure Python (with
+# rsa), which holds the GIL throughout.
+try:
+    from google.auth.crypt import _cryptography_rsa  # noqa: F401
+except ImportError:
+    _OPENSSL_VERIFIER = False
+else:
+    _OPENSSL_VERIFIER = True
+
 
 class GoogleSignInValidator:
+    """
+    Validates Google Sign In ID tokens against Google's certificates,
+    which are kept fresh in the background.
+
+    The signature checks run in a pool of up to
+    ``verificationThreads`` threads, so a burst of sign-ins doesn't
+    hold up other requests on the reactor thread. With google-auth
+    1.4.1 or later and cryptography installed (as the Pipfile
+    requires), the RSA work happens in OpenSSL, which releases the
+    GIL, so the threads also verify tokens in parallel. With the
+    pure-Python fallback they don't, and a warning is logged. With 0,
+    tokens are verified on the reactor thread. The public keys are
+    parsed from the certificates once per key ID, not once per
+    token.
+
+    The certificates are fetched once, when the first token needs
+    them, and then kept for as long as the response's Cache-Control
+    max-age says (or ``_CERTS_MAX_AGE`` without one). Before they
+    expire, a refresh is started in the background, so sign-ins
+    don't wait for it. If that refresh fails, or the expiry passes
+    without a refresh, sign-ins keep using the old certificates for
+    up to ``_CERTS_MAX_STALE`` seconds more while a refresh is
+    retried. Only after that do they wait for a fetch. However many
+    sign-ins need the certificates at once, only one fetch is made.
+
+    Ages are measured with ``clock`` (the monotonic clock by default),
+    so changes to the system time don't matter.
+
+    Args:
+        googleAppClientId (str): The app's OAuth2 client ID.
+        certsUrl (str): Where to fetch the certificates from.
+        httpClient: A treq-like client (with ``get`` and ``content``)
+            to fetch them with; a ``treq.testing.StubTreq`` in front
+            of a stand-in certificate resource in tests.
+        reactor: Schedules the background refreshes.
+        clock (callable): Returns the current time in seconds. Must
+            not go backwards.
+        verificationThreads (int): Maximum number of threads verifying
+            tokens at once.
+    """
     _CERTS_MAX_AGE = 3600
+    _CERTS_MAX_STALE = 3600 * 24
+    # Refresh when this fraction of the max age has passed...
+    _REFRESH_AT = 0.8
+    # ...and retry this many seconds after a failed refresh.
+    _RETRY_DELAY = 60
 
-    def __init__(self, googleAppClientId):
+    def __init__(
+                self,
+                googleAppClientId,
+                *,
+                certsUrl=_GOOGLE_OAUTH2_CERTS_URL,
+                httpClient=treq,
+                reactor=None,
+                clock=time.monotonic,
+                verificationThreads=4,
+            ):
+        if reactor is None:
+            from twisted.internet import reactor
         self._googleAppClientId = googleAppClientId
-        self._certsRetrievedAt = 0
-        self._request_fake = None
+        self._certsUrl = certsUrl
+        self._httpClient = httpClient
+        self._reactor = reactor
+        self._clock = clock
+        self._verificationThreads = verificationThreads
+        self._threadPool = None
+        if verificationThreads and not _OPENSSL_VERIFIER:
+            log.warn(
+                'google-auth is verifying tokens in pure Python, so the '
+                'verification threads hold the GIL; install google-auth '
+                '>= 1.4.1 and cryptography to verify them in OpenSSL')
+        self._certs = None
+        self._certsRetrievedAt = None
+        self._certsMaxAge = self._CERTS_MAX_AGE
+        self._refreshWaiters = []
+        self._scheduledRefresh = None
 
     async def validateUserIdFromToken(self, token):
         """
         Validate a Google Sign In ID token and return the associated
         Google user ID.
         """
-        certsRequestFake = await self._makeGoogleAuthCertsRequestFake()
+        certs = await self._getCerts()
         try:
-            idinfo = google_id_token.verify_oauth2_token(
-                token, certsRequestFake, self._googleAppClientId)
-
-            if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-                raise ValueError('Wrong issuer.')
-
-            # If auth request is from a G Suite domain:
-            # if idinfo['hd'] != GSUITE_DOMAIN_NAME:
-            #     raise ValueError('Wrong hosted domain.')
-
-            # ID token is valid. Get the user's Google Account ID from the decoded token.
-            googleUserId = idinfo['sub']
+            idinfo = await self._runVerification(
+                _verifyGoogleIdToken, token, certs, self._googleAppClientId)
         except ValueError as e:
             raise InvalidGoogleSignInIdToken(e)
 
-        return googleUserId
+        # ID token is valid. Get the user's Google Account ID from the decoded token.
+        return idinfo['sub']
+
+    def _runVerification(self, function, *args):
+        if self._verificationThreads == 0:
+            return defer.maybeDeferred(function, *args)
+        if self._threadPool is None:
+            self._threadPool = ThreadPool(
+                minthreads=0,
+                maxthreads=self._verificationThreads,
+                name='GoogleSignInValidator',
+            )
+            self._threadPool.start()
+            self._reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._threadPool.stop)
+        return threads.deferToThreadPool(
+            self._reactor, self._threadPool, function, *args)
+
+    def stop(self):
+        """
+        Cancel the next background refresh, if one is scheduled.
+        (The verification threads are stopped when the reactor shuts
+        down.)
+        """
+        if self._scheduledRefresh is not None:
+            if self._scheduledRefresh.active():
+                self._scheduledRefresh.cancel()
+            self._scheduledRefresh = None
+
+    async def _getCerts(self):
+        if self._certs is not None:
+            age = self._clock() - self._certsRetrievedAt
+            if age <= self._certsMaxAge:
+                return self._certs
+            if age <= self._certsMaxAge + self._CERTS_MAX_STALE:
+                # Stale, but still usable while they are refreshed.
+                self._refreshInBackground()
+                return self._certs
+        await self._refreshCerts()
+        return self._certs
+
+    def _refreshCerts(self):
+        """
+        Return a Deferred that fires once the refresh in progress
+        (started now if there isn't one) has finished.
+        """
+        waiter = defer.Deferred()
+        self._refreshWaiters.append(waiter)
+        if len(self._refreshWaiters) == 1:
+            dfd = defer.ensureDeferred(self._fetchCerts())
+            dfd.addBoth(self._refreshFinished)
+        return waiter
+
+    def _refreshFinished(self, result):
+        waiters, self._refreshWaiters = self._refreshWaiters, []
+        for waiter in waiters:
+            waiter.callback(result)
+
+    def _refreshInBackground(self):
+        self.stop()
+        if self._refreshWaiters:
+            # Already refreshing.
+            return
+
+        def ebRetry(failure):
+            log.failure(
+                'Failed to refresh the Google OAuth2 certificates',
+                failure=failure)
+            self._scheduleRefresh(self._RETRY_DELAY)
+
+        self._refreshCerts().addErrback(ebRetry)
+
+    def _scheduleRefresh(self, delay):
+        self.stop()
+        self._scheduledRefresh = self._reactor.callLater(
+            delay, self._refreshInBackground)
+
+    async def _fetchCerts(self):
+        response = await self._httpClient.get(self._certsUrl)
+        body = await self._httpClient.content(response)
+        if response.code != 200:
+            raise GoogleCertsUnavailable(
+                'Fetching {0} gave status {1}'.format(
+                    self._certsUrl, response.code))
+        headers = {
+            key.decode('ascii').lower(): values[-1].decode('utf-8')
+            for key, values in response.headers.getAllRawHeaders()
+        }
+        self._certs = _GoogleCerts(
+            json.loads(body.decode('utf-8')), previous=self._certs)
+        self._certsRetrievedAt = self._clock()
+        self._certsMaxAge = _certsMaxAge(headers, self._CERTS_MAX_AGE)
+        self._scheduleRefresh(max(
+            self._certsMaxAge * self._REFRESH_AT, self._RETRY_DELAY))
 
-    async def _makeGoogleAuthCertsRequestFake(self):
-        # FIXME: This is not resilient in the face of system clock changes
-        if not self._request_fake or time.time() - self._certsRetrievedAt > self._CERTS_MAX_AGE:
-            response = await treq.get(_GOOGLE_OAUTH2_CERTS_URL)
-            status = response.code
-            headers = {
-                key.decode('ascii'): value.decode('utf-8')
-                for key, value in response.headers.getAllRawHeaders()
-            }
-            body = await treq.content(response)
-            self._request_fake = _GoogleOAuth2CertsRequestFake(
-                status, headers, body)
-            self._certsRetrievedAt = time.time()
 
-        return self._request_fake
+_MAX_AGE_RE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?([0-9]+)"?\s*(?:,|$)')
 
 
-class InvalidGoogleSignInIdToken(Exception):
+def _certsMaxAge(headers, default):
+    """
+    How many more seconds a response with ``headers`` (a dict with
+    lowercase keys) may be used for, from its Cache-Control max-age
+    less its Age.
+    """
+    match = _MAX_AGE_RE.search(headers.get('cache-control', '').lower())
+    if match is None:
+        return default
+    maxAge = int(match.group(1))
+    try:
+        maxAge -= int(headers.get('age', 0))
+    except ValueError:
+        pass
+    return max(maxAge, 0)
+
+
+class GoogleCertsUnavailable(Exception):
     pass
 
 
-class _GoogleOAuth2CertsRequestFake(google_auth_transport.Request):
-    def __init__(
-            self, response_status_code,
-            response_headers_dict, certs_response_bytes):
-        self._response_status_code = response_status_code
-        self._response_headers_dict = response_headers_dict
-        self._response_body_bytes = certs_response_bytes
-
-    def __call__(
-            self, url, method='GET', body=None, headers=None, timeout=None,
-            **kwargs):
-        if url != _GOOGLE_OAUTH2_CERTS_URL:
-            raise Exception('Expected certs url {0} but got {1}'.format(
-                _GOOGLE_OAUTH2_CERTS_URL, url))
-        if method != 'GET':
-            raise Exception('Expected GET method but got {0}'.format(method))
-
-        return _GoogleOAuth2CertsResponse(
-            self._response_status_code,
-            self._response_headers_dict,
-            self._response_body_bytes)
-
-
-@attr.s
-class _GoogleOAuth2CertsResponse(google_auth_transport.Response):
-    status = attr.ib()
-    headers = attr.ib()
-    data = attr.ib()
+class _GoogleCerts:
+    """
+    A set of Google's certificates, by key ID, with the verifiers for
+    their public keys made as they are needed.
+
+    Verifiers are shared with ``previous`` (the set these replace)
+    for the certificates that haven't changed, which is most of them
+    at any refresh.
+
+    Used from the verification threads; at worst two of them make the
+    same verifier.
+    """
+    def __init__(self, certsByKeyId, previous=None):
+        if not isinstance(certsByKeyId, dict):
+            raise GoogleCertsUnavailable('Unexpected certificates format')
+        self.certsByKeyId = certsByKeyId
+        self._verifiersByKeyId = {}
+        if previous is not None:
+            for keyId, verifier in previous._verifiersByKeyId.items():
+                if previous.certsByKeyId[keyId] == certsByKeyId.get(keyId):
+                    self._verifiersByKeyId[keyId] = verifier
+
+    def getVerifier(self, keyId):
+        """
+        The :class:`google.auth.crypt.Verifier` for ``keyId``.
+
+        Raises:
+            ValueError: if there is no such key.
+        """
+        verifier = self._verifiersByKeyId.get(keyId)
+        if verifier is None:
+            cert = self.certsByKeyId.get(keyId)
+            if cert is None:
+                raise ValueError(
+                    'No certificate for key ID {0!r}'.format(keyId))
+            verifier = google_crypt.RSAVerifier.from_string(cert)
+            self._verifiersByKeyId[keyId] = verifier
+        return verifier
+
+    def getVerifiers(self):
+        return [self.getVerifier(keyId) for keyId in self.certsByKeyId]
+
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + b'=' * (-len(segment) % 4))
+
+
+def _verifyGoogleIdToken(token, certs, audience, now=None):
+    """
+    Verify a Google ID token (an RS256 JWT) against ``certs``, a
+    :class:`_GoogleCerts`, like ``google.oauth2.id_token`` does, and
+    return its claims.
+
+    Raises:
+        ValueError: if the token isn't valid.
+    """
+    if isinstance(token, str):
+        token = token.encode('ascii')
+    if token.count(b'.') != 2:
+        raise ValueError('Wrong number of segments in token')
+    signedSection, _, encodedSignature = token.rpartition(b'.')
+    encodedHeader, _, encodedPayload = signedSection.partition(b'.')
+    header = json.loads(_b64decode(encodedHeader).decode('utf-8'))
+    payload = json.loads(_b64decode(encodedPayload).decode('utf-8'))
+    signature = _b64decode(encodedSignature)
+    if not isinstance(header, dict) or not isinstance(payload, dict):
+        raise ValueError('Token segments must be JSON objects')
+
+    if header.get('alg') != 'RS256':
+        raise ValueError(
+            'Unsupported signature algorithm {0!r}'.format(header.get('alg')))
+    keyId = header.get('kid')
+    if keyId is not None:
+        verifiers = [certs.getVerifier(keyId)]
+    else:
+        verifiers = certs.getVerifiers()
+    if not any(
+            verifier.verify(signedSection, signature)
+            for verifier in verifiers):
+        raise ValueError('Could not verify token signature.')
+
+    if now is None:
+        now = time.time()
+    try:
+        issuedAt = payload['iat']
+        expiresAt = payload['exp']
+    except KeyError as e:
+        raise ValueError('Token is missing the {0} claim'.format(e))
+    if now < issuedAt - _ID_TOKEN_CLOCK_SKEW:
+        raise ValueError('Token used too early')
+    if expiresAt + _ID_TOKEN_CLOCK_SKEW < now:
+        raise ValueError('Token expired')
+    if payload.get('aud') != audience:
+        raise ValueError(
+            'Token has wrong audience {0!r}'.format(payload.get('aud')))
+    if payload.get('iss') not in _GOOGLE_ISSUERS:
+        raise ValueError('Wrong issuer.')
+    # If auth request is from a G Suite domain:
+    # if payload['hd'] != GSUITE_DOMAIN_NAME:
+    #     raise ValueError('Wrong hosted domain.')
+    if 'sub' not in payload:
+        raise ValueError('Token is missing the sub claim')
+    return payload
+
+
+class InvalidGoogleSignInIdToken(Exception):
+    pass
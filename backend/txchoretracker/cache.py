@@ -0,0 +1,139 @@
+"""
+A small in-process LRU cache with TTL expiry and a size bound.
+
+This is deliberately single threaded: it is only meant to be used from
+the reactor thread.
+"""
+import collections
+import time
+
+import attr
+
+
+@attr.s
+class _Entry:
+    value = attr.ib()
+    size = attr.ib()
+    expiresAt = attr.ib()
+
+
+class LRUCache:
+    """
+    Least-recently-used cache where entries also expire after ``ttl``
+    seconds.
+
+    The cache is bounded both by the number of entries and by the sum
+    of the entry sizes given to :meth:`put` (whatever unit the caller
+    uses; :mod:`txchoretracker.dbcache` uses estimated bytes). When
+    either bound is exceeded the least recently used entries are
+    evicted.
+
+    Args:
+        maxEntries (int): Maximum number of entries.
+        maxSize (int): Maximum total size of the entries.
+        ttl (float): Seconds an entry stays valid after being stored.
+        onRemove (callable or None):
+            Called with the key whenever an entry leaves the cache for
+            any reason, so callers can keep secondary indexes tidy.
+        clock (callable):
+            Returns the current time in seconds. Must not go backwards.
+    """
+    def __init__(
+                self,
+                *,
+                maxEntries: int,
+                maxSize: int,
+                ttl: float,
+                onRemove=None,
+                clock=time.monotonic,
+            ):
+        self._entries = collections.OrderedDict()
+        self._maxEntries = maxEntries
+        self._maxSize = maxSize
+        self._ttl = ttl
+        self._onRemove = onRemove
+        self._clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def maxSize(self):
+        return self._maxSize
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry.expiresAt <= self._clock():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def put(self, key, value, size=1, ttl=None):
+        """
+        Store ``value`` for ``key``. It expires after ``ttl`` seconds,
+        if given, instead of the cache's default.
+        """
+        if size > self._maxSize:
+            # Would evict everything else and still not fit.
+            return
+        if ttl is None:
+            ttl = self._ttl
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(value, size, self._clock() + ttl)
+        self.size += size
+        while (len(self._entries) > self._maxEntries
+                or self.size > self._maxSize):
+            oldestKey = next(iter(self._entries))
+            self._remove(oldestKey)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Remove the entry for ``key`` if there is one.
+        """
+        if key in self._entries:
+            self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        for key in list(self._entries):
+            self.invalidate(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        if self._onRemove is not None:
+            self._onRemove(key)
+
+    def stats(self):
+        """
+        Counters for monitoring, as a dict.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
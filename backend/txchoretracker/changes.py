@@ -0,0 +1,219 @@
+"""
+Delivery of database change events to in-process subscribers.
+
+Triggers installed by ./functions.sql NOTIFY the ``choretracker_changes``
+channel whenever a task, task group or user profile row is written,
+whichever process made the write. :class:`ChangeListener` keeps a
+dedicated connection LISTENing on that channel and hands each change to
+its subscribers as a :class:`ChangeEvent`.
+
+Notifications sent while the listener is disconnected are lost, so after
+(re)connecting subscribers get a :data:`RESYNC` event, meaning they
+should assume anything may have changed. Subscribers that need to
+know when changes might be going unseen also get a
+:data:`DISCONNECTED` event when the connection is lost or the
+listener is stopped.
+"""
+import json
+
+import attr
+import psycopg2
+import psycopg2.extensions
+import zope.interface
+from twisted import logger
+from twisted.internet import defer
+from twisted.internet import threads
+from twisted.internet.interfaces import IReadDescriptor
+
+
+CHANNEL = 'choretracker_changes'
+
+
+@attr.s(frozen=True)
+class ChangeEvent:
+    """
+    Attributes:
+        table (str or None):
+            ``'task'``, ``'task_group'``, ``'user_profile'`` or
+            ``'users_m2m_task_groups'``, or None for :data:`RESYNC`
+            and :data:`DISCONNECTED`.
+        operation (str):
+            ``'INSERT'``, ``'UPDATE'``, ``'DELETE'``, ``'RESYNC'`` or
+            ``'DISCONNECTED'``.
+        rowId (int or None):
+            The ID of the changed row (the user ID for user profiles
+            and task group memberships).
+        taskGroupIds (tuple of int):
+            For tasks, the task groups the task was and is in. For
+            task group memberships, the task group.
+    """
+    table = attr.ib()
+    operation = attr.ib()
+    rowId = attr.ib()
+    taskGroupIds = attr.ib(default=())
+
+
+RESYNC = ChangeEvent(table=None, operation='RESYNC', rowId=None)
+DISCONNECTED = ChangeEvent(table=None, operation='DISCONNECTED', rowId=None)
+
+
+def parseNotifyPayload(payload: str) -> ChangeEvent:
+    structure = json.loads(payload)
+    return ChangeEvent(
+        table=structure['table'],
+        operation=structure['op'],
+        rowId=structure['id'],
+        taskGroupIds=tuple(structure.get('taskGroupIds') or ()),
+    )
+
+
+def _connectAndListen(postgresDSN):
+    # Runs in a thread, since connecting blocks.
+    connection = psycopg2.connect(
+        postgresDSN,
+        # Notice a dead server (or NAT timeout) on an otherwise idle
+        # connection.
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3,
+    )
+    connection.set_isolation_level(
+        psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with connection.cursor() as cursor:
+        cursor.execute('LISTEN {0}'.format(CHANNEL))
+    return connection
+
+
+@zope.interface.implementer(IReadDescriptor)
+class ChangeListener:
+    """
+    Holds a long-lived LISTEN connection and fans change events out to
+    subscribers.
+
+    Subscribers are callables taking a :class:`ChangeEvent`. They may
+    return a Deferred; failures are logged and otherwise ignored.
+    """
+    log = logger.Logger()
+
+    initialRetryDelay = 1.0
+    maxRetryDelay = 60.0
+
+    def __init__(self, postgresDSN, *, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._postgresDSN = postgresDSN
+        self._connection = None
+        self._subscribers = []
+        self._retryDelay = self.initialRetryDelay
+        self._retryCall = None
+        self._stopped = True
+
+    def subscribe(self, subscriber):
+        """
+        Add a subscriber, which is called with each
+        :class:`ChangeEvent` and can return a Deferred. It must not
+        return a coroutine, which wouldn't be run; wrap ``async def``
+        subscribers with :func:`txchoretracker.utils.coroToDeferred`.
+
+        Returns a callable of no arguments that removes it again.
+        """
+        self._subscribers.append(subscriber)
+        return lambda: self._subscribers.remove(subscriber)
+
+    def start(self):
+        """
+        Connect and start listening. Returns a Deferred that fires once
+        the first connection attempt is done, whether it worked or not
+        (failed attempts are retried in the background).
+        """
+        self._stopped = False
+        return self._connect()
+
+    def stop(self):
+        self._stopped = True
+        if self._retryCall is not None and self._retryCall.active():
+            self._retryCall.cancel()
+        self._retryCall = None
+        self._disconnect()
+
+    def _connect(self):
+        dfd = threads.deferToThreadPool(
+            self._reactor, self._reactor.getThreadPool(),
+            _connectAndListen, self._postgresDSN)
+
+        @dfd.addCallback
+        def cbConnected(connection):
+            if self._stopped:
+                connection.close()
+                return
+            self.log.info('Listening for changes on {channel}',
+                          channel=CHANNEL)
+            self._connection = connection
+            self._retryDelay = self.initialRetryDelay
+            self._reactor.addReader(self)
+            # Anything could have changed while we weren't listening.
+            self._deliver(RESYNC)
+
+        @dfd.addErrback
+        def ebConnectFailed(failure):
+            self.log.failure(
+                'Failed to connect to listen for changes', failure=failure)
+            self._scheduleReconnect()
+        return dfd
+
+    def _disconnect(self):
+        if self._connection is not None:
+            self._reactor.removeReader(self)
+            self._connection.close()
+            self._connection = None
+            self._deliver(DISCONNECTED)
+
+    def _scheduleReconnect(self):
+        if self._stopped:
+            return
+        self.log.info('Reconnecting change listener in {delay} seconds',
+                      delay=self._retryDelay)
+        self._retryCall = self._reactor.callLater(
+            self._retryDelay, self._connect)
+        self._retryDelay = min(self._retryDelay * 2, self.maxRetryDelay)
+
+    def _deliver(self, event):
+        for subscriber in list(self._subscribers):
+            dfd = defer.maybeDeferred(subscriber, event)
+            dfd.addErrback(
+                lambda failure: self.log.failure(
+                    'Change subscriber failed for {event}',
+                    event=event, failure=failure))
+
+    ### IReadDescriptor methods
+    def fileno(self):
+        if self._connection is None:
+            return -1
+        return self._connection.fileno()
+
+    def doRead(self):
+        try:
+            self._connection.poll()
+        except psycopg2.Error as dberr:
+            return dberr
+        notifies = self._connection.notifies[:]
+        del self._connection.notifies[:]
+        for notify in notifies:
+            try:
+                event = parseNotifyPayload(notify.payload)
+            except (ValueError, KeyError):
+                self.log.error('Ignoring malformed change payload {payload!r}',
+                               payload=notify.payload)
+                continue
+            self._deliver(event)
+
+    def connectionLost(self, reason):
+        self.log.warn('Lost the change listener connection: {reason}',
+                      reason=reason)
+        self._disconnect()
+        self._scheduleReconnect()
+
+    def logPrefix(self):
+        return 'ChangeListener'
@@ -0,0 +1,155 @@
+"""
+Negotiated compression of JSON API response bodies.
+
+The policy installed in :mod:`txchoretracker.kleinhelpers` (see
+:attr:`txchoretracker.config.RestApiConfig.compression`) lists the
+content codings the server is willing to use, in order of preference:
+
+-   ``gzip``, with :mod:`zlib`.
+-   ``br`` (brotli), which requires the brotli package.
+
+For each response the best coding the request's Accept-Encoding header
+allows is picked. Bodies smaller than the policy's minimum size are
+sent as they are, since compressing them saves next to nothing and
+still costs CPU time.
+"""
+import zlib
+
+import attr
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class _GzipCompressor:
+    def __init__(self, level):
+        # 16 + MAX_WBITS makes zlib write the gzip header and trailer.
+        self._compressobj = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressobj.compress(data)
+
+    def flush(self):
+        return self._compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressobj.flush(zlib.Z_FINISH)
+
+
+class _BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+# Coding -> (compressor class, CompressionPolicy attribute holding its
+# level).
+_COMPRESSORS = {
+    'gzip': (_GzipCompressor, 'gzipLevel'),
+    'br': (_BrotliCompressor, 'brotliQuality'),
+}
+
+ENCODING_NAMES = frozenset(_COMPRESSORS)
+
+
+@attr.s(frozen=True)
+class CompressionPolicy:
+    """
+    Attributes:
+        encodings (tuple of str):
+            The content codings to offer, most preferred first. Empty
+            to never compress.
+        minSize (int):
+            Bodies with fewer bytes than this are never compressed.
+        gzipLevel (int):
+            zlib compression level, 1 (fastest) to 9 (smallest).
+        brotliQuality (int):
+            brotli quality, 0 (fastest) to 11 (smallest).
+    """
+    encodings = attr.ib(default=())
+    minSize = attr.ib(default=1024)
+    gzipLevel = attr.ib(default=6)
+    brotliQuality = attr.ib(default=4)
+
+    def negotiate(self, acceptEncoding):
+        """
+        The coding to use for a request with the Accept-Encoding
+        header value ``acceptEncoding`` (bytes or None), or None to
+        send the body as it is.
+        """
+        if not self.encodings or acceptEncoding is None:
+            return None
+        qualities = _parseAcceptEncoding(acceptEncoding)
+        wildcard = qualities.get('*', 0.0)
+        best = None
+        bestQuality = 0.0
+        # Strictly greater, so ties go to the earlier (preferred) one.
+        for encoding in self.encodings:
+            quality = qualities.get(encoding, wildcard)
+            if quality > bestQuality:
+                best = encoding
+                bestQuality = quality
+        return best
+
+    def makeCompressor(self, encoding):
+        """
+        Make a compressor for ``encoding``, with ``compress(data)``,
+        ``flush()`` and ``finish()`` methods returning compressed
+        bytes.
+        """
+        compressorClass, levelAttribute = _COMPRESSORS[encoding]
+        return compressorClass(getattr(self, levelAttribute))
+
+
+def _parseAcceptEncoding(headerValue):
+    qualities = {}
+    for item in headerValue.decode('latin-1').split(','):
+        coding, *parameters = item.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        qualities[coding] = max(quality, qualities.get(coding, 0.0))
+    return qualities
+
+
+def makeCompressionPolicy(encodings, **kwargs) -> CompressionPolicy:
+    """
+    Make a :class:`CompressionPolicy` offering ``encodings`` (names
+    from :data:`ENCODING_NAMES`), passing the other keyword arguments
+    through.
+
+    Raises:
+        ValueError: if there is no such encoding.
+        RuntimeError: if the package it needs isn't installed.
+    """
+    encodings = tuple(encodings)
+    for encoding in encodings:
+        if encoding not in _COMPRESSORS:
+            raise ValueError(
+                'Unknown content coding {0!r}'.format(encoding))
+        if encoding == 'br' and brotli is None:
+            raise RuntimeError(
+                'The br content coding requires the brotli package to '
+                'be installed')
+    return CompressionPolicy(encodings=encodings, **kwargs)
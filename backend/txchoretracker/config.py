@@ -37,23 +37,161 @@ class RestApiConfig:
         domain:
             The domain the application is running on.
             Use "localhost" for local development.
+
+        json_codec:
+            How request and response bodies are decoded and encoded
+            (see :mod:`txchoretracker.jsoncodecs`): ``stdlib`` (the
+            default), ``ujson``, ``orjson``, or ``auto`` for the
+            fastest installed. The response bytes are the same
+            whichever is used.
+
+        compression:
+            Comma-separated content codings to compress response
+            bodies with, most preferred first, when the client accepts
+            them (see :mod:`txchoretracker.compression`): ``gzip``
+            (the default) and ``br`` (needs the brotli package).
+            Empty to never compress.
+
+        compression_min_size:
+            Response bodies smaller than this many bytes are sent
+            uncompressed.
+
+        compression_gzip_level:
+            zlib level for gzip, 1 (fastest) to 9 (smallest).
+
+        compression_brotli_quality:
+            Quality for br, 0 (fastest) to 11 (smallest).
+
+        port:
+            The TCP port to serve on.
+
+        interface:
+            The address to serve on. Empty (the default) for all IPv4
+            addresses; an IPv6 address (like ``::``) for IPv6.
+
+        workers:
+            How many processes to serve from (see
+            :mod:`txchoretracker.workers`). With more than one, each
+            worker is a separate process with its own database
+            connections, accepting connections on a listening socket
+            shared with the others.
+
+        shutdown_timeout:
+            Seconds to wait for requests in progress to finish when
+            shutting down.
     """
     development: bool = attr.ib()
     cookie_secret: str = attr.ib(
         validator=attr.validators.instance_of(str),
     )
     domain: str = attr.ib()
+    json_codec: str = attr.ib(
+        default='stdlib',
+        validator=attr.validators.in_({'stdlib', 'ujson', 'orjson', 'auto'}),
+    )
+    compression: tuple = attr.ib(default=('gzip',))
+    compression_min_size: int = attr.ib(default=1024)
+    compression_gzip_level: int = attr.ib(
+        default=6,
+        validator=attr.validators.in_(range(1, 10)),
+    )
+    compression_brotli_quality: int = attr.ib(
+        default=4,
+        validator=attr.validators.in_(range(0, 12)),
+    )
+    port: int = attr.ib(default=8080)
+    interface: str = attr.ib(default='')
+    workers: int = attr.ib(
+        default=1,
+        validator=attr.validators.in_(range(1, 257)),
+    )
+    shutdown_timeout: float = attr.ib(default=10.0)
 
 
 @attr.s
 class DatabaseConfig:
     """
     The [postgresql] section of the config file.
+
+    Attributes:
+        backend:
+            Which connection backend to use (see
+            :mod:`txchoretracker.dbbackends`).
+
+            -   ``adbapi`` (the default) runs queries in the reactor
+                thread pool.
+            -   ``txpostgres`` runs queries on non-blocking
+                connections in the reactor thread. Requires the
+                txpostgres package; without it, ``adbapi`` is used
+                (with a warning).
+
+        prepared_statements:
+            Run the api.* function calls as server-side prepared
+            statements (the default). Turn this off when connecting
+            through a pooler that doesn't keep sessions, like
+            pgbouncer in transaction mode.
+
+        change_log_retention_days:
+            How long task changes are kept for incremental sync (see
+            ``GET /tasks/changes``). Clients that haven't synced for
+            longer get all their tasks again.
+
+        pool_min, pool_max:
+            The adbapi backend keeps at least ``pool_min`` connections
+            open once it has opened them, and opens at most
+            ``pool_max``. The txpostgres backend opens ``pool_min``
+            connections when starting, and more as needed up to
+            ``pool_max``.
+
+        reconnect:
+            Reconnect connections that turn out to be broken when a
+            transaction is rolled back (adbapi backend).
+
+        check_query:
+            The query used to check that a connection still works.
+
+        check_after:
+            Run ``check_query`` on an adbapi connection that has been
+            idle for this many seconds before using it, and reconnect
+            if it fails. 0 turns the checks off.
+
+        statement_timeout:
+            Seconds after which PostgreSQL cancels a statement on the
+            adbapi connections. 0 (the default) means no limit.
+
+        adaptive:
+            Size the adbapi pool to the load: it starts at
+            ``pool_min`` connections, grows towards ``pool_max`` while
+            queries wait longer than ``adaptive_target_wait`` seconds
+            for a connection, and shrinks again while connections go
+            unused. It's adjusted every ``adaptive_interval`` seconds.
     """
     dbname: str = attr.ib()
     host: str = attr.ib(default=None)
     username: str = attr.ib(default=None)
     password: str = attr.ib(default=None, repr=False)
+    backend: str = attr.ib(
+        default='adbapi',
+        validator=attr.validators.in_({'adbapi', 'txpostgres'}),
+    )
+    prepared_statements: bool = attr.ib(default=True)
+    change_log_retention_days: int = attr.ib(default=30)
+    pool_min: int = attr.ib(default=3)
+    pool_max: int = attr.ib(default=5)
+    reconnect: bool = attr.ib(default=True)
+    check_query: str = attr.ib(default='SELECT 1')
+    check_after: float = attr.ib(default=60.0)
+    statement_timeout: float = attr.ib(default=0.0)
+    adaptive: bool = attr.ib(default=False)
+    adaptive_target_wait: float = attr.ib(default=0.01)
+    adaptive_interval: float = attr.ib(default=5.0)
+
+    @pool_max.validator
+    def _checkPoolMax(self, attribute, value):
+        if not 1 <= self.pool_min <= value:
+            raise ValueError(
+                'pool_min and pool_max must satisfy '
+                '1 <= pool_min <= pool_max')
 
     def get_dsn(self):
         if self.host is None:
@@ -71,6 +209,217 @@ class DatabaseConfig:
         )
 
 
+@attr.s
+class CacheConfig:
+    """
+    The optional [cache] section of the config file.
+
+    Attributes:
+        enabled:
+            Cache task reads in process (see
+            :mod:`txchoretracker.dbcache`). Off by default.
+        max_entries:
+            Maximum number of cached tasks and task lists.
+        max_bytes:
+            Rough upper bound on the memory used by the cached tasks.
+        ttl:
+            Seconds a cached entry stays valid, as a backstop for
+            changes the cache doesn't see.
+    """
+    enabled: bool = attr.ib(default=False)
+    max_entries: int = attr.ib(default=10000)
+    max_bytes: int = attr.ib(default=64 * 1024 * 1024)
+    ttl: float = attr.ib(default=60.0)
+
+
+@attr.s
+class PushConfig:
+    """
+    The optional [push] section of the config file.
+
+    Attributes:
+        enabled:
+            Serve live task changes at /changes (see
+            :mod:`txchoretracker.push`). On by default.
+        max_connections:
+            Maximum number of change streams open at once.
+        max_connections_per_user:
+            Maximum number of change streams open at once per user.
+        max_queued_events:
+            Events held for a client that isn't reading its stream
+            before they are dropped and it is told to resync.
+        keepalive_interval:
+            Seconds between keepalive comments on idle streams.
+    """
+    enabled: bool = attr.ib(default=True)
+    max_connections: int = attr.ib(default=1000)
+    max_connections_per_user: int = attr.ib(default=5)
+    max_queued_events: int = attr.ib(default=100)
+    keepalive_interval: float = attr.ib(default=30.0)
+
+
+@attr.s
+class SchedulerConfig:
+    """
+    The optional [scheduler] section of the config file.
+
+    Attributes:
+        enabled:
+            Create the tasks of repeating tasks ahead of time (see
+            :mod:`txchoretracker.scheduler`). On by default.
+        horizon_days:
+            How many days ahead to create them.
+        batch_size:
+            Repeating tasks read and updated per query.
+        max_delay:
+            The longest to wait between passes, in seconds.
+    """
+    enabled: bool = attr.ib(default=True)
+    horizon_days: float = attr.ib(default=14.0)
+    batch_size: int = attr.ib(default=500)
+    max_delay: float = attr.ib(default=300.0)
+
+
+@attr.s
+class NotificationsConfig:
+    """
+    The optional [notifications] section of the config file.
+
+    Attributes:
+        enabled:
+            Email task group members when their tasks come due (see
+            :mod:`txchoretracker.notifications`). Off by default.
+        sender:
+            How to send them: ``smtp`` (the default), or ``log`` to
+            only log them, for development.
+        smtp_host:
+            The SMTP server to send through.
+        smtp_port:
+            Its port.
+        from_address:
+            The address the emails are from.
+        lead_time:
+            How many seconds before a task is due to notify.
+        lookahead:
+            How many seconds of upcoming due times are kept in memory.
+            They are loaded again every half of this.
+        max_lateness:
+            Tasks that came due more than this many seconds ago
+            without being notified (e.g. while nothing was running)
+            are skipped.
+        batch_size:
+            Notifications claimed and sent together.
+    """
+    enabled: bool = attr.ib(default=False)
+    sender: str = attr.ib(
+        default='smtp',
+        validator=attr.validators.in_({'smtp', 'log'}),
+    )
+    smtp_host: str = attr.ib(default='localhost')
+    smtp_port: int = attr.ib(default=25)
+    from_address: str = attr.ib(default='choretracker@localhost')
+    lead_time: float = attr.ib(default=0.0)
+    lookahead: float = attr.ib(default=60.0 * 60)
+    max_lateness: float = attr.ib(default=24.0 * 60 * 60)
+    batch_size: int = attr.ib(default=100)
+
+
+@attr.s
+class MetricsConfig:
+    """
+    The optional [metrics] section of the config file.
+
+    Attributes:
+        enabled:
+            Serve request, database, serialization, cache and pool
+            metrics in the Prometheus text format (see
+            :mod:`txchoretracker.metrics`) at ``/metrics`` on a port of
+            their own. Off by default.
+        port:
+            The port to serve them on. With several workers, worker N
+            (from 0) serves its own metrics on ``port + N``. The
+            profiling admin endpoint (see :class:`ProfilingConfig`) is
+            served on the same port.
+        interface:
+            The interface to serve them on; only local by default.
+    """
+    enabled: bool = attr.ib(default=False)
+    port: int = attr.ib(default=9180)
+    interface: str = attr.ib(default='127.0.0.1')
+
+
+@attr.s
+class TracingConfig:
+    """
+    The optional [tracing] section of the config file.
+
+    Attributes:
+        enabled:
+            Trace a sample of API requests (see
+            :mod:`txchoretracker.tracing`). Off by default.
+        sample_rate:
+            The fraction of requests to trace, from 0 to 1.
+        exporter:
+            Where traces go: ``jsonlines`` (the default) appends their
+            spans to ``path`` as lines of JSON, and ``memory`` keeps
+            the last ones in memory.
+        path:
+            The file for the ``jsonlines`` exporter. Several workers
+            can share it.
+    """
+    enabled: bool = attr.ib(default=False)
+    sample_rate: float = attr.ib(default=0.01)
+    exporter: str = attr.ib(
+        default='jsonlines',
+        validator=attr.validators.in_({'jsonlines', 'memory'}),
+    )
+    path: str = attr.ib(default='traces.jsonl')
+
+
+@attr.s
+class ProfilingConfig:
+    """
+    The optional [profiling] section of the config file.
+
+    Attributes:
+        enabled:
+            Log slow requests and queries, and serve the profiling
+            admin endpoint at ``/profile`` on the metrics port (see
+            :mod:`txchoretracker.profiling`). Off by default.
+        slow_request_threshold:
+            Log requests that take at least this many seconds, with
+            their database calls.
+        route_thresholds:
+            Thresholds for particular routes, overriding
+            ``slow_request_threshold``, like
+            ``TasksApiEndpoint.fetchAll = 2, TasksApiEndpoint.fetch =
+            0.2``. Change streams are never logged as slow.
+        slow_query_threshold:
+            Log database calls that take at least this many seconds,
+            with their (redacted) parameters. 0 to not log them.
+        output_dir:
+            The directory to write captured profiles to.
+    """
+    enabled: bool = attr.ib(default=False)
+    slow_request_threshold: float = attr.ib(default=1.0)
+    route_thresholds: dict = attr.ib(default=attr.Factory(dict))
+    slow_query_threshold: float = attr.ib(default=0.5)
+    output_dir: str = attr.ib(default='profiles')
+
+
+def _parseRouteThresholds(value):
+    routeThresholds = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        route, separator, threshold = item.partition('=')
+        if not separator:
+            raise ValueError(
+                'Expected route = seconds, not {0!r}'.format(item.strip()))
+        routeThresholds[route.strip()] = float(threshold)
+    return routeThresholds
+
+
 @attr.s
 class ApplicationConfig:
     db: DatabaseConfig = attr.ib(
@@ -79,6 +428,34 @@ class ApplicationConfig:
     restapi: RestApiConfig = attr.ib(
         validator=attr.validators.instance_of(RestApiConfig)
     )
+    cache: CacheConfig = attr.ib(
+        default=attr.Factory(CacheConfig),
+        validator=attr.validators.instance_of(CacheConfig)
+    )
+    push: PushConfig = attr.ib(
+        default=attr.Factory(PushConfig),
+        validator=attr.validators.instance_of(PushConfig)
+    )
+    scheduler: SchedulerConfig = attr.ib(
+        default=attr.Factory(SchedulerConfig),
+        validator=attr.validators.instance_of(SchedulerConfig)
+    )
+    notifications: NotificationsConfig = attr.ib(
+        default=attr.Factory(NotificationsConfig),
+        validator=attr.validators.instance_of(NotificationsConfig)
+    )
+    metrics: MetricsConfig = attr.ib(
+        default=attr.Factory(MetricsConfig),
+        validator=attr.validators.instance_of(MetricsConfig)
+    )
+    tracing: TracingConfig = attr.ib(
+        default=attr.Factory(TracingConfig),
+        validator=attr.validators.instance_of(TracingConfig)
+    )
+    profiling: ProfilingConfig = attr.ib(
+        default=attr.Factory(ProfilingConfig),
+        validator=attr.validators.instance_of(ProfilingConfig)
+    )
 
 
 def processConfigFile(configFilePath):
@@ -90,8 +467,159 @@ def processConfigFile(configFilePath):
         development=restapiSection.getboolean('development', fallback=False),
         domain=restapiSection['domain'],
         cookie_secret=restapiSection['cookie_secret'],
+        json_codec=restapiSection.get('json_codec', fallback='stdlib'),
+        compression=tuple(
+            encoding.strip()
+            for encoding in restapiSection.get(
+                'compression', fallback='gzip').split(',')
+            if encoding.strip()
+        ),
+        compression_min_size=restapiSection.getint(
+            'compression_min_size', fallback=1024),
+        compression_gzip_level=restapiSection.getint(
+            'compression_gzip_level', fallback=6),
+        compression_brotli_quality=restapiSection.getint(
+            'compression_brotli_quality', fallback=4),
+        port=restapiSection.getint('port', fallback=8080),
+        interface=restapiSection.get('interface', fallback=''),
+        workers=restapiSection.getint('workers', fallback=1),
+        shutdown_timeout=restapiSection.getfloat(
+            'shutdown_timeout', fallback=10.0),
     )
+    postgresqlSection = parser['postgresql']
+    db = DatabaseConfig(
+        dbname=postgresqlSection['dbname'],
+        host=postgresqlSection.get('host'),
+        username=postgresqlSection.get('username'),
+        password=postgresqlSection.get('password'),
+        backend=postgresqlSection.get('backend', fallback='adbapi'),
+        prepared_statements=postgresqlSection.getboolean(
+            'prepared_statements', fallback=True),
+        change_log_retention_days=postgresqlSection.getint(
+            'change_log_retention_days', fallback=30),
+        pool_min=postgresqlSection.getint('pool_min', fallback=3),
+        pool_max=postgresqlSection.getint('pool_max', fallback=5),
+        reconnect=postgresqlSection.getboolean('reconnect', fallback=True),
+        check_query=postgresqlSection.get(
+            'check_query', fallback='SELECT 1'),
+        check_after=postgresqlSection.getfloat('check_after', fallback=60.0),
+        statement_timeout=postgresqlSection.getfloat(
+            'statement_timeout', fallback=0.0),
+        adaptive=postgresqlSection.getboolean('adaptive', fallback=False),
+        adaptive_target_wait=postgresqlSection.getfloat(
+            'adaptive_target_wait', fallback=0.01),
+        adaptive_interval=postgresqlSection.getfloat(
+            'adaptive_interval', fallback=5.0),
+    )
+    cache = CacheConfig()
+    if parser.has_section('cache'):
+        cacheSection = parser['cache']
+        cache = CacheConfig(
+            enabled=cacheSection.getboolean('enabled', fallback=cache.enabled),
+            max_entries=cacheSection.getint(
+                'max_entries', fallback=cache.max_entries),
+            max_bytes=cacheSection.getint(
+                'max_bytes', fallback=cache.max_bytes),
+            ttl=cacheSection.getfloat('ttl', fallback=cache.ttl),
+        )
+    push = PushConfig()
+    if parser.has_section('push'):
+        pushSection = parser['push']
+        push = PushConfig(
+            enabled=pushSection.getboolean('enabled', fallback=push.enabled),
+            max_connections=pushSection.getint(
+                'max_connections', fallback=push.max_connections),
+            max_connections_per_user=pushSection.getint(
+                'max_connections_per_user',
+                fallback=push.max_connections_per_user),
+            max_queued_events=pushSection.getint(
+                'max_queued_events', fallback=push.max_queued_events),
+            keepalive_interval=pushSection.getfloat(
+                'keepalive_interval', fallback=push.keepalive_interval),
+        )
+    scheduler = SchedulerConfig()
+    if parser.has_section('scheduler'):
+        schedulerSection = parser['scheduler']
+        scheduler = SchedulerConfig(
+            enabled=schedulerSection.getboolean(
+                'enabled', fallback=scheduler.enabled),
+            horizon_days=schedulerSection.getfloat(
+                'horizon_days', fallback=scheduler.horizon_days),
+            batch_size=schedulerSection.getint(
+                'batch_size', fallback=scheduler.batch_size),
+            max_delay=schedulerSection.getfloat(
+                'max_delay', fallback=scheduler.max_delay),
+        )
+    notifications = NotificationsConfig()
+    if parser.has_section('notifications'):
+        notificationsSection = parser['notifications']
+        notifications = NotificationsConfig(
+            enabled=notificationsSection.getboolean(
+                'enabled', fallback=notifications.enabled),
+            sender=notificationsSection.get(
+                'sender', fallback=notifications.sender),
+            smtp_host=notificationsSection.get(
+                'smtp_host', fallback=notifications.smtp_host),
+            smtp_port=notificationsSection.getint(
+                'smtp_port', fallback=notifications.smtp_port),
+            from_address=notificationsSection.get(
+                'from_address', fallback=notifications.from_address),
+            lead_time=notificationsSection.getfloat(
+                'lead_time', fallback=notifications.lead_time),
+            lookahead=notificationsSection.getfloat(
+                'lookahead', fallback=notifications.lookahead),
+            max_lateness=notificationsSection.getfloat(
+                'max_lateness', fallback=notifications.max_lateness),
+            batch_size=notificationsSection.getint(
+                'batch_size', fallback=notifications.batch_size),
+        )
+    metrics = MetricsConfig()
+    if parser.has_section('metrics'):
+        metricsSection = parser['metrics']
+        metrics = MetricsConfig(
+            enabled=metricsSection.getboolean(
+                'enabled', fallback=metrics.enabled),
+            port=metricsSection.getint('port', fallback=metrics.port),
+            interface=metricsSection.get(
+                'interface', fallback=metrics.interface),
+        )
+    tracing = TracingConfig()
+    if parser.has_section('tracing'):
+        tracingSection = parser['tracing']
+        tracing = TracingConfig(
+            enabled=tracingSection.getboolean(
+                'enabled', fallback=tracing.enabled),
+            sample_rate=tracingSection.getfloat(
+                'sample_rate', fallback=tracing.sample_rate),
+            exporter=tracingSection.get(
+                'exporter', fallback=tracing.exporter),
+            path=tracingSection.get('path', fallback=tracing.path),
+        )
+    profiling = ProfilingConfig()
+    if parser.has_section('profiling'):
+        profilingSection = parser['profiling']
+        profiling = ProfilingConfig(
+            enabled=profilingSection.getboolean(
+                'enabled', fallback=profiling.enabled),
+            slow_request_threshold=profilingSection.getfloat(
+                'slow_request_threshold',
+                fallback=profiling.slow_request_threshold),
+            route_thresholds=_parseRouteThresholds(
+                profilingSection.get('route_thresholds', fallback='')),
+            slow_query_threshold=profilingSection.getfloat(
+                'slow_query_threshold',
+                fallback=profiling.slow_query_threshold),
+            output_dir=profilingSection.get(
+                'output_dir', fallback=profiling.output_dir),
+        )
     return ApplicationConfig(
-        db=DatabaseConfig(**parser['postgresql']),
+        db=db,
         restapi=restapi,
+        cache=cache,
+        push=push,
+        scheduler=scheduler,
+        notifications=notifications,
+        metrics=metrics,
+        tracing=tracing,
+        profiling=profiling,
     )
@@ -3,20 +3,36 @@ Database pool wrapper to bridge the model object <-> database gap.
 
 Each method just uses a PL/pgSQL function (see ./functions.sql),
 and (most) return a model (or list of models) (see ./models.py).
+The function calls are run as prepared statements (see
+./preparedstatements.py and :data:`API_STATEMENTS`).
 
 They are all coroutines, so in order to use them in code that expects
 Deferreds, wrap the result with
 :func:`twisted.internet.defer.ensureDeferred`.
+
+How long each function call takes (from the reactor's point of view,
+so including the wait for a pooled connection) is recorded in
+:data:`txchoretracker.metrics.REGISTRY`, and traced requests get a
+span per call (see :mod:`txchoretracker.tracing`).
 """
+import operator
 import os.path
+import time
 from types import MappingProxyType
 
+import attr
 import psycopg2.extras
 from twisted import logger
-from twisted.enterprise import adbapi
 from twisted.internet import defer
 
+from txchoretracker import metrics
 from txchoretracker import models
+from txchoretracker import dbbackends
+from txchoretracker import profiling
+from txchoretracker import tracing
+from txchoretracker.preparedstatements import (
+    PreparedStatement, PreparedStatementRegistry
+)
 from txchoretracker import exceptions
 from txchoretracker import config
 from txchoretracker.utils import coroToDeferred
@@ -26,22 +42,65 @@ log = logger.Logger()
 _here = os.path.abspath(os.path.dirname(__file__))
 _dbFunctionsPath = os.path.join(_here, 'functions.sql')
 
+_callSeconds = metrics.REGISTRY.histogram(
+    'choretracker_db_call_duration_seconds',
+    'Time to run a database function, by prepared statement name.',
+    ('function',),
+)
+_callErrors = metrics.REGISTRY.counter(
+    'choretracker_db_call_errors_total',
+    'Database function calls that failed.',
+    ('function',),
+)
+
+# Calls that take at least this many seconds are logged (see
+# setSlowQueryThreshold).
+_slowQueryThreshold = None
+
+
+def setSlowQueryThreshold(seconds):
+    """
+    Log database calls that take at least ``seconds``, with their
+    redacted parameters (see :func:`txchoretracker.profiling.redactParams`).
+    None (or 0) not to.
+    """
+    global _slowQueryThreshold
+    _slowQueryThreshold = seconds or None
+
+
+def _logSlowCall(statementName, params, elapsed):
+    # The request the call was made for, if it's being traced.
+    current = tracing.currentSpan()
+    log.warn(
+        'Slow database call: {function} took {duration:.3f}s '
+        '(params {params}, route {route})',
+        function=statementName,
+        duration=elapsed,
+        params=profiling.redactParams(params),
+        route=(None if current is None
+               else current.trace.spans[0].attributes.get('route')),
+    )
+
 
-def setupDBWrapper(postgresDSN):
+def setupDBWrapper(dbConfig: config.DatabaseConfig):
     """
     Returns a Deferred that fires with a
     :class:`ChoreTrackerDatabase` instance.
     """
-    log.info('Creating connection pool')
-    dbpool = adbapi.ConnectionPool(
-        'psycopg2',
-        postgresDSN,
-        cursor_factory=psycopg2.extras.DictCursor
-    )
-    log.info('Installing database functions')
-    with open(_dbFunctionsPath, 'r', encoding='utf-8') as fp:
-        dbFunctionsSQL = fp.read()
-    d = dbpool.runOperation(dbFunctionsSQL)
+    log.info(
+        'Creating connection pool using the {backend} backend',
+        backend=dbConfig.backend)
+    statements = PreparedStatementRegistry(
+        API_STATEMENTS, usePrepared=dbConfig.prepared_statements)
+    dbpool = dbbackends.makeConnectionBackend(dbConfig, statements)
+    d = dbpool.start()
+
+    @d.addCallback
+    def cbInstallFunctions(ignored):
+        log.info('Installing database functions')
+        with open(_dbFunctionsPath, 'r', encoding='utf-8') as fp:
+            dbFunctionsSQL = fp.read()
+        return dbpool.runOperation(dbFunctionsSQL)
 
     @d.addCallback
     def cbSuccess(ignored):
@@ -50,13 +109,143 @@ def setupDBWrapper(postgresDSN):
     return d.addCallback(ChoreTrackerDatabase)
 
 
+API_STATEMENTS = (
+    PreparedStatement(
+        'asuser_fetch_all_tasks',
+        'SELECT * FROM api.asuser_fetch_all_tasks($1)',
+        ('bigint',),
+    ),
+    PreparedStatement(
+        'asuser_fetch_tasks_page',
+        'SELECT * FROM api.asuser_fetch_tasks_page'
+        '($1, $2, $3, $4, $5, $6, $7, $8)',
+        (
+            'bigint', 'integer', 'bigint', 'integer',
+            'bigint', 'integer', 'integer', 'boolean',
+        ),
+    ),
+    PreparedStatement(
+        'asuser_fetch_task',
+        'SELECT * FROM api.asuser_fetch_task($1, $2)',
+        ('bigint', 'bigint'),
+    ),
+    PreparedStatement(
+        'asuser_create_task',
+        'SELECT * FROM api.asuser_create_task($1, $2, $3, $4, $5)',
+        ('bigint', 'bigint', 'varchar', 'varchar', 'integer'),
+    ),
+    PreparedStatement(
+        'asuser_update_task',
+        'SELECT * FROM api.asuser_update_task($1, $2, $3, $4, $5, $6)',
+        ('bigint', 'bigint', 'bigint', 'varchar', 'varchar', 'integer'),
+    ),
+    PreparedStatement(
+        'asuser_delete_task',
+        'SELECT api.asuser_delete_task($1, $2)',
+        ('bigint', 'bigint'),
+    ),
+    PreparedStatement(
+        'asuser_apply_task_batch',
+        'SELECT * FROM api.asuser_apply_task_batch($1, $2)',
+        ('bigint', 'jsonb'),
+    ),
+    PreparedStatement(
+        'asuser_fetch_task_changes',
+        'SELECT * FROM api.asuser_fetch_task_changes($1, $2)',
+        ('bigint', 'bigint'),
+    ),
+    PreparedStatement(
+        'prune_task_changes',
+        'SELECT api.prune_task_changes($1) AS pruned_count',
+        ('integer',),
+    ),
+    PreparedStatement(
+        'asuser_fetch_all_repeating_tasks',
+        'SELECT * FROM api.asuser_fetch_all_repeating_tasks($1)',
+        ('bigint',),
+    ),
+    PreparedStatement(
+        'asuser_fetch_repeating_task',
+        'SELECT * FROM api.asuser_fetch_repeating_task($1, $2)',
+        ('bigint', 'bigint'),
+    ),
+    PreparedStatement(
+        'asuser_create_repeating_task',
+        'SELECT * FROM api.asuser_create_repeating_task'
+        '($1, $2, $3, $4, $5, $6, $7)',
+        (
+            'bigint', 'bigint', 'varchar', 'varchar',
+            'varchar', 'integer', 'integer',
+        ),
+    ),
+    PreparedStatement(
+        'asuser_delete_repeating_task',
+        'SELECT api.asuser_delete_repeating_task($1, $2)',
+        ('bigint', 'bigint'),
+    ),
+    PreparedStatement(
+        'fetch_due_repeating_tasks',
+        'SELECT * FROM api.fetch_due_repeating_tasks($1, $2)',
+        ('integer', 'integer'),
+    ),
+    PreparedStatement(
+        'fetch_next_repeating_task_due',
+        'SELECT api.fetch_next_repeating_task_due() AS next_due_unix',
+        (),
+    ),
+    PreparedStatement(
+        'apply_repeating_task_materializations',
+        'SELECT api.apply_repeating_task_materializations($1)'
+        ' AS created_count',
+        ('jsonb',),
+    ),
+    PreparedStatement(
+        'fetch_upcoming_task_dues',
+        'SELECT * FROM api.fetch_upcoming_task_dues($1, $2, $3, $4)',
+        ('integer', 'bigint', 'integer', 'integer'),
+    ),
+    PreparedStatement(
+        'fetch_task_dues',
+        'SELECT * FROM api.fetch_task_dues($1)',
+        ('bigint[]',),
+    ),
+    PreparedStatement(
+        'claim_due_task_notifications',
+        'SELECT * FROM api.claim_due_task_notifications($1, $2, $3)',
+        ('bigint[]', 'integer', 'integer'),
+    ),
+    PreparedStatement(
+        'fetch_task_group_member_ids',
+        'SELECT * FROM api.fetch_task_group_member_ids($1)',
+        ('bigint',),
+    ),
+    PreparedStatement(
+        'fetch_user_profile',
+        'SELECT * FROM api.fetch_user_profile($1)',
+        ('bigint',),
+    ),
+    PreparedStatement(
+        'create_or_update_user_profile',
+        'SELECT * FROM api.create_or_update_user_profile($1, $2, $3)',
+        ('bigint', 'varchar', 'varchar'),
+    ),
+    PreparedStatement(
+        'google_auth_fetch_existing_user_id_or_create',
+        'SELECT * FROM api.google_auth_fetch_existing_user_id_or_create($1)',
+        ('varchar',),
+    ),
+)
+
+
 _DB_RAISE_DETAIL_TO_APP_EXCEPTION = MappingProxyType({
     'NO_SUCH_TASK': exceptions.NoSuchTask,
+    'NO_SUCH_REPEATING_TASK': exceptions.NoSuchRepeatingTask,
     'USER_NOT_MEMBER_OF_TASK_GROUP': exceptions.UserNotInTaskGroup,
     'USER_NOT_MEMBER_OF_REQUESTED_TASK_GROUP':
             exceptions.UserNotInRequestedTaskGroup,
     'NO_SUCH_USER': exceptions.NoSuchUser,
     'NO_PROFILE_FOR_USER': exceptions.NoProfileForUser,
+    'DUPLICATE_TASK_IN_BATCH': exceptions.DuplicateTaskInBatch,
 })
 
 
@@ -77,30 +266,172 @@ def _wrapAndRaiseDBException(dberr):
     raise appExceptionClass(dberr)
 
 
+def _modelRowFactory(modelClass):
+    """
+    Make a ``rowFactory`` (see
+    :meth:`dbbackends.IConnectionBackend.runPreparedQuery`) that builds
+    instances of the attrs class ``modelClass`` from row tuples, by
+    passing the columns positionally in the order of the class's
+    attributes. Every attribute must have a column of the same name.
+    """
+    attributeNames = tuple(a.name for a in attr.fields(modelClass))
+    makers = {}
+
+    def rowFactory(columnNames):
+        columnNames = tuple(columnNames)
+        makeModel = makers.get(columnNames)
+        if makeModel is None:
+            getColumns = operator.itemgetter(
+                *[columnNames.index(name) for name in attributeNames])
+            makeModel = makers[columnNames] = (
+                lambda row: modelClass(*getColumns(row)))
+        return makeModel
+    return rowFactory
+
+
+_TASK_ROWS = _modelRowFactory(models.Task)
+_USER_PROFILE_ROWS = _modelRowFactory(models.UserProfile)
+_REPEATING_TASK_ROWS = _modelRowFactory(models.RepeatingTask)
+_DUE_TASK_NOTIFICATION_ROWS = _modelRowFactory(models.DueTaskNotification)
+
+
+def _taskBatchRows(columnNames):
+    # Rows of api.asuser_apply_task_batch -> (error, task). The task
+    # is all None but the id for deletes, and meaningless for errors.
+    errorIndex = list(columnNames).index('error')
+    makeTask = _TASK_ROWS(columnNames)
+    return lambda row: (row[errorIndex], makeTask(row))
+
+
+def _taskChangeRows(columnNames):
+    # Rows of api.asuser_fetch_task_changes -> (change kind, task). The
+    # task is all None but the id for everything but 'task' rows.
+    kindIndex = list(columnNames).index('change_kind')
+    makeTask = _TASK_ROWS(columnNames)
+    return lambda row: (row[kindIndex], makeTask(row))
+
+
+def _taskBatchItem(operation):
+    item = {'op': operation.operation, 'task_id': operation.task_id}
+    task = operation.task
+    if task is not None:
+        item.update(
+            task_group_id=task.task_group_id,
+            name=task.name,
+            description=task.description,
+            due_unix=task.due_unix,
+        )
+    return item
+
+
 class ChoreTrackerDatabase:
-    def __init__(self, dbpool: adbapi.ConnectionPool):
+    def __init__(self, dbpool: dbbackends.IConnectionBackend):
         self.pool = dbpool
 
 
+    async def _runPreparedQuery(self, statementName, params, rowFactory=None):
+        start = time.perf_counter()
+        span = tracing.startSpan('db', function=statementName)
+        if span is not None:
+            span.params = params
+        try:
+            # The backend can record what happens to the query under
+            # the span.
+            with tracing.activated(span):
+                dfd = self.pool.runPreparedQuery(
+                    statementName, params, rowFactory)
+            return await dfd
+        except Exception as e:
+            _callErrors.labels(statementName).inc()
+            if span is not None:
+                span.attributes['error'] = type(e).__name__
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _callSeconds.labels(statementName).observe(elapsed)
+            if (_slowQueryThreshold is not None
+                    and elapsed >= _slowQueryThreshold):
+                _logSlowCall(statementName, params, elapsed)
+            if span is not None:
+                span.finish()
+
+
     async def asUserFetchAllTasks(self, *, userId):
-        sql = 'SELECT * FROM api.asuser_fetch_all_tasks(%s)'
-        taskRows = await self.pool.runQuery(sql, [userId])
-        return [models.Task(**row) for row in taskRows]
+        """
+        Fetch all the tasks the user can view, in (due, id) order.
+        """
+        return await self._runPreparedQuery(
+            'asuser_fetch_all_tasks', [userId], _TASK_ROWS)
+
+
+    async def asUserIterAllTasks(self, *, userId, batchSize=500):
+        """
+        Asynchronously iterate over all the tasks the user can view,
+        in (due, id) order, fetching ``batchSize`` at a time so that
+        only one batch is in memory.
+
+        Each batch is its own query, so this is not a consistent
+        snapshot if the tasks are changed during iteration.
+        """
+        async for task in self.asUserIterTasks(
+                userId=userId, taskListQuery=models.TaskListQuery(),
+                batchSize=batchSize):
+            yield task
+
+
+    async def asUserIterTasks(self, *, userId, taskListQuery, batchSize=500):
+        """
+        Like :meth:`asUserIterAllTasks`, but only the tasks matching
+        the filters of the :class:`models.TaskListQuery` (whose
+        ``limit`` is ignored), starting after its cursor.
+        """
+        while True:
+            tasks = await self.asUserFetchTasksPage(
+                userId=userId, taskListQuery=taskListQuery, limit=batchSize)
+            for task in tasks:
+                yield task
+            if len(tasks) < batchSize:
+                return
+            taskListQuery = attr.evolve(
+                taskListQuery, after=models.TaskCursor.afterTask(tasks[-1]))
+
+
+    async def asUserFetchTasksPage(self, *, userId, taskListQuery, limit):
+        """
+        Fetch up to ``limit`` tasks matching the
+        :class:`models.TaskListQuery` (whose own ``limit`` is ignored,
+        so callers can ask for an extra row to see if there are more).
+        """
+        after = taskListQuery.after
+        params = (
+            userId,
+            None if after is None else after.due_unix,
+            None if after is None else after.id,
+            limit,
+            taskListQuery.task_group_id,
+            taskListQuery.due_after_unix,
+            taskListQuery.due_before_unix,
+            taskListQuery.overdue,
+        )
+        try:
+            return await self._runPreparedQuery(
+                'asuser_fetch_tasks_page', params, _TASK_ROWS)
+        except psycopg2.InternalError as dberr:
+            _wrapAndRaiseDBException(dberr)
 
 
     async def asUserFetchTask(self, *, userId, taskId):
-        sql = 'SELECT * FROM api.asuser_fetch_task(%s, %s)'
         params = (userId, taskId)
         try:
-            [task_row] = await self.pool.runQuery(sql, params)
+            [task] = await self._runPreparedQuery(
+                'asuser_fetch_task', params, _TASK_ROWS)
         except psycopg2.InternalError as dberr:
             _wrapAndRaiseDBException(dberr)
 
-        return models.Task(**task_row)
+        return task
 
 
     async def asUserCreateTask(self, *, userId, taskToCreate):
-        sql = 'SELECT * FROM api.asuser_create_task(%s, %s, %s, %s, %s)'
         params = (
             userId, 
             taskToCreate.task_group_id,
@@ -109,15 +440,15 @@ class ChoreTrackerDatabase:
             taskToCreate.due_unix
         )
         try:
-            [newTaskRow] = await self.pool.runQuery(sql, params)
+            [task] = await self._runPreparedQuery(
+                'asuser_create_task', params, _TASK_ROWS)
         except psycopg2.InternalError as dberr:
             _wrapAndRaiseDBException(dberr)
 
-        return models.Task(**newTaskRow)
+        return task
 
 
     async def asUserUpdateTask(self, *, userId, taskId, taskToUpdate):
-        sql = 'SELECT * FROM api.asuser_update_task(%s, %s, %s, %s, %s, %s)'
         params = (
             userId,
             taskId,
@@ -127,45 +458,245 @@ class ChoreTrackerDatabase:
             taskToUpdate.due_unix
         )
         try:
-            [updatedTaskRow] = await self.pool.runQuery(sql, params)
+            [task] = await self._runPreparedQuery(
+                'asuser_update_task', params, _TASK_ROWS)
         except psycopg2.InternalError as dberr:
             _wrapAndRaiseDBException(dberr)
 
-        return models.Task(**updatedTaskRow)
+        return task
 
 
     async def asUserDeleteTask(self, *, userId, taskId):
-        sql = 'SELECT api.asuser_delete_task(%s, %s)'
         params = (userId, taskId)
         try:
-            result = await self.pool.runQuery(sql, params)
+            result = await self._runPreparedQuery(
+                'asuser_delete_task', params)
+        except psycopg2.InternalError as dberr:
+            _wrapAndRaiseDBException(dberr)
+
+        return None
+
+
+    async def asUserApplyTaskBatch(self, *, userId, operations):
+        """
+        Apply the :class:`models.TaskBatchOperation` list (with its
+        tasks loaded) in a single statement, so a single transaction.
+
+        Returns a :class:`models.TaskBatchResult` per operation, in
+        order. Operations that fail their checks are skipped and get
+        the exception the single-task method would have raised as
+        their error; the rest are still applied.
+        """
+        params = (
+            userId,
+            psycopg2.extras.Json([_taskBatchItem(op) for op in operations]),
+        )
+        rows = await self._runPreparedQuery(
+            'asuser_apply_task_batch', params, _taskBatchRows)
+
+        results = []
+        for index, (operation, (error, task)) in enumerate(
+                zip(operations, rows)):
+            if error is not None:
+                appExceptionClass = _DB_RAISE_DETAIL_TO_APP_EXCEPTION[error]
+                results.append(models.TaskBatchResult(
+                    error=appExceptionClass(
+                        '{0} for batch item {1}'.format(error, index))))
+            elif operation.operation == 'delete':
+                results.append(models.TaskBatchResult(task_id=task.id))
+            else:
+                results.append(
+                    models.TaskBatchResult(task_id=task.id, task=task))
+        return results
+
+
+    async def asUserFetchTaskChanges(self, *, userId, since):
+        """
+        Fetch the changes to the tasks the user can view since the
+        :class:`models.SyncCursor` ``since`` (None for all of them).
+
+        Returns a :class:`models.TaskChanges`.
+        """
+        params = (userId, None if since is None else since.txid)
+        rows = await self._runPreparedQuery(
+            'asuser_fetch_task_changes', params, _taskChangeRows)
+
+        (kind, cursorRow), *rows = rows
+        assert kind == 'cursor'
+        reset = bool(rows) and rows[0][0] == 'reset'
+        if reset:
+            del rows[0]
+        return models.TaskChanges(
+            cursor=models.SyncCursor(txid=cursorRow.id),
+            reset=reset,
+            tasks=[task for kind, task in rows if kind == 'task'],
+            deleted_task_ids=[
+                task.id for kind, task in rows if kind == 'deleted'],
+        )
+
+
+    async def pruneTaskChanges(self, *, keepSeconds):
+        """
+        Delete the task change log older than ``keepSeconds``. Sync
+        cursors from before then will get a reset. Returns how many
+        log entries were deleted.
+        """
+        [row] = await self._runPreparedQuery(
+            'prune_task_changes', [keepSeconds])
+        return row['pruned_count']
+
+
+    async def asUserFetchAllRepeatingTasks(self, *, userId):
+        return await self._runPreparedQuery(
+            'asuser_fetch_all_repeating_tasks', [userId],
+            _REPEATING_TASK_ROWS)
+
+
+    async def asUserFetchRepeatingTask(self, *, userId, repeatingTaskId):
+        params = (userId, repeatingTaskId)
+        try:
+            [repeatingTask] = await self._runPreparedQuery(
+                'asuser_fetch_repeating_task', params, _REPEATING_TASK_ROWS)
+        except psycopg2.InternalError as dberr:
+            _wrapAndRaiseDBException(dberr)
+
+        return repeatingTask
+
+
+    async def asUserCreateRepeatingTask(
+                self, *, userId, repeatingTaskToCreate):
+        """
+        Create the :class:`models.RepeatingTask`, with its
+        ``next_due_unix`` already set to its first occurrence. Its
+        tasks are created by :meth:`applyRepeatingTaskMaterializations`.
+        """
+        params = (
+            userId,
+            repeatingTaskToCreate.task_group_id,
+            repeatingTaskToCreate.name,
+            repeatingTaskToCreate.description,
+            repeatingTaskToCreate.recurrence,
+            repeatingTaskToCreate.start_unix,
+            repeatingTaskToCreate.next_due_unix,
+        )
+        try:
+            [repeatingTask] = await self._runPreparedQuery(
+                'asuser_create_repeating_task', params, _REPEATING_TASK_ROWS)
+        except psycopg2.InternalError as dberr:
+            _wrapAndRaiseDBException(dberr)
+
+        return repeatingTask
+
+
+    async def asUserDeleteRepeatingTask(self, *, userId, repeatingTaskId):
+        params = (userId, repeatingTaskId)
+        try:
+            await self._runPreparedQuery(
+                'asuser_delete_repeating_task', params)
         except psycopg2.InternalError as dberr:
             _wrapAndRaiseDBException(dberr)
 
         return None
 
 
+    async def fetchDueRepeatingTasks(self, *, beforeUnix, limit):
+        """
+        Fetch up to ``limit`` :class:`models.RepeatingTask` with their
+        next occurrence before ``beforeUnix``, soonest first.
+        """
+        return await self._runPreparedQuery(
+            'fetch_due_repeating_tasks', (beforeUnix, limit),
+            _REPEATING_TASK_ROWS)
+
+
+    async def fetchNextRepeatingTaskDue(self):
+        """
+        The soonest next occurrence of any repeating task (Unix time),
+        or None if there are none.
+        """
+        [row] = await self._runPreparedQuery(
+            'fetch_next_repeating_task_due', ())
+        return row['next_due_unix']
+
+
+    async def applyRepeatingTaskMaterializations(self, materializations):
+        """
+        Apply the :class:`models.RepeatingTaskMaterialization` list in a
+        single statement. Returns the number of tasks created.
+        """
+        batch = [attr.asdict(m) for m in materializations]
+        [row] = await self._runPreparedQuery(
+            'apply_repeating_task_materializations',
+            [psycopg2.extras.Json(batch)])
+        return row['created_count']
+
+
+    async def fetchUpcomingTaskDues(
+                self, *, fromUnix, afterTaskId, beforeUnix, limit):
+        """
+        Fetch up to ``limit`` ``(task ID, due time)`` pairs of the tasks
+        due from ``fromUnix`` to before ``beforeUnix`` that haven't been
+        notified for their due time, in (due, ID) order, starting after
+        the task ``afterTaskId`` (0 to start at ``fromUnix``).
+        """
+        params = (fromUnix, afterTaskId, beforeUnix, limit)
+        rows = await self._runPreparedQuery(
+            'fetch_upcoming_task_dues', params)
+        return [(row['id'], row['due_unix']) for row in rows]
+
+
+    async def fetchTaskDues(self, *, taskIds):
+        """
+        Fetch the ``(task ID, due time)`` pairs of the tasks in
+        ``taskIds`` that exist.
+        """
+        rows = await self._runPreparedQuery(
+            'fetch_task_dues', [list(taskIds)])
+        return [(row['id'], row['due_unix']) for row in rows]
+
+
+    async def claimDueTaskNotifications(
+                self, *, taskIds, notBeforeUnix, beforeUnix):
+        """
+        Claim the notifications of the tasks in ``taskIds`` due from
+        ``notBeforeUnix`` to before ``beforeUnix`` that no one has
+        claimed for their due time yet. Returns a
+        :class:`models.DueTaskNotification` for each of them and member
+        of its task group with a verified email address.
+        """
+        params = (list(taskIds), notBeforeUnix, beforeUnix)
+        return await self._runPreparedQuery(
+            'claim_due_task_notifications', params,
+            _DUE_TASK_NOTIFICATION_ROWS)
+
+
+    async def fetchTaskGroupMemberIds(self, *, taskGroupId):
+        rows = await self._runPreparedQuery(
+            'fetch_task_group_member_ids', [taskGroupId])
+        return [row['member_user_id'] for row in rows]
+
+
     async def fetchUserProfile(self, *, userId):
-        sql = 'SELECT * FROM api.fetch_user_profile(%s)'
         params = [userId]
         try:
-            [userProfileRow] = await self.pool.runQuery(sql, params)
+            [userProfile] = await self._runPreparedQuery(
+                'fetch_user_profile', params, _USER_PROFILE_ROWS)
         except psycopg2.InternalError as dberr:
             _wrapAndRaiseDBException(dberr)
 
-        return models.UserProfile(**userProfileRow)
+        return userProfile
 
 
     async def createOrUpdateUserProfile(self, *, userId, userProfile):
-        sql = 'SELECT * FROM api.create_or_update_user_profile(%s, %s, %s)'
         params = (userId, userProfile.email, userProfile.display_name)
-        [updatedProfileRow] = await self.pool.runQuery(sql, params)
-        return models.UserProfile(**updatedProfileRow)
+        [updatedProfile] = await self._runPreparedQuery(
+            'create_or_update_user_profile', params, _USER_PROFILE_ROWS)
+        return updatedProfile
 
 
     async def googleAuthCreateOrFetchExistingUserId(
                 self, *, validatedGoogleUserId):
-        sql = 'SELECT api.google_auth_fetch_existing_user_id_or_create(%s)'
         params = [validatedGoogleUserId]
-        [row] = await self.pool.runQuery(sql, params)
+        [row] = await self._runPreparedQuery(
+            'google_auth_fetch_existing_user_id_or_create', params)
         return row['existing_or_new_user_id'], row['has_profile']
@@ -0,0 +1,660 @@
+"""
+Pluggable connection backends for :class:`txchoretracker.db.ChoreTrackerDatabase`.
+
+A backend owns the actual PostgreSQL connections and exposes the
+small Deferred-returning surface the database wrapper needs (see
+:class:`IConnectionBackend`). Which one is used is selected by
+:attr:`txchoretracker.config.DatabaseConfig.backend`.
+
+-   ``adbapi`` (the default) runs blocking psycopg2 calls in the
+    reactor thread pool via :class:`twisted.enterprise.adbapi.ConnectionPool`.
+-   ``txpostgres`` uses psycopg2's asynchronous connection mode driven
+    directly by the reactor, so no thread hop is needed per query.
+    Requires the ``txpostgres`` package to be installed; without it,
+    ``adbapi`` is used instead.
+
+Rows returned from both backends are :class:`psycopg2.extras.DictRow`
+instances, so ``SomeModel(**row)`` works the same either way. For large
+results, :meth:`IConnectionBackend.runPreparedQuery` can instead build
+the result objects straight from plain row tuples (see
+:data:`rowFactory <IConnectionBackend.runPreparedQuery>`).
+
+Both backends run the api.* calls as server-side prepared statements
+(see :mod:`txchoretracker.preparedstatements`) through
+:meth:`IConnectionBackend.runPreparedQuery`.
+
+The pool sizes of both backends, and the ``adbapi`` backend's
+connection checks and statement timeout, come from
+:class:`txchoretracker.config.DatabaseConfig`. With
+``adaptive`` on, :class:`AdaptivePoolSizer` grows the pool while
+queries wait too long for a connection and shrinks it again when
+connections sit unused.
+"""
+import functools
+import threading
+import time
+from types import MappingProxyType
+
+import psycopg2.extensions
+import psycopg2.extras
+import zope.interface
+from twisted import logger
+from twisted.enterprise import adbapi
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.internet import threads
+
+from txchoretracker import tracing
+from txchoretracker.metrics import Histogram
+from txchoretracker.utils import coroToDeferred
+
+try:
+    from txpostgres import txpostgres
+except ImportError:
+    txpostgres = None
+
+
+log = logger.Logger()
+
+
+def _fetchRows(cursor, rowFactory):
+    rows = cursor.fetchall()
+    if rowFactory is None:
+        return rows
+    makeRow = rowFactory([column[0] for column in cursor.description])
+    return [makeRow(row) for row in rows]
+
+
+class IConnectionBackend(zope.interface.Interface):
+    statements = zope.interface.Attribute('''
+        The :class:`txchoretracker.preparedstatements.PreparedStatementRegistry`
+        used by :meth:`runPreparedQuery`.
+    ''')
+
+    def start():
+        """
+        Open the initial connections. Returns a Deferred that fires
+        when the backend is ready to run queries.
+        """
+
+    def runQuery(sql, params=None):
+        """
+        Run a single query in its own transaction. Returns a Deferred
+        that fires with a list of rows.
+        """
+
+    def runPreparedQuery(statementName, params, rowFactory=None):
+        """
+        Run the named prepared statement in its own transaction,
+        preparing the statements on the connection first if needed.
+        Returns a Deferred that fires with a list of rows.
+
+        If ``rowFactory`` is given, the rows are fetched as plain
+        tuples instead, and ``rowFactory`` is called with the list of
+        result column names. It must return a callable that turns a
+        row tuple into the object to put in the result list.
+        """
+
+    def runOperation(sql, params=None):
+        """
+        Run a single statement (or script) that returns no rows.
+        Returns a Deferred that fires with None.
+        """
+
+    def close():
+        """
+        Close all the connections.
+        """
+
+    def stats():
+        """
+        Pool counters for monitoring, as a dict. Includes at least
+        ``size`` (the most connections the pool will open),
+        ``connections`` (how many are open), ``waiters`` (queries
+        waiting for a connection) and ``inUse`` (queries running).
+        """
+
+
+class _PoolThread(threading.Thread):
+    """
+    A thread pool thread that calls ``onExit`` in the thread as it
+    finishes.
+    """
+    def __init__(self, *args, onExit, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._onExit = onExit
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self._onExit()
+
+
+class InstrumentedConnectionPool(adbapi.ConnectionPool):
+    """
+    :class:`twisted.enterprise.adbapi.ConnectionPool` that keeps
+    statistics on how its connections are used, checks connections
+    that have been idle before handing them out, and can be resized
+    while it runs.
+
+    adbapi keeps one connection per pool thread. Here, a thread closes
+    its connection when it exits, so shrinking the thread pool (see
+    :meth:`resize`) closes connections too.
+
+    Takes the same arguments as ``adbapi.ConnectionPool``, and:
+
+    Args:
+        cp_check_after (float):
+            Run ``cp_good_sql`` on a connection before using it if it
+            hasn't been used for this many seconds, and reconnect if
+            that fails. 0 turns the checks off.
+        cp_clock (callable):
+            Returns the current time in seconds.
+    """
+    def __init__(self, dbapiName, *connargs, **connkw):
+        self.checkAfter = connkw.pop('cp_check_after', 0)
+        self._clock = connkw.pop('cp_clock', time.monotonic)
+        super().__init__(dbapiName, *connargs, **connkw)
+        self.threadpool.threadFactory = functools.partial(
+            _PoolThread, onExit=self._disconnectThread)
+        # Guards the counters below, which pool threads update.
+        self._lock = threading.Lock()
+        self._lastUsed = {}
+        self.waiters = 0
+        self.inUse = 0
+        self.peakInUse = 0
+        self.checksFailed = 0
+        # Seconds queries waited for a connection, and then held one.
+        self.waitTimes = Histogram()
+        self.useTimes = Histogram()
+
+    def runInteraction(self, interaction, *args, **kw):
+        with self._lock:
+            self.waiters += 1
+        return threads.deferToThreadPool(
+            self._reactor, self.threadpool, self._runTimedInteraction,
+            self._clock(), tracing.currentSpan(), interaction, *args, **kw)
+
+    def _runTimedInteraction(
+                self, submitted, span, interaction, *args, **kw):
+        # Runs in a pool thread. ``span`` is the current tracing span
+        # when the interaction was submitted, if any.
+        started = self._clock()
+        with self._lock:
+            self.waiters -= 1
+            self.inUse += 1
+            self.peakInUse = max(self.peakInUse, self.inUse)
+            self.waitTimes.observe(started - submitted)
+        try:
+            return self._runInteraction(interaction, *args, **kw)
+        finally:
+            finished = self._clock()
+            with self._lock:
+                self.inUse -= 1
+                self.useTimes.observe(finished - started)
+            if span is not None:
+                span.record('db.pool_wait', submitted, started)
+                span.record('db.query', started, finished)
+
+    def connect(self):
+        conn = super().connect()
+        tid = self.threadID()
+        now = self._clock()
+        lastUsed = self._lastUsed.get(tid)
+        self._lastUsed[tid] = now
+        if (self.checkAfter and lastUsed is not None
+                and now - lastUsed > self.checkAfter
+                and not self._checkConnection(conn)):
+            with self._lock:
+                self.checksFailed += 1
+            log.warn('Reconnecting a database connection that failed its check')
+            self.disconnect(conn)
+            conn = super().connect()
+        return conn
+
+    def _checkConnection(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.good_sql)
+            cursor.close()
+            conn.rollback()
+        except self.dbapi.Error:
+            return False
+        return True
+
+    def _disconnectThread(self):
+        # Runs in a pool thread as it exits.
+        self._lastUsed.pop(self.threadID(), None)
+        conn = self.connections.pop(self.threadID(), None)
+        if conn is not None:
+            self._close(conn)
+
+    @property
+    def size(self):
+        return self.threadpool.max
+
+    def resize(self, size):
+        """
+        Allow up to ``size`` connections. Idle connections beyond that
+        are closed straight away, busy ones once they're done.
+        """
+        self.threadpool.adjustPoolsize(min(self.min, size), size)
+
+    def takePeakInUse(self):
+        """
+        Return the most connections that were in use at once since the
+        last call.
+        """
+        with self._lock:
+            peakInUse = self.peakInUse
+            self.peakInUse = self.inUse
+        return peakInUse
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'connections': len(self.connections),
+                'waiters': self.waiters,
+                'inUse': self.inUse,
+                'checksFailed': self.checksFailed,
+                'waitTime': self.waitTimes.snapshot(),
+                'useTime': self.useTimes.snapshot(),
+            }
+
+
+class AdaptivePoolSizer:
+    """
+    Resizes an :class:`InstrumentedConnectionPool` between ``minSize``
+    and ``maxSize`` connections every ``interval`` seconds.
+
+    The pool grows by half (at least one connection) when the 90th
+    percentile of the time queries waited for a connection over the
+    last interval is above ``targetWait``, or when queries are waiting
+    and every connection was in use. It shrinks by one when neither is
+    the case and the pool was never fully in use.
+    Growing fast and shrinking slowly copes with bursts without
+    flapping.
+
+    Args:
+        pool (InstrumentedConnectionPool): The pool to resize.
+        minSize (int): The fewest connections to allow.
+        maxSize (int): The most connections to allow.
+        targetWait (float): Seconds a query may wait for a connection.
+        interval (float): Seconds between adjustments.
+        reactor: Schedules the adjustments.
+    """
+    log = logger.Logger()
+
+    def __init__(
+                self,
+                pool,
+                *,
+                minSize: int,
+                maxSize: int,
+                targetWait: float,
+                interval: float,
+                reactor=None,
+            ):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._pool = pool
+        self._minSize = minSize
+        self._maxSize = maxSize
+        self._targetWait = targetWait
+        self._interval = interval
+        self._lastWaitTimes = pool.waitTimes.copy()
+        self._loop = task.LoopingCall(self.adjust)
+        self._loop.clock = reactor
+        self.grown = 0
+        self.shrunk = 0
+
+    def start(self):
+        self._pool.resize(self._minSize)
+        self._loop.start(self._interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def adjust(self):
+        waitTimes = self._pool.waitTimes.copy()
+        slowWait = waitTimes.quantile(0.9, since=self._lastWaitTimes)
+        self._lastWaitTimes = waitTimes
+        peakInUse = self._pool.takePeakInUse()
+        size = self._pool.size
+        # Queries stuck behind long-running ones haven't been counted
+        # in the wait times yet.
+        starved = slowWait > self._targetWait or (
+            self._pool.waiters and peakInUse >= size)
+        if starved and size < self._maxSize:
+            newSize = min(self._maxSize, size + max(1, size // 2))
+            self.grown += 1
+        elif not starved and peakInUse < size and size > self._minSize:
+            newSize = size - 1
+            self.shrunk += 1
+        else:
+            return
+        self.log.debug(
+            'Resizing the database pool from {size} to {newSize} '
+            'connections', size=size, newSize=newSize)
+        self._pool.resize(newSize)
+
+
+@zope.interface.implementer(IConnectionBackend)
+class AdbapiConnectionBackend:
+    """
+    Blocking psycopg2 connections used from the reactor thread pool.
+
+    Args:
+        postgresDSN (str): Where to connect.
+        statements: The prepared statement registry.
+        minSize (int): Connections to keep open once opened.
+        maxSize (int): The most connections to open.
+        reconnect (bool):
+            Reconnect connections found broken when rolling back.
+        checkQuery (str): The query to check connections with.
+        checkAfter (float):
+            Check connections idle for this many seconds before using
+            them (0 for never).
+        statementTimeout (float):
+            Seconds after which PostgreSQL cancels a statement (0 for
+            no limit).
+        adaptive (bool):
+            Resize the pool between ``minSize`` and ``maxSize`` with
+            an :class:`AdaptivePoolSizer`.
+        targetWait (float), adaptInterval (float):
+            Passed to the :class:`AdaptivePoolSizer`.
+    """
+    def __init__(
+                self,
+                postgresDSN,
+                statements,
+                *,
+                minSize=3,
+                maxSize=5,
+                reconnect=True,
+                checkQuery='SELECT 1',
+                checkAfter=60.0,
+                statementTimeout=0.0,
+                adaptive=False,
+                targetWait=0.01,
+                adaptInterval=5.0,
+                reactor=None,
+            ):
+        self.statements = statements
+        self._statementTimeout = statementTimeout
+        self._pool = InstrumentedConnectionPool(
+            'psycopg2',
+            postgresDSN,
+            cursor_factory=psycopg2.extras.DictCursor,
+            cp_min=minSize,
+            cp_max=maxSize,
+            cp_reconnect=reconnect,
+            cp_good_sql=checkQuery,
+            cp_check_after=checkAfter,
+            cp_openfun=self._setUpConnection,
+            cp_reactor=reactor,
+        )
+        self._sizer = None
+        if adaptive:
+            self._sizer = AdaptivePoolSizer(
+                self._pool,
+                minSize=minSize,
+                maxSize=maxSize,
+                targetWait=targetWait,
+                interval=adaptInterval,
+                reactor=reactor,
+            )
+
+    def _setUpConnection(self, connection):
+        # Runs in a pool thread for each new connection.
+        if self._statementTimeout:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SET statement_timeout = %s',
+                    (int(self._statementTimeout * 1000),))
+            connection.commit()
+
+    def start(self):
+        # adbapi.ConnectionPool starts itself once the reactor is
+        # running, and connects lazily on first use.
+        if self._sizer is not None:
+            self._sizer.start()
+        return defer.succeed(None)
+
+    def runQuery(self, sql, params=None):
+        return self._pool.runQuery(sql, params)
+
+    def runPreparedQuery(self, statementName, params, rowFactory=None):
+        return self._pool.runInteraction(
+            self._runPreparedInteraction, statementName, params, rowFactory)
+
+    def _runPreparedInteraction(
+                self, txn, statementName, params, rowFactory):
+        # Runs in a pool thread. The transaction forwards attribute
+        # access to its cursor, so this is the raw psycopg2 connection.
+        connection = txn.connection
+        cursor = txn
+        if rowFactory is not None:
+            # The pool's connections default to DictCursor.
+            cursor = connection.cursor(
+                cursor_factory=psycopg2.extensions.cursor)
+        try:
+            cursor.execute(
+                self.statements.sqlFor(connection, statementName), params)
+        except psycopg2.Error as dberr:
+            if not self.statements.forgetIfStale(connection, dberr):
+                raise
+            connection.rollback()
+            cursor.execute(
+                self.statements.sqlFor(connection, statementName), params)
+        self.statements.markPrepared(connection)
+        return _fetchRows(cursor, rowFactory)
+
+    def runOperation(self, sql, params=None):
+        return self._pool.runOperation(sql, params)
+
+    def close(self):
+        if self._sizer is not None:
+            self._sizer.stop()
+        self._pool.close()
+
+    def stats(self):
+        return self._pool.stats()
+
+
+@zope.interface.implementer(IConnectionBackend)
+class TxPostgresConnectionBackend:
+    """
+    Non-blocking psycopg2 connections driven by the reactor, using
+    :class:`txpostgres.txpostgres.Connection`.
+
+    Each query gets a connection to itself, so that prepared statements
+    are tracked against the connection that actually ran them.
+
+    A connection found closed after a query fails (the server went
+    away, say) is dropped, and a new one is opened in its place the
+    next time a connection is needed. The new connection is a new key
+    for the prepared statement registry, so it gets the statements
+    prepared again on its first prepared query.
+
+    Args:
+        postgresDSN (str): Where to connect.
+        statements: The prepared statement registry.
+        minSize (int): Connections to open when starting.
+        maxSize (int):
+            The most connections to open. More than ``minSize`` are
+            opened as queries need them, and then kept open.
+        connectionFactory (callable):
+            Makes a new, unconnected connection. Defaults to
+            :class:`txpostgres.txpostgres.Connection`.
+    """
+    def __init__(
+                self,
+                postgresDSN,
+                statements,
+                *,
+                minSize=3,
+                maxSize=5,
+                connectionFactory=None,
+            ):
+        if connectionFactory is None:
+            if txpostgres is None:
+                raise RuntimeError(
+                    'The txpostgres database backend requires the '
+                    'txpostgres package to be installed')
+            connectionFactory = txpostgres.Connection
+        self.statements = statements
+        self._postgresDSN = postgresDSN
+        self._minSize = minSize
+        self._maxSize = maxSize
+        self._connectionFactory = connectionFactory
+        self._connections = set()
+        self._idleConnections = []
+        # Never more borrowers than maxSize, so there's always room
+        # to open a connection for one when none are idle.
+        self._semaphore = defer.DeferredSemaphore(maxSize)
+        self.reconnects = 0
+
+    def start(self):
+        dfd = defer.gatherResults(
+            [self._connect() for _ in range(self._minSize)],
+            consumeErrors=True,
+        )
+        dfd.addCallback(self._idleConnections.extend)
+        return dfd
+
+    @coroToDeferred
+    async def _connect(self):
+        connection = self._connectionFactory()
+        await connection.connect(
+            self._postgresDSN, cursor_factory=psycopg2.extras.DictCursor)
+        self._connections.add(connection)
+        return connection
+
+    def _withConnection(self, func, *args):
+        return self._semaphore.run(self._borrowConnection, func, *args)
+
+    @coroToDeferred
+    async def _borrowConnection(self, func, *args):
+        if self._idleConnections:
+            connection = self._idleConnections.pop()
+        else:
+            connection = await self._connect()
+        try:
+            return await defer.maybeDeferred(func, connection, *args)
+        finally:
+            if connection.pollable().closed:
+                self._dropConnection(connection)
+            else:
+                self._idleConnections.append(connection)
+
+    def _dropConnection(self, connection):
+        log.warn('Dropping a closed database connection')
+        self._connections.discard(connection)
+        self.reconnects += 1
+        connection.close()
+
+    def runQuery(self, sql, params=None):
+        return self._withConnection(
+            lambda connection: connection.runQuery(sql, params))
+
+    def runPreparedQuery(self, statementName, params, rowFactory=None):
+        return self._withConnection(
+            self._runPreparedQuery, statementName, params, rowFactory)
+
+    @coroToDeferred
+    async def _runPreparedQuery(
+                self, connection, statementName, params, rowFactory):
+        rawConnection = connection.pollable()
+        try:
+            rows = await self._runRowsQuery(
+                connection,
+                self.statements.sqlFor(rawConnection, statementName),
+                params,
+                rowFactory)
+        except psycopg2.Error as dberr:
+            if not self.statements.forgetIfStale(rawConnection, dberr):
+                raise
+            rows = await self._runRowsQuery(
+                connection,
+                self.statements.sqlFor(rawConnection, statementName),
+                params,
+                rowFactory)
+        self.statements.markPrepared(rawConnection)
+        return rows
+
+    async def _runRowsQuery(self, connection, sql, params, rowFactory):
+        if rowFactory is None:
+            return await connection.runQuery(sql, params)
+        # The connections default to DictCursor, so wrap a plain cursor
+        # by hand.
+        cursor = txpostgres.Cursor(
+            connection.pollable().cursor(
+                cursor_factory=psycopg2.extensions.cursor),
+            connection)
+        await cursor.execute(sql, params)
+        return _fetchRows(cursor, rowFactory)
+
+    def runOperation(self, sql, params=None):
+        return self._withConnection(
+            lambda connection: connection.runOperation(sql, params))
+
+    def close(self):
+        for connection in list(self._connections):
+            connection.close()
+
+    def stats(self):
+        return {
+            'size': self._maxSize,
+            'connections': len(self._connections),
+            'waiters': len(self._semaphore.waiting),
+            'inUse': len(self._connections) - len(self._idleConnections),
+            'reconnects': self.reconnects,
+        }
+
+
+_BACKEND_CLASSES = MappingProxyType({
+    'adbapi': AdbapiConnectionBackend,
+    'txpostgres': TxPostgresConnectionBackend,
+})
+
+
+def makeConnectionBackend(dbConfig, statements):
+    """
+    Create the (not yet started) connection backend selected by
+    ``dbConfig.backend``, running prepared queries from the
+    ``statements`` registry. Falls back to the ``adbapi`` backend if
+    ``txpostgres`` is selected but not installed.
+    """
+    backendName = dbConfig.backend
+    if backendName == 'txpostgres' and txpostgres is None:
+        log.warn('The txpostgres package is not installed, so using the '
+                 'adbapi database backend instead')
+        backendName = 'adbapi'
+    backendClass = _BACKEND_CLASSES.get(backendName)
+    if backendClass is None:
+        raise ValueError(
+            'Unknown database backend {0!r}'.format(backendName))
+    if backendClass is AdbapiConnectionBackend:
+        return backendClass(
+            dbConfig.get_dsn(),
+            statements,
+            minSize=dbConfig.pool_min,
+            maxSize=dbConfig.pool_max,
+            reconnect=dbConfig.reconnect,
+            checkQuery=dbConfig.check_query,
+            checkAfter=dbConfig.check_after,
+            statementTimeout=dbConfig.statement_timeout,
+            adaptive=dbConfig.adaptive,
+            targetWait=dbConfig.adaptive_target_wait,
+            adaptInterval=dbConfig.adaptive_interval,
+        )
+    return backendClass(
+        dbConfig.get_dsn(),
+        statements,
+        minSize=dbConfig.pool_min,
+        maxSize=dbConfig.pool_max,
+    )
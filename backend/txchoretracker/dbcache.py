@@ -0,0 +1,265 @@
+"""
+Read-through cache in front of :class:`txchoretracker.db.ChoreTrackerDatabase`.
+
+Two kinds of entries are cached:
+
+-   ``('task', userId, taskId)``: the result of ``asUserFetchTask``
+-   ``('tasks', userId)``: the result of ``asUserFetchAllTasks``, or
+    of iterating over ``asUserIterAllTasks`` to the end. Both are in
+    (due, id) order.
+
+Writes made through this wrapper evict exactly the entries they can
+affect. A task is visible to every member of its task group, so:
+
+-   Creating a task in a task group evicts the task lists of all the
+    members of that task group.
+-   Updating or deleting a task evicts every cached copy of that task,
+    and every cached task list containing it. An update also evicts the
+    task lists of the members of the task's (possibly new) task group.
+
+Batches of task writes follow the same rules for each applied item.
+
+This relies on every cached task list of a task group member
+containing all of that task group's tasks, which the rules above
+maintain. Membership changes aren't made through the API. When they
+are seen through :meth:`CachingChoreTrackerDatabase.handleChange`,
+every entry of the user is evicted, so a user removed from a task
+group can't go on reading its tasks from the cache.
+
+Writes made by other processes are picked up by subscribing
+:meth:`CachingChoreTrackerDatabase.handleChange` to a
+:class:`txchoretracker.changes.ChangeListener`. Changes may go unseen
+while the listener isn't connected, so until it has connected, and
+from when it disconnects until it has reconnected, the cache is
+emptied and bypassed: every read goes to the database, and nothing is
+stored.
+
+Failures (no such task, forbidden, ...) are never cached.
+"""
+import collections
+
+from txchoretracker.cache import LRUCache
+from txchoretracker.utils import coroToDeferred
+
+
+# Rough per-object overheads in bytes, used to keep the cache within
+# its memory bound without the cost of measuring every object.
+_TASK_OVERHEAD = 600
+_LIST_OVERHEAD = 64
+
+
+def _estimateTaskSize(task):
+    return _TASK_OVERHEAD + len(task.name) + len(task.description)
+
+
+class CachingChoreTrackerDatabase:
+    """
+    Wraps a :class:`txchoretracker.db.ChoreTrackerDatabase`, caching
+    task reads and invalidating them on task writes. Anything not
+    handled here is passed straight through to the wrapped instance.
+
+    Cached model instances are shared between callers, so they must
+    not be modified.
+    """
+    def __init__(self, dbWrapper, *, maxEntries, maxBytes, ttl, **cacheKw):
+        self._db = dbWrapper
+        self.cache = LRUCache(
+            maxEntries=maxEntries,
+            maxSize=maxBytes,
+            ttl=ttl,
+            onRemove=self._unindex,
+            **cacheKw
+        )
+        # taskId -> set of cache keys holding that task, either as the
+        # single task or as part of a task list, and the reverse.
+        self._keysByTaskId = collections.defaultdict(set)
+        self._taskIdsByKey = {}
+        # userId -> set of cache keys of that user.
+        self._keysByUserId = collections.defaultdict(set)
+        # Bumped on every invalidation, so a read that was in flight
+        # while a write happened doesn't store a stale result.
+        self._generation = 0
+        # If the change listener is connected, so the cache can be
+        # used.
+        self._live = False
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    @property
+    def live(self):
+        """
+        If the cache is being used (the change listener is connected).
+        """
+        return self._live
+
+    async def asUserFetchAllTasks(self, *, userId):
+        if not self._live:
+            return await self._db.asUserFetchAllTasks(userId=userId)
+        key = ('tasks', userId)
+        tasks = self.cache.get(key)
+        if tasks is None:
+            generation = self._generation
+            tasks = await self._db.asUserFetchAllTasks(userId=userId)
+            if generation == self._generation:
+                self._store(key, tasks, [task.id for task in tasks])
+        return tasks
+
+    async def asUserIterAllTasks(self, *, userId, **kwargs):
+        """
+        Iterate over the cached task list if there is one. Otherwise
+        stream from the database, keeping the tasks as they go by so
+        the list can be cached once it's complete (unless it gets too
+        big to be cached anyway, when they're let go).
+        """
+        if not self._live:
+            async for task in self._db.asUserIterAllTasks(
+                    userId=userId, **kwargs):
+                yield task
+            return
+        key = ('tasks', userId)
+        tasks = self.cache.get(key)
+        if tasks is not None:
+            for task in tasks:
+                yield task
+            return
+        generation = self._generation
+        tasks = []
+        size = _LIST_OVERHEAD
+        async for task in self._db.asUserIterAllTasks(
+                userId=userId, **kwargs):
+            if tasks is not None:
+                size += _estimateTaskSize(task)
+                if size > self.cache.maxSize:
+                    tasks = None
+                else:
+                    tasks.append(task)
+            yield task
+        if tasks is not None and generation == self._generation:
+            self._store(key, tasks, [task.id for task in tasks])
+
+    async def asUserFetchTask(self, *, userId, taskId):
+        if not self._live:
+            return await self._db.asUserFetchTask(
+                userId=userId, taskId=taskId)
+        key = ('task', userId, taskId)
+        task = self.cache.get(key)
+        if task is None:
+            generation = self._generation
+            task = await self._db.asUserFetchTask(
+                userId=userId, taskId=taskId)
+            if generation == self._generation:
+                self._store(key, task, [task.id])
+        return task
+
+    async def asUserCreateTask(self, *, userId, taskToCreate):
+        task = await self._db.asUserCreateTask(
+            userId=userId, taskToCreate=taskToCreate)
+        await self._invalidateTaskGroupLists(task.task_group_id)
+        return task
+
+    async def asUserUpdateTask(self, *, userId, taskId, taskToUpdate):
+        task = await self._db.asUserUpdateTask(
+            userId=userId, taskId=taskId, taskToUpdate=taskToUpdate)
+        self.invalidateTask(taskId)
+        await self._invalidateTaskGroupLists(task.task_group_id)
+        return task
+
+    async def asUserDeleteTask(self, *, userId, taskId):
+        result = await self._db.asUserDeleteTask(userId=userId, taskId=taskId)
+        self.invalidateTask(taskId)
+        return result
+
+    async def asUserApplyTaskBatch(self, *, userId, operations):
+        results = await self._db.asUserApplyTaskBatch(
+            userId=userId, operations=operations)
+        taskGroupIds = set()
+        for operation, result in zip(operations, results):
+            if result.error is not None:
+                continue
+            if operation.operation != 'create':
+                self.invalidateTask(result.task_id)
+            if result.task is not None:
+                taskGroupIds.add(result.task.task_group_id)
+        for taskGroupId in taskGroupIds:
+            await self._invalidateTaskGroupLists(taskGroupId)
+        return results
+
+    def invalidateTask(self, taskId):
+        """
+        Evict every cached copy of the task, and every cached task list
+        that contains it.
+        """
+        self._generation += 1
+        for key in list(self._keysByTaskId.get(taskId, ())):
+            self.cache.invalidate(key)
+
+    def invalidateUserTaskList(self, userId):
+        self._generation += 1
+        self.cache.invalidate(('tasks', userId))
+
+    def invalidateUser(self, userId):
+        """
+        Evict every cached entry of the user: their task list and
+        their single tasks.
+        """
+        self._generation += 1
+        for key in list(self._keysByUserId.get(userId, ())):
+            self.cache.invalidate(key)
+
+    @coroToDeferred
+    async def handleChange(self, event):
+        """
+        Apply a :class:`txchoretracker.changes.ChangeEvent`, usually
+        caused by a write in another process, using the same rules as
+        for local writes.
+        """
+        if event.operation == 'RESYNC':
+            self._generation += 1
+            self.cache.clear()
+            self._live = True
+        elif event.operation == 'DISCONNECTED':
+            self._generation += 1
+            self.cache.clear()
+            self._live = False
+        elif event.table == 'task':
+            self.invalidateTask(event.rowId)
+            for taskGroupId in event.taskGroupIds:
+                await self._invalidateTaskGroupLists(taskGroupId)
+        elif event.table == 'users_m2m_task_groups':
+            self.invalidateUser(event.rowId)
+
+    async def _invalidateTaskGroupLists(self, taskGroupId):
+        self._generation += 1
+        memberIds = await self._db.fetchTaskGroupMemberIds(
+            taskGroupId=taskGroupId)
+        for memberId in memberIds:
+            self.invalidateUserTaskList(memberId)
+
+    def _store(self, key, value, taskIds):
+        if key[0] == 'tasks':
+            size = _LIST_OVERHEAD + sum(_estimateTaskSize(t) for t in value)
+        else:
+            size = _estimateTaskSize(value)
+        self.cache.put(key, value, size)
+        if key in self.cache:
+            self._taskIdsByKey[key] = taskIds
+            for taskId in taskIds:
+                self._keysByTaskId[taskId].add(key)
+            self._keysByUserId[key[1]].add(key)
+
+    def _unindex(self, key):
+        if key not in self._taskIdsByKey:
+            return
+        for taskId in self._taskIdsByKey.pop(key):
+            keys = self._keysByTaskId[taskId]
+            keys.discard(key)
+            if not keys:
+                del self._keysByTaskId[taskId]
+        userKeys = self._keysByUserId[key[1]]
+        userKeys.discard(key)
+        if not userKeys:
+            del self._keysByUserId[key[1]]
+
+    def stats(self):
+        return self.cache.stats()
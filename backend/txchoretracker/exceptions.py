@@ -16,3 +16,9 @@ class NoSuchUser(ChoreTrackerException):
 
 class NoProfileForUser(ChoreTrackerException):
     pass
+
+class DuplicateTaskInBatch(ChoreTrackerException):
+    pass
+
+class NoSuchRepeatingTask(ChoreTrackerException):
+    pass
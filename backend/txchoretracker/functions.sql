@@ -1,5 +1,10 @@
 START TRANSACTION ISOLATION LEVEL SERIALIZABLE;
 
+-- Processes installing these at the same time (like the API and
+-- notification services starting together) take turns, rather than
+-- failing with "tuple concurrently updated".
+SELECT pg_advisory_xact_lock(hashtext('choretracker functions.sql'));
+
 --
 -- Public DB API
 --
@@ -181,6 +186,27 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+/*
+Fetch the IDs of the users that are members of the task group.
+*/
+CREATE OR REPLACE FUNCTION
+  api.fetch_task_group_member_ids(requested_task_group_id BIGINT)
+RETURNS TABLE (
+  member_user_id BIGINT
+) AS $$
+BEGIN
+  RETURN QUERY
+    SELECT
+      u2tg.user_id
+        as member_user_id
+      FROM users_m2m_task_groups u2tg
+      WHERE u2tg.task_group_id = requested_task_group_id
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
 /*
 Fetch all tasks for which the requesting user is in
 the task's task_group.
@@ -218,7 +244,142 @@ BEGIN
       ON
         u2tg.task_group_id = task.task_group_id
         AND u2tg.user_id = requesting_user_id
-      ORDER BY due ASC
+      ORDER BY task.due ASC, task.id ASC
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Fetch one page of the tasks for which the requesting user is in
+the task's task_group, ordered by (due, id).
+
+Paging is keyset based: pass the due time and ID of the last task of
+the previous page as after_due_unix and after_id (both NULL for the
+first page). page_limit may be NULL for no limit.
+
+The optional filters are:
+  filter_task_group_id
+    only tasks in this task group
+  due_after_unix
+    only tasks due at or after this time
+  due_before_unix
+    only tasks due before this time
+  filter_overdue
+    TRUE for only tasks due before now, FALSE for only tasks due
+    now or later
+
+All of these turn into a single range on (due, id), so the
+task (task_group_id, due, id) and task (due, id) indexes can be
+used without any OFFSET.
+
+Raises exceptions:
+  DETAIL = 'USER_NOT_MEMBER_OF_REQUESTED_TASK_GROUP'
+    if filtering on a task group the user isn't a member of.
+*/
+CREATE OR REPLACE FUNCTION
+  api.asuser_fetch_tasks_page(
+    requesting_user_id BIGINT,
+    after_due_unix INTEGER,
+    after_id BIGINT,
+    page_limit INTEGER,
+    filter_task_group_id BIGINT,
+    due_after_unix INTEGER,
+    due_before_unix INTEGER,
+    filter_overdue BOOLEAN
+  )
+RETURNS TABLE (
+  id BIGINT,
+  task_group_id BIGINT,
+  name VARCHAR,
+  description VARCHAR,
+  due_unix INTEGER,
+  created_unix INTEGER,
+  modified_unix INTEGER
+) AS $$
+DECLARE
+  visible_task_group_ids BIGINT[];
+  -- Exclusive lower bound on (due, id). Task IDs start at 1, so an
+  -- ID of 0 makes the bound inclusive of the due time.
+  lower_due TIMESTAMP := '-infinity';
+  lower_id BIGINT := 0;
+  -- Exclusive upper bound on due.
+  upper_due TIMESTAMP := 'infinity';
+  now_due TIMESTAMP := now() AT TIME ZONE 'UTC';
+  bound_due TIMESTAMP;
+BEGIN
+  IF filter_task_group_id IS NOT NULL THEN
+    IF
+      NOT api_impl.is_user_in_task_group(
+        requesting_user_id, filter_task_group_id)
+    THEN
+      RAISE EXCEPTION
+        'user with id % cannot access task group %',
+          requesting_user_id,
+          filter_task_group_id
+      USING
+        DETAIL = 'USER_NOT_MEMBER_OF_REQUESTED_TASK_GROUP'
+      ;
+    END IF;
+    visible_task_group_ids = ARRAY[filter_task_group_id];
+  ELSE
+    visible_task_group_ids = ARRAY(
+      SELECT u2tg.task_group_id
+      FROM users_m2m_task_groups u2tg
+      WHERE u2tg.user_id = requesting_user_id
+    );
+  END IF;
+
+  IF after_due_unix IS NOT NULL THEN
+    lower_due = api_impl.unix_integer_to_timestamp(after_due_unix);
+    lower_id = after_id;
+  END IF;
+
+  IF due_after_unix IS NOT NULL THEN
+    bound_due = api_impl.unix_integer_to_timestamp(due_after_unix);
+    IF (bound_due, 0) > (lower_due, lower_id) THEN
+      lower_due = bound_due;
+      lower_id = 0;
+    END IF;
+  END IF;
+
+  IF filter_overdue IS FALSE AND (now_due, 0) > (lower_due, lower_id) THEN
+    lower_due = now_due;
+    lower_id = 0;
+  END IF;
+
+  IF due_before_unix IS NOT NULL THEN
+    upper_due = api_impl.unix_integer_to_timestamp(due_before_unix);
+  END IF;
+
+  IF filter_overdue IS TRUE THEN
+    upper_due = least(upper_due, now_due);
+  END IF;
+
+  RETURN QUERY
+    SELECT
+      task.id
+        as id,
+      task.task_group_id
+        as task_group_id,
+      task.name
+        as name,
+      task.description
+        as description,
+      api_impl.timestamp_to_unix_integer(task.due)
+        as due_unix,
+      api_impl.timestamp_to_unix_integer(task.created)
+        as created_unix,
+      api_impl.timestamp_to_unix_integer(task.modified)
+        as modified_unix
+      FROM task
+      WHERE
+        task.task_group_id = ANY(visible_task_group_ids)
+        AND (task.due, task.id) > (lower_due, lower_id)
+        AND task.due < upper_due
+      ORDER BY task.due ASC, task.id ASC
+      LIMIT page_limit
     ;
   RETURN;
 END;
@@ -503,6 +664,830 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+/*
+Apply a batch of task creates, updates and deletes for the requesting
+user in a single statement.
+
+The batch is a JSON array of objects, each with "op" ('create',
+'update' or 'delete') and, as relevant for the operation, "task_id",
+"task_group_id", "name", "description" and "due_unix".
+
+Items that fail their checks are skipped rather than raising, so the
+others still get applied. One row is returned per item, in order, with
+item_index counting from 0 and error set to one of
+  NO_SUCH_TASK
+    if the task to update or delete doesn't exist
+  USER_NOT_MEMBER_OF_TASK_GROUP
+    if the user isn't in the task's current task group
+  USER_NOT_MEMBER_OF_REQUESTED_TASK_GROUP
+    if the user isn't in the task group to create or move the task in
+  DUPLICATE_TASK_IN_BATCH
+    if an earlier item in the batch already updates or deletes the task
+or NULL if the item was applied, in which case the remaining columns
+are the created or updated task (just the id for deletes).
+*/
+CREATE OR REPLACE FUNCTION
+  api.asuser_apply_task_batch(
+    requesting_user_id BIGINT,
+    batch JSONB
+  )
+RETURNS TABLE (
+  item_index INTEGER,
+  error VARCHAR,
+  id BIGINT,
+  task_group_id BIGINT,
+  name VARCHAR,
+  description VARCHAR,
+  due_unix INTEGER,
+  created_unix INTEGER,
+  modified_unix INTEGER
+) AS $$
+DECLARE
+  visible_task_group_ids BIGINT[];
+BEGIN
+  SELECT coalesce(array_agg(u2tg.task_group_id), '{}')
+    INTO visible_task_group_ids
+    FROM users_m2m_task_groups u2tg
+    WHERE u2tg.user_id = requesting_user_id
+  ;
+
+  RETURN QUERY
+    WITH
+    item AS (
+      SELECT
+        (b.ordinality - 1)::INTEGER
+          as item_index,
+        b.item->>'op'
+          as operation,
+        (b.item->>'task_id')::BIGINT
+          as task_id,
+        (b.item->>'task_group_id')::BIGINT
+          as task_group_id,
+        (b.item->>'name')::VARCHAR
+          as name,
+        (b.item->>'description')::VARCHAR
+          as description,
+        (b.item->>'due_unix')::INTEGER
+          as due_unix
+        FROM jsonb_array_elements(batch) WITH ORDINALITY
+          AS b(item, ordinality)
+    ),
+    checked AS (
+      SELECT
+        item.*,
+        CASE
+          WHEN item.operation <> 'create' AND existing.id IS NULL
+            THEN 'NO_SUCH_TASK'
+          WHEN item.operation <> 'create'
+              AND existing.task_group_id <> ALL(visible_task_group_ids)
+            THEN 'USER_NOT_MEMBER_OF_TASK_GROUP'
+          WHEN item.operation <> 'delete'
+              AND item.task_group_id <> ALL(visible_task_group_ids)
+            THEN 'USER_NOT_MEMBER_OF_REQUESTED_TASK_GROUP'
+          WHEN item.operation <> 'create'
+              AND row_number() OVER (
+                PARTITION BY item.operation = 'create', item.task_id
+                ORDER BY item.item_index
+              ) > 1
+            THEN 'DUPLICATE_TASK_IN_BATCH'
+        END::VARCHAR
+          as error
+        FROM item
+        LEFT JOIN task existing ON existing.id = item.task_id
+    ),
+    to_create AS (
+      -- Allocate the IDs up front, since INSERT ... RETURNING can't
+      -- say which item a new row came from.
+      SELECT
+        checked.*,
+        nextval(pg_get_serial_sequence('task', 'id'))
+          as new_task_id
+        FROM checked
+        WHERE checked.operation = 'create' AND checked.error IS NULL
+    ),
+    created AS (
+      INSERT INTO task
+        (id, task_group_id, name, description, due, created, modified)
+      SELECT
+        to_create.new_task_id, to_create.task_group_id, to_create.name,
+        to_create.description, to_timestamp(to_create.due_unix),
+        now(), now()
+        FROM to_create
+      RETURNING task.*
+    ),
+    updated AS (
+      UPDATE task SET
+        task_group_id = checked.task_group_id,
+        name = checked.name,
+        description = checked.description,
+        due = to_timestamp(checked.due_unix),
+        modified = now()
+      FROM checked
+      WHERE
+        checked.operation = 'update'
+        AND checked.error IS NULL
+        AND task.id = checked.task_id
+      RETURNING checked.item_index, task.*
+    ),
+    deleted AS (
+      DELETE FROM task
+      USING checked
+      WHERE
+        checked.operation = 'delete'
+        AND checked.error IS NULL
+        AND task.id = checked.task_id
+      RETURNING checked.item_index, task.id
+    ),
+    changed AS (
+      SELECT to_create.item_index, created.*
+        FROM created
+        JOIN to_create ON to_create.new_task_id = created.id
+      UNION ALL
+      SELECT updated.*
+        FROM updated
+    )
+    SELECT
+      checked.item_index,
+      checked.error,
+      coalesce(changed.id, deleted.id),
+      changed.task_group_id,
+      changed.name,
+      changed.description,
+      api_impl.timestamp_to_unix_integer(changed.due),
+      api_impl.timestamp_to_unix_integer(changed.created),
+      api_impl.timestamp_to_unix_integer(changed.modified)
+      FROM checked
+      LEFT JOIN changed ON changed.item_index = checked.item_index
+      LEFT JOIN deleted ON deleted.item_index = checked.item_index
+      ORDER BY checked.item_index
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Fetch what changed in the tasks the requesting user can view since
+the sync cursor since_txid, for clients that keep a copy of them.
+
+The first row has change_kind 'cursor', and the cursor to pass as
+since_txid next time as its id. The cursor is the oldest transaction
+still running: every transaction before it has committed (or rolled
+back) by now, so the next call carries on exactly where this one's
+changes stop, however out of order the transactions commit. Changes
+from transactions still running are left for the next call.
+
+If since_txid is NULL, older than the pruned part of the task_change
+log, not a cursor given out by this database, or if the user's task
+group memberships changed since then, the next row has change_kind
+'reset', followed by a 'task' row for every task the user can view:
+the client should replace its copy with those.
+
+Otherwise there is a 'task' row for every task created or modified
+since since_txid that the user can view, and a 'deleted' row with
+just the ID for every task deleted or moved out of the user's task
+groups since then.
+
+The function is STABLE so that all of its queries, and the cursor,
+use the same snapshot.
+*/
+CREATE OR REPLACE FUNCTION
+  api.asuser_fetch_task_changes(
+    requesting_user_id BIGINT,
+    since_txid BIGINT
+  )
+RETURNS TABLE (
+  change_kind VARCHAR,
+  id BIGINT,
+  task_group_id BIGINT,
+  name VARCHAR,
+  description VARCHAR,
+  due_unix INTEGER,
+  created_unix INTEGER,
+  modified_unix INTEGER
+) AS $$
+DECLARE
+  sync_cursor BIGINT := txid_snapshot_xmin(txid_current_snapshot());
+  horizon_txid BIGINT;
+  full_sync BOOLEAN := since_txid IS NULL;
+BEGIN
+  IF NOT full_sync THEN
+    SELECT coalesce(max(tch.txid), 0)
+      INTO horizon_txid
+      FROM task_change_horizon tch;
+    full_sync = (
+      since_txid < horizon_txid
+      OR since_txid > sync_cursor
+      OR EXISTS(
+        SELECT 1
+        FROM task_change tc
+        WHERE
+          tc.user_id = requesting_user_id
+          AND tc.txid >= since_txid
+          AND tc.txid < sync_cursor
+      )
+    );
+  END IF;
+
+  RETURN QUERY
+    SELECT
+      'cursor'::VARCHAR, sync_cursor,
+      NULL::BIGINT, NULL::VARCHAR, NULL::VARCHAR,
+      NULL::INTEGER, NULL::INTEGER, NULL::INTEGER
+    ;
+
+  IF full_sync THEN
+    RETURN QUERY
+      SELECT
+        'reset'::VARCHAR, NULL::BIGINT,
+        NULL::BIGINT, NULL::VARCHAR, NULL::VARCHAR,
+        NULL::INTEGER, NULL::INTEGER, NULL::INTEGER
+      ;
+    RETURN QUERY
+      SELECT
+        'task'::VARCHAR
+          as change_kind,
+        task.id
+          as id,
+        task.task_group_id
+          as task_group_id,
+        task.name
+          as name,
+        task.description
+          as description,
+        api_impl.timestamp_to_unix_integer(task.due)
+          as due_unix,
+        api_impl.timestamp_to_unix_integer(task.created)
+          as created_unix,
+        api_impl.timestamp_to_unix_integer(task.modified)
+          as modified_unix
+        FROM task
+        INNER JOIN users_m2m_task_groups u2tg
+        ON
+          u2tg.task_group_id = task.task_group_id
+          AND u2tg.user_id = requesting_user_id
+        ORDER BY task.id ASC
+      ;
+    RETURN;
+  END IF;
+
+  -- The log is only searched in the task groups the user is in now.
+  -- Whatever happened in groups they have left or joined since is
+  -- covered by the reset above.
+  RETURN QUERY
+    WITH changed_task_ids AS (
+      SELECT DISTINCT tc.task_id
+        FROM task_change tc
+        INNER JOIN users_m2m_task_groups u2tg
+        ON
+          u2tg.task_group_id = tc.task_group_id
+          AND u2tg.user_id = requesting_user_id
+        WHERE
+          tc.task_id IS NOT NULL
+          AND tc.txid >= since_txid
+          AND tc.txid < sync_cursor
+    ), visible_task AS (
+      SELECT task.*
+        FROM task
+        INNER JOIN users_m2m_task_groups u2tg
+        ON
+          u2tg.task_group_id = task.task_group_id
+          AND u2tg.user_id = requesting_user_id
+        WHERE task.id IN (SELECT changed_task_ids.task_id
+                          FROM changed_task_ids)
+    )
+    SELECT
+      CASE
+        WHEN visible_task.id IS NULL THEN 'deleted'
+        ELSE 'task'
+      END::VARCHAR
+        as change_kind,
+      changed_task_ids.task_id
+        as id,
+      visible_task.task_group_id
+        as task_group_id,
+      visible_task.name
+        as name,
+      visible_task.description
+        as description,
+      api_impl.timestamp_to_unix_integer(visible_task.due)
+        as due_unix,
+      api_impl.timestamp_to_unix_integer(visible_task.created)
+        as created_unix,
+      api_impl.timestamp_to_unix_integer(visible_task.modified)
+        as modified_unix
+      FROM changed_task_ids
+      LEFT JOIN visible_task
+      ON visible_task.id = changed_task_ids.task_id
+      ORDER BY changed_task_ids.task_id ASC
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+/*
+Delete the task_change log entries older than keep_seconds, and move
+the horizon past them, so that sync cursors from before then get a
+reset from api.asuser_fetch_task_changes.
+
+Returns the number of entries deleted.
+*/
+CREATE OR REPLACE FUNCTION
+  api.prune_task_changes(keep_seconds INTEGER)
+RETURNS BIGINT AS $$
+DECLARE
+  pruned_count BIGINT;
+  pruned_max_txid BIGINT;
+BEGIN
+  WITH pruned AS (
+    DELETE FROM task_change tc
+      WHERE tc.changed < now() - keep_seconds * interval '1 second'
+      RETURNING tc.txid
+  )
+  SELECT count(*), max(pruned.txid)
+    INTO pruned_count, pruned_max_txid
+    FROM pruned;
+
+  IF pruned_max_txid IS NOT NULL THEN
+    INSERT INTO task_change_horizon (txid) VALUES (pruned_max_txid + 1);
+    -- Only the highest matters.
+    DELETE FROM task_change_horizon tch
+      WHERE tch.txid < (SELECT max(latest.txid)
+                        FROM task_change_horizon latest);
+  END IF;
+
+  RETURN pruned_count;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Fetch all repeating tasks for which the requesting user is in
+the repeating task's task_group.
+*/
+CREATE OR REPLACE FUNCTION
+  api.asuser_fetch_all_repeating_tasks(requesting_user_id BIGINT)
+RETURNS TABLE (
+  id BIGINT,
+  task_group_id BIGINT,
+  name VARCHAR,
+  description VARCHAR,
+  recurrence VARCHAR,
+  start_unix INTEGER,
+  next_due_unix INTEGER,
+  occurrence_count INTEGER,
+  created_unix INTEGER,
+  modified_unix INTEGER
+) AS $$
+BEGIN
+  RETURN QUERY
+    SELECT
+      rt.id,
+      rt.task_group_id,
+      rt.name,
+      rt.description,
+      rt.recurrence,
+      api_impl.timestamp_to_unix_integer(rt.start),
+      api_impl.timestamp_to_unix_integer(rt.next_due),
+      rt.occurrence_count,
+      api_impl.timestamp_to_unix_integer(rt.created),
+      api_impl.timestamp_to_unix_integer(rt.modified)
+      FROM repeating_task rt
+      INNER JOIN users_m2m_task_groups u2tg
+      ON
+        u2tg.task_group_id = rt.task_group_id
+        AND u2tg.user_id = requesting_user_id
+      ORDER BY rt.id ASC
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Fetch the specific repeating task by ID.
+
+Raises exceptions:
+  DETAIL = 'NO_SUCH_REPEATING_TASK'
+    if the repeating task with the specified ID doesn't exist
+  DETAIL = 'USER_NOT_MEMBER_OF_TASK_GROUP'
+    if the user isn't in its task group (but it exists)
+*/
+CREATE OR REPLACE FUNCTION
+  api.asuser_fetch_repeating_task(
+    requesting_user_id BIGINT,
+    requested_repeating_task_id BIGINT
+  )
+RETURNS TABLE (
+  id BIGINT,
+  task_group_id BIGINT,
+  name VARCHAR,
+  description VARCHAR,
+  recurrence VARCHAR,
+  start_unix INTEGER,
+  next_due_unix INTEGER,
+  occurrence_count INTEGER,
+  created_unix INTEGER,
+  modified_unix INTEGER
+) AS $$
+BEGIN
+  PERFORM api_impl.check_user_can_access_repeating_task(
+    requesting_user_id, requested_repeating_task_id);
+
+  RETURN QUERY
+    SELECT
+      rt.id,
+      rt.task_group_id,
+      rt.name,
+      rt.description,
+      rt.recurrence,
+      api_impl.timestamp_to_unix_integer(rt.start),
+      api_impl.timestamp_to_unix_integer(rt.next_due),
+      rt.occurrence_count,
+      api_impl.timestamp_to_unix_integer(rt.created),
+      api_impl.timestamp_to_unix_integer(rt.modified)
+      FROM repeating_task rt
+      WHERE rt.id = requested_repeating_task_id
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Create a repeating task in the requested task group. Its recurrence
+is evaluated by the application, which also gives the first
+occurrence as new_next_due_unix (NULL if there are none). Its tasks
+are created later, by api.apply_repeating_task_materializations.
+
+Raises exception:
+  DETAIL = 'USER_NOT_MEMBER_OF_REQUESTED_TASK_GROUP'
+    if the user is not a member of the requested task group.
+*/
+CREATE OR REPLACE FUNCTION
+  api.asuser_create_repeating_task(
+    requesting_user_id BIGINT,
+    new_task_group_id BIGINT,
+    new_name VARCHAR,
+    new_description VARCHAR,
+    new_recurrence VARCHAR,
+    new_start_unix INTEGER,
+    new_next_due_unix INTEGER
+  )
+RETURNS TABLE (
+  id BIGINT,
+  task_group_id BIGINT,
+  name VARCHAR,
+  description VARCHAR,
+  recurrence VARCHAR,
+  start_unix INTEGER,
+  next_due_unix INTEGER,
+  occurrence_count INTEGER,
+  created_unix INTEGER,
+  modified_unix INTEGER
+) AS $$
+BEGIN
+  IF
+    NOT api_impl.is_user_in_task_group(requesting_user_id, new_task_group_id)
+  THEN
+    RAISE EXCEPTION
+      'user with id % cannot access task group %',
+        requesting_user_id,
+        new_task_group_id
+    USING
+      DETAIL = 'USER_NOT_MEMBER_OF_REQUESTED_TASK_GROUP'
+    ;
+  END IF;
+
+  RETURN QUERY
+    INSERT INTO repeating_task
+      (
+        task_group_id, name, description, recurrence, start, next_due,
+        occurrence_count, created, modified
+      )
+    VALUES
+      (
+        new_task_group_id, new_name, new_description, new_recurrence,
+        to_timestamp(new_start_unix), to_timestamp(new_next_due_unix),
+        0, now(), now()
+      )
+    RETURNING
+      repeating_task.id,
+      repeating_task.task_group_id,
+      repeating_task.name,
+      repeating_task.description,
+      repeating_task.recurrence,
+      api_impl.timestamp_to_unix_integer(repeating_task.start),
+      api_impl.timestamp_to_unix_integer(repeating_task.next_due),
+      repeating_task.occurrence_count,
+      api_impl.timestamp_to_unix_integer(repeating_task.created),
+      api_impl.timestamp_to_unix_integer(repeating_task.modified)
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Delete a repeating task, and its tasks that aren't due yet. Its
+earlier tasks are kept, as one-off tasks.
+
+Raises exceptions:
+  DETAIL = 'NO_SUCH_REPEATING_TASK'
+    if the repeating task doesn't exist
+  DETAIL = 'USER_NOT_MEMBER_OF_TASK_GROUP'
+    if the user isn't in its task group
+*/
+CREATE OR REPLACE FUNCTION
+  api.asuser_delete_repeating_task(
+    requesting_user_id BIGINT,
+    repeating_task_id_to_delete BIGINT
+  )
+RETURNS void AS $$
+BEGIN
+  PERFORM api_impl.check_user_can_access_repeating_task(
+    requesting_user_id, repeating_task_id_to_delete);
+
+  DELETE FROM task
+    WHERE
+      task.repeating_task_id = repeating_task_id_to_delete
+      AND task.due > now();
+  DELETE FROM repeating_task
+    WHERE repeating_task.id = repeating_task_id_to_delete;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Fetch up to batch_limit of the repeating tasks with their next
+occurrence before before_unix, soonest first. Only those are read,
+using the repeating_task (next_due) index, however many repeating
+tasks there are.
+*/
+CREATE OR REPLACE FUNCTION
+  api.fetch_due_repeating_tasks(before_unix INTEGER, batch_limit INTEGER)
+RETURNS TABLE (
+  id BIGINT,
+  task_group_id BIGINT,
+  name VARCHAR,
+  description VARCHAR,
+  recurrence VARCHAR,
+  start_unix INTEGER,
+  next_due_unix INTEGER,
+  occurrence_count INTEGER,
+  created_unix INTEGER,
+  modified_unix INTEGER
+) AS $$
+BEGIN
+  RETURN QUERY
+    SELECT
+      rt.id,
+      rt.task_group_id,
+      rt.name,
+      rt.description,
+      rt.recurrence,
+      api_impl.timestamp_to_unix_integer(rt.start),
+      api_impl.timestamp_to_unix_integer(rt.next_due),
+      rt.occurrence_count,
+      api_impl.timestamp_to_unix_integer(rt.created),
+      api_impl.timestamp_to_unix_integer(rt.modified)
+      FROM repeating_task rt
+      WHERE rt.next_due < to_timestamp(before_unix)
+      ORDER BY rt.next_due ASC
+      LIMIT batch_limit
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+The soonest next occurrence of any repeating task, or NULL if there
+are none.
+*/
+CREATE OR REPLACE FUNCTION
+  api.fetch_next_repeating_task_due()
+RETURNS INTEGER AS $$
+DECLARE
+  soonest_next_due TIMESTAMP;
+BEGIN
+  SELECT min(rt.next_due)
+    INTO soonest_next_due
+    FROM repeating_task rt;
+  RETURN api_impl.timestamp_to_unix_integer(soonest_next_due);
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Create the tasks for occurrences of repeating tasks, and move the
+repeating tasks on past them, in a single statement.
+
+The batch is a JSON array of objects with "repeating_task_id",
+"expected_next_due_unix" (the next_due_unix the occurrences were
+worked out from), "due_unixes" (an array of the occurrences to create
+tasks for), and the repeating task's new "next_due_unix" (NULL if
+there are no more occurrences) and "occurrence_count".
+
+An item is skipped if its repeating task has been deleted, or its
+next_due has changed meanwhile (another process got there first). A
+task that already exists for the occurrence isn't created again.
+
+Returns the number of tasks created.
+*/
+CREATE OR REPLACE FUNCTION
+  api.apply_repeating_task_materializations(batch JSONB)
+RETURNS BIGINT AS $$
+DECLARE
+  created_count BIGINT;
+BEGIN
+  WITH
+  item AS (
+    SELECT
+      (b.item->>'repeating_task_id')::BIGINT
+        as repeating_task_id,
+      (b.item->>'expected_next_due_unix')::INTEGER
+        as expected_next_due_unix,
+      (b.item->>'next_due_unix')::INTEGER
+        as next_due_unix,
+      (b.item->>'occurrence_count')::INTEGER
+        as occurrence_count,
+      b.item->'due_unixes'
+        as due_unixes
+      FROM jsonb_array_elements(batch) AS b(item)
+  ),
+  advanced AS (
+    UPDATE repeating_task SET
+      next_due = to_timestamp(item.next_due_unix),
+      occurrence_count = item.occurrence_count
+    FROM item
+    WHERE
+      repeating_task.id = item.repeating_task_id
+      AND api_impl.timestamp_to_unix_integer(repeating_task.next_due)
+        = item.expected_next_due_unix
+    RETURNING repeating_task.*, item.due_unixes
+  ),
+  created AS (
+    INSERT INTO task
+      (
+        task_group_id, name, description, due, created, modified,
+        repeating_task_id
+      )
+    SELECT
+      advanced.task_group_id, advanced.name, advanced.description,
+      to_timestamp(occurrence.due_unix::INTEGER), now(), now(),
+      advanced.id
+      FROM advanced
+      CROSS JOIN jsonb_array_elements_text(advanced.due_unixes)
+        AS occurrence(due_unix)
+    ON CONFLICT (repeating_task_id, due) DO NOTHING
+    RETURNING task.id
+  )
+  SELECT count(*) INTO created_count FROM created;
+
+  RETURN created_count;
+END;
+$$ LANGUAGE plpgsql;
+
+
+/*
+Fetch up to batch_limit (task ID, due time) pairs of the tasks due from
+from_unix (inclusive) to before_unix (exclusive), in (due, id) order,
+after the task after_task_id (0 to start at from_unix). Tasks already
+notified for their due time are left out.
+
+Only the tasks in the range are read, using the task (due, id) index,
+however many tasks there are.
+*/
+CREATE OR REPLACE FUNCTION
+  api.fetch_upcoming_task_dues(
+    from_unix INTEGER,
+    after_task_id BIGINT,
+    before_unix INTEGER,
+    batch_limit INTEGER
+  )
+RETURNS TABLE (
+  id BIGINT,
+  due_unix INTEGER
+) AS $$
+BEGIN
+  RETURN QUERY
+    SELECT
+      task.id,
+      api_impl.timestamp_to_unix_integer(task.due)
+      FROM task
+      WHERE
+        (task.due, task.id) > (
+          api_impl.unix_integer_to_timestamp(from_unix), after_task_id)
+        AND task.due < api_impl.unix_integer_to_timestamp(before_unix)
+        AND NOT EXISTS(
+          SELECT 1
+          FROM task_notification tn
+          WHERE tn.task_id = task.id AND tn.due = task.due
+        )
+      ORDER BY task.due ASC, task.id ASC
+      LIMIT batch_limit
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+/*
+Fetch the (task ID, due time) pairs of the given tasks. Tasks that
+don't exist are left out.
+*/
+CREATE OR REPLACE FUNCTION
+  api.fetch_task_dues(requested_task_ids BIGINT[])
+RETURNS TABLE (
+  id BIGINT,
+  due_unix INTEGER
+) AS $$
+BEGIN
+  RETURN QUERY
+    SELECT
+      task.id,
+      api_impl.timestamp_to_unix_integer(task.due)
+      FROM task
+      WHERE task.id = ANY(requested_task_ids)
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+/*
+Claim the due notifications of the given tasks, and fetch what to send
+for them: a row per task and member of its task group with a verified
+email address.
+
+Only the tasks due from not_before_unix (inclusive) to before_unix
+(exclusive) that haven't already been notified for their due time are
+claimed, so each due time is only notified once, whichever process
+claims it first.
+*/
+CREATE OR REPLACE FUNCTION
+  api.claim_due_task_notifications(
+    requested_task_ids BIGINT[],
+    not_before_unix INTEGER,
+    before_unix INTEGER
+  )
+RETURNS TABLE (
+  task_id BIGINT,
+  task_name VARCHAR,
+  task_group_name VARCHAR,
+  due_unix INTEGER,
+  email VARCHAR,
+  display_name VARCHAR
+) AS $$
+BEGIN
+  RETURN QUERY
+    WITH
+    claimed AS (
+      INSERT INTO task_notification AS tn (task_id, due, notified)
+      SELECT task.id, task.due, now() AT TIME ZONE 'UTC'
+        FROM task
+        WHERE
+          task.id = ANY(requested_task_ids)
+          AND task.due >= api_impl.unix_integer_to_timestamp(not_before_unix)
+          AND task.due < api_impl.unix_integer_to_timestamp(before_unix)
+      ON CONFLICT ON CONSTRAINT task_notification_pkey DO UPDATE SET
+        due = EXCLUDED.due,
+        notified = EXCLUDED.notified
+        WHERE tn.due <> EXCLUDED.due
+      RETURNING tn.task_id
+    )
+    SELECT
+      task.id
+        AS task_id,
+      task.name
+        AS task_name,
+      task_group.name
+        AS task_group_name,
+      api_impl.timestamp_to_unix_integer(task.due)
+        AS due_unix,
+      user_profile.email
+        AS email,
+      user_profile.display_name
+        AS display_name
+      FROM claimed
+      INNER JOIN task
+        ON task.id = claimed.task_id
+      INNER JOIN task_group
+        ON task_group.id = task.task_group_id
+      INNER JOIN users_m2m_task_groups u2tg
+        ON u2tg.task_group_id = task.task_group_id
+      INNER JOIN user_profile
+        ON user_profile.user_id = u2tg.user_id
+      WHERE user_profile.email_verified
+      ORDER BY task.due ASC, task.id ASC
+    ;
+  RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+
 --
 -- Private implementation details
 --
@@ -519,6 +1504,17 @@ BEGIN
 END $$ LANGUAGE plpgsql;
 
 
+/*
+The inverse of api_impl.timestamp_to_unix_integer.
+*/
+CREATE OR REPLACE FUNCTION
+  api_impl.unix_integer_to_timestamp(unix_integer INTEGER)
+RETURNS timestamp AS $$
+BEGIN
+  RETURN to_timestamp(unix_integer) AT TIME ZONE 'UTC';
+END $$ LANGUAGE plpgsql IMMUTABLE;
+
+
 CREATE OR REPLACE FUNCTION
   api_impl.does_task_exist(requested_task_id BIGINT)
 RETURNS BOOLEAN AS $$
@@ -567,6 +1563,188 @@ BEGIN
   );
 END
 $$ LANGUAGE plpgsql;
+
+
+/*
+Raises exceptions:
+  DETAIL = 'NO_SUCH_REPEATING_TASK'
+    if the repeating task doesn't exist
+  DETAIL = 'USER_NOT_MEMBER_OF_TASK_GROUP'
+    if the user isn't in its task group
+*/
+CREATE OR REPLACE FUNCTION
+  api_impl.check_user_can_access_repeating_task(
+    requesting_user_id BIGINT, requested_repeating_task_id BIGINT)
+RETURNS void AS $$
+DECLARE
+  found_task_group_id BIGINT;
+BEGIN
+  SELECT rt.task_group_id
+    INTO found_task_group_id
+    FROM repeating_task rt
+    WHERE rt.id = requested_repeating_task_id;
+
+  IF NOT FOUND THEN
+    RAISE EXCEPTION
+      'repeating task does not exist with id %', requested_repeating_task_id
+    USING
+      DETAIL = 'NO_SUCH_REPEATING_TASK'
+    ;
+  END IF;
+
+  IF
+    NOT api_impl.is_user_in_task_group(
+      requesting_user_id, found_task_group_id)
+  THEN
+    RAISE EXCEPTION
+      'user with id % cannot access task group for repeating task id %',
+        requesting_user_id,
+        requested_repeating_task_id
+    USING
+      DETAIL = 'USER_NOT_MEMBER_OF_TASK_GROUP'
+    ;
+  END IF;
+END
+$$ LANGUAGE plpgsql;
+
+
+/*
+Trigger function that publishes row changes on the
+choretracker_changes channel, so that every application process
+can keep its caches coherent (see txchoretracker/changes.py).
+
+The payload is a JSON object with the table name, the operation,
+the changed row's ID, and for tasks, the task group IDs the task
+was and is in. For task group memberships, the ID is the user's and
+the task group ID is the one joined or left.
+*/
+CREATE OR REPLACE FUNCTION
+  api_impl.notify_change()
+RETURNS trigger AS $$
+DECLARE
+  changed_row_id BIGINT;
+  changed_task_group_ids BIGINT[] := '{}';
+BEGIN
+  IF TG_TABLE_NAME = 'task' THEN
+    IF TG_OP = 'INSERT' THEN
+      changed_row_id = NEW.id;
+      changed_task_group_ids = ARRAY[NEW.task_group_id];
+    ELSIF TG_OP = 'DELETE' THEN
+      changed_row_id = OLD.id;
+      changed_task_group_ids = ARRAY[OLD.task_group_id];
+    ELSIF OLD.task_group_id = NEW.task_group_id THEN
+      changed_row_id = NEW.id;
+      changed_task_group_ids = ARRAY[NEW.task_group_id];
+    ELSE
+      changed_row_id = NEW.id;
+      changed_task_group_ids = ARRAY[OLD.task_group_id, NEW.task_group_id];
+    END IF;
+  ELSIF TG_TABLE_NAME = 'task_group' THEN
+    IF TG_OP = 'DELETE' THEN
+      changed_row_id = OLD.id;
+    ELSE
+      changed_row_id = NEW.id;
+    END IF;
+  ELSIF TG_TABLE_NAME = 'user_profile' THEN
+    IF TG_OP = 'DELETE' THEN
+      changed_row_id = OLD.user_id;
+    ELSE
+      changed_row_id = NEW.user_id;
+    END IF;
+  ELSIF TG_TABLE_NAME = 'users_m2m_task_groups' THEN
+    IF TG_OP = 'DELETE' THEN
+      changed_row_id = OLD.user_id;
+      changed_task_group_ids = ARRAY[OLD.task_group_id];
+    ELSE
+      changed_row_id = NEW.user_id;
+      changed_task_group_ids = ARRAY[NEW.task_group_id];
+    END IF;
+  END IF;
+
+  PERFORM pg_notify(
+    'choretracker_changes',
+    json_build_object(
+      'table', TG_TABLE_NAME,
+      'op', TG_OP,
+      'id', changed_row_id,
+      'taskGroupIds', changed_task_group_ids
+    )::text
+  );
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS notify_change ON task;
+CREATE TRIGGER notify_change
+  AFTER INSERT OR UPDATE OR DELETE ON task
+  FOR EACH ROW EXECUTE PROCEDURE api_impl.notify_change();
+
+DROP TRIGGER IF EXISTS notify_change ON task_group;
+CREATE TRIGGER notify_change
+  AFTER INSERT OR UPDATE OR DELETE ON task_group
+  FOR EACH ROW EXECUTE PROCEDURE api_impl.notify_change();
+
+DROP TRIGGER IF EXISTS notify_change ON user_profile;
+CREATE TRIGGER notify_change
+  AFTER INSERT OR UPDATE OR DELETE ON user_profile
+  FOR EACH ROW EXECUTE PROCEDURE api_impl.notify_change();
+
+DROP TRIGGER IF EXISTS notify_change ON users_m2m_task_groups;
+CREATE TRIGGER notify_change
+  AFTER INSERT OR UPDATE OR DELETE ON users_m2m_task_groups
+  FOR EACH ROW EXECUTE PROCEDURE api_impl.notify_change();
+
+
+/*
+Trigger function that logs task writes and task group membership
+changes in task_change, for api.asuser_fetch_task_changes (see
+tables.py for what the rows mean).
+*/
+CREATE OR REPLACE FUNCTION
+  api_impl.log_task_change()
+RETURNS trigger AS $$
+DECLARE
+  current_txid BIGINT := txid_current();
+BEGIN
+  IF TG_TABLE_NAME = 'task' THEN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+      INSERT INTO task_change (txid, task_id, task_group_id, changed)
+      VALUES (current_txid, OLD.id, OLD.task_group_id, now());
+    END IF;
+    IF
+      TG_OP = 'INSERT'
+      OR (TG_OP = 'UPDATE' AND NEW.task_group_id <> OLD.task_group_id)
+    THEN
+      INSERT INTO task_change (txid, task_id, task_group_id, changed)
+      VALUES (current_txid, NEW.id, NEW.task_group_id, now());
+    END IF;
+  ELSIF TG_TABLE_NAME = 'users_m2m_task_groups' THEN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+      INSERT INTO task_change (txid, task_group_id, user_id, changed)
+      VALUES (current_txid, OLD.task_group_id, OLD.user_id, now());
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+      INSERT INTO task_change (txid, task_group_id, user_id, changed)
+      VALUES (current_txid, NEW.task_group_id, NEW.user_id, now());
+    END IF;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS log_task_change ON task;
+CREATE TRIGGER log_task_change
+  AFTER INSERT OR UPDATE OR DELETE ON task
+  FOR EACH ROW EXECUTE PROCEDURE api_impl.log_task_change();
+
+DROP TRIGGER IF EXISTS log_task_change ON users_m2m_task_groups;
+CREATE TRIGGER log_task_change
+  AFTER INSERT OR UPDATE OR DELETE ON users_m2m_task_groups
+  FOR EACH ROW EXECUTE PROCEDURE api_impl.log_task_change();
+
+
 -- Bookkeeping: Ensure no function names appear twice in case
 -- the function signature was changed.
 DO LANGUAGE plpgsql $$
@@ -0,0 +1,138 @@
+"""
+Pluggable JSON encoding and decoding for the REST API.
+
+Every request body is decoded and every response body encoded with the
+codec installed in :mod:`txchoretracker.kleinhelpers`, which is
+selected by :attr:`txchoretracker.config.RestApiConfig.json_codec`:
+
+-   ``stdlib`` (the default) uses :mod:`json`.
+-   ``ujson`` uses the ujson package for both directions.
+-   ``orjson`` decodes with the orjson package. It has no way to
+    produce the ASCII-only, space-separated output the API has always
+    sent, so it encodes with :mod:`json`.
+-   ``auto`` uses the fastest of those that are installed for each
+    direction, falling back to :mod:`json`.
+
+Whichever codec is used, the encoded bytes are exactly what
+``json.dumps(structure, ensure_ascii=True)`` gives.
+"""
+import json
+import re
+from types import MappingProxyType
+
+import attr
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@attr.s(frozen=True)
+class JSONCodec:
+    """
+    Attributes:
+        name (str):
+            The name the codec was selected with.
+        encode (callable):
+            Takes a JSON-serializable structure, returns ASCII bytes.
+        decode (callable):
+            Takes bytes of UTF-8 JSON, returns the structure. Raises
+            ValueError if it isn't valid JSON.
+    """
+    name = attr.ib()
+    encode = attr.ib()
+    decode = attr.ib()
+
+
+def _stdlibEncode(structure):
+    return json.dumps(structure, ensure_ascii=True).encode('ascii')
+
+
+# ujson writes exponents with as few digits as possible ("1e-7" where
+# json writes "1e-07"), and doesn't escape DEL. Both are rare in API
+# responses, so they are cheap to check for and only then fixed up.
+_UJSON_SHORT_EXPONENT = re.compile(rb'[0-9]e[+-][0-9](?![0-9])')
+_UJSON_STRING_OR_SHORT_EXPONENT = re.compile(
+    rb'"(?:[^"\\]|\\.)*"|([0-9]e[+-])([0-9](?![0-9]))')
+
+
+def _padExponent(match):
+    if match.group(1) is None:
+        # A string, which is left as it is.
+        return match.group(0)
+    return match.group(1) + b'0' + match.group(2)
+
+
+def _ujsonEncode(structure):
+    try:
+        encoded = ujson.dumps(
+            structure,
+            ensure_ascii=True,
+            escape_forward_slashes=False,
+            separators=(', ', ': '),
+        ).encode('ascii')
+    except (TypeError, ValueError, OverflowError):
+        # Let json raise its own errors (or succeed, where it is more
+        # lenient).
+        return _stdlibEncode(structure)
+    if b'\x7f' in encoded:
+        # Raw DEL can only be in a string.
+        encoded = encoded.replace(b'\x7f', b'\\u007f')
+    # The substring checks are much quicker than the regular
+    # expression, which is only needed if they find something.
+    if ((b'e-' in encoded or b'e+' in encoded)
+            and _UJSON_SHORT_EXPONENT.search(encoded) is not None):
+        encoded = _UJSON_STRING_OR_SHORT_EXPONENT.sub(_padExponent, encoded)
+    return encoded
+
+
+def _stdlibDecode(data):
+    return json.loads(data)
+
+
+_ENCODERS = MappingProxyType({
+    'stdlib': _stdlibEncode,
+    'ujson': _ujsonEncode if ujson is not None else None,
+    'orjson': _stdlibEncode,
+})
+
+_DECODERS = MappingProxyType({
+    'stdlib': _stdlibDecode,
+    'ujson': ujson.loads if ujson is not None else None,
+    'orjson': orjson.loads if orjson is not None else None,
+})
+
+# Fastest first, for "auto".
+_ENCODER_PREFERENCE = ('ujson', 'stdlib')
+_DECODER_PREFERENCE = ('orjson', 'ujson', 'stdlib')
+
+CODEC_NAMES = frozenset(_ENCODERS).union({'auto'})
+
+
+def makeJSONCodec(name: str) -> JSONCodec:
+    """
+    Make the codec called ``name`` (one of :data:`CODEC_NAMES`).
+
+    Raises:
+        ValueError: if there is no such codec.
+        RuntimeError: if the package it needs isn't installed.
+    """
+    if name == 'auto':
+        encode = next(filter(None, map(_ENCODERS.get, _ENCODER_PREFERENCE)))
+        decode = next(filter(None, map(_DECODERS.get, _DECODER_PREFERENCE)))
+        return JSONCodec(name=name, encode=encode, decode=decode)
+    if name not in _ENCODERS:
+        raise ValueError('Unknown JSON codec {0!r}'.format(name))
+    encode = _ENCODERS[name]
+    decode = _DECODERS[name]
+    if encode is None or decode is None:
+        raise RuntimeError(
+            'The {0} JSON codec requires the {0} package to be '
+            'installed'.format(name))
+    return JSONCodec(name=name, encode=encode, decode=decode)
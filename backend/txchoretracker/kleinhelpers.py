@@ -1,8 +1,19 @@
 """
 Helpers to make writing Klein code nicer for this JSON API.
+
+JSON is encoded and decoded with the codec installed by
+:func:`setJSONCodec` (see :mod:`txchoretracker.jsoncodecs`), and
+response bodies are compressed as the policy installed by
+:func:`setCompressionPolicy` allows (see
+:mod:`txchoretracker.compression`).
+
+Every routed request's duration and status code are recorded in
+:data:`txchoretracker.metrics.REGISTRY`, by handler and method, and
+sampled requests are traced (see :mod:`txchoretracker.tracing`).
 """
-import json
 import functools
+import inspect
+import time
 import types
 import urllib.parse
 
@@ -12,17 +23,59 @@ import werkzeug.routing
 import klein
 from twisted import logger
 from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import failure
 from twisted.web.resource import IResource
 from twisted.web.server import NOT_DONE_YET
 
+from txchoretracker import compression
+from txchoretracker import jsoncodecs
+from txchoretracker import metrics
+from txchoretracker import tracing
+
 
 log = logger.Logger()
 
+_requestSeconds = metrics.REGISTRY.histogram(
+    'choretracker_http_request_duration_seconds',
+    'Time from routing an API request to finishing the response.',
+    ('route', 'method'),
+)
+_responses = metrics.REGISTRY.counter(
+    'choretracker_http_responses_total',
+    'API responses, by status code ("aborted" if the client went away).',
+    ('route', 'method', 'status'),
+)
+
+_jsonCodec = jsoncodecs.makeJSONCodec('stdlib')
+
+
+def setJSONCodec(codec: jsoncodecs.JSONCodec):
+    """
+    Use ``codec`` for all JSON request and response bodies from now on.
+    """
+    global _jsonCodec
+    _jsonCodec = codec
+
+
+_compressionPolicy = compression.CompressionPolicy()
+
+
+def setCompressionPolicy(policy: compression.CompressionPolicy):
+    """
+    Compress response bodies as ``policy`` allows from now on.
+    """
+    global _compressionPolicy
+    _compressionPolicy = policy
+
 
 _SUCCESS_CODES = frozenset({200, 201})
-_FAILURE_CODES = frozenset({400, 403, 404, 405})
+_FAILURE_CODES = frozenset({400, 403, 404, 405, 503})
+# Successful, but sent without a body.
+_NO_BODY_CODES = frozenset({304})
 assert _SUCCESS_CODES.isdisjoint(_FAILURE_CODES)
-_ALLOWED_CODES = _SUCCESS_CODES.union(_FAILURE_CODES)
+assert _NO_BODY_CODES.isdisjoint(_SUCCESS_CODES.union(_FAILURE_CODES))
+_ALLOWED_CODES = _SUCCESS_CODES.union(_FAILURE_CODES, _NO_BODY_CODES)
 
 
 class JSONApiRouter:
@@ -37,7 +90,8 @@ class JSONApiRouter:
             raise RuntimeError('Already added an auth policy')
         self._authPolicy = authPolicy
 
-    def route(self, *routeArgs, requiresAuth=True, **routeKeywords):
+    def route(self, *routeArgs, requiresAuth=True, longLived=False,
+              **routeKeywords):
         """
         Add a method as a route handler, with goodies.
 
@@ -47,6 +101,14 @@ class JSONApiRouter:
         If requiresAuth is True (the default), the request will be
         rejected with a 403 Forbidden unless the auth policy has
         authenticated the user.
+
+        Each request is timed and, with a tracer installed, traced
+        (see :mod:`txchoretracker.tracing`), under the route name
+        ``ClassName.methodName``; that's the name slow request
+        thresholds and profile captures refer to (see
+        :mod:`txchoretracker.profiling`). Routes whose responses stay
+        open for as long as the client likes, like event streams,
+        should pass longLived=True so they aren't logged as slow.
         """
         # Stop werkzeug's trailing slash redirect behavior.
         routeKeywords['strict_slashes'] = False
@@ -57,16 +119,29 @@ class JSONApiRouter:
             # Wrap with translate request _after_ anything else, so the
             # previous wrappers will get the JSONApiRequest instead of
             # the twisted one.
-            handlerFunction = self._translateRequest(handlerFunction)
+            handlerFunction = self._translateRequest(
+                handlerFunction, longLived)
             wrapRoute = self.kleinRouter.route(*routeArgs, **routeKeywords)
             return wrapRoute(handlerFunction)
         return decorator
 
-    def _translateRequest(self, handlerFunction):
+    def _translateRequest(self, handlerFunction, longLived=False):
+        # The handler's name identifies the route in metrics; the URL
+        # patterns are relative to where the endpoint is mounted.
+        routeName = handlerFunction.__qualname__
+
         @functools.wraps(handlerFunction)
         def wrapTXRequest(instance, txRequest, **kwargs):
+            _recordResponse(txRequest, routeName)
+            rootSpan = _traceRequest(txRequest, routeName, longLived)
             request = JSONApiRequest(txRequest, self._authPolicy)
-            return handlerFunction(instance, request, **kwargs)
+            if rootSpan is None:
+                return handlerFunction(instance, request, **kwargs)
+            with tracing.activated(rootSpan):
+                result = handlerFunction(instance, request, **kwargs)
+            if inspect.iscoroutine(result):
+                result = tracing.ensureDeferred(result, rootSpan)
+            return result
         return wrapTXRequest
 
     def _protect(self, handlerFunction):
@@ -78,6 +153,51 @@ class JSONApiRouter:
         return ensureUserIdOr403
 
 
+def _recordResponse(txRequest, routeName):
+    """
+    Record the duration and status of the response to ``txRequest``
+    once it has finished.
+    """
+    start = time.perf_counter()
+    method = txRequest.method.decode('ascii', 'replace')
+
+    def recordFinished(result):
+        elapsed = time.perf_counter() - start
+        if isinstance(result, failure.Failure):
+            status = 'aborted'
+        else:
+            status = str(txRequest.code)
+        _requestSeconds.labels(routeName, method).observe(elapsed)
+        _responses.labels(routeName, method, status).inc()
+    txRequest.notifyFinish().addBoth(recordFinished)
+
+
+def _traceRequest(txRequest, routeName, longLived=False):
+    """
+    Start tracing ``txRequest`` if it's sampled, and return the root
+    span, which is finished along with the request.
+    """
+    attributes = {
+        'route': routeName,
+        'method': txRequest.method.decode('ascii', 'replace'),
+        'uri': txRequest.uri.decode('utf-8', 'replace'),
+    }
+    if longLived:
+        attributes['longLived'] = True
+    rootSpan = tracing.startTrace('http.request', **attributes)
+    if rootSpan is None:
+        return None
+    tracing.setRequestSpan(txRequest, rootSpan)
+
+    def finishTrace(result):
+        if isinstance(result, failure.Failure):
+            rootSpan.finish(status='aborted')
+        else:
+            rootSpan.finish(status=txRequest.code)
+    txRequest.notifyFinish().addBoth(finishTrace)
+    return rootSpan
+
+
 _MAX_POSTGRES_BIGINT = 9223372036854775807
 
 def _PostgreSQLBigSerialConverter(*args, **kwargs):
@@ -85,6 +205,28 @@ def _PostgreSQLBigSerialConverter(*args, **kwargs):
         *args, **kwargs, min=1, max=_MAX_POSTGRES_BIGINT)
 
 
+_NOT_AUTHENTICATED_YET = object()
+
+
+class InvalidJSONRequest(Exception):
+    """
+    The request body can't be read as JSON. The message says why, and
+    is fit for a 400 response.
+    """
+
+
+class MissingContentType(InvalidJSONRequest):
+    pass
+
+
+class NotJSONContent(InvalidJSONRequest):
+    pass
+
+
+class InvalidJSONContent(InvalidJSONRequest):
+    pass
+
+
 class JSONApiRequest:
     """
     Wrapper for the *request* part of
@@ -98,35 +240,72 @@ class JSONApiRequest:
             Only the _last_ provided parameter value will be used.
         authenticatedUserId (int or None):
             The user ID gathered from the request via the
-            authentication policy.
+            authentication policy. The policy is only consulted the
+            first time this is read, so routes that never look at it
+            don't pay for authentication.
     """
     def __init__(self, txRequest, authPolicy):
         self.method = txRequest.method.decode('ascii')
-        self.authenticatedUserId = authPolicy.getAuthenticatedUserId(txRequest)
         self._txRequest = txRequest
+        self._authPolicy = authPolicy
+        self._authenticatedUserId = _NOT_AUTHENTICATED_YET
+        self._query = None
+
+    @property
+    def authenticatedUserId(self):
+        if self._authenticatedUserId is _NOT_AUTHENTICATED_YET:
+            with tracing.span('auth'):
+                self._authenticatedUserId = \
+                    self._authPolicy.getAuthenticatedUserId(self)
+        return self._authenticatedUserId
 
     @property
     def query(self):
-        params = urllib.parse.parse_qs(
-            urllib.parse.urlsplit(txRequest.uri).query.decode('ascii'),
-        )
-        # Memoize the query parameters
-        self.query = {k: v[-1] for k, v in params.items()}
-        return self.query
+        if self._query is None:
+            params = urllib.parse.parse_qs(
+                urllib.parse.urlsplit(self._txRequest.uri).query.decode(
+                    'ascii'),
+            )
+            # Memoize the query parameters
+            self._query = {k: v[-1] for k, v in params.items()}
+        return self._query
 
     def getCookie(self, cookieName: str):
         return self._txRequest.getCookie(cookieName.encode('ascii'))
 
+    def addCookie(self, cookieName: str, value: bytes, **kwargs):
+        """
+        Set a cookie on the response, with the keyword arguments of
+        :meth:`twisted.web.server.Request.addCookie`.
+        """
+        self._txRequest.addCookie(cookieName.encode('ascii'), value, **kwargs)
+
+    def isNotModified(self, etag):
+        """
+        If the request's If-None-Match header matches ``etag``, so a
+        304 Not Modified response will do. Always False if ``etag`` is
+        None.
+        """
+        return _ifNoneMatchMatches(
+            self._txRequest.getHeader(b'if-none-match'), etag)
+
     def getJSONContent(self):
+        """
+        The request body, decoded from JSON.
+
+        Raises:
+            InvalidJSONRequest: if there's no JSON body (see the
+                subclasses).
+        """
         contentType = self._txRequest.getHeader(b'content-type')
         if contentType is None:
-            raise MissingContentType
+            raise MissingContentType('missing Content-Type header')
         if contentType.split(b';', 1)[0].rstrip() != b'application/json':
-            raise NotJSONContent
+            raise NotJSONContent('Content-Type must be application/json')
         try:
-            return json.loads(self._txRequest.content.read())
+            return _jsonCodec.decode(self._txRequest.content.read())
         except ValueError:
-            raise InvalidJSONContent
+            raise InvalidJSONContent('request body is not valid JSON')
 
 
 @zope.interface.implementer(IResource)
@@ -150,6 +329,16 @@ class JSONResponseResource:
             it as necessary. Will be called before writing the body
             and finalizing the response, as long as the structure
             is valid.
+        meta (dict or None):
+            Extra information about a successful response's data
+            (like the cursor for the next page of a listing),
+            serialized at the "meta" key if given.
+        etag (str or None):
+            The (unquoted) entity tag for a 200 response. If the
+            request's If-None-Match header matches it, the response
+            is a 304 Not Modified without a body instead.
+        cacheControl (str or None):
+            Value for the Cache-Control header, if any.
     """
     structure = attr.ib(
         validator=attr.validators.instance_of((list, dict)),
@@ -164,6 +353,27 @@ class JSONResponseResource:
             attr.validators.instance_of((types.FunctionType, types.MethodType))
         )
     )
+    meta = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(dict)),
+    )
+    etag = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+    cacheControl = attr.ib(
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(str)),
+    )
+
+    @classmethod
+    def makeNotModified(cls, etag: str, cacheControl: str = None):
+        return cls(
+            {},
+            status=304,
+            etag=etag,
+            cacheControl=cacheControl,
+        )
 
     @classmethod
     def makeNotFound(cls, message : str = 'not found'):
@@ -186,6 +396,13 @@ class JSONResponseResource:
             status=400,
         )
 
+    @classmethod
+    def makeServiceUnavailable(cls, message : str = 'service unavailable'):
+        return cls(
+            {'message': message},
+            status=503,
+        )
+
     @classmethod
     def makeInternalServerError(cls, message : str = 'internal server error'):
         return cls(
@@ -201,11 +418,32 @@ class JSONResponseResource:
         return NOT_DONE_YET
 
     def _respond(self, txRequest):
+        rootSpan = tracing.requestSpan(txRequest)
+        if rootSpan is None:
+            return self._writeResponse(txRequest)
+        with tracing.activated(rootSpan), tracing.span('respond'):
+            return self._writeResponse(txRequest)
+
+    def _writeResponse(self, txRequest):
+        status = self.status
+        if status == 200 and _ifNoneMatchMatches(
+                txRequest.getHeader(b'if-none-match'), self.etag):
+            status = 304
+        if status in _NO_BODY_CODES:
+            txRequest.setResponseCode(status)
+            _setCachingHeaders(txRequest, self.etag, self.cacheControl)
+            if self.txRequestCallback is not None:
+                self.txRequestCallback(txRequest)
+            txRequest.finish()
+            return
+
         if self.status in _SUCCESS_CODES:
             bodyStructure = {
                 'status': self.status,
                 'data': self.structure,
             }
+            if self.meta is not None:
+                bodyStructure['meta'] = self.meta
         elif self.status in _FAILURE_CODES:
             bodyStructure = {
                 'status': self.status,
@@ -214,33 +452,170 @@ class JSONResponseResource:
         else:
             raise ValueError(
                 'Unexpected response status code {0}'.format(self.status))
-        data = _makeJSONBytes(bodyStructure)
+        with tracing.span('json.encode'):
+            data = _makeJSONBytes(bodyStructure)
         txRequest.setResponseCode(self.status)
         txRequest.setHeader(b'Content-Type', b'application/json')
+        writer = _BodyWriter(txRequest, _compressionPolicy)
+        compressed = writer.start(len(data))
+        _setCachingHeaders(
+            txRequest, self.etag, self.cacheControl, weak=compressed)
         if self.txRequestCallback is not None:
             self.txRequestCallback(txRequest)
-        txRequest.write(data)
+        writer.write(data)
+        writer.close()
         txRequest.finish()
 
     def _respondOnUnhandledException(self, failure, *, txRequest):
-        """
-        Last resort: log the failure, and respond with 500 and a
-        generic message.
-        """
-        log.failure(
-            'Unhandled error in render of response to {method} {uri}',
-            method=txRequest.method.decode('ascii'),
-            uri=txRequest.uri.decode('utf-8'),
-            failure=failure,
-        )
-        data = _makeJSONBytes({
-            'status': 500,
-            'error': {'message': 'internal server error'},
-        })
-        txRequest.setResponseCode(500)
+        _respondOnUnhandledException(failure, txRequest=txRequest)
+
+    isLeaf = True
+
+    def getChildWithDefault(self, name, request):
+        # Since isLeaf is true, this shouldn't be called anyway.
+        raise NotImplementedError('getChildWithDefault not supported')
+
+    def putChild(self, path, child):
+        raise NotImplementedError('putChild not supported')
+
+
+@zope.interface.implementer(IResource, IPushProducer)
+@attr.s
+class StreamingJSONResponseResource:
+    """
+    A :class:`twisted.web.resource.IResource` that renders a successful
+    JSON response whose "data" is a list, encoding and writing the
+    items as they arrive from an asynchronous iterator instead of
+    building the whole body first.
+
+    The body is byte for byte what :class:`JSONResponseResource` would
+    render for the same items (before any compression). It is written
+    in chunks of about ``chunkSize`` bytes, each compressed and flushed
+    on its own when the response is compressed, and the resource
+    registers itself as a producer so it stops pulling items while the
+    client isn't keeping up. Memory use therefore doesn't grow with the
+    number of items.
+
+    The first item is fetched before anything is written, so if the
+    iterator fails straight away the client still gets a proper 500
+    response. A failure after that can only be signalled by dropping
+    the connection, which leaves the client with a truncated body.
+
+    Attributes:
+        items (async iterable):
+            The items for the "data" list.
+        serializeItem (callable):
+            Turns an item into a JSON-serializable structure.
+        status (int):
+            HTTP status code (default 200)
+        chunkSize (int):
+            Roughly how many bytes to buffer between writes.
+        etag (str or None):
+            As for :class:`JSONResponseResource`. On a match, the
+            items aren't iterated over at all.
+        cacheControl (str or None):
+            As for :class:`JSONResponseResource`.
+    """
+    items = attr.ib()
+    serializeItem = attr.ib(default=lambda item: item)
+    status = attr.ib(
+        default=200,
+        validator=attr.validators.in_(_SUCCESS_CODES),
+    )
+    chunkSize = attr.ib(default=16 * 1024)
+    etag = attr.ib(default=None)
+    cacheControl = attr.ib(default=None)
+    _paused = attr.ib(default=None, init=False, repr=False)
+    _stopped = attr.ib(default=False, init=False, repr=False)
+
+    ### IResource methods
+    def render(self, txRequest):
+        txRequest.notifyFinish().addErrback(
+            lambda failure: self.stopProducing())
+        with tracing.activated(tracing.requestSpan(txRequest)):
+            respondSpan = tracing.startSpan('respond.stream')
+        dfd = tracing.ensureDeferred(self._respond(txRequest), respondSpan)
+        if respondSpan is not None:
+            dfd.addBoth(_finishSpan, respondSpan)
+        dfd.addErrback(_respondOnUnhandledException, txRequest=txRequest)
+        return NOT_DONE_YET
+
+    async def _respond(self, txRequest):
+        if self.status == 200 and _ifNoneMatchMatches(
+                txRequest.getHeader(b'if-none-match'), self.etag):
+            txRequest.setResponseCode(304)
+            _setCachingHeaders(txRequest, self.etag, self.cacheControl)
+            txRequest.finish()
+            return
+
+        iterator = self.items.__aiter__()
+        try:
+            firstItem = await iterator.__anext__()
+        except StopAsyncIteration:
+            iterator = firstItem = None
+
+        txRequest.setResponseCode(self.status)
         txRequest.setHeader(b'Content-Type', b'application/json')
-        txRequest.write(data)
-        txRequest.finish()
+        writer = _BodyWriter(txRequest, _compressionPolicy)
+        txRequest.registerProducer(self, True)
+        try:
+            await self._writeBody(writer, iterator, firstItem)
+        except Exception:
+            log.failure(
+                'Error while streaming response to {method} {uri}',
+                method=txRequest.method.decode('ascii', 'replace'),
+                uri=txRequest.uri.decode('utf-8', 'replace'),
+            )
+            if not self._stopped:
+                txRequest.unregisterProducer()
+                txRequest.loseConnection()
+            return
+        finally:
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+        if not self._stopped:
+            txRequest.unregisterProducer()
+            txRequest.finish()
+
+    async def _writeBody(self, writer, iterator, firstItem):
+        # Mirror the separators json.dumps uses by default.
+        buffer = [b'{"status": ', str(self.status).encode('ascii'),
+                  b', "data": [']
+        bufferedSize = 0
+        if iterator is not None:
+            item = firstItem
+            while True:
+                data = _makeJSONBytes(self.serializeItem(item))
+                buffer.append(data)
+                bufferedSize += len(data)
+                if bufferedSize >= self.chunkSize:
+                    if not writer.started:
+                        # More is to come, so the whole body is at
+                        # least this big.
+                        self._startBody(writer, bufferedSize)
+                    writer.write(b''.join(buffer), flush=True)
+                    buffer = []
+                    bufferedSize = 0
+                    if self._paused is not None:
+                        await self._paused
+                    if self._stopped:
+                        return
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                buffer.append(b', ')
+        buffer.append(b']}')
+        data = b''.join(buffer)
+        if not writer.started:
+            self._startBody(writer, len(data))
+        writer.write(data)
+        writer.close()
+
+    def _startBody(self, writer, size):
+        compressed = writer.start(size)
+        _setCachingHeaders(
+            writer.txRequest, self.etag, self.cacheControl, weak=compressed)
 
     isLeaf = True
 
@@ -251,6 +626,136 @@ class JSONResponseResource:
     def putChild(self, path, child):
         raise NotImplementedError('putChild not supported')
 
+    ### IPushProducer methods
+    def pauseProducing(self):
+        if self._paused is None:
+            self._paused = defer.Deferred()
+
+    def resumeProducing(self):
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
+
+    def stopProducing(self):
+        self._stopped = True
+        self.resumeProducing()
+
+
+def _finishSpan(result, span):
+    span.finish()
+    return result
+
+
+def _respondOnUnhandledException(failure, *, txRequest):
+    """
+    Last resort: log the failure, and respond with 500 and a
+    generic message.
+    """
+    log.failure(
+        'Unhandled error in render of response to {method} {uri}',
+        method=txRequest.method.decode('ascii'),
+        uri=txRequest.uri.decode('utf-8'),
+        failure=failure,
+    )
+    data = _makeJSONBytes({
+        'status': 500,
+        'error': {'message': 'internal server error'},
+    })
+    txRequest.setResponseCode(500)
+    txRequest.setHeader(b'Content-Type', b'application/json')
+    txRequest.write(data)
+    txRequest.finish()
+
+
+class _BodyWriter:
+    """
+    Writes a response body, compressed if the policy and the request
+    allow it.
+
+    :meth:`start` must be called before anything is written, once
+    (at least a lower bound on) the body size is known. It sets the
+    Content-Encoding and Vary headers. Then :meth:`write` the body and
+    :meth:`close` it before finishing the request.
+    """
+    def __init__(self, txRequest, policy):
+        self.txRequest = txRequest
+        self.started = False
+        self._policy = policy
+        self._compressor = None
+
+    def start(self, bodySize):
+        """
+        Decide whether to compress a body of at least ``bodySize``
+        bytes. Returns True if it will be compressed.
+        """
+        self.started = True
+        if not self._policy.encodings:
+            return False
+        # Whether or not this response is compressed, another request
+        # for the same URL may get a differently encoded one.
+        self.txRequest.setHeader(b'Vary', b'Accept-Encoding')
+        if bodySize < self._policy.minSize:
+            return False
+        encoding = self._policy.negotiate(
+            self.txRequest.getHeader(b'accept-encoding'))
+        if encoding is None:
+            return False
+        self.txRequest.setHeader(
+            b'Content-Encoding', encoding.encode('ascii'))
+        self._compressor = self._policy.makeCompressor(encoding)
+        return True
+
+    def write(self, data, flush=False):
+        """
+        Write ``data``. With ``flush``, everything written so far is
+        sent, at some cost to the compression ratio.
+        """
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+            if flush:
+                data += self._compressor.flush()
+        if data:
+            self.txRequest.write(data)
+
+    def close(self):
+        if self._compressor is not None:
+            self.txRequest.write(self._compressor.finish())
+
+
+def _quoteETag(etag, weak=False):
+    quoted = '"{0}"'.format(etag).encode('ascii')
+    if weak:
+        return b'W/' + quoted
+    return quoted
+
+
+def _ifNoneMatchMatches(headerValue, etag):
+    # If-None-Match uses the weak comparison, so W/ prefixes are
+    # ignored.
+    if headerValue is None or etag is None:
+        return False
+    headerValue = headerValue.strip()
+    if headerValue == b'*':
+        return True
+    quotedETag = _quoteETag(etag)
+    for candidate in headerValue.split(b','):
+        candidate = candidate.strip()
+        if candidate.startswith(b'W/'):
+            candidate = candidate[2:]
+        if candidate == quotedETag:
+            return True
+    return False
+
+
+def _setCachingHeaders(txRequest, etag, cacheControl, weak=False):
+    # A compressed body has different bytes, so it only gets a weak
+    # ETag (If-None-Match compares weakly, so it still matches).
+    if etag is not None:
+        txRequest.setHeader(b'ETag', _quoteETag(etag, weak))
+    if cacheControl is not None:
+        txRequest.setHeader(
+            b'Cache-Control', cacheControl.encode('ascii'))
+
 
 def _makeJSONBytes(structure):
-    return json.dumps(structure, ensure_ascii=True).encode('ascii')
+    return _jsonCodec.encode(structure)
@@ -0,0 +1,304 @@
+"""
+Lightweight measurements for monitoring.
+
+:class:`Histogram` counts observations (usually durations in seconds)
+in fixed buckets, so recording one is a bisect and two additions, and
+percentiles can be estimated from the counts later.
+
+Metrics are grouped in families of :class:`Counter`, :class:`Gauge`
+and :class:`HistogramFamily`, with one value per combination of label
+values, and registered in a :class:`MetricsRegistry` (normally the
+process-wide :data:`REGISTRY`). The registry renders them in the
+Prometheus text exposition format, which :class:`MetricsResource`
+serves (see :class:`txchoretracker.config.MetricsConfig`).
+
+Recording is cheap enough to leave on: a dict lookup for the labels
+and an addition or a bisect. It all happens in the reactor thread, so
+nothing is locked. Values that other objects already keep (cache and
+pool statistics) are read when the metrics are rendered, by
+collectors (see :meth:`MetricsRegistry.addCollector`).
+"""
+import bisect
+import math
+
+from twisted import logger
+from twisted.web import resource
+
+
+log = logger.Logger()
+
+
+# Upper bounds, in seconds, of the buckets used for latencies.
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """
+    Counts of observed values in buckets with fixed upper bounds.
+
+    A value goes in the first bucket whose bound it doesn't exceed;
+    values above the last bound go in an extra overflow bucket.
+
+    This does no locking; callers that observe from several threads
+    must hold their own lock.
+
+    Args:
+        bounds (sequence of float): The bucket upper bounds.
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self):
+        histogram = Histogram(self.bounds)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+    def quantile(self, q, since=None):
+        """
+        Estimate the ``q`` quantile (0 < q <= 1) as the upper bound of
+        the bucket it falls in: ``inf`` if that's the overflow bucket,
+        and 0.0 if nothing has been observed.
+
+        If ``since`` is an earlier :meth:`copy` of this histogram, only
+        the values observed after it was taken are considered.
+        """
+        counts = self.counts
+        if since is not None:
+            counts = [now - then for now, then in zip(counts, since.counts)]
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.bounds, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        """
+        The histogram as a dict, with cumulative bucket counts like
+        Prometheus histograms.
+        """
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeValue:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class _MetricFamily:
+    type = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._children = {}
+
+    def labels(self, *labelValues):
+        """
+        The value for these label values (in the order of
+        ``labelNames``), created if needed.
+        """
+        child = self._children.get(labelValues)
+        if child is None:
+            if len(labelValues) != len(self.labelNames):
+                raise ValueError('{0} takes labels {1}, not {2!r}'.format(
+                    self.name, self.labelNames, labelValues))
+            child = self._children[labelValues] = self._makeChild()
+        return child
+
+    def _labelPairs(self, labelValues):
+        return list(zip(self.labelNames, labelValues))
+
+    def samples(self):
+        """
+        Yield (sample name, [(label name, label value)], value) for
+        each value in the family.
+        """
+        for labelValues, child in sorted(self._children.items()):
+            yield self.name, self._labelPairs(labelValues), child.value
+
+
+class Counter(_MetricFamily):
+    """
+    Counts of something that only goes up, like responses sent.
+    Counter names should end in ``_total``.
+    """
+    type = 'counter'
+    _makeChild = _CounterValue
+
+
+class Gauge(_MetricFamily):
+    """
+    Current values of something, like open connections.
+    """
+    type = 'gauge'
+    _makeChild = _GaugeValue
+
+
+class HistogramFamily(_MetricFamily):
+    """
+    :class:`Histogram` values, like request durations.
+
+    Collectors can also add histograms that something else keeps, as
+    :meth:`Histogram.snapshot` dicts, with :meth:`addSnapshot`.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), bounds=LATENCY_BUCKETS):
+        super().__init__(name, help, labelNames)
+        self.bounds = bounds
+        self._snapshots = {}
+
+    def _makeChild(self):
+        return Histogram(self.bounds)
+
+    def addSnapshot(self, snapshot, *labelValues):
+        self._snapshots[labelValues] = snapshot
+
+    def samples(self):
+        snapshots = dict(self._snapshots)
+        for labelValues, child in self._children.items():
+            snapshots[labelValues] = child.snapshot()
+        for labelValues, snapshot in sorted(snapshots.items()):
+            labelPairs = self._labelPairs(labelValues)
+            for bound, count in snapshot['buckets']:
+                yield (self.name + '_bucket',
+                       labelPairs + [('le', _formatValue(bound))], count)
+            yield self.name + '_sum', labelPairs, snapshot['sum']
+            yield self.name + '_count', labelPairs, snapshot['count']
+
+
+def _formatValue(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _escapeLabelValue(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class MetricsRegistry:
+    """
+    The metric families to expose, by name.
+    """
+    def __init__(self):
+        self._families = {}
+        self._collectors = []
+
+    def _register(self, family):
+        if family.name in self._families:
+            raise ValueError(
+                'Metric {0} is already registered'.format(family.name))
+        self._families[family.name] = family
+        return family
+
+    def counter(self, name, help, labelNames=()):
+        return self._register(Counter(name, help, labelNames))
+
+    def gauge(self, name, help, labelNames=()):
+        return self._register(Gauge(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), bounds=LATENCY_BUCKETS):
+        return self._register(
+            HistogramFamily(name, help, labelNames, bounds))
+
+    def addCollector(self, collect):
+        """
+        Call ``collect`` whenever the metrics are rendered. It must
+        return an iterable of metric families (built afresh, not
+        registered) with the current values.
+        """
+        self._collectors.append(collect)
+
+    def removeCollector(self, collect):
+        self._collectors.remove(collect)
+
+    def _allFamilies(self):
+        yield from self._families.values()
+        for collect in list(self._collectors):
+            try:
+                families = list(collect())
+            except Exception:
+                log.failure('Metrics collector {collect!r} failed',
+                            collect=collect)
+                continue
+            yield from families
+
+    def exposition(self):
+        """
+        All the metrics, in the Prometheus text exposition format, as
+        bytes.
+        """
+        lines = []
+        for family in self._allFamilies():
+            lines.append('# HELP {0} {1}'.format(
+                family.name,
+                family.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {0} {1}'.format(family.name, family.type))
+            for sampleName, labelPairs, value in family.samples():
+                if labelPairs:
+                    sampleName += '{' + ','.join(
+                        '{0}="{1}"'.format(
+                            labelName, _escapeLabelValue(labelValue))
+                        for labelName, labelValue in labelPairs) + '}'
+                lines.append('{0} {1}'.format(sampleName, _formatValue(value)))
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+
+# The registry the application records its metrics in.
+REGISTRY = MetricsRegistry()
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serves a registry's metrics to Prometheus.
+    """
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        super().__init__()
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(
+            b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self._registry.exposition()
@@ -4,10 +4,19 @@ client-provided JSON into models.
 
 The names of the fields match the database table columns to make
 `SomeModel(**databaseRow)` possible.
+
+The models that can come back from the database by the thousand
+(:class:`Task` and :class:`UserProfile`) are slotted, so instances
+don't each carry a ``__dict__``.
 """
+import base64
+import binascii
+
 import attr
 import marshmallow as mm
 
+from txchoretracker.recurrence import parseRecurrence
+
 # JSON structure --schema.load()--> App obj
 # App obj --schema.dump()--> JSON structure
 
@@ -24,7 +33,7 @@ def _UnixTimeInteger(**kwargs):
         **kwargs)
 
 
-@attr.s
+@attr.s(slots=True)
 class UserProfile:
     """
     User details that are unrelated to authentication.
@@ -62,7 +71,7 @@ class UserProfileSchema(mm.Schema):
         return UserProfile(**validated)
 
 
-@attr.s
+@attr.s(slots=True)
 class Task:
     task_group_id = attr.ib()
     name = attr.ib()
@@ -118,3 +127,350 @@ class TaskSchema(mm.Schema):
     @mm.post_load
     def make_task(self, validated):
         return Task(**validated)
+
+
+@attr.s(slots=True)
+class RepeatingTask:
+    """
+    A schedule of tasks, one per occurrence of ``recurrence`` (see
+    :mod:`txchoretracker.recurrence`) from ``start_unix`` on.
+    """
+    task_group_id = attr.ib()
+    name = attr.ib()
+    description = attr.ib(repr=False)
+    recurrence = attr.ib()
+    start_unix = attr.ib()
+    id = attr.ib(default=None)
+    # The first occurrence without a task yet, or None if there are no
+    # more.
+    next_due_unix = attr.ib(default=None)
+    # How many occurrences have tasks.
+    occurrence_count = attr.ib(default=0)
+    created_unix = attr.ib(default=None)
+    modified_unix = attr.ib(default=None)
+
+
+class RepeatingTaskSchema(mm.Schema):
+    id = mm.fields.Integer(
+        dump_only=True)
+    task_group_id = mm.fields.Integer(
+        required=True,
+        load_from='taskGroup',
+        dump_to='taskGroup',
+        validate=mm.validate.Range(min=0))
+    name = mm.fields.String(
+        required=True,
+        validate=mm.validate.Length(min=1))
+    description = mm.fields.String(
+        required=True)
+    recurrence = mm.fields.String(
+        required=True)
+    start_unix = _UnixTimeInteger(
+        required=True,
+        load_from='start',
+        dump_to='start')
+    next_due_unix = _UnixTimeInteger(
+        dump_to='nextDue',
+        dump_only=True)
+    created_unix = _UnixTimeInteger(
+        dump_to='created',
+        dump_only=True)
+    modified_unix = _UnixTimeInteger(
+        dump_to='modified',
+        dump_only=True)
+
+    def __init__(self, *args, **kwargs):
+        # Default to strict and not partial
+        kwargs.setdefault('strict', True)
+        kwargs.setdefault('partial', False)
+        super().__init__(*args, **kwargs)
+
+    @mm.validates('recurrence')
+    def validate_recurrence(self, value):
+        try:
+            parseRecurrence(value)
+        except ValueError as e:
+            raise mm.ValidationError(str(e))
+
+    # Make sure the input to dump() is an attrs class instance
+    # (attr.asdict will throw if it's not).
+    @mm.pre_dump(pass_many=True)
+    def deserialize_repeating_task(self, repeating_task_or_tasks, many):
+        if many:
+            return [attr.asdict(rt) for rt in repeating_task_or_tasks]
+        else:
+            return attr.asdict(repeating_task_or_tasks)
+
+    @mm.post_load
+    def make_repeating_task(self, validated):
+        # Stored in canonical form.
+        validated['recurrence'] = parseRecurrence(
+            validated['recurrence']).format()
+        return RepeatingTask(**validated)
+
+
+@attr.s
+class RepeatingTaskMaterialization:
+    """
+    Tasks to create for the occurrences of a :class:`RepeatingTask`
+    (see :mod:`txchoretracker.scheduler`).
+
+    Attributes:
+        repeating_task_id (int):
+            The repeating task.
+        expected_next_due_unix (int):
+            Its ``next_due_unix`` that the occurrences were worked out
+            from. If it has changed since, nothing is applied.
+        due_unixes (list of int):
+            The occurrences to create tasks for.
+        next_due_unix (int or None):
+            Its new ``next_due_unix``.
+        occurrence_count (int):
+            Its new ``occurrence_count``.
+    """
+    repeating_task_id = attr.ib()
+    expected_next_due_unix = attr.ib()
+    due_unixes = attr.ib()
+    next_due_unix = attr.ib()
+    occurrence_count = attr.ib()
+
+
+@attr.s(frozen=True)
+class DueTaskNotification:
+    """
+    A task that has come due, for one of the members of its task group
+    to be told about (see :mod:`txchoretracker.notifications`).
+    """
+    task_id = attr.ib()
+    task_name = attr.ib()
+    task_group_name = attr.ib()
+    due_unix = attr.ib()
+    email = attr.ib()
+    display_name = attr.ib()
+
+
+TASK_BATCH_OPERATIONS = ('create', 'update', 'delete')
+MAX_TASK_BATCH_SIZE = 1000
+
+
+@attr.s
+class TaskBatchOperation:
+    """
+    One item of a task batch.
+
+    Attributes:
+        operation (str):
+            One of :data:`TASK_BATCH_OPERATIONS`.
+        task_id (int or None):
+            The task to update or delete (None for creates).
+        task (Task or dict or None):
+            The task to create or the updated task (None for deletes).
+            :class:`TaskBatchOperationSchema` leaves this as the raw
+            structure, for loading with :class:`TaskSchema`.
+    """
+    operation = attr.ib()
+    task_id = attr.ib(default=None)
+    task = attr.ib(default=None)
+
+
+class TaskBatchOperationSchema(mm.Schema):
+    operation = mm.fields.String(
+        required=True,
+        load_from='op',
+        validate=mm.validate.OneOf(TASK_BATCH_OPERATIONS))
+    task_id = mm.fields.Integer(
+        load_from='id',
+        validate=mm.validate.Range(min=1))
+    task = mm.fields.Dict()
+
+    @mm.validates_schema
+    def validate_fields_for_operation(self, validated):
+        operation = validated.get('operation')
+        if operation == 'create' and 'task_id' in validated:
+            raise mm.ValidationError('Not allowed for create.', 'id')
+        if operation in ('update', 'delete') and 'task_id' not in validated:
+            raise mm.ValidationError('Missing data for required field.', 'id')
+        if operation in ('create', 'update') and 'task' not in validated:
+            raise mm.ValidationError(
+                'Missing data for required field.', 'task')
+        if operation == 'delete' and 'task' in validated:
+            raise mm.ValidationError('Not allowed for delete.', 'task')
+
+    @mm.post_load
+    def make_task_batch_operation(self, validated):
+        return TaskBatchOperation(**validated)
+
+
+@attr.s
+class TaskBatchResult:
+    """
+    The outcome of one :class:`TaskBatchOperation`.
+
+    Attributes:
+        task_id (int or None):
+            The ID of the created, updated or deleted task, or None if
+            the operation failed.
+        task (Task or None):
+            The created or updated task.
+        error (exceptions.ChoreTrackerException or None):
+            Why the operation wasn't applied.
+    """
+    task_id = attr.ib(default=None)
+    task = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+
+DEFAULT_TASK_PAGE_LIMIT = 100
+MAX_TASK_PAGE_LIMIT = 500
+
+
+@attr.s(frozen=True)
+class TaskCursor:
+    """
+    Position in a task listing ordered by (due, id): the listing
+    continues with the tasks after this one.
+    """
+    due_unix = attr.ib()
+    id = attr.ib()
+
+    @classmethod
+    def afterTask(cls, task):
+        return cls(due_unix=task.due_unix, id=task.id)
+
+    def encode(self) -> str:
+        raw = '{0}:{1}'.format(self.due_unix, self.id).encode('ascii')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @classmethod
+    def decode(cls, encoded: str):
+        """
+        Raises:
+            ValueError: if ``encoded`` isn't a valid cursor.
+        """
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode('ascii'))
+            dueUnix, taskId = raw.decode('ascii').split(':')
+            return cls(due_unix=int(dueUnix), id=int(taskId))
+        except (binascii.Error, UnicodeError, ValueError):
+            raise ValueError('Invalid task cursor {0!r}'.format(encoded))
+
+
+@attr.s(frozen=True)
+class SyncCursor:
+    """
+    Position in the task change log (see
+    :meth:`txchoretracker.db.ChoreTrackerDatabase.asUserFetchTaskChanges`):
+    the changes since it haven't been synced yet.
+
+    Attributes:
+        txid (int): The oldest database transaction that may not have
+            been synced.
+    """
+    txid = attr.ib()
+
+    def encode(self) -> str:
+        raw = 'sync:{0}'.format(self.txid).encode('ascii')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    @classmethod
+    def decode(cls, encoded: str):
+        """
+        Raises:
+            ValueError: if ``encoded`` isn't a valid cursor.
+        """
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode('ascii'))
+            prefix, txid = raw.decode('ascii').split(':')
+            if prefix != 'sync':
+                raise ValueError(prefix)
+            return cls(txid=int(txid))
+        except (binascii.Error, UnicodeError, ValueError):
+            raise ValueError('Invalid sync cursor {0!r}'.format(encoded))
+
+
+class _CursorField(mm.fields.Field):
+    def __init__(self, cursorClass, **kwargs):
+        super().__init__(**kwargs)
+        self.cursorClass = cursorClass
+
+    def _serialize(self, value, attr, obj):
+        if value is None:
+            return None
+        return value.encode()
+
+    def _deserialize(self, value, attr, data):
+        try:
+            return self.cursorClass.decode(value)
+        except ValueError:
+            raise mm.ValidationError('Not a valid cursor.')
+
+
+@attr.s
+class TaskListQuery:
+    """
+    Filters and paging for a task listing. None means "don't filter"
+    for all the filters.
+    """
+    task_group_id = attr.ib(default=None)
+    due_after_unix = attr.ib(default=None)
+    due_before_unix = attr.ib(default=None)
+    overdue = attr.ib(default=None)
+    after = attr.ib(default=None)
+    limit = attr.ib(default=DEFAULT_TASK_PAGE_LIMIT)
+
+
+class TaskListQuerySchema(mm.Schema):
+    """
+    Loads a :class:`TaskListQuery` from the query parameters of
+    ``GET /tasks``.
+    """
+    task_group_id = mm.fields.Integer(
+        load_from='taskGroup',
+        validate=mm.validate.Range(min=0))
+    due_after_unix = _UnixTimeInteger(
+        load_from='dueAfter')
+    due_before_unix = _UnixTimeInteger(
+        load_from='dueBefore')
+    overdue = mm.fields.Boolean()
+    after = _CursorField(
+        TaskCursor,
+        load_from='cursor')
+    limit = mm.fields.Integer(
+        validate=mm.validate.Range(min=1, max=MAX_TASK_PAGE_LIMIT))
+
+    @mm.post_load
+    def make_task_list_query(self, validated):
+        return TaskListQuery(**validated)
+
+
+@attr.s
+class TaskChanges:
+    """
+    What changed in the tasks a user can view since a
+    :class:`SyncCursor`.
+
+    Attributes:
+        cursor (SyncCursor):
+            Where the next sync should start from.
+        reset (bool):
+            If true, ``tasks`` are all the tasks the user can view,
+            and should replace the client's copy; there are no
+            ``deleted_task_ids``.
+        tasks (list of Task):
+            The tasks created or modified.
+        deleted_task_ids (list of int):
+            The IDs of the tasks deleted, or that the user can no
+            longer view.
+    """
+    cursor = attr.ib()
+    reset = attr.ib(default=False)
+    tasks = attr.ib(default=attr.Factory(list))
+    deleted_task_ids = attr.ib(default=attr.Factory(list))
+
+
+class TaskChangesQuerySchema(mm.Schema):
+    """
+    Loads the query parameters of ``GET /tasks/changes``: ``since``,
+    the cursor the last sync ended at (missing for a first sync).
+    """
+    since = _CursorField(SyncCursor)
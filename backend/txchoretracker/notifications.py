@@ -0,0 +1,525 @@
+"""
+Emailing task group members when their tasks come due.
+
+:class:`NotificationService` runs alongside the API service, with its
+own connection pool and :class:`txchoretracker.changes.ChangeListener`.
+Its :class:`DueTaskNotifier` doesn't scan the task table for due
+tasks. It keeps the due times coming up in the next ``lookahead``
+seconds in a heap, loaded a window at a time from the task
+``(due, id)`` index, and kept up to date from the change events of
+task writes. A timer fires when the soonest comes due, so the work
+done is proportional to the tasks coming due, not to the number of
+tasks.
+
+Due tasks are claimed in the database before they are sent (see
+``api.claim_due_task_notifications``), so each due time is only
+notified once, whichever process gets there first, and however often
+the windows are reloaded. A task whose due time changes is notified
+again. Delivery is at most once: a batch that fails to send after it
+was claimed is logged and not retried.
+
+Notifications are delivered in batches through an
+:class:`INotificationSender`: :class:`SMTPNotificationSender`, or
+:class:`LogNotificationSender` for development without a mail server.
+"""
+import collections
+import datetime
+import email.message
+import heapq
+
+import zope.interface
+from twisted import logger
+from twisted.application import service
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.mail import smtp
+
+from txchoretracker import changes
+from txchoretracker import config
+from txchoretracker import db
+
+
+log = logger.Logger()
+
+
+class INotificationSender(zope.interface.Interface):
+    def send(notifications):
+        """
+        Deliver a batch of :class:`models.DueTaskNotification`.
+        Returns a Deferred that fires once they have been sent (or
+        failed to be; failures are the sender's to log).
+        """
+
+
+def composeMessages(notifications, fromAddress):
+    """
+    Compose an email for each recipient of ``notifications``, listing
+    their tasks in the batch. Returns a list of
+    ``(toAddress, email.message.EmailMessage)`` pairs.
+    """
+    byEmail = collections.OrderedDict()
+    for notification in notifications:
+        byEmail.setdefault(notification.email, []).append(notification)
+    messages = []
+    for toAddress, recipientNotifications in byEmail.items():
+        message = email.message.EmailMessage()
+        message['From'] = fromAddress
+        message['To'] = toAddress
+        if len(recipientNotifications) == 1:
+            message['Subject'] = 'Due: {0}'.format(
+                recipientNotifications[0].task_name)
+        else:
+            message['Subject'] = '{0} tasks due'.format(
+                len(recipientNotifications))
+        lines = [
+            'Hi {0},'.format(recipientNotifications[0].display_name),
+            '',
+            'These tasks are due:',
+            '',
+        ]
+        for notification in recipientNotifications:
+            due = datetime.datetime.utcfromtimestamp(notification.due_unix)
+            lines.append('- {0} ({1}), due {2} UTC'.format(
+                notification.task_name, notification.task_group_name,
+                due.strftime('%Y-%m-%d %H:%M')))
+        message.set_content('\n'.join(lines) + '\n')
+        messages.append((toAddress, message))
+    return messages
+
+
+@zope.interface.implementer(INotificationSender)
+class SMTPNotificationSender:
+    """
+    Sends an email per recipient through an SMTP server.
+
+    Args:
+        host (str): The SMTP server.
+        port (int): Its port.
+        fromAddress (str): The address the emails are from.
+        concurrency (int): How many emails to send at once.
+        sendmail: :func:`twisted.mail.smtp.sendmail`, or a stand-in
+            with the same signature.
+    """
+    def __init__(
+                self,
+                host,
+                port,
+                fromAddress,
+                *,
+                concurrency=4,
+                sendmail=smtp.sendmail,
+            ):
+        self._host = host
+        self._port = port
+        self._fromAddress = fromAddress
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._sendmail = sendmail
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, notifications):
+        sends = [
+            self._semaphore.run(self._sendOne, toAddress, message)
+            for toAddress, message
+            in composeMessages(notifications, self._fromAddress)
+        ]
+        return defer.DeferredList(sends, consumeErrors=True)
+
+    def _sendOne(self, toAddress, message):
+        d = self._sendmail(
+            self._host, self._fromAddress, [toAddress],
+            message.as_bytes(), port=self._port)
+
+        @d.addCallback
+        def cbSent(ignored):
+            self.sent += 1
+
+        @d.addErrback
+        def ebLogFailure(failure):
+            self.failed += 1
+            log.failure(
+                'Failed to email a notification to {toAddress}',
+                failure=failure, toAddress=toAddress)
+        return d
+
+
+@zope.interface.implementer(INotificationSender)
+class LogNotificationSender:
+    """
+    Logs the emails instead of sending them.
+    """
+    def __init__(self, fromAddress):
+        self._fromAddress = fromAddress
+
+    def send(self, notifications):
+        for toAddress, message in composeMessages(
+                notifications, self._fromAddress):
+            log.info(
+                'Notification for {toAddress}: {subject}',
+                toAddress=toAddress, subject=message['Subject'])
+        return defer.succeed(None)
+
+
+def makeNotificationSender(notificationsConfig):
+    if notificationsConfig.sender == 'log':
+        return LogNotificationSender(notificationsConfig.from_address)
+    return SMTPNotificationSender(
+        notificationsConfig.smtp_host,
+        notificationsConfig.smtp_port,
+        notificationsConfig.from_address,
+    )
+
+
+class DueTaskNotifier:
+    """
+    Notifies tasks as they come due, through ``sender``.
+
+    Subscribe :meth:`handleChange` to a
+    :class:`txchoretracker.changes.ChangeListener`, so that task
+    writes are seen, and reload everything when it resyncs.
+
+    Args:
+        dbWrapper: For ``fetchUpcomingTaskDues``, ``fetchTaskDues`` and
+            ``claimDueTaskNotifications``.
+        sender (INotificationSender): Delivers the notifications.
+        leadTime (float): How many seconds before a task is due to
+            notify.
+        lookahead (float): How many seconds of upcoming due times to
+            keep in memory. The next window is loaded every half of
+            this.
+        maxLateness (float): Tasks that came due more than this many
+            seconds ago without being notified are skipped.
+        batchSize (int): Tasks claimed and sent together.
+        pageSize (int): Due times loaded per query.
+        reactor: Schedules the notifications and loads.
+    """
+    # Seconds to wait after failing to claim notifications.
+    retryDelay = 60.0
+
+    def __init__(
+                self,
+                dbWrapper,
+                sender,
+                *,
+                leadTime=0.0,
+                lookahead=60.0 * 60,
+                maxLateness=24.0 * 60 * 60,
+                batchSize=100,
+                pageSize=1000,
+                reactor=None,
+            ):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._db = dbWrapper
+        self._sender = sender
+        self._leadTime = leadTime
+        self._lookahead = lookahead
+        self._maxLateness = maxLateness
+        self._batchSize = batchSize
+        self._pageSize = pageSize
+        self._reactor = reactor
+        # (due time, task ID) pairs. Entries that no longer match
+        # _dueByTaskId are stale and skipped when they come up.
+        self._heap = []
+        self._dueByTaskId = {}
+        # Due times in [_acceptFrom, _acceptUntil) are tracked; later
+        # ones are picked up as the window moves on.
+        self._acceptFrom = 0
+        self._acceptUntil = 0
+        # Where the next window load starts, as a (due, ID) keyset.
+        self._loadCursor = (0, 0)
+        # Bumped on every reload, so that loads and lookups that were
+        # in flight meanwhile aren't applied.
+        self._generation = 0
+        self._loadingGeneration = None
+        self._changedTaskIds = set()
+        self._lookupCall = None
+        self._lookingUp = False
+        self._timer = None
+        self._dispatching = False
+        self._retryAt = 0
+        self._extendCall = None
+        self._stopped = True
+        self.batches = 0
+        self.notifications = 0
+
+    def start(self):
+        """
+        Load the first window of due times and start notifying.
+        """
+        self._stopped = False
+        self._reload()
+        self._extendCall = task.LoopingCall(self._extendWindow)
+        self._extendCall.clock = self._reactor
+        self._extendCall.start(self._lookahead / 2, now=False)
+
+    def stop(self):
+        self._stopped = True
+        if self._extendCall is not None:
+            self._extendCall.stop()
+            self._extendCall = None
+        for call in (self._timer, self._lookupCall):
+            if call is not None and call.active():
+                call.cancel()
+        self._timer = None
+        self._lookupCall = None
+
+    def handleChange(self, event):
+        if self._stopped:
+            return
+        if event.operation == changes.RESYNC.operation:
+            self._reload()
+        elif event.table != 'task':
+            return
+        elif event.operation == 'DELETE':
+            self._dueByTaskId.pop(event.rowId, None)
+        else:
+            # Looked up together with the others that came in at the
+            # same time.
+            self._changedTaskIds.add(event.rowId)
+            self._scheduleLookup()
+
+    def _add(self, taskId, dueUnix):
+        if not self._acceptFrom <= dueUnix < self._acceptUntil:
+            self._dueByTaskId.pop(taskId, None)
+            return
+        if self._dueByTaskId.get(taskId) == dueUnix:
+            return
+        self._dueByTaskId[taskId] = dueUnix
+        heapq.heappush(self._heap, (dueUnix, taskId))
+        if len(self._heap) > 2 * len(self._dueByTaskId) + 100:
+            # Mostly stale entries, from tasks that were changed.
+            self._heap = [
+                (dueUnix, taskId)
+                for taskId, dueUnix in self._dueByTaskId.items()]
+            heapq.heapify(self._heap)
+
+    ### Loading
+    def _reload(self):
+        self._generation += 1
+        self._heap = []
+        self._dueByTaskId = {}
+        self._changedTaskIds.clear()
+        self._acceptFrom = int(self._reactor.seconds() - self._maxLateness)
+        self._acceptUntil = self._acceptFrom
+        self._loadCursor = (self._acceptFrom, 0)
+        self._extendWindow()
+
+    def _extendWindow(self):
+        if self._loadingGeneration == self._generation:
+            # Already loading.
+            return
+        d = defer.ensureDeferred(self._load())
+
+        @d.addErrback
+        def ebLogFailure(failure):
+            # Tried again with the next window.
+            log.failure('Failed to load upcoming due times', failure=failure)
+        return d
+
+    async def _load(self):
+        generation = self._loadingGeneration = self._generation
+        try:
+            untilUnix = int(
+                self._reactor.seconds() + self._leadTime + self._lookahead)
+            # Changes within the window are tracked from now on, even
+            # where it hasn't been loaded yet.
+            self._acceptUntil = max(self._acceptUntil, untilUnix)
+            fromUnix, afterTaskId = self._loadCursor
+            while True:
+                rows = await self._db.fetchUpcomingTaskDues(
+                    fromUnix=fromUnix, afterTaskId=afterTaskId,
+                    beforeUnix=untilUnix, limit=self._pageSize)
+                if generation != self._generation:
+                    return
+                for taskId, dueUnix in rows:
+                    self._add(taskId, dueUnix)
+                self._arm()
+                if len(rows) < self._pageSize:
+                    break
+                afterTaskId, fromUnix = rows[-1]
+            self._loadCursor = (untilUnix, 0)
+        finally:
+            if self._loadingGeneration == generation:
+                self._loadingGeneration = None
+
+    def _scheduleLookup(self):
+        if self._lookupCall is None and not self._lookingUp:
+            self._lookupCall = self._reactor.callLater(
+                0, self._lookUpChangedTasks)
+
+    def _lookUpChangedTasks(self):
+        self._lookupCall = None
+        if not self._changedTaskIds:
+            return
+        taskIds = sorted(self._changedTaskIds)
+        self._changedTaskIds.clear()
+        generation = self._generation
+        # One lookup at a time, so an older answer can't overwrite a
+        # newer one.
+        self._lookingUp = True
+        d = defer.ensureDeferred(self._db.fetchTaskDues(taskIds=taskIds))
+
+        @d.addCallback
+        def cbAddDues(rows):
+            if generation != self._generation:
+                return
+            for taskId, dueUnix in rows:
+                self._add(taskId, dueUnix)
+            self._arm()
+
+        @d.addErrback
+        def ebReload(failure):
+            log.failure(
+                'Failed to look up changed tasks; reloading',
+                failure=failure)
+            if not self._stopped:
+                self._reload()
+
+        @d.addBoth
+        def cbLookUpNext(ignored):
+            self._lookingUp = False
+            if self._changedTaskIds and not self._stopped:
+                self._scheduleLookup()
+        return d
+
+    ### Dispatching
+    def _arm(self):
+        if self._stopped or self._dispatching:
+            return
+        heap = self._heap
+        while heap and self._dueByTaskId.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        if not heap:
+            return
+        now = self._reactor.seconds()
+        notifyAt = max(heap[0][0] - self._leadTime, self._retryAt)
+        delay = max(notifyAt - now, 0)
+        if self._timer is not None:
+            if self._timer.getTime() <= now + delay:
+                return
+            self._timer.cancel()
+        self._timer = self._reactor.callLater(delay, self._dispatch)
+
+    def _dispatch(self):
+        self._timer = None
+        now = self._reactor.seconds()
+        entries = []
+        heap = self._heap
+        while (heap and len(entries) < self._batchSize
+               and heap[0][0] - self._leadTime <= now):
+            dueUnix, taskId = heapq.heappop(heap)
+            if self._dueByTaskId.get(taskId) != dueUnix:
+                continue
+            del self._dueByTaskId[taskId]
+            entries.append((dueUnix, taskId))
+        if not entries:
+            self._arm()
+            return
+        self._dispatching = True
+        d = defer.ensureDeferred(self._notify(entries, now))
+
+        @d.addErrback
+        def ebLogFailure(failure):
+            log.failure('Failed to send notifications', failure=failure)
+
+        @d.addBoth
+        def cbArmNext(ignored):
+            self._dispatching = False
+            self._arm()
+        return d
+
+    async def _notify(self, entries, now):
+        try:
+            notifications = await self._db.claimDueTaskNotifications(
+                taskIds=[taskId for dueUnix, taskId in entries],
+                notBeforeUnix=int(now - self._maxLateness),
+                beforeUnix=int(now + self._leadTime) + 1)
+        except Exception:
+            log.failure('Failed to claim due task notifications')
+            # Put them back, unless they've changed meanwhile.
+            for dueUnix, taskId in entries:
+                if taskId not in self._dueByTaskId:
+                    self._add(taskId, dueUnix)
+            self._retryAt = now + self.retryDelay
+            return
+        if notifications:
+            self.batches += 1
+            self.notifications += len(notifications)
+            await self._sender.send(notifications)
+
+    def stats(self):
+        """
+        Counters for monitoring, as a dict.
+        """
+        return {
+            'pending': len(self._dueByTaskId),
+            'batches': self.batches,
+            'notifications': self.notifications,
+        }
+
+
+class NotificationService(service.Service):
+    """
+    Runs a :class:`DueTaskNotifier`, with its own connection pool and
+    change listener.
+    """
+    log = logger.Logger()
+
+    def __init__(
+                self,
+                dbConfig: config.DatabaseConfig,
+                notificationsConfig: config.NotificationsConfig,
+                sender=None,
+            ):
+        super().__init__()
+        self.dbConfig = dbConfig
+        self.notificationsConfig = notificationsConfig
+        if sender is None:
+            sender = makeNotificationSender(notificationsConfig)
+        self.sender = sender
+        self.changeListener = changes.ChangeListener(dbConfig.get_dsn())
+        self.notifier = None
+        self._dbWrapper = None
+
+    def startService(self):
+        super().startService()
+        dfd = db.setupDBWrapper(self.dbConfig)
+
+        @dfd.addCallback
+        def cbStartNotifier(dbWrapper):
+            self._dbWrapper = dbWrapper
+            notificationsConfig = self.notificationsConfig
+            self.notifier = DueTaskNotifier(
+                dbWrapper,
+                self.sender,
+                leadTime=notificationsConfig.lead_time,
+                lookahead=notificationsConfig.lookahead,
+                maxLateness=notificationsConfig.max_lateness,
+                batchSize=notificationsConfig.batch_size,
+            )
+            self.changeListener.subscribe(self.notifier.handleChange)
+            # The notifier ignores the listener's first resync, and
+            # loads once it's started.
+            return self.changeListener.start()
+
+        @dfd.addCallback
+        def cbStarted(ignored):
+            if self.running:
+                self.notifier.start()
+
+        @dfd.addErrback
+        def ebCancelStart(failure):
+            self.log.failure(
+                'Failed to start NotificationService', failure=failure)
+            return self.stopService()
+
+    def stopService(self):
+        super().stopService()
+        self.changeListener.stop()
+        if self.notifier is not None:
+            self.notifier.stop()
+        if self._dbWrapper is not None:
+            self.log.info('Closing notification database pool')
+            self._dbWrapper.pool.close()
+            self._dbWrapper = None
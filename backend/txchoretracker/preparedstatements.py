@@ -0,0 +1,151 @@
+"""
+Server-side prepared statements for the fixed set of api.* calls.
+
+Every connection gets the whole set PREPAREd the first time it is used
+for a prepared query (in the same round trip as that first query), and
+from then on the calls are made with ``EXECUTE name (...)`` so the
+server doesn't need to parse and plan them again.
+
+The registry remembers which connections have the statements prepared,
+keyed weakly on the underlying psycopg2 connection. A connection that
+the pool replaces after a reconnect is a new key, so it simply gets the
+statements prepared again on first use.
+"""
+import threading
+import weakref
+
+import attr
+
+
+# Errors meaning the statements we think are prepared on a connection
+# can't be used: invalid_sql_statement_name ("prepared statement does
+# not exist") and feature_not_supported ("cached plan must not change
+# result type", e.g. after functions.sql has been reinstalled).
+_STALE_STATEMENT_PGCODES = frozenset({'26000', '0A000'})
+
+
+@attr.s(frozen=True)
+class PreparedStatement:
+    """
+    Attributes:
+        name (str):
+            The server-side statement name.
+        query (str):
+            The statement body, with ``$1``-style placeholders.
+        parameterTypes (tuple of str):
+            PostgreSQL type names of the parameters, in order.
+    """
+    name = attr.ib()
+    query = attr.ib()
+    parameterTypes = attr.ib()
+
+    def prepareSQL(self):
+        # PostgreSQL doesn't accept an empty parameter list.
+        if not self.parameterTypes:
+            return 'PREPARE {name} AS {query}'.format(
+                name=self.name, query=self.query)
+        return 'PREPARE {name} ({types}) AS {query}'.format(
+            name=self.name,
+            types=', '.join(self.parameterTypes),
+            query=self.query,
+        )
+
+    def executeSQL(self):
+        if not self.parameterTypes:
+            return 'EXECUTE {name}'.format(name=self.name)
+        return 'EXECUTE {name} ({placeholders})'.format(
+            name=self.name,
+            placeholders=', '.join(['%s'] * len(self.parameterTypes)),
+        )
+
+    def directSQL(self):
+        """
+        The equivalent unprepared query, with psycopg2 placeholders.
+        """
+        query = self.query
+        # Replace the highest numbered placeholders first so $1
+        # doesn't clobber the start of $10.
+        for position in range(len(self.parameterTypes), 0, -1):
+            query = query.replace('${0}'.format(position), '%s')
+        return query
+
+
+class PreparedStatementRegistry:
+    """
+    Tracks which connections have the statements prepared, and counts
+    how often a statement could be executed by name (a hit) versus how
+    often the set had to be prepared first (a miss).
+
+    Methods may be called from adbapi worker threads, but each
+    connection is only ever used by one thread at a time.
+    """
+    def __init__(self, statements, *, usePrepared=True):
+        self._statements = {
+            statement.name: statement for statement in statements}
+        self._usePrepared = usePrepared
+        # Start from a clean slate so a half-prepared set (e.g. from a
+        # transaction that was rolled back) can't get in the way.
+        self._prepareAllSQL = '; '.join(
+            ['DEALLOCATE ALL'] +
+            [statement.prepareSQL() for statement in statements]
+        )
+        self._preparedConnections = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reprepares = 0
+
+    def sqlFor(self, connection, statementName):
+        """
+        Return the SQL to run the named statement on ``connection``
+        (a raw psycopg2 connection).
+
+        If the connection hasn't had the statements prepared yet, the
+        returned SQL prepares them first; call :meth:`markPrepared`
+        once it has run successfully.
+        """
+        statement = self._statements[statementName]
+        if not self._usePrepared:
+            return statement.directSQL()
+        if connection in self._preparedConnections:
+            with self._lock:
+                self.hits += 1
+            return statement.executeSQL()
+        with self._lock:
+            self.misses += 1
+        return self._prepareAllSQL + '; ' + statement.executeSQL()
+
+    def markPrepared(self, connection):
+        if self._usePrepared:
+            self._preparedConnections[connection] = True
+
+    def forgetIfStale(self, connection, dberr):
+        """
+        If ``dberr`` shows that the statements on ``connection`` are
+        unusable, forget that they were prepared and return True, so
+        the caller can retry (which will prepare them again).
+        """
+        if getattr(dberr, 'pgcode', None) not in _STALE_STATEMENT_PGCODES:
+            return False
+        if self._preparedConnections.pop(connection, None) is None:
+            # They were being prepared in this very query, so it isn't
+            # a stale statement problem.
+            return False
+        with self._lock:
+            self.reprepares += 1
+        return True
+
+    def stats(self):
+        """
+        Counters for monitoring, as a dict.
+        """
+        with self._lock:
+            hits, misses, reprepares = self.hits, self.misses, self.reprepares
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'reprepares': reprepares,
+            'hitRate': hits / total if total else 0.0,
+            'preparedConnections': len(self._preparedConnections),
+        }
@@ -0,0 +1,240 @@
+"""
+Finding out why requests are slow.
+
+:class:`RequestProfiler` watches every request's trace (see
+:mod:`txchoretracker.tracing`; it's a tracer observer, so requests are
+traced for it even when they aren't sampled for export):
+
+-   A request that takes longer than its route's threshold is logged,
+    with its call path: the tree of spans under it, including each
+    database call's function, duration and redacted parameters.
+    Long-lived requests, like change streams, aren't.
+-   An admin can ask for the next N requests to a route to be profiled
+    with ``cProfile`` (see :class:`ProfilingAdminResource`). Each of
+    those requests' profile is written to the output directory, for
+    ``python -m pstats`` or snakeviz.
+
+The profiler is only enabled while one of the request's spans is
+current, so concurrent requests don't end up in each other's
+profiles. Queries run in database pool threads, so only the time spent
+waiting for them shows up in the profiles; it's in the logged call
+path.
+
+Slow database calls are logged by
+:meth:`txchoretracker.db.ChoreTrackerDatabase._runPreparedQuery` too
+(see :func:`txchoretracker.db.setSlowQueryThreshold`), with
+:func:`redactParams`.
+"""
+import cProfile
+import json
+import os
+import time
+from collections import defaultdict, deque
+
+from twisted import logger
+from twisted.web import resource
+
+
+log = logger.Logger()
+
+
+def redactParams(params):
+    """
+    A description of query parameters that's safe to log: numbers,
+    booleans and None are shown, but strings (names, emails, tokens)
+    only as their length, and anything else only as its type.
+    """
+    if params is None:
+        return None
+    return [_redactParam(param) for param in params]
+
+
+def _redactParam(param):
+    if param is None or isinstance(param, (bool, int, float)):
+        return param
+    if isinstance(param, str):
+        return '<str {0} chars>'.format(len(param))
+    if isinstance(param, (list, tuple)):
+        return '<{0} of {1}>'.format(type(param).__name__, len(param))
+    return '<{0}>'.format(type(param).__name__)
+
+
+def formatCallPath(trace):
+    """
+    The spans of ``trace`` as an indented tree, one line per span, with
+    its duration in milliseconds and the interesting attributes.
+    """
+    childrenById = defaultdict(list)
+    for span in trace.spans:
+        childrenById[span.parentId].append(span)
+    lines = []
+
+    def addLines(span, depth):
+        parts = [span.name]
+        if 'function' in span.attributes:
+            parts.append(span.attributes['function'])
+        if span.duration is None:
+            parts.append('(unfinished)')
+        else:
+            parts.append('{0:.1f}ms'.format(span.duration * 1000))
+        if 'error' in span.attributes:
+            parts.append('error={0}'.format(span.attributes['error']))
+        if span.params is not None:
+            parts.append('params={0}'.format(redactParams(span.params)))
+        lines.append('  ' * depth + ' '.join(parts))
+        for child in childrenById[span.spanId]:
+            addLines(child, depth + 1)
+
+    for root in childrenById[None]:
+        addLines(root, 0)
+    return '\n'.join(lines)
+
+
+class RequestProfiler:
+    """
+    A tracer observer that logs slow requests and profiles requests on
+    demand.
+
+    Args:
+        slowThreshold (float or None):
+            Log requests that take at least this many seconds (None not
+            to).
+        routeThresholds (dict):
+            Thresholds for particular routes (``JSONApiRouter`` route
+            names, like ``TasksApiEndpoint.fetchAll``), overriding
+            ``slowThreshold``.
+        outputDir (str): Where to write captured profiles.
+
+    Attributes:
+        profiles (deque of str): The paths of the last profiles written.
+        slowRequests (int): How many slow requests have been logged.
+    """
+    def __init__(self, slowThreshold=1.0, routeThresholds=None,
+                 outputDir='profiles'):
+        self.slowThreshold = slowThreshold
+        self.routeThresholds = dict(routeThresholds or {})
+        self.outputDir = outputDir
+        self.profiles = deque(maxlen=100)
+        self.slowRequests = 0
+        self._captures = {}
+
+    def capture(self, route, count):
+        """
+        Profile the next ``count`` requests to ``route`` (0 to stop).
+        """
+        if count > 0:
+            self._captures[route] = count
+        else:
+            self._captures.pop(route, None)
+        log.info('Profiling the next {count} requests to {route}',
+                 count=count, route=route)
+
+    def captures(self):
+        """
+        How many more requests will be profiled, by route.
+        """
+        return dict(self._captures)
+
+    def traceStarted(self, rootSpan):
+        route = rootSpan.attributes.get('route')
+        remaining = self._captures.get(route)
+        if not remaining:
+            return
+        if remaining == 1:
+            del self._captures[route]
+        else:
+            self._captures[route] = remaining - 1
+        rootSpan.trace.profile = cProfile.Profile()
+
+    def traceFinished(self, trace):
+        rootSpan = trace.spans[0]
+        route = rootSpan.attributes.get('route')
+        threshold = self.routeThresholds.get(route, self.slowThreshold)
+        if (threshold is not None
+                and rootSpan.duration >= threshold
+                and not rootSpan.attributes.get('longLived')):
+            self._logSlowRequest(trace)
+        if trace.profile is not None:
+            self._writeProfile(trace)
+
+    def _logSlowRequest(self, trace):
+        self.slowRequests += 1
+        attributes = trace.spans[0].attributes
+        log.warn(
+            'Slow request: {method} {path} ({route}) took {duration:.3f}s, '
+            'status {status}\n{callPath}',
+            method=attributes.get('method'),
+            # The query string can hold personal data.
+            path=attributes.get('uri', '').partition('?')[0],
+            route=attributes.get('route'),
+            duration=trace.spans[0].duration,
+            status=attributes.get('status'),
+            callPath=formatCallPath(trace),
+            traceId=trace.traceId,
+        )
+
+    def _writeProfile(self, trace):
+        # This blocks the reactor, but only for the few requests an
+        # admin asked to profile.
+        route = trace.spans[0].attributes.get('route')
+        path = os.path.join(self.outputDir, '{0}-{1}-{2}.prof'.format(
+            route, time.strftime('%Y%m%dT%H%M%S'), trace.traceId[:8]))
+        try:
+            os.makedirs(self.outputDir, exist_ok=True)
+            trace.profile.dump_stats(path)
+        except OSError:
+            log.failure('Failed to write the profile of a request to {route}',
+                        route=route)
+            return
+        self.profiles.append(path)
+        log.info('Wrote the profile of a request to {route} to {path}',
+                 route=route, path=path)
+
+
+class ProfilingAdminResource(resource.Resource):
+    """
+    Lets an admin profile requests (see :class:`RequestProfiler`):
+
+    -   ``POST /profile?route=TasksApiEndpoint.fetchAll&count=10``
+        profiles the next 10 requests to that route (``count=0``
+        stops).
+    -   ``GET /profile`` shows the pending captures and the profiles
+        written.
+
+    It's served on the metrics port, which only listens locally by
+    default. With several workers, each has its own port and profiles
+    only its own requests.
+    """
+    isLeaf = True
+
+    def __init__(self, profiler):
+        super().__init__()
+        self._profiler = profiler
+
+    def _status(self, request):
+        request.setHeader(b'Content-Type', b'application/json')
+        return json.dumps({
+            'captures': self._profiler.captures(),
+            'profiles': list(self._profiler.profiles),
+        }).encode('utf-8')
+
+    def _badRequest(self, request, message):
+        request.setResponseCode(400)
+        request.setHeader(b'Content-Type', b'application/json')
+        return json.dumps({'error': message}).encode('utf-8')
+
+    def render_GET(self, request):
+        return self._status(request)
+
+    def render_POST(self, request):
+        route = request.args.get(b'route', [b''])[0].decode('utf-8')
+        if not route:
+            return self._badRequest(request, 'route is required')
+        try:
+            count = int(request.args.get(b'count', [b'1'])[0])
+        except ValueError:
+            return self._badRequest(request, 'count must be a number')
+        if count < 0:
+            return self._badRequest(request, 'count must not be negative')
+        self._profiler.capture(route, count)
+        return self._status(request)
@@ -0,0 +1,328 @@
+"""
+Pushing task changes to connected clients, so they don't have to poll.
+
+Clients hold a Server-Sent Events stream open (see
+:class:`txchoretracker.api.ChangesApiEndpoint`).
+:class:`TaskChangeHub` is subscribed to the
+:class:`txchoretracker.changes.ChangeListener`, so it sees every task
+write from every process, and sends each change to the connected
+users who are members of the task's task groups (before or after the
+change). The events only name the task::
+
+    event: task
+    data: {"op": "UPDATE", "id": 123}
+
+and clients fetch the task again (cheaply, with If-None-Match) if
+they care about it. A ``resync`` event means the client should assume
+anything may have changed and fetch its whole task list again. It is
+sent when:
+
+-   the change listener reconnects or disconnects, since changes may
+    have been missed;
+-   the user's task group memberships change;
+-   the client wasn't reading its stream quickly enough, and more
+    than ``maxQueuedEvents`` events backed up for it. They are then
+    dropped, so a slow client can't make the server buffer without
+    bound.
+
+There are limits on the number of streams open at once, overall and
+per user. Every stream gets a comment line every ``keepaliveInterval``
+seconds so that proxies don't close it as idle.
+"""
+import collections
+import json
+
+import zope.interface
+from twisted.internet import task
+from twisted.web.resource import IResource
+from twisted.web.server import NOT_DONE_YET
+
+from txchoretracker.kleinhelpers import JSONResponseResource
+from txchoretracker.utils import coroToDeferred
+
+
+class TooManyConnections(Exception):
+    pass
+
+
+def _formatEvent(eventType, structure):
+    return 'event: {0}\ndata: {1}\n\n'.format(
+        eventType, json.dumps(structure)).encode('ascii')
+
+
+_RESYNC = _formatEvent('resync', {})
+_KEEPALIVE = b': keepalive\n\n'
+_RETRY = b'retry: 5000\n\n'
+
+
+class EventStream:
+    """
+    One client's event stream: queues the events for it while its
+    transport is paused.
+
+    Args:
+        write (callable): Writes bytes to the client.
+        userId (int): The user the stream is for.
+        maxQueuedEvents (int): How many events may wait while the
+            client isn't reading before they are replaced by a single
+            ``resync``.
+        close (callable or None): Ends the response.
+    """
+    def __init__(self, write, userId, maxQueuedEvents, close=None):
+        self.userId = userId
+        self._write = write
+        self._close = close
+        self._maxQueuedEvents = maxQueuedEvents
+        self._queue = collections.deque()
+        self._paused = False
+        self._overflowed = False
+        self.droppedEvents = 0
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def send(self, data):
+        if not self._paused:
+            self._write(data)
+        elif self._overflowed:
+            self.droppedEvents += 1
+        elif len(self._queue) >= self._maxQueuedEvents:
+            self.droppedEvents += len(self._queue) + 1
+            self._queue.clear()
+            self._overflowed = True
+        else:
+            self._queue.append(data)
+
+    ### Producer methods, for the transport to apply backpressure.
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        if self._overflowed:
+            self._overflowed = False
+            self._write(_RESYNC)
+        # Sent one by one, in case the transport pauses again.
+        while self._queue and not self._paused:
+            self._write(self._queue.popleft())
+
+    def stopProducing(self):
+        self._queue.clear()
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+
+class TaskChangeHub:
+    """
+    Keeps track of the open event streams and sends them the changes
+    from a :class:`txchoretracker.changes.ChangeListener` (subscribe
+    :meth:`handleChange` to it).
+
+    Task group members are looked up with ``dbWrapper`` and kept in
+    memory until a change to the group's memberships, or a resync.
+    Nothing is looked up while no streams are open.
+
+    Args:
+        dbWrapper: For ``fetchTaskGroupMemberIds``.
+        maxConnections (int): Streams allowed open at once.
+        maxConnectionsPerUser (int): Streams allowed open at once for
+            any one user.
+        maxQueuedEvents (int): See :class:`EventStream`.
+        keepaliveInterval (float): Seconds between keepalive comments.
+        reactor: Schedules the keepalives.
+    """
+    def __init__(
+                self,
+                dbWrapper,
+                *,
+                maxConnections=1000,
+                maxConnectionsPerUser=5,
+                maxQueuedEvents=100,
+                keepaliveInterval=30.0,
+                reactor=None,
+            ):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._db = dbWrapper
+        self._maxConnections = maxConnections
+        self._maxConnectionsPerUser = maxConnectionsPerUser
+        self._maxQueuedEvents = maxQueuedEvents
+        self._keepaliveInterval = keepaliveInterval
+        self._reactor = reactor
+        self._streamsByUserId = collections.defaultdict(set)
+        self._connectionCount = 0
+        self._membersByTaskGroupId = {}
+        # Bumped whenever cached members are dropped, so lookups that
+        # were in flight meanwhile aren't stored.
+        self._membershipGeneration = 0
+        self._keepalive = None
+
+    @property
+    def connectionCount(self):
+        return self._connectionCount
+
+    def connect(self, write, userId, close=None):
+        """
+        Open a stream for ``userId`` that writes with ``write``, and is
+        ended with ``close``.
+
+        Raises:
+            TooManyConnections: if either limit has been reached.
+        """
+        userStreams = self._streamsByUserId[userId]
+        if (self._connectionCount >= self._maxConnections
+                or len(userStreams) >= self._maxConnectionsPerUser):
+            if not userStreams:
+                del self._streamsByUserId[userId]
+            raise TooManyConnections
+        stream = EventStream(write, userId, self._maxQueuedEvents, close)
+        userStreams.add(stream)
+        self._connectionCount += 1
+        if self._keepalive is None:
+            self._keepalive = task.LoopingCall(self._sendKeepalives)
+            self._keepalive.clock = self._reactor
+            self._keepalive.start(self._keepaliveInterval, now=False)
+        return stream
+
+    def disconnect(self, stream):
+        userStreams = self._streamsByUserId.get(stream.userId)
+        if userStreams is None or stream not in userStreams:
+            return
+        userStreams.remove(stream)
+        if not userStreams:
+            del self._streamsByUserId[stream.userId]
+        self._connectionCount -= 1
+        if self._connectionCount == 0:
+            self.stop()
+
+    def stop(self):
+        """
+        Stop the keepalives. (They start again with the next stream.)
+        """
+        if self._keepalive is not None:
+            self._keepalive.stop()
+            self._keepalive = None
+
+    def closeAll(self):
+        """
+        End every stream, e.g. when shutting down. Clients reconnect,
+        to wherever is still serving.
+        """
+        for userStreams in list(self._streamsByUserId.values()):
+            for stream in list(userStreams):
+                stream.close()
+
+    @coroToDeferred
+    async def handleChange(self, event):
+        """
+        Apply a :class:`txchoretracker.changes.ChangeEvent`.
+        """
+        if event.operation in ('RESYNC', 'DISCONNECTED'):
+            self._forgetMembers(list(self._membersByTaskGroupId))
+            self._sendToAll(_RESYNC)
+        elif event.table == 'users_m2m_task_groups':
+            self._forgetMembers(event.taskGroupIds)
+            self._sendToUser(event.rowId, _RESYNC)
+        elif event.table == 'task_group':
+            self._forgetMembers([event.rowId])
+        elif event.table == 'task':
+            if not self._streamsByUserId:
+                return
+            data = _formatEvent(
+                'task', {'op': event.operation, 'id': event.rowId})
+            userIds = set()
+            for taskGroupId in event.taskGroupIds:
+                userIds.update(await self._fetchMemberIds(taskGroupId))
+            for userId in userIds:
+                self._sendToUser(userId, data)
+
+    async def _fetchMemberIds(self, taskGroupId):
+        memberIds = self._membersByTaskGroupId.get(taskGroupId)
+        if memberIds is None:
+            generation = self._membershipGeneration
+            memberIds = frozenset(await self._db.fetchTaskGroupMemberIds(
+                taskGroupId=taskGroupId))
+            if generation == self._membershipGeneration:
+                self._membersByTaskGroupId[taskGroupId] = memberIds
+        return memberIds
+
+    def _forgetMembers(self, taskGroupIds):
+        self._membershipGeneration += 1
+        for taskGroupId in taskGroupIds:
+            self._membersByTaskGroupId.pop(taskGroupId, None)
+
+    def _sendToUser(self, userId, data):
+        for stream in list(self._streamsByUserId.get(userId, ())):
+            stream.send(data)
+
+    def _sendToAll(self, data):
+        for userStreams in list(self._streamsByUserId.values()):
+            for stream in list(userStreams):
+                stream.send(data)
+
+    def _sendKeepalives(self):
+        # Paused streams aren't idle, and shouldn't queue these.
+        for userStreams in list(self._streamsByUserId.values()):
+            for stream in list(userStreams):
+                if not stream.paused:
+                    stream.send(_KEEPALIVE)
+
+    def stats(self):
+        """
+        Counters for monitoring, as a dict.
+        """
+        return {
+            'connections': self._connectionCount,
+            'users': len(self._streamsByUserId),
+            'cachedTaskGroups': len(self._membersByTaskGroupId),
+        }
+
+
+@zope.interface.implementer(IResource)
+class EventStreamResource:
+    """
+    A :class:`twisted.web.resource.IResource` that opens an event
+    stream on ``hub`` for ``userId``, and keeps the response open
+    until the client goes away.
+    """
+    def __init__(self, hub, userId):
+        self._hub = hub
+        self._userId = userId
+
+    def render(self, txRequest):
+        def close():
+            # Twisted logs an error for requests finished with a
+            # producer still registered.
+            txRequest.unregisterProducer()
+            txRequest.finish()
+        try:
+            stream = self._hub.connect(txRequest.write, self._userId, close)
+        except TooManyConnections:
+            return JSONResponseResource.makeServiceUnavailable(
+                'too many open change streams').render(txRequest)
+        txRequest.setResponseCode(200)
+        txRequest.setHeader(b'Content-Type', b'text/event-stream')
+        txRequest.setHeader(b'Cache-Control', b'no-cache')
+        # Stop nginx from buffering the stream.
+        txRequest.setHeader(b'X-Accel-Buffering', b'no')
+        txRequest.registerProducer(stream, True)
+        # Sends the headers, and tells the client how soon to
+        # reconnect if the stream drops.
+        txRequest.write(_RETRY)
+
+        def disconnect(result):
+            self._hub.disconnect(stream)
+        txRequest.notifyFinish().addBoth(disconnect)
+        return NOT_DONE_YET
+
+    isLeaf = True
+
+    def getChildWithDefault(self, name, request):
+        # Since isLeaf is true, this shouldn't be called anyway.
+        raise NotImplementedError('getChildWithDefault not supported')
+
+    def putChild(self, path, child):
+        raise NotImplementedError('putChild not supported')
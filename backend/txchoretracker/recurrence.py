@@ -0,0 +1,359 @@
+"""
+Recurrence rules for repeating tasks, in a subset of the iCalendar
+RRULE syntax (RFC 5545, section 3.3.10), for example::
+
+    FREQ=DAILY;INTERVAL=3
+    FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH
+    FREQ=MONTHLY;BYDAY=1SA;COUNT=12
+    FREQ=MONTHLY;BYMONTHDAY=-1;UNTIL=20191231T000000Z
+    FREQ=YEARLY;BYMONTH=4,10;BYMONTHDAY=1
+
+The supported rule parts are:
+
+-   ``FREQ``: ``DAILY``, ``WEEKLY``, ``MONTHLY`` or ``YEARLY``.
+-   ``INTERVAL``: every how many days, weeks, months or years.
+-   ``COUNT`` or ``UNTIL``: when the occurrences stop. ``UNTIL`` is in
+    UTC, and a date on its own includes the whole day.
+-   ``BYMONTH``: only in these months.
+-   ``BYMONTHDAY``: on these days of the month, counting back from the
+    end if negative (``-1`` is the last day). Not with ``WEEKLY``.
+-   ``BYDAY``: on these days of the week. With ``MONTHLY`` they may
+    have an ordinal: ``2TU`` is the second Tuesday of the month, and
+    ``-1FR`` the last Friday. Not with ``YEARLY``.
+
+Occurrences are at the time of day of the start time, in UTC. As with
+python-dateutil (and unlike RFC 5545), the start time is only an
+occurrence if it matches the rule. Occurrences past the last time a
+task can be due (see :data:`txchoretracker.models._LAST_UNIX`) are
+never generated.
+"""
+import datetime
+import functools
+import re
+
+import attr
+
+
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+_WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+# Same as models._LAST_UNIX: due times are 32 bit in the database.
+_LAST_UNIX = 2 ** 31 - 1
+_LAST_DATE = datetime.datetime.utcfromtimestamp(_LAST_UNIX).date()
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_BYDAY_PATTERN = re.compile(r'([+-]?[1-5])?(MO|TU|WE|TH|FR|SA|SU)$')
+_UNTIL_PATTERN = re.compile(r'(\d{8})(?:T(\d{6})Z)?$')
+
+
+def _toUnix(dt):
+    return int((dt - _EPOCH).total_seconds())
+
+
+def _daysInMonth(year, month):
+    if month == 12:
+        return 31
+    return (datetime.date(year, month + 1, 1)
+            - datetime.date(year, month, 1)).days
+
+
+@attr.s(frozen=True)
+class Recurrence:
+    """
+    A parsed recurrence rule (see :meth:`parse`).
+
+    Attributes:
+        frequency (str): One of :data:`FREQUENCIES`.
+        interval (int): Every how many periods of ``frequency``.
+        count (int or None): How many occurrences there are at most.
+        untilUnix (int or None): The last time there can be an
+            occurrence.
+        byMonth (tuple of int): Months, 1 to 12.
+        byMonthDay (tuple of int): Days of the month, 1 to 31 or -31
+            to -1.
+        byWeekday (tuple of (int or None, int)): (ordinal, weekday)
+            pairs, with Monday as 0. The ordinal is None for every one
+            of those weekdays.
+    """
+    frequency = attr.ib()
+    interval = attr.ib(default=1)
+    count = attr.ib(default=None)
+    untilUnix = attr.ib(default=None)
+    byMonth = attr.ib(default=())
+    byMonthDay = attr.ib(default=())
+    byWeekday = attr.ib(default=())
+
+    @classmethod
+    def parse(cls, rule: str):
+        """
+        Parse an RRULE value (without the ``RRULE:`` prefix).
+
+        Raises:
+            ValueError: if ``rule`` isn't valid, or uses what isn't
+                supported.
+        """
+        parts = {}
+        for part in rule.strip().upper().split(';'):
+            name, sep, value = part.partition('=')
+            if not sep or not value:
+                raise ValueError('Invalid rule part {0!r}'.format(part))
+            if name in parts:
+                raise ValueError('Duplicate rule part {0}'.format(name))
+            parts[name] = value
+
+        frequency = parts.pop('FREQ', None)
+        if frequency not in FREQUENCIES:
+            raise ValueError('FREQ must be one of {0}'.format(
+                ', '.join(FREQUENCIES)))
+        kwargs = {}
+        if 'INTERVAL' in parts:
+            kwargs['interval'] = _parseInteger(
+                'INTERVAL', parts.pop('INTERVAL'), 1, 10000)
+        if 'COUNT' in parts and 'UNTIL' in parts:
+            raise ValueError('COUNT and UNTIL cannot both be given')
+        if 'COUNT' in parts:
+            kwargs['count'] = _parseInteger(
+                'COUNT', parts.pop('COUNT'), 1, 100000)
+        if 'UNTIL' in parts:
+            kwargs['untilUnix'] = _parseUntil(parts.pop('UNTIL'))
+        if 'BYMONTH' in parts:
+            kwargs['byMonth'] = tuple(sorted(set(
+                _parseInteger('BYMONTH', value, 1, 12)
+                for value in parts.pop('BYMONTH').split(','))))
+        if 'BYMONTHDAY' in parts:
+            if frequency == 'WEEKLY':
+                raise ValueError('BYMONTHDAY cannot be used with WEEKLY')
+            byMonthDay = set()
+            for value in parts.pop('BYMONTHDAY').split(','):
+                day = _parseInteger('BYMONTHDAY', value, -31, 31)
+                if day == 0:
+                    raise ValueError('BYMONTHDAY cannot be 0')
+                byMonthDay.add(day)
+            kwargs['byMonthDay'] = tuple(sorted(byMonthDay))
+        if 'BYDAY' in parts:
+            if frequency == 'YEARLY':
+                raise ValueError('BYDAY is not supported with YEARLY')
+            kwargs['byWeekday'] = _parseByDay(
+                parts.pop('BYDAY'), allowOrdinals=frequency == 'MONTHLY')
+        if parts:
+            raise ValueError('Unsupported rule part(s) {0}'.format(
+                ', '.join(sorted(parts))))
+        return cls(frequency, **kwargs)
+
+    def format(self) -> str:
+        """
+        The rule as an RRULE value, in a canonical form.
+        """
+        parts = ['FREQ=' + self.frequency]
+        if self.interval != 1:
+            parts.append('INTERVAL={0}'.format(self.interval))
+        if self.byMonth:
+            parts.append('BYMONTH=' + ','.join(map(str, self.byMonth)))
+        if self.byMonthDay:
+            parts.append(
+                'BYMONTHDAY=' + ','.join(map(str, self.byMonthDay)))
+        if self.byWeekday:
+            parts.append('BYDAY=' + ','.join(
+                '{0}{1}'.format('' if ordinal is None else ordinal,
+                                _WEEKDAYS[weekday])
+                for ordinal, weekday in self.byWeekday))
+        if self.count is not None:
+            parts.append('COUNT={0}'.format(self.count))
+        if self.untilUnix is not None:
+            until = datetime.datetime.utcfromtimestamp(self.untilUnix)
+            parts.append(until.strftime('UNTIL=%Y%m%dT%H%M%SZ'))
+        return ';'.join(parts)
+
+    def occurrences(self, startUnix, fromUnix=None):
+        """
+        Iterate over the occurrence times (Unix) of the rule started
+        at ``startUnix``, in order.
+
+        If ``fromUnix`` is given, only the occurrences at or after it
+        are generated, skipping straight to them rather than working
+        through the earlier ones. ``count`` is then not applied, since
+        how many occurrences came before isn't known: callers resuming
+        a rule have to keep count themselves.
+        """
+        start = datetime.datetime.utcfromtimestamp(startUnix)
+        lowerUnix = startUnix
+        if fromUnix is not None:
+            lowerUnix = max(lowerUnix, fromUnix)
+        upperUnix = _LAST_UNIX
+        if self.untilUnix is not None:
+            upperUnix = min(upperUnix, self.untilUnix)
+        remaining = self.count if fromUnix is None else None
+
+        lowerDate = datetime.datetime.utcfromtimestamp(lowerUnix).date()
+        upperDate = datetime.datetime.utcfromtimestamp(upperUnix).date()
+        timeOfDay = start.time()
+        for periodStart, periodDates in self._iterPeriods(
+                start.date(), lowerDate):
+            if periodStart > upperDate:
+                return
+            for date in periodDates:
+                occurrenceUnix = _toUnix(
+                    datetime.datetime.combine(date, timeOfDay))
+                if occurrenceUnix < lowerUnix:
+                    continue
+                if occurrenceUnix > upperUnix:
+                    return
+                yield occurrenceUnix
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+
+    def _iterPeriods(self, startDate, lowerDate):
+        # Yields the first day and the sorted candidate dates of each
+        # period (day, week, month or year), from the one containing
+        # lowerDate on, until past the last possible due date.
+        if self.frequency == 'DAILY':
+            step = datetime.timedelta(days=self.interval)
+            skip = max(0, (lowerDate - startDate).days // self.interval)
+            day = startDate + skip * step
+            while day <= _LAST_DATE:
+                yield day, [day] if self._matchesDay(day) else []
+                day += step
+        elif self.frequency == 'WEEKLY':
+            weekdays = sorted(set(
+                weekday for ordinal, weekday in self.byWeekday))
+            if not weekdays:
+                weekdays = [startDate.weekday()]
+            firstMonday = startDate - datetime.timedelta(
+                days=startDate.weekday())
+            step = datetime.timedelta(weeks=self.interval)
+            skip = max(0, (lowerDate - firstMonday).days
+                          // (7 * self.interval))
+            monday = firstMonday + skip * step
+            while monday <= _LAST_DATE:
+                days = [monday + datetime.timedelta(days=weekday)
+                        for weekday in weekdays]
+                yield monday, [
+                    day for day in days
+                    if not self.byMonth or day.month in self.byMonth]
+                monday += step
+        elif self.frequency == 'MONTHLY':
+            firstMonth = startDate.year * 12 + startDate.month - 1
+            lowerMonth = lowerDate.year * 12 + lowerDate.month - 1
+            month = firstMonth + self.interval * max(
+                0, (lowerMonth - firstMonth) // self.interval)
+            while month // 12 <= _LAST_DATE.year:
+                year, monthOfYear = month // 12, month % 12 + 1
+                yield (datetime.date(year, monthOfYear, 1),
+                       self._monthDates(year, monthOfYear, startDate))
+                month += self.interval
+        else:
+            year = startDate.year + self.interval * max(
+                0, (lowerDate.year - startDate.year) // self.interval)
+            months = self.byMonth
+            if not months:
+                # Days of the month on their own mean every month.
+                months = range(1, 13) if self.byMonthDay else (
+                    startDate.month,)
+            while year <= _LAST_DATE.year:
+                dates = []
+                for month in months:
+                    dates.extend(self._monthDates(year, month, startDate))
+                yield datetime.date(year, 1, 1), dates
+                year += self.interval
+
+    def _matchesDay(self, day):
+        if self.byMonth and day.month not in self.byMonth:
+            return False
+        if self.byMonthDay and not (
+                set(self.byMonthDay) & set(_monthDayNumbers(day))):
+            return False
+        if self.byWeekday and day.weekday() not in (
+                weekday for ordinal, weekday in self.byWeekday):
+            return False
+        return True
+
+    def _monthDates(self, year, month, startDate):
+        if self.byMonth and month not in self.byMonth:
+            return []
+        daysInMonth = _daysInMonth(year, month)
+        days = None
+        if self.byMonthDay:
+            days = set(
+                day if day > 0 else daysInMonth + 1 + day
+                for day in self.byMonthDay
+                if abs(day) <= daysInMonth)
+        if self.byWeekday:
+            weekdayDays = set()
+            firstWeekday = datetime.date(year, month, 1).weekday()
+            for ordinal, weekday in self.byWeekday:
+                # All the days of the month on that weekday.
+                candidates = range(
+                    (weekday - firstWeekday) % 7 + 1, daysInMonth + 1, 7)
+                if ordinal is None:
+                    weekdayDays.update(candidates)
+                elif abs(ordinal) <= len(candidates):
+                    weekdayDays.add(
+                        candidates[ordinal - 1 if ordinal > 0 else ordinal])
+            days = weekdayDays if days is None else days & weekdayDays
+        if days is None:
+            # Like the start date, or not at all in shorter months.
+            days = {startDate.day} if startDate.day <= daysInMonth else set()
+        return [datetime.date(year, month, day) for day in sorted(days)]
+
+
+def _monthDayNumbers(day):
+    # The day's BYMONTHDAY numbers, counting from the start and the end.
+    return day.day, day.day - _daysInMonth(day.year, day.month) - 1
+
+
+def _parseInteger(name, value, minimum, maximum):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError('{0} must be an integer'.format(name))
+    if not minimum <= number <= maximum:
+        raise ValueError('{0} must be from {1} to {2}'.format(
+            name, minimum, maximum))
+    return number
+
+
+def _parseUntil(value):
+    match = _UNTIL_PATTERN.match(value)
+    if match is None:
+        raise ValueError('UNTIL must be YYYYMMDD or YYYYMMDDTHHMMSSZ')
+    date, time = match.groups()
+    try:
+        if time is None:
+            # The whole day is included.
+            until = datetime.datetime.strptime(date, '%Y%m%d') \
+                + datetime.timedelta(days=1, seconds=-1)
+        else:
+            until = datetime.datetime.strptime(date + time, '%Y%m%d%H%M%S')
+    except ValueError:
+        raise ValueError('UNTIL is not a valid date')
+    return min(max(_toUnix(until), 0), _LAST_UNIX)
+
+
+def _parseByDay(value, allowOrdinals):
+    byWeekday = set()
+    for item in value.split(','):
+        match = _BYDAY_PATTERN.match(item)
+        if match is None:
+            raise ValueError('Invalid BYDAY value {0!r}'.format(item))
+        ordinal, weekday = match.groups()
+        if ordinal is not None:
+            if not allowOrdinals:
+                raise ValueError(
+                    'BYDAY can only have ordinals with MONTHLY')
+            ordinal = int(ordinal)
+        byWeekday.add((ordinal, _WEEKDAYS.index(weekday)))
+    # Sorted by weekday, then ordinal (None first).
+    return tuple(sorted(
+        byWeekday,
+        key=lambda pair: (pair[1], pair[0] is not None, pair[0] or 0)))
+
+
+@functools.lru_cache(maxsize=1024)
+def parseRecurrence(rule: str) -> Recurrence:
+    """
+    :meth:`Recurrence.parse`, with the results of the most recently
+    used rules cached, since the same few rules are used by many
+    repeating tasks.
+    """
+    return Recurrence.parse(rule)
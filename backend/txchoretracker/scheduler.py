@@ -0,0 +1,228 @@
+"""
+Creating the tasks of repeating tasks ahead of time.
+
+Each repeating task's next occurrence without a task is kept in the
+database (``repeating_task.next_due``, which is indexed), which makes
+the table a priority queue of schedules. A pass of the
+:class:`RepeatingTaskScheduler` only reads the schedules whose next
+occurrence comes within the horizon, in batches, soonest first.
+Creating their tasks up to the horizon moves them back in the queue,
+so a pass touches each due schedule once, however many there are in
+all. Between passes the scheduler sleeps until the soonest next
+occurrence comes within the horizon.
+
+Every application process can run a scheduler. The tasks of an
+occurrence are only created once, since a batch is only applied to
+the schedules that are still where it found them, and there is a
+unique index on ``task (repeating_task_id, due)``.
+"""
+from twisted import logger
+from twisted.internet import defer
+
+from txchoretracker import models
+from txchoretracker.recurrence import parseRecurrence
+
+
+log = logger.Logger()
+
+
+def materialize(repeatingTask, horizonUnix, maxOccurrences):
+    """
+    Work out the :class:`models.RepeatingTaskMaterialization` for the
+    occurrences of ``repeatingTask`` from its ``next_due_unix`` up to
+    ``horizonUnix`` (exclusive), at most ``maxOccurrences`` of them.
+
+    Raises:
+        ValueError: if its recurrence isn't valid.
+    """
+    recurrence = parseRecurrence(repeatingTask.recurrence)
+    occurrenceCount = repeatingTask.occurrence_count
+    dueUnixes = []
+    nextDueUnix = None
+    for dueUnix in recurrence.occurrences(
+            repeatingTask.start_unix, repeatingTask.next_due_unix):
+        if (recurrence.count is not None
+                and occurrenceCount >= recurrence.count):
+            break
+        if dueUnix >= horizonUnix or len(dueUnixes) >= maxOccurrences:
+            nextDueUnix = dueUnix
+            break
+        dueUnixes.append(dueUnix)
+        occurrenceCount += 1
+    return models.RepeatingTaskMaterialization(
+        repeating_task_id=repeatingTask.id,
+        expected_next_due_unix=repeatingTask.next_due_unix,
+        due_unixes=dueUnixes,
+        next_due_unix=nextDueUnix,
+        occurrence_count=occurrenceCount,
+    )
+
+
+class RepeatingTaskScheduler:
+    """
+    Creates the tasks for the occurrences of repeating tasks up to
+    ``horizon`` seconds ahead, in passes.
+
+    Args:
+        dbWrapper: For ``fetchDueRepeatingTasks``,
+            ``fetchNextRepeatingTaskDue`` and
+            ``applyRepeatingTaskMaterializations``.
+        horizon (float): How many seconds ahead to create tasks.
+        batchSize (int): Repeating tasks to read and update per query.
+        maxOccurrencesPerBatch (int): The most tasks to create for any
+            one repeating task per batch. It gets the rest in the next
+            batch.
+        maxDelay (float): The longest to sleep between passes, as a
+            backstop for repeating tasks created by other processes.
+        reactor: Schedules the passes.
+    """
+    def __init__(
+                self,
+                dbWrapper,
+                *,
+                horizon=14 * 24 * 60 * 60,
+                batchSize=500,
+                maxOccurrencesPerBatch=1000,
+                maxDelay=300.0,
+                reactor=None,
+            ):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._db = dbWrapper
+        self._horizon = horizon
+        self._batchSize = batchSize
+        self._maxOccurrencesPerBatch = maxOccurrencesPerBatch
+        self._maxDelay = maxDelay
+        self._reactor = reactor
+        self._delayedCall = None
+        self._running = False
+        self._wakeRequested = False
+        self._stopped = True
+        self.tasksCreated = 0
+        self.passes = 0
+
+    def start(self):
+        """
+        Run a pass now, and keep running them until :meth:`stop`.
+        """
+        self._stopped = False
+        self._schedule(0)
+
+    def stop(self):
+        self._stopped = True
+        if self._delayedCall is not None and self._delayedCall.active():
+            self._delayedCall.cancel()
+        self._delayedCall = None
+
+    def wake(self):
+        """
+        Run a pass soon, e.g. because a repeating task was created.
+        """
+        if self._stopped:
+            return
+        if self._running:
+            self._wakeRequested = True
+        else:
+            self._schedule(0)
+
+    def _schedule(self, delay):
+        if self._delayedCall is not None and self._delayedCall.active():
+            if self._delayedCall.getTime() <= self._reactor.seconds() + delay:
+                return
+            self._delayedCall.cancel()
+        self._delayedCall = self._reactor.callLater(delay, self._runPass)
+
+    def _runPass(self):
+        self._delayedCall = None
+        self._running = True
+        self._wakeRequested = False
+        d = defer.ensureDeferred(self.runPass())
+
+        @d.addCallback
+        def cbNextPassDelay(ignored):
+            return defer.ensureDeferred(self._nextPassDelay())
+
+        @d.addErrback
+        def ebLogFailure(failure):
+            log.failure(
+                'Repeating task scheduler pass failed', failure=failure)
+            return self._maxDelay
+
+        @d.addCallback
+        def cbScheduleNext(delay):
+            self._running = False
+            if self._stopped:
+                return
+            if self._wakeRequested:
+                delay = 0
+            self._schedule(delay)
+        return d
+
+    async def runPass(self):
+        """
+        Create the tasks for every occurrence within the horizon that
+        doesn't have one yet. Returns how many tasks were created.
+        """
+        horizonUnix = int(self._reactor.seconds() + self._horizon)
+        created = 0
+        previousPositions = None
+        while True:
+            repeatingTasks = await self._db.fetchDueRepeatingTasks(
+                beforeUnix=horizonUnix, limit=self._batchSize)
+            positions = [(rt.id, rt.next_due_unix) for rt in repeatingTasks]
+            if not repeatingTasks or positions == previousPositions:
+                # Nothing due, or nothing moved on (which shouldn't
+                # happen), so there's no point asking again.
+                break
+            previousPositions = positions
+            materializations = []
+            for repeatingTask in repeatingTasks:
+                try:
+                    materializations.append(materialize(
+                        repeatingTask, horizonUnix,
+                        self._maxOccurrencesPerBatch))
+                except ValueError:
+                    # Validated when created, so this shouldn't happen.
+                    # Stop it rather than failing every pass on it.
+                    log.failure(
+                        'Invalid recurrence for repeating task {id}',
+                        id=repeatingTask.id)
+                    materializations.append(
+                        models.RepeatingTaskMaterialization(
+                            repeating_task_id=repeatingTask.id,
+                            expected_next_due_unix=(
+                                repeatingTask.next_due_unix),
+                            due_unixes=[],
+                            next_due_unix=None,
+                            occurrence_count=(
+                                repeatingTask.occurrence_count),
+                        ))
+            created += await self._db.applyRepeatingTaskMaterializations(
+                materializations)
+            if len(repeatingTasks) < self._batchSize:
+                break
+        self.passes += 1
+        self.tasksCreated += created
+        if created:
+            log.info(
+                'Created {count} tasks for repeating tasks', count=created)
+        return created
+
+    async def _nextPassDelay(self):
+        # When the soonest next occurrence comes within the horizon
+        # (which ends just before the horizon time). At least a second,
+        # so a schedule that can't be moved on isn't retried in a loop.
+        nextDueUnix = await self._db.fetchNextRepeatingTaskDue()
+        if nextDueUnix is None:
+            return self._maxDelay
+        delay = nextDueUnix + 1 - self._horizon - self._reactor.seconds()
+        return min(max(delay, 1), self._maxDelay)
+
+    def stats(self):
+        """
+        Counters for monitoring, as a dict.
+        """
+        return {
+            'passes': self.passes,
+            'tasksCreated': self.tasksCreated,
+        }
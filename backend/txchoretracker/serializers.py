@@ -0,0 +1,151 @@
+"""
+Fast dump-only serializers compiled from marshmallow schemas.
+
+``schema.dump()`` does a lot of work per object: running the
+``pre_dump`` hooks (``attr.asdict`` for our models), then looking up,
+formatting and renaming every field through the generic field
+machinery. For the read paths that dump the same kinds of model over
+and over, :func:`compileDumper` turns a schema's field definitions into
+a generated function that reads the model attributes directly and
+builds the output dict in one go.
+
+The output is the same as ``schema.dump(obj).data`` for the models in
+./models.py, down to the key order, which is what makes the JSON bytes
+the same too (see tests/test_serializers.py). Schemas using features
+that the compiler doesn't know how to reproduce exactly are rejected
+with a TypeError rather than dumped differently.
+"""
+import attr
+import marshmallow as mm
+from marshmallow import utils as mm_utils
+from marshmallow.decorators import POST_DUMP
+
+
+# Field class -> (fast path type, slow path converter). Values that are
+# None or already of the fast path type are used as is, anything else
+# goes through the converter, which must match the field's _serialize.
+_FIELD_CONVERSIONS = {
+    mm.fields.Integer: (int, int),
+    mm.fields.String: (str, mm_utils.ensure_text_type),
+}
+
+# Field class -> type whose values the field dumps unchanged. Anything
+# else goes through the field's own _serialize.
+_PASSTHROUGH_TYPES = {
+    mm.fields.Boolean: bool,
+}
+
+
+def _checkField(name, field):
+    attribute = field.attribute or name
+    if not attribute.isidentifier():
+        raise TypeError(
+            'Cannot compile field {0!r} with attribute {1!r}'.format(
+                name, attribute))
+    if field.default is not mm.missing:
+        raise TypeError(
+            'Cannot compile field {0!r} with a dump default'.format(name))
+    if getattr(field, 'as_string', False):
+        raise TypeError(
+            'Cannot compile field {0!r} with as_string'.format(name))
+
+
+@attr.s(frozen=True)
+class CompiledDumper:
+    """
+    Dumps model instances like the schema it was compiled from.
+
+    Unlike ``schema.dump()``, values that can't be serialized raise
+    (ValueError or TypeError) instead of being reported as errors.
+
+    Attributes:
+        dumpOne (callable):
+            Takes a model and returns its serialized dict.
+        dumpMany (callable):
+            Takes an iterable of models and returns a list of dicts.
+        source (str):
+            The generated source of the two functions.
+    """
+    dumpOne = attr.ib()
+    dumpMany = attr.ib()
+    source = attr.ib(repr=False)
+
+    def dump(self, modelOrModels, many=False):
+        if many:
+            return self.dumpMany(modelOrModels)
+        return self.dumpOne(modelOrModels)
+
+
+def compileDumper(schema: mm.Schema) -> CompiledDumper:
+    """
+    Compile a dumper for the models that ``schema`` dumps.
+
+    Only the declared fields are used; the schema's ``pre_dump`` hooks
+    are assumed to do nothing more than turn the model into a dict of
+    its attributes (like ``attr.asdict``), and there must be no
+    ``post_dump`` hooks.
+    """
+    processors = schema.__processors__
+    if processors.get((POST_DUMP, False)) or processors.get((POST_DUMP, True)):
+        raise TypeError('Cannot compile schemas with post_dump hooks')
+
+    namespace = {}
+    assignments = []
+    outputItems = []
+    # schema.fields is what schema.dump() iterates over, so this keeps
+    # the same key order. (For unordered schemas that order comes from
+    # a set, so it can differ between processes, but not between this
+    # dumper and the schema it was compiled from.)
+    for position, (name, field) in enumerate(schema.fields.items()):
+        if field.load_only:
+            continue
+        _checkField(name, field)
+        attribute = field.attribute or name
+        variable = 'v{0}'.format(position)
+        assignments.append('    {0} = obj.{1}'.format(variable, attribute))
+
+        conversion = _FIELD_CONVERSIONS.get(type(field))
+        if conversion is not None:
+            fastType, converter = conversion
+            fastTypeName = '_type{0}'.format(position)
+            converterName = '_convert{0}'.format(position)
+            namespace[fastTypeName] = fastType
+            namespace[converterName] = converter
+            assignments.append(
+                '    if {v} is not None and {v}.__class__ is not {t}:\n'
+                '        {v} = {c}({v})'.format(
+                    v=variable, t=fastTypeName, c=converterName))
+        else:
+            # Anything else goes through the field itself, which is
+            # still cheaper than the full schema machinery.
+            fieldName = '_field{0}'.format(position)
+            namespace[fieldName] = field
+            serialize = '{v} = {f}._serialize({v}, {name!r}, obj)'.format(
+                v=variable, f=fieldName, name=name)
+            passthroughType = _PASSTHROUGH_TYPES.get(type(field))
+            if passthroughType is None:
+                assignments.append('    ' + serialize)
+            else:
+                fastTypeName = '_type{0}'.format(position)
+                namespace[fastTypeName] = passthroughType
+                assignments.append(
+                    '    if {v}.__class__ is not {t}:\n'
+                    '        {s}'.format(
+                        v=variable, t=fastTypeName, s=serialize))
+
+        outputKey = field.dump_to or name
+        outputItems.append('{0!r}: {1}'.format(outputKey, variable))
+
+    source = '\n'.join(
+        ['def dumpOne(obj):'] +
+        assignments +
+        ['    return {' + ', '.join(outputItems) + '}'] +
+        [
+            '',
+            'def dumpMany(objs):',
+            '    return [dumpOne(obj) for obj in objs]',
+        ]
+    ) + '\n'
+    exec(compile(source, '<compiled dumper for {0}>'.format(
+        type(schema).__name__), 'exec'), namespace)
+    return CompiledDumper(namespace['dumpOne'], namespace['dumpMany'], source)
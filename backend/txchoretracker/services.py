@@ -1,36 +1,219 @@
+import socket
+
 from twisted import logger
 from twisted.web import server
 from twisted.web import resource
 from twisted.application import service
+from twisted.internet import defer
 from twisted.internet import endpoints
 from twisted.internet import reactor
+from twisted.internet import task
 
 from txchoretracker import api
+from txchoretracker import changes
+from txchoretracker import compression
 from txchoretracker import db
+from txchoretracker import dbcache
 from txchoretracker import config
+from txchoretracker import jsoncodecs
+from txchoretracker import kleinhelpers
+from txchoretracker import metrics
+from txchoretracker import profiling
+from txchoretracker import push
+from txchoretracker import scheduler
+from txchoretracker import tracing
+from txchoretracker import versions
+
+
+# How often the task change log is pruned.
+_PRUNE_INTERVAL = 60 * 60
+
+# Database pool statistics (see IConnectionBackend.stats), with help.
+_POOL_GAUGES = (
+    ('size', 'The most connections the database pool will open.'),
+    ('connections', 'Open database connections.'),
+    ('waiters', 'Queries waiting for a database connection.'),
+    ('inUse', 'Database connections in use.'),
+)
+_POOL_HISTOGRAMS = (
+    ('waitTime', 'Time queries waited for a database connection.'),
+    ('useTime', 'Time queries held a database connection.'),
+)
+# Task cache counters that only go up, and the ones that are gauges.
+_CACHE_COUNTERS = ('hits', 'misses', 'evictions', 'expirations', 'invalidations')
+_CACHE_GAUGES = ('entries', 'size')
+
+
+def addressFamily(interface):
+    """
+    The socket address family for serving on ``interface``.
+    """
+    return socket.AF_INET6 if ':' in interface else socket.AF_INET
+
 
+class DrainableSite(server.Site):
+    """
+    A :class:`twisted.web.server.Site` that keeps count of the requests
+    in progress, so that shutting down can wait for them to finish.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requestsInProgress = 0
+        self._drainWaiters = []
+
+    def getResourceFor(self, request):
+        self.requestsInProgress += 1
+        request.notifyFinish().addBoth(self._requestDone)
+        return super().getResourceFor(request)
+
+    def _requestDone(self, ignored):
+        self.requestsInProgress -= 1
+        if self.requestsInProgress == 0:
+            waiters, self._drainWaiters = self._drainWaiters, []
+            for waiter in waiters:
+                waiter.callback(None)
+
+    def whenDrained(self):
+        """
+        Returns a Deferred that fires once no requests are in progress.
+        """
+        if self.requestsInProgress == 0:
+            return defer.succeed(None)
+        waiter = defer.Deferred()
+        self._drainWaiters.append(waiter)
+        return waiter
 
 
 class ChoreTrackerAPIService(service.Service):
+    """
+    Serves the API.
+
+    ``listenFileno`` is the file descriptor of a listening socket to
+    serve on instead of binding one, for a worker process (see
+    :mod:`txchoretracker.workers`). Such a worker serves its metrics
+    and profiling admin endpoint (if enabled) on the metrics port plus
+    ``metricsPortOffset``.
+    """
     log = logger.Logger()
 
     def __init__(
                 self,
                 restApiConfig: config.RestApiConfig,
                 dbConfig: config.DatabaseConfig,
+                cacheConfig: config.CacheConfig = None,
+                pushConfig: config.PushConfig = None,
+                schedulerConfig: config.SchedulerConfig = None,
+                listenFileno: int = None,
+                metricsConfig: config.MetricsConfig = None,
+                metricsPortOffset: int = 0,
+                tracingConfig: config.TracingConfig = None,
+                profilingConfig: config.ProfilingConfig = None,
             ):
         super().__init__()
         self._dbWrapper = None
         self._listeningPort = None
+        self._listenFileno = listenFileno
+        self._site = None
+        self.changeListener = changes.ChangeListener(dbConfig.get_dsn())
+        # For ETags; only live while the change listener is connected.
+        self.versions = versions.ChangeVersions()
+        self.changeListener.subscribe(self.versions.handleChange)
         self.dbConfig = dbConfig
         self.restApiConfig = restApiConfig
+        if cacheConfig is None:
+            cacheConfig = config.CacheConfig()
+        self.cacheConfig = cacheConfig
+        if pushConfig is None:
+            pushConfig = config.PushConfig()
+        self.pushConfig = pushConfig
+        if schedulerConfig is None:
+            schedulerConfig = config.SchedulerConfig()
+        self.schedulerConfig = schedulerConfig
+        if metricsConfig is None:
+            metricsConfig = config.MetricsConfig()
+        self.metricsConfig = metricsConfig
+        self._metricsPortOffset = metricsPortOffset
+        self._metricsPort = None
+        if tracingConfig is None:
+            tracingConfig = config.TracingConfig()
+        self.tracingConfig = tracingConfig
+        self.tracer = None
+        if profilingConfig is None:
+            profilingConfig = config.ProfilingConfig()
+        self.profilingConfig = profilingConfig
+        self.profiler = None
+        self.changeHub = None
+        self.scheduler = None
+        self._pruneCall = None
 
     def startService(self):
-        dfd = db.setupDBWrapper(self.dbConfig.get_dsn())
+        codec = jsoncodecs.makeJSONCodec(self.restApiConfig.json_codec)
+        self.log.info('Using the {codec} JSON codec', codec=codec.name)
+        kleinhelpers.setJSONCodec(codec)
+        kleinhelpers.setCompressionPolicy(compression.makeCompressionPolicy(
+            self.restApiConfig.compression,
+            minSize=self.restApiConfig.compression_min_size,
+            gzipLevel=self.restApiConfig.compression_gzip_level,
+            brotliQuality=self.restApiConfig.compression_brotli_quality,
+        ))
+        if self.tracingConfig.enabled:
+            self.log.info(
+                'Tracing {rate:.1%} of requests to the {exporter} exporter',
+                rate=self.tracingConfig.sample_rate,
+                exporter=self.tracingConfig.exporter)
+            self.tracer = tracing.makeTracer(self.tracingConfig)
+        if self.profilingConfig.enabled:
+            self.log.info('Logging slow requests and queries')
+            self.profiler = profiling.RequestProfiler(
+                self.profilingConfig.slow_request_threshold,
+                self.profilingConfig.route_thresholds,
+                self.profilingConfig.output_dir,
+            )
+            if self.tracer is None:
+                # Trace every request for the profiler, exporting none.
+                self.tracer = tracing.Tracer(None, sampleRate=0.0)
+            self.tracer.addObserver(self.profiler)
+            db.setSlowQueryThreshold(
+                self.profilingConfig.slow_query_threshold)
+        if self.tracer is not None:
+            tracing.setTracer(self.tracer)
+        dfd = db.setupDBWrapper(self.dbConfig)
 
         @dfd.addCallback
         def cbSetDBWrapper(dbWrapper):
+            if self.cacheConfig.enabled:
+                self.log.info('Enabling the task cache')
+                dbWrapper = dbcache.CachingChoreTrackerDatabase(
+                    dbWrapper,
+                    maxEntries=self.cacheConfig.max_entries,
+                    maxBytes=self.cacheConfig.max_bytes,
+                    ttl=self.cacheConfig.ttl,
+                )
+                # Keep the cache coherent with writes from other
+                # processes.
+                self.changeListener.subscribe(dbWrapper.handleChange)
             self._dbWrapper = dbWrapper
+            if self.pushConfig.enabled:
+                self.changeHub = push.TaskChangeHub(
+                    dbWrapper,
+                    maxConnections=self.pushConfig.max_connections,
+                    maxConnectionsPerUser=(
+                        self.pushConfig.max_connections_per_user),
+                    maxQueuedEvents=self.pushConfig.max_queued_events,
+                    keepaliveInterval=self.pushConfig.keepalive_interval,
+                )
+                self.changeListener.subscribe(self.changeHub.handleChange)
+            self.changeListener.start()
+            self._pruneCall = task.LoopingCall(self._pruneTaskChanges)
+            self._pruneCall.start(_PRUNE_INTERVAL)
+            if self.schedulerConfig.enabled:
+                self.scheduler = scheduler.RepeatingTaskScheduler(
+                    dbWrapper,
+                    horizon=self.schedulerConfig.horizon_days * 24 * 60 * 60,
+                    batchSize=self.schedulerConfig.batch_size,
+                    maxDelay=self.schedulerConfig.max_delay,
+                )
+                self.scheduler.start()
             return dbWrapper
 
         dfd.addCallback(self._createSite)
@@ -40,6 +223,8 @@ class ChoreTrackerAPIService(service.Service):
         def cbSetLastBits(listeningPort):
             self.running = True
             self._listeningPort = listeningPort
+            if self.metricsConfig.enabled or self.profiler is not None:
+                return self._startAdminSite()
 
         @dfd.addErrback
         def ebCancelStart(failure):
@@ -50,28 +235,177 @@ class ChoreTrackerAPIService(service.Service):
             return self.stopService()
 
     def stopService(self):
+        """
+        Stop accepting connections, let the requests in progress finish
+        (for up to ``shutdown_timeout`` seconds), then close the
+        database pool. Returns a Deferred that fires when done.
+        """
         self.running = False
+        self.changeListener.stop()
+        if self._pruneCall is not None:
+            self._pruneCall.stop()
+            self._pruneCall = None
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        dfd = defer.succeed(None)
+        if self._metricsPort is not None:
+            if self.metricsConfig.enabled:
+                metrics.REGISTRY.removeCollector(self._collectMetrics)
+            self._metricsPort.stopListening()
+            self._metricsPort = None
         if self._listeningPort is not None:
             self.log.info('Stopping listening port')
-            # TODO: Figure out what to do with the possible deferred here
-            self._listeningPort.stopListening()
-        if self._dbWrapper is not None:
-            self.log.info('Closing database pool')
-            self._dbWrapper.pool.close()
-            self._dbWrapper = None
+            dfd = defer.maybeDeferred(self._listeningPort.stopListening)
+            self._listeningPort = None
+        if self.changeHub is not None:
+            self.changeHub.stop()
+            # Change streams never finish by themselves.
+            self.changeHub.closeAll()
+        dfd.addCallback(lambda ignored: self._waitForRequests())
+
+        @dfd.addBoth
+        def cbClosePool(result):
+            if self._dbWrapper is not None:
+                self.log.info('Closing database pool')
+                self._dbWrapper.pool.close()
+                self._dbWrapper = None
+            if self.tracer is not None:
+                tracing.setTracer(None)
+                if self.tracer.exporter is not None:
+                    self.tracer.exporter.close()
+                self.tracer = None
+            if self.profiler is not None:
+                db.setSlowQueryThreshold(None)
+                self.profiler = None
+            return result
+        return dfd
+
+    def _waitForRequests(self):
+        site = self._site
+        if site is None or site.requestsInProgress == 0:
+            return None
+        self.log.info(
+            'Waiting for {count} requests in progress',
+            count=site.requestsInProgress)
+        dfd = site.whenDrained()
+        dfd.addTimeout(self.restApiConfig.shutdown_timeout, reactor)
 
+        @dfd.addErrback
+        def ebGiveUp(failure):
+            failure.trap(defer.TimeoutError)
+            self.log.warn(
+                'Shutting down with {count} requests still in progress',
+                count=site.requestsInProgress)
+        return dfd
+
+
+    def _startAdminSite(self):
+        """
+        Serve the metrics at /metrics and the profiling admin endpoint
+        at /profile, whichever are enabled, on the metrics port.
+        """
+        rootResource = resource.Resource()
+        if self.metricsConfig.enabled:
+            metrics.REGISTRY.addCollector(self._collectMetrics)
+            rootResource.putChild(b'metrics', metrics.MetricsResource())
+        if self.profiler is not None:
+            rootResource.putChild(
+                b'profile', profiling.ProfilingAdminResource(self.profiler))
+        port = self.metricsConfig.port + self._metricsPortOffset
+        self.log.info('Serving metrics and admin endpoints on port {port}',
+                      port=port)
+        dfd = _tcpEndpoint(self.metricsConfig.interface, port).listen(
+            server.Site(rootResource))
+
+        @dfd.addCallback
+        def cbSetMetricsPort(metricsPort):
+            self._metricsPort = metricsPort
+        return dfd
+
+    def _collectMetrics(self):
+        """
+        The database pool and task cache statistics, as metric families.
+        """
+        if self._dbWrapper is None:
+            return
+        poolStats = self._dbWrapper.pool.stats()
+        for key, help in _POOL_GAUGES:
+            gauge = metrics.Gauge(
+                'choretracker_db_pool_{0}'.format(_snakeCase(key)), help)
+            gauge.labels().set(poolStats[key])
+            yield gauge
+        for key, help in _POOL_HISTOGRAMS:
+            # Only the adbapi backend keeps these.
+            if key in poolStats:
+                histogram = metrics.HistogramFamily(
+                    'choretracker_db_pool_{0}_seconds'.format(
+                        _snakeCase(key)), help)
+                histogram.addSnapshot(poolStats[key])
+                yield histogram
+        if self.cacheConfig.enabled:
+            cacheStats = self._dbWrapper.stats()
+            for key in _CACHE_COUNTERS:
+                counter = metrics.Counter(
+                    'choretracker_task_cache_{0}_total'.format(key),
+                    'Task cache {0}.'.format(key))
+                counter.labels().inc(cacheStats[key])
+                yield counter
+            for key in _CACHE_GAUGES:
+                gauge = metrics.Gauge(
+                    'choretracker_task_cache_{0}'.format(key),
+                    'Task cache {0}.'.format(key))
+                gauge.labels().set(cacheStats[key])
+                yield gauge
+
+    def _pruneTaskChanges(self):
+        keepSeconds = self.dbConfig.change_log_retention_days * 24 * 60 * 60
+        d = defer.ensureDeferred(
+            self._dbWrapper.pruneTaskChanges(keepSeconds=keepSeconds))
+
+        @d.addCallback
+        def cbLogPruned(prunedCount):
+            if prunedCount:
+                self.log.info(
+                    'Pruned {count} task change log entries',
+                    count=prunedCount)
+
+        @d.addErrback
+        def ebLogFailure(failure):
+            # Keep the LoopingCall going; it's tried again next time.
+            self.log.failure(
+                'Failed to prune the task change log', failure=failure)
+        return d
 
     def _createSite(self, dbWrapper):
         # TODO: Add more stuff here. Session stuff, auth framework stuff, etc.
-        apiApp = api.makeApisApp(dbWrapper)
+        apiApp = api.makeApisApp(
+            dbWrapper, self.versions, self.changeHub, self.scheduler)
         if self.restApiConfig.development:
             rootResource = resource.Resource()
             rootResource.putChild(b'apis', apiApp.resource())
         else:
             rootResource = apiApp.resource()
-        site = server.Site(rootResource)
-        return site
+        self._site = DrainableSite(rootResource)
+        return self._site
 
     def _startListening(self, site):
-        self._endpoint = endpoints.TCP4ServerEndpoint(reactor, 8080)
+        interface = self.restApiConfig.interface
+        if self._listenFileno is not None:
+            # The socket is shared with the other workers.
+            return reactor.adoptStreamPort(
+                self._listenFileno, addressFamily(interface), site)
+        self._endpoint = _tcpEndpoint(interface, self.restApiConfig.port)
         return self._endpoint.listen(site)
+
+
+def _tcpEndpoint(interface, port):
+    if addressFamily(interface) == socket.AF_INET6:
+        endpointClass = endpoints.TCP6ServerEndpoint
+    else:
+        endpointClass = endpoints.TCP4ServerEndpoint
+    return endpointClass(reactor, port, interface=interface)
+
+
+def _snakeCase(name):
+    return ''.join(
+        '_' + char.lower() if char.isupper() else char for char in name)
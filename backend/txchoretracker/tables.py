@@ -67,6 +67,43 @@ users_m2m_task_groups = sqla.Table(
 )
 
 
+# A schedule of tasks: api.apply_repeating_task_materializations
+# creates a task for each occurrence of the recurrence rule (see
+# txchoretracker/recurrence.py) as it comes within the scheduler's
+# horizon (see txchoretracker/scheduler.py).
+repeating_task = sqla.Table(
+    'repeating_task',
+    metadata,
+    _IDColumn(),
+    sqla.Column(
+        'task_group_id',
+        None,
+        sqla.ForeignKey(task_group.c.id),
+        nullable=False
+    ),
+    sqla.Column('name', sqla.String, nullable=False),
+    sqla.Column('description', sqla.String, nullable=False),
+    # An RRULE value, in the canonical form of Recurrence.format().
+    sqla.Column('recurrence', sqla.String, nullable=False),
+    sqla.Column('start', sqla.DateTime(timezone=False), nullable=False),
+    # The first occurrence that has no task yet; NULL once there are no
+    # more occurrences.
+    sqla.Column('next_due', sqla.DateTime(timezone=False), nullable=True),
+    # How many occurrences have tasks, for COUNT rules.
+    sqla.Column(
+        'occurrence_count', sqla.Integer, nullable=False, default=0),
+    sqla.Column('created', sqla.DateTime(timezone=False), nullable=False),
+    sqla.Column('modified', sqla.DateTime(timezone=False), nullable=False),
+)
+
+# The scheduler's queue: only the schedules with an occurrence coming
+# within the horizon are read.
+sqla.Index(
+    'ix_repeating_task_next_due',
+    repeating_task.c.next_due,
+    postgresql_where=repeating_task.c.next_due.isnot(None))
+
+
 task = sqla.Table(
     'task',
     metadata,
@@ -84,6 +121,83 @@ task = sqla.Table(
     #       ...or maybe not, just do everything in PL/pgSQL.
     sqla.Column('created', sqla.DateTime(timezone=False), nullable=False),
     sqla.Column('modified', sqla.DateTime(timezone=False), nullable=False),
+    # The schedule this task is an occurrence of, if any. The task is
+    # kept as a one-off if the schedule is deleted.
+    sqla.Column(
+        'repeating_task_id',
+        None,
+        sqla.ForeignKey(repeating_task.c.id, ondelete='SET NULL'),
+        nullable=True
+    ),
+)
+
+# Keyset pagination of task listings (see api.asuser_fetch_tasks_page)
+# walks these in (due, id) order.
+sqla.Index('ix_task_due_id', task.c.due, task.c.id)
+sqla.Index(
+    'ix_task_task_group_id_due_id',
+    task.c.task_group_id, task.c.due, task.c.id)
+# One task per occurrence, however many times it is materialized.
+sqla.Index(
+    'ix_task_repeating_task_id_due',
+    task.c.repeating_task_id, task.c.due,
+    unique=True)
+
+
+# The due time each task was last notified for (see
+# txchoretracker/notifications.py), so that each due time is only
+# notified once, by whichever process claims it first. A task whose due
+# time changes is notified again.
+task_notification = sqla.Table(
+    'task_notification',
+    metadata,
+    sqla.Column(
+        'task_id',
+        None,
+        sqla.ForeignKey(task.c.id, ondelete='CASCADE'),
+        primary_key=True
+    ),
+    sqla.Column('due', sqla.DateTime(timezone=False), nullable=False),
+    sqla.Column('notified', sqla.DateTime(timezone=False), nullable=False),
+)
+
+
+# Log of task writes for incremental sync (see
+# api.asuser_fetch_task_changes), filled in by the log_task_change
+# trigger. Rows are keyed by the ID of the transaction that wrote them
+# (txid_current()), not by time, so a sync cursor can't skip a change
+# that committed late.
+#
+# For a task write, task_id and task_group_id are set and user_id is
+# NULL; a task moved between groups is logged in both. For a change to
+# a user's task group memberships, user_id is set and task_id is NULL.
+# No foreign keys, since the log outlives deleted tasks.
+task_change = sqla.Table(
+    'task_change',
+    metadata,
+    _IDColumn(),
+    sqla.Column('txid', sqla.BigInteger, nullable=False),
+    sqla.Column('task_id', sqla.BigInteger, nullable=True),
+    sqla.Column('task_group_id', sqla.BigInteger, nullable=False),
+    sqla.Column('user_id', sqla.BigInteger, nullable=True),
+    sqla.Column('changed', sqla.DateTime(timezone=False), nullable=False),
+)
+
+sqla.Index(
+    'ix_task_change_task_group_id_txid',
+    task_change.c.task_group_id, task_change.c.txid)
+sqla.Index(
+    'ix_task_change_user_id_txid',
+    task_change.c.user_id, task_change.c.txid,
+    postgresql_where=task_change.c.user_id.isnot(None))
+sqla.Index('ix_task_change_changed', task_change.c.changed)
+
+# The lowest txid task_change is still complete from: everything
+# logged before it may have been pruned (see api.prune_task_changes).
+task_change_horizon = sqla.Table(
+    'task_change_horizon',
+    metadata,
+    sqla.Column('txid', sqla.BigInteger, nullable=False),
 )
 
 
@@ -92,3 +206,6 @@ if __name__ == '__main__':
     for table in metadata.sorted_tables:
         ddl = str(sc.CreateTable(table).compile(dialect=pg.dialect())).strip()
         print(ddl + ';')
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            ddl = str(sc.CreateIndex(index).compile(dialect=pg.dialect()))
+            print(ddl.strip() + ';')
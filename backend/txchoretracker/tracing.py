@@ -0,0 +1,396 @@
+"""
+Lightweight span-based tracing of API requests.
+
+A sampled request gets a trace: a root span covering the whole request
+(started by :class:`txchoretracker.kleinhelpers.JSONApiRouter`) and
+child spans for authentication, database calls (split into the wait
+for a pooled connection and the query itself), serialization and
+rendering the response. When the root span finishes, the trace is
+handed to the tracer's exporter (see :class:`ISpanExporter`).
+
+Spans are started with :func:`span`, which nests the new span under
+the *current* one. There is no ``contextvars`` on the Pythons we
+support, so the current span is a module global, set only while code
+for that request is running in the reactor thread:
+
+-   :func:`ensureDeferred` runs a coroutine with a span current
+    whenever the coroutine is running, saving and restoring it around
+    each ``await`` that suspends, so it survives the Deferred
+    boundaries inside the coroutine.
+-   :func:`activated` makes a span current for a block of code, e.g.
+    when rendering a response for a request traced earlier (see
+    :func:`requestSpan`).
+
+:func:`span` blocks must not ``await``: code that isn't run by
+:func:`ensureDeferred` would leave the span current while suspended.
+To time something asynchronous, :func:`startSpan` a span and finish it
+by hand.
+
+When the request isn't sampled (or tracing is off), there is no
+current span and :func:`span` does nothing, so untraced requests only
+pay for a global lookup per instrumented call.
+
+A tracer can also have observers (see :meth:`Tracer.addObserver`),
+like :class:`txchoretracker.profiling.RequestProfiler`, which see every
+request's trace. Then every request is traced, but only the sampled
+traces are exported. A trace can carry a ``cProfile.Profile``, which
+is enabled exactly while a span of that trace is current.
+"""
+import contextlib
+import json
+import random
+import time
+import weakref
+from collections import deque
+
+import zope.interface
+from twisted.internet import defer
+
+
+class Span:
+    """
+    A timed operation within a trace.
+
+    Attributes:
+        trace (Trace): The trace the span belongs to.
+        spanId (str): Its id, 16 hex digits.
+        parentId (str or None): The id of the span it's nested under.
+        name (str): What it times.
+        start (float): When it started (``time.monotonic()``).
+        end (float or None): When it finished, if it has.
+        attributes (dict): Details, like the route or status code.
+        params (tuple or None):
+            The parameters of a database call. They can hold personal
+            data, so they aren't exported.
+    """
+    def __init__(self, trace, name, parentId, start, attributes):
+        self.trace = trace
+        self.spanId = '{0:016x}'.format(random.getrandbits(64))
+        self.parentId = parentId
+        self.name = name
+        self.start = start
+        self.end = None
+        self.attributes = attributes
+        self.params = None
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def child(self, name, start=None, **attributes):
+        """
+        Start a span nested under this one (but don't make it current).
+        """
+        return self.trace.startSpan(name, self, start, attributes)
+
+    def finish(self, end=None, **attributes):
+        self.attributes.update(attributes)
+        self.end = time.monotonic() if end is None else end
+        if self.parentId is None:
+            self.trace.finished()
+
+    def record(self, name, start, end, **attributes):
+        """
+        Add a finished child span with the given times.
+
+        Pool threads use this to record what happened to a query, so
+        it only appends to the trace's span list.
+        """
+        self.child(name, start, **attributes).end = end
+
+
+class Trace:
+    """
+    The spans of one request.
+
+    Attributes:
+        traceId (str): Its id, 32 hex digits.
+        spans (list of Span): In the order they were started.
+        epochOffset (float):
+            What to add to span times to get Unix times.
+        sampled (bool): Whether to export the trace.
+        profile (cProfile.Profile or None):
+            Profiles the code run while a span of the trace is current.
+    """
+    def __init__(self, tracer, sampled=True):
+        self.traceId = '{0:032x}'.format(random.getrandbits(128))
+        self.spans = []
+        self.epochOffset = time.time() - time.monotonic()
+        self.sampled = sampled
+        self.profile = None
+        self._tracer = tracer
+
+    def startSpan(self, name, parent=None, start=None, attributes=None):
+        span = Span(
+            self,
+            name,
+            None if parent is None else parent.spanId,
+            time.monotonic() if start is None else start,
+            {} if attributes is None else attributes,
+        )
+        self.spans.append(span)
+        return span
+
+    def finished(self):
+        self._tracer.traceFinished(self)
+
+    def asDicts(self):
+        """
+        The spans as JSON-serializable dicts, with Unix start times.
+        """
+        return [
+            {
+                'traceId': self.traceId,
+                'spanId': span.spanId,
+                'parentId': span.parentId,
+                'name': span.name,
+                'start': span.start + self.epochOffset,
+                'duration': span.duration,
+                'attributes': span.attributes,
+            }
+            for span in self.spans
+        ]
+
+
+class ISpanExporter(zope.interface.Interface):
+    def export(trace):
+        """
+        Take a :class:`Trace` whose root span has finished. Called in
+        the reactor thread, so it must not block for long.
+        """
+
+    def close():
+        """
+        Release any resources, like open files.
+        """
+
+
+@zope.interface.implementer(ISpanExporter)
+class InMemorySpanExporter:
+    """
+    Keeps the last ``maxTraces`` traces in :attr:`traces`, for tests
+    and for poking at from a manhole.
+    """
+    def __init__(self, maxTraces=1000):
+        self.traces = deque(maxlen=maxTraces)
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+    def close(self):
+        pass
+
+
+@zope.interface.implementer(ISpanExporter)
+class JSONLinesSpanExporter:
+    """
+    Appends each span to the file at ``path`` as a line of JSON (see
+    :meth:`Trace.asDicts`), for offline analysis.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def export(self, trace):
+        # One write per trace, so that traces from several worker
+        # processes appending to the same file don't get mixed up.
+        self._file.write(''.join(
+            json.dumps(spanDict, default=str) + '\n'
+            for spanDict in trace.asDicts()))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Tracer:
+    """
+    Starts traces for a ``sampleRate`` fraction (0 to 1) of requests,
+    and hands them to ``exporter`` (if not None) when they finish.
+    """
+    def __init__(self, exporter, sampleRate=1.0, random=random.random):
+        self.exporter = exporter
+        self.sampleRate = sampleRate
+        self._random = random
+        self._observers = []
+
+    def addObserver(self, observer):
+        """
+        Show ``observer`` every trace, sampled or not: its
+        ``traceStarted`` method gets each root span as it starts, and
+        its ``traceFinished`` method each trace as it finishes.
+        """
+        self._observers.append(observer)
+
+    def startTrace(self, name, **attributes):
+        """
+        Returns the root span of a new trace, or None if this one
+        isn't sampled and there are no observers.
+        """
+        sampled = self._random() < self.sampleRate
+        if not (sampled or self._observers):
+            return None
+        rootSpan = Trace(self, sampled).startSpan(name, attributes=attributes)
+        for observer in self._observers:
+            observer.traceStarted(rootSpan)
+        return rootSpan
+
+    def traceFinished(self, trace):
+        if trace.profile is not None:
+            trace.profile.disable()
+        for observer in self._observers:
+            observer.traceFinished(trace)
+        # Anything still running for the request isn't profiled.
+        trace.profile = None
+        if trace.sampled and self.exporter is not None:
+            self.exporter.export(trace)
+
+
+def makeTracer(tracingConfig):
+    """
+    Create the :class:`Tracer` configured by ``tracingConfig`` (a
+    :class:`txchoretracker.config.TracingConfig`).
+    """
+    if tracingConfig.exporter == 'jsonlines':
+        exporter = JSONLinesSpanExporter(tracingConfig.path)
+    else:
+        exporter = InMemorySpanExporter()
+    return Tracer(exporter, tracingConfig.sample_rate)
+
+
+_tracer = None
+_current = None
+_spansByRequest = weakref.WeakKeyDictionary()
+
+
+def setTracer(tracer):
+    """
+    Trace requests with ``tracer`` from now on (None to stop).
+    """
+    global _tracer
+    _tracer = tracer
+
+
+def startTrace(name, **attributes):
+    """
+    Start a trace with the installed tracer. Returns its root span, or
+    None if there is no tracer or the trace isn't sampled.
+    """
+    if _tracer is None:
+        return None
+    return _tracer.startTrace(name, **attributes)
+
+
+def currentSpan():
+    return _current
+
+
+def setRequestSpan(txRequest, rootSpan):
+    _spansByRequest[txRequest] = rootSpan
+
+
+def requestSpan(txRequest):
+    """
+    The root span of ``txRequest``'s trace, if it's being traced.
+    """
+    return _spansByRequest.get(txRequest)
+
+
+def _switchTo(span):
+    # Make ``span`` current, and return the span that was. Moving
+    # between traces switches profiles.
+    global _current
+    previous, _current = _current, span
+    previousProfile = None if previous is None else previous.trace.profile
+    profile = None if span is None else span.trace.profile
+    if profile is not previousProfile:
+        if previousProfile is not None:
+            previousProfile.disable()
+        if profile is not None:
+            profile.enable()
+    return previous
+
+
+@contextlib.contextmanager
+def activated(span):
+    """
+    Make ``span`` current for the duration of the block.
+    """
+    previous = _switchTo(span)
+    try:
+        yield span
+    finally:
+        _switchTo(previous)
+
+
+def startSpan(name, **attributes):
+    """
+    Start a span nested under the current one, without making it
+    current. Returns None if there is no current span.
+    """
+    if _current is None:
+        return None
+    return _current.child(name, **attributes)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Time the block (which must not ``await``) as a span nested under
+    the current one, and make it current meanwhile. Does nothing if
+    there is no current span.
+    """
+    global _current
+    parent = _current
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, **attributes)
+    _current = child
+    try:
+        yield child
+    except BaseException as e:
+        child.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        _current = parent
+        child.finish()
+
+
+def _runWithSpan(coroutine, span):
+    # A generator that runs ``coroutine`` for inlineCallbacks, making
+    # ``span`` (or whichever span the coroutine left current when it
+    # last suspended) current while it runs.
+    value = error = None
+    while True:
+        previous = _switchTo(span)
+        try:
+            if error is None:
+                awaited = coroutine.send(value)
+            else:
+                awaited = coroutine.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            span = _switchTo(previous)
+        try:
+            value, error = (yield awaited), None
+        except GeneratorExit:
+            coroutine.close()
+            raise
+        except BaseException as e:
+            value, error = None, e
+
+
+def ensureDeferred(coroutine, span=None):
+    """
+    Like :func:`twisted.internet.defer.ensureDeferred`, but with
+    ``span`` (by default the current one) current whenever the
+    coroutine runs.
+    """
+    if span is None:
+        span = _current
+    if span is None:
+        return defer.ensureDeferred(coroutine)
+    return defer.ensureDeferred(_runWithSpan(coroutine, span))
@@ -0,0 +1,111 @@
+"""
+In-process version counters, used to make ETags for conditional GETs
+without a database round trip.
+
+:class:`ChangeVersions` counts the changes it is told about, either by
+the API write paths directly or by subscribing
+:meth:`ChangeVersions.handleChange` to a
+:class:`txchoretracker.changes.ChangeListener` (which covers writes
+from every process). An ETag is the current epoch plus the relevant
+counter, so it changes whenever the data it stands for may have.
+
+Each epoch starts with all the counters at zero. A new epoch (with a
+fresh random ID) starts whenever the listener (re)connects, since
+changes may have been missed while it wasn't listening. While it is
+disconnected, or before it has ever connected, no ETags are given out
+at all.
+
+Task listings depend on task group membership, which is too costly to
+track per user here. Instead, any change to any task, task group or
+membership bumps a single listing counter, so listing ETags are
+coarse but never stale. Task ETags are per user, and change with any
+task group or membership change too, so an ETag for one user (or from
+before a user lost access) never matches after the change. The API
+still checks access before answering a conditional GET with 304.
+Changes made by other processes only show up
+once their notification arrives, so a client may briefly get a 304
+for data another process has just changed.
+"""
+import binascii
+import os
+
+
+def _newEpochId():
+    return binascii.hexlify(os.urandom(4)).decode('ascii')
+
+
+class ChangeVersions:
+    def __init__(self):
+        self._live = False
+        self._startEpoch()
+
+    @property
+    def live(self):
+        """
+        If ETags are being given out (the change listener is
+        connected).
+        """
+        return self._live
+
+    def _startEpoch(self):
+        self._epoch = _newEpochId()
+        self._listVersion = 0
+        self._membershipVersion = 0
+        # Only changed IDs are stored, so these grow with the number
+        # of rows changed during the epoch.
+        self._taskVersions = {}
+        self._profileVersions = {}
+
+    def handleChange(self, event):
+        """
+        Apply a :class:`txchoretracker.changes.ChangeEvent`.
+        """
+        if event.operation == 'RESYNC':
+            self._startEpoch()
+            self._live = True
+        elif event.operation == 'DISCONNECTED':
+            self._live = False
+        elif event.table == 'task':
+            self.taskChanged(event.rowId)
+        elif event.table in ('task_group', 'users_m2m_task_groups'):
+            self._listVersion += 1
+            self._membershipVersion += 1
+        elif event.table == 'user_profile':
+            self.profileChanged(event.rowId)
+
+    def taskChanged(self, taskId):
+        self._taskVersions[taskId] = self._taskVersions.get(taskId, 0) + 1
+        self._listVersion += 1
+
+    def profileChanged(self, userId):
+        self._profileVersions[userId] = \
+            self._profileVersions.get(userId, 0) + 1
+
+    def taskETag(self, userId, taskId):
+        """
+        The ETag for a single task as seen by the user, or None if
+        there isn't one.
+        """
+        if not self._live:
+            return None
+        return '{0}-t{1}.{2}.{3}.{4}'.format(
+            self._epoch, userId, taskId, self._taskVersions.get(taskId, 0),
+            self._membershipVersion)
+
+    def taskListETag(self, userId):
+        """
+        The ETag for any of the user's task listings, or None if there
+        isn't one.
+        """
+        if not self._live:
+            return None
+        return '{0}-l{1}.{2}'.format(self._epoch, userId, self._listVersion)
+
+    def profileETag(self, userId):
+        """
+        The ETag for the user's profile, or None if there isn't one.
+        """
+        if not self._live:
+            return None
+        return '{0}-p{1}.{2}'.format(
+            self._epoch, userId, self._profileVersions.get(userId, 0))
@@ -0,0 +1,207 @@
+"""
+Serving the API from several processes, to use more than one core.
+
+With ``workers`` set above 1 in the [restapi] section,
+:class:`WorkerPoolService` binds the listening socket in the parent
+process and spawns that many worker processes (``python -m
+txchoretracker.workers``). Each worker adopts the socket and runs its
+own :class:`txchoretracker.services.ChoreTrackerAPIService`, with its
+own database pool, change listener, caches and change streams, and the
+kernel hands each new connection to one of the workers waiting to
+accept. A worker that exits is started again.
+
+Stopping the service shuts the workers down together: each is sent
+SIGTERM, stops accepting connections, lets its requests in progress
+finish and exits. Any still running after ``shutdown_timeout`` (plus a
+little) are killed.
+"""
+import os
+import signal
+import socket
+import sys
+
+from twisted import logger
+from twisted.application import service
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import protocol
+
+from txchoretracker import config
+from txchoretracker.services import ChoreTrackerAPIService, addressFamily
+
+
+# The file descriptor the listening socket has in the workers.
+WORKER_LISTEN_FD = 3
+
+
+def makeListeningSocket(interface, port, backlog=128):
+    """
+    Bind and listen on a non-blocking TCP socket, to share with the
+    workers.
+    """
+    listeningSocket = socket.socket(addressFamily(interface))
+    listeningSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listeningSocket.bind((interface, port))
+    listeningSocket.listen(backlog)
+    listeningSocket.setblocking(False)
+    return listeningSocket
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool, index):
+        self._pool = pool
+        self.index = index
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self._pool._workerEnded(self, reason)
+
+
+class WorkerPoolService(service.Service):
+    """
+    Runs ``restApiConfig.workers`` API worker processes on a shared
+    listening socket.
+
+    Args:
+        configFilePath (str): The config file, for the workers to read.
+        restApiConfig (config.RestApiConfig): The port, interface,
+            worker count and shutdown timeout.
+        executable (str): The Python to run the workers with.
+        reactor: Spawns the workers.
+    """
+    log = logger.Logger()
+
+    # Seconds to wait before starting a worker that exited again.
+    restartDelay = 1.0
+    # Seconds to allow a worker beyond the shutdown timeout to exit.
+    killGrace = 5.0
+
+    def __init__(
+                self,
+                configFilePath,
+                restApiConfig: config.RestApiConfig,
+                *,
+                executable=sys.executable,
+                reactor=None,
+            ):
+        super().__init__()
+        if reactor is None:
+            from twisted.internet import reactor
+        self._configFilePath = os.path.abspath(configFilePath)
+        self._restApiConfig = restApiConfig
+        self._executable = executable
+        self._reactor = reactor
+        self._socket = None
+        self._workers = {}
+        self.restarts = 0
+
+    def startService(self):
+        super().startService()
+        self._socket = makeListeningSocket(
+            self._restApiConfig.interface, self._restApiConfig.port)
+        self.log.info(
+            'Starting {count} workers on port {port}',
+            count=self._restApiConfig.workers,
+            port=self._restApiConfig.port)
+        for index in range(self._restApiConfig.workers):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        if not self.running:
+            return
+        worker = _WorkerProtocol(self, index)
+        self._reactor.spawnProcess(
+            worker,
+            self._executable,
+            [
+                self._executable, '-m', 'txchoretracker.workers',
+                self._configFilePath, str(WORKER_LISTEN_FD), str(index),
+            ],
+            env=os.environ,
+            childFDs={
+                0: 0, 1: 1, 2: 2,
+                WORKER_LISTEN_FD: self._socket.fileno(),
+            },
+        )
+        self._workers[index] = worker
+
+    def _workerEnded(self, worker, reason):
+        if self._workers.get(worker.index) is worker:
+            del self._workers[worker.index]
+        if not self.running:
+            return
+        self.log.warn(
+            'Worker {index} exited ({reason}); restarting it',
+            index=worker.index, reason=reason.value)
+        self.restarts += 1
+        self._reactor.callLater(self.restartDelay, self._spawn, worker.index)
+
+    def stopService(self):
+        """
+        Shut the workers down. Returns a Deferred that fires once they
+        have all exited.
+        """
+        super().stopService()
+        workers = list(self._workers.values())
+        self.log.info('Stopping {count} workers', count=len(workers))
+        for worker in workers:
+            self._signal(worker, 'TERM')
+        killCall = self._reactor.callLater(
+            self._restApiConfig.shutdown_timeout + self.killGrace,
+            self._killAll, workers)
+        dfd = defer.DeferredList([worker.ended for worker in workers])
+
+        @dfd.addBoth
+        def cbCleanUp(result):
+            if killCall.active():
+                killCall.cancel()
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+        return dfd
+
+    def _killAll(self, workers):
+        for worker in workers:
+            if not worker.ended.called:
+                self.log.warn(
+                    'Killing worker {index}, which did not stop in time',
+                    index=worker.index)
+                self._signal(worker, 'KILL')
+
+    def _signal(self, worker, signalName):
+        try:
+            worker.transport.signalProcess(signalName)
+        except error.ProcessExitedAlready:
+            pass
+
+
+def runWorker(configFilePath, listenFileno, workerIndex=0):
+    """
+    Run a worker process: serve the API on the inherited listening
+    socket until SIGTERM. Worker ``workerIndex`` serves its metrics
+    and profiling admin endpoint on the metrics port plus its index.
+    """
+    from twisted.internet import reactor
+
+    logger.globalLogBeginner.beginLoggingTo(
+        [logger.textFileLogObserver(sys.stdout)])
+    appConfig = config.processConfigFile(configFilePath)
+    apiService = ChoreTrackerAPIService(
+        appConfig.restapi, appConfig.db, appConfig.cache, appConfig.push,
+        appConfig.scheduler, listenFileno=listenFileno,
+        metricsConfig=appConfig.metrics, metricsPortOffset=workerIndex,
+        tracingConfig=appConfig.tracing,
+        profilingConfig=appConfig.profiling)
+    # The parent process handles Ctrl-C for the terminal's process
+    # group, and tells the workers to stop with SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    apiService.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', apiService.stopService)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    runWorker(
+        sys.argv[1], int(sys.argv[2]),
+        int(sys.argv[3]) if len(sys.argv) > 3 else 0)